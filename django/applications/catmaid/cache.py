@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict, defaultdict
+import logging
+import os
+import select
+import shutil
+import tempfile
+import threading
+import time
+from typing import (Any, Callable, DefaultDict, Dict, Hashable, List, Optional,
+        Sequence, Set, Tuple)
+
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache():
+    """A thread-safe least-recently-used cache, bounded by the total size of
+    its entries. Each entry can be associated with a tag, which allows to
+    invalidate a group of entries at once (e.g. all LOD variants of a grid
+    cell). Optionally, entries expire after a maximum age in seconds.
+    """
+
+    # An approximation of the bookkeeping overhead of a single entry in bytes.
+    entry_overhead = 100
+
+    def __init__(self, max_bytes:int, max_age:Optional[float]=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries:OrderedDict = OrderedDict()
+        self._tags:DefaultDict[Hashable, Set] = defaultdict(set)
+        self._lock = threading.RLock()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def get(self, key, default=None) -> Any:
+        """Return the cached value for the passed in key and mark it as most
+        recently used. If there is no (valid) entry, <default> is returned.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, size, tag, created = entry
+            if self.max_age is not None and time.time() - created > self.max_age:
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size:int, tag:Optional[Hashable]=None) -> bool:
+        """Add or replace an entry. Entries larger than the complete cache are
+        not stored and False is returned in this case.
+        """
+        size += self.entry_overhead
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, tag, time.time())
+            self.n_bytes += size
+            if tag is not None:
+                self._tags[tag].add(key)
+            while self.n_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_tag(self, tag:Hashable) -> None:
+        """Remove all entries associated with the passed in tag."""
+        with self._lock:
+            keys = self._tags.get(tag)
+            if keys:
+                for key in list(keys):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self.n_bytes = 0
+
+    def _remove(self, key) -> None:
+        value, size, tag, created = self._entries.pop(key)
+        self.n_bytes -= size
+        if tag is not None:
+            tag_keys = self._tags.get(tag)
+            if tag_keys is not None:
+                tag_keys.discard(key)
+                if not tag_keys:
+                    del self._tags[tag]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit, miss and eviction counters along with the current size
+        of this cache.
+        """
+        n_lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'entries': len(self._entries),
+            'bytes': self.n_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_lookups if n_lookups else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+class TileCache():
+    """Cache encoded tiles in a per-process LRUCache and optionally as files in
+    a directory, which is shared by all processes. Tiles are addressed by a tag
+    tuple and a file extension (i.e. format). All but the last tag element are
+    used as directories, which allows to remove groups of tiles at once.
+
+    Invalidations are counted, so that tiles which were rendered while their
+    tag was invalidated can be rejected: a generation() taken before rendering
+    is passed to set(), which only stores the tile if it didn't change. Tags
+    share counters by hash, which can only prevent tiles from being cached.
+    """
+
+    # The number of invalidation counters, which are shared by all tags.
+    n_generation_buckets = 4096
+
+    def __init__(self, max_bytes:int, path:Optional[str]=None,
+            extensions:Sequence[str]=('png', 'gif')):
+        self.memory = LRUCache(max_bytes)
+        self.path = path
+        self.extensions = extensions
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self._epoch = 0
+        self._generations = [0] * self.n_generation_buckets
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory.enabled or bool(self.path)
+
+    def get_path(self, tag:Tuple, extension:str) -> str:
+        if not self.path:
+            raise ValueError("No tile cache path configured")
+        return os.path.join(self.path, *(str(t) for t in tag[:-1]),
+                f'{tag[-1]}.{extension}')
+
+    def get(self, tag:Tuple, extension:str, use_memory:bool=True) -> Optional[bytes]:
+        """Return the cached tile data or None if the tile isn't cached. Tiles
+        that are found on disk are added to the memory cache.
+        """
+        if use_memory and self.memory.enabled:
+            data = self.memory.get((tag, extension))
+            if data is not None:
+                return data
+        if not self.path:
+            return None
+        try:
+            with open(self.get_path(tag, extension), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        if use_memory and self.memory.enabled:
+            self.memory.set((tag, extension), data, len(data), tag)
+        return data
+
+    def generation(self, tag:Tuple) -> Tuple[int, int]:
+        """Return a stamp that changes whenever the passed in tag or the whole
+        cache is invalidated.
+        """
+        return self._epoch, self._generations[hash(tag) % self.n_generation_buckets]
+
+    def set(self, tag:Tuple, extension:str, data:bytes,
+            use_memory:bool=True, generation:Optional[Tuple[int, int]]=None) -> bool:
+        """Store a tile. If a <generation> is passed in, the tile is only
+        stored if its tag wasn't invalidated since then. Returns whether the
+        tile was stored.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation(tag):
+                return False
+            if use_memory and self.memory.enabled:
+                self.memory.set((tag, extension), data, len(data), tag)
+            if self.path:
+                # Write to a temporary file first, so that readers never see
+                # partially written tiles.
+                path = self.get_path(tag, extension)
+                directory = os.path.dirname(path)
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp_path, path)
+                except Exception:
+                    os.unlink(tmp_path)
+                    raise
+        return True
+
+    def invalidate_tag(self, tag:Tuple, delete_files:bool=False) -> None:
+        """Remove all formats of a tile from memory and optionally from disk."""
+        with self._lock:
+            self._generations[hash(tag) % self.n_generation_buckets] += 1
+            self.memory.invalidate_tag(tag)
+            if delete_files and self.path:
+                for extension in self.extensions:
+                    try:
+                        os.unlink(self.get_path(tag, extension))
+                    except FileNotFoundError:
+                        pass
+
+    def clear(self, prefix:Optional[Tuple]=None, delete_files:bool=False) -> None:
+        """Remove all tiles from memory and optionally all tiles with the passed
+        in tag prefix from disk.
+        """
+        with self._lock:
+            self._epoch += 1
+            self.memory.clear()
+            if delete_files and self.path:
+                path = os.path.join(self.path, *(str(t) for t in prefix or ()))
+                shutil.rmtree(path, ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.memory.stats()
+        stats.update({
+            'path': self.path,
+            'disk_hits': self.disk_hits,
+            'disk_misses': self.disk_misses,
+        })
+        return stats
+
+
+class VersionedCache():
+    """Cache serialized data along with the version stamp of the data it was
+    created from. Entries are kept in a per-process LRUCache and optionally as
+    files in a directory, which is shared by all processes. Keys are tuples of
+    path compatible strings or numbers. All but the last key element are used
+    as directories. An entry is only returned if its version matches the
+    requested one, outdated entries are replaced on the next set().
+    """
+
+    def __init__(self, max_bytes:int, path:Optional[str]=None):
+        self.memory = LRUCache(max_bytes)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.disk_hits = 0
+        self.bytes_served = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory.enabled or bool(self.path)
+
+    def get_path(self, key:Tuple) -> str:
+        if not self.path:
+            raise ValueError("No cache path configured")
+        return os.path.join(self.path, *(str(k) for k in key))
+
+    def get(self, key:Tuple, version:str) -> Optional[bytes]:
+        """Return the cached data for the passed in key if it was stored with
+        the passed in version, otherwise None. Entries found on disk are added
+        to the memory cache.
+        """
+        data = self._get(key, version)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.bytes_served += len(data)
+        return data
+
+    def _get(self, key:Tuple, version:str) -> Optional[bytes]:
+        if self.memory.enabled:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] == version:
+                    return entry[1]
+                self.memory.invalidate(key)
+                self.stale += 1
+        if not self.path:
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                stored_version, data = f.read().split(b'\n', 1)
+        except (FileNotFoundError, ValueError):
+            return None
+        if stored_version.decode('utf-8') != version:
+            self.stale += 1
+            return None
+        self.disk_hits += 1
+        if self.memory.enabled:
+            self.memory.set(key, (version, data), len(data), key[:-1])
+        return data
+
+    def set(self, key:Tuple, version:str, data:bytes) -> None:
+        if self.memory.enabled:
+            self.memory.set(key, (version, data), len(data), key[:-1])
+        if self.path:
+            # Write to a temporary file first, so that readers never see
+            # partially written entries.
+            path = self.get_path(key)
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(version.encode('utf-8') + b'\n')
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+    def invalidate_tag(self, tag:Tuple, delete_files:bool=False) -> None:
+        """Remove all entries whose key starts with the passed in tag, i.e.
+        all but the last key element, from memory and optionally from disk.
+        """
+        self.memory.invalidate_tag(tag)
+        if delete_files and self.path:
+            shutil.rmtree(self.get_path(tag), ignore_errors=True)
+
+    def clear(self, delete_files:bool=False) -> None:
+        self.memory.clear()
+        if delete_files and self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit and miss counters of both tiers combined, along with the
+        size of the memory cache and the number of bytes served from cache.
+        """
+        memory_stats = self.memory.stats()
+        n_lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'path': self.path,
+            'entries': memory_stats['entries'],
+            'bytes': memory_stats['bytes'],
+            'max_bytes': memory_stats['max_bytes'],
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_lookups if n_lookups else None,
+            'disk_hits': self.disk_hits,
+            'stale': self.stale,
+            'bytes_served': self.bytes_served,
+            'evictions': memory_stats['evictions'],
+        }
+
+
+class NotificationListener():
+    """Listen to Postgres NOTIFY events on a set of channels, using a dedicated
+    database connection that is independent of the (request) transactions of
+    the default connection. The connection is opened lazily on the first
+    poll(). Received events are passed to the handler registered for their
+    channel. If the connection had to be (re-)established, <on_reset> is called
+    first, because events might have been missed in the meantime.
+    """
+
+    def __init__(self, handlers:Dict[str, Callable],
+            on_reset:Optional[Callable]=None, alias:str=DEFAULT_DB_ALIAS):
+        self.handlers = handlers
+        self.channels = list(handlers.keys())
+        self.on_reset = on_reset
+        self.alias = alias
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> None:
+        wrapper = connections[self.alias]
+        conn = wrapper.get_new_connection(wrapper.get_connection_params())
+        conn.autocommit = True
+        cursor = conn.cursor()
+        for channel in self.channels:
+            cursor.execute(f'LISTEN "{channel}"')
+        self._connection = conn
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+    def poll(self, timeout:float=0) -> bool:
+        """Dispatch all pending events without blocking (unless a timeout is
+        given). Returns False if no listening connection could be established,
+        in which case no guarantees about missed events can be made.
+        """
+        with self._lock:
+            try:
+                if self._connection is None:
+                    self._connect()
+                    if self.on_reset:
+                        self.on_reset()
+                if timeout:
+                    select.select([self._connection], [], [], timeout)
+                self._connection.poll()
+                notifies = self._connection.notifies
+                self._connection.notifies = []
+            except Exception as e:
+                logger.warning(f'Could not poll for database events: {e}')
+                self._close()
+                if self.on_reset:
+                    self.on_reset()
+                return False
+
+        for n in notifies:
+            handler = self.handlers.get(n.channel)
+            if handler:
+                handler(n)
+
+        return True
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Encode node query results in a compact columnar binary format.
+
+A response consists of a file header, followed by a number of blocks. Each
+block represents one regular node query result (e.g. one grid cell LOD) and
+stores each treenode, connector and connector link property as a typed little
+endian array. Labels, the relation map and skeleton origin information are
+stored as UTF-8 encoded JSON at the end of a block. All sections are padded to
+multiples of eight bytes, which allows clients to read columns as typed arrays
+without copying. Clients merge blocks just like they merge the extra results of
+a JSON or msgpack response.
+
+File header (16 bytes): magic "CNCF", version (uint16), reserved (uint16),
+number of blocks (uint32), reserved (uint32).
+
+Block header (24 bytes): block size in bytes including the header (uint32),
+number of treenodes, connectors and links (uint32 each), size of the JSON
+metadata without padding (uint32), node limit reached (uint8), padding.
+
+The header is followed by the treenode, connector and link columns in the
+order listed below. Root nodes have a parent ID of -1. Connector links are
+stored consecutively, <n_links> defines how many links belong to each
+connector.
+"""
+
+import json
+import struct
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+
+MAGIC = b'CNCF'
+VERSION = 1
+
+FILE_HEADER = struct.Struct('<4sHHII')
+BLOCK_HEADER = struct.Struct('<IIIIIB3x')
+
+TREENODE_COLUMNS = (
+    ('id', '<i8'),
+    ('parent_id', '<i8'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('z', '<f4'),
+    ('confidence', '<u1'),
+    ('radius', '<f4'),
+    ('skeleton_id', '<i8'),
+    ('edition_time', '<f8'),
+    ('user_id', '<i4'),
+)
+
+CONNECTOR_COLUMNS = (
+    ('id', '<i8'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('z', '<f4'),
+    ('confidence', '<u1'),
+    ('edition_time', '<f8'),
+    ('user_id', '<i4'),
+    ('n_links', '<u4'),
+)
+
+LINK_COLUMNS = (
+    ('treenode_id', '<i8'),
+    ('relation_id', '<i8'),
+    ('confidence', '<u1'),
+    ('edition_time', '<f8'),
+    ('id', '<i8'),
+)
+
+
+def _padding(n_bytes) -> bytes:
+    return b'\0' * (-n_bytes % 8)
+
+
+def _pack_column(values, dtype) -> bytes:
+    data = np.array(values, dtype=dtype).tobytes()
+    return data + _padding(len(data))
+
+
+def _get_columns(rows, n_columns) -> List:
+    if rows:
+        return list(zip(*rows))
+    return [()] * n_columns
+
+
+def is_origin_data(data) -> bool:
+    """Whether an entry of the extra data of a node result is a list of
+    skeleton origin rows rather than another node result.
+    """
+    return bool(data and data[0] and not isinstance(data[0][0], (list, tuple)))
+
+
+def encode_block(result, origin=None) -> bytes:
+    """Encode the first five elements of a node query result as block. Extra
+    results need to be encoded separately.
+    """
+    treenodes, connectors, labels, limit_reached = result[0:4]
+    relation_map = result[4] if len(result) > 4 else None
+
+    body = []
+    treenode_columns = _get_columns(treenodes, len(TREENODE_COLUMNS))
+    for i, (name, dtype) in enumerate(TREENODE_COLUMNS):
+        values = treenode_columns[i]
+        if name == 'parent_id':
+            values = [-1 if v is None else v for v in values]
+        body.append(_pack_column(values, dtype))
+
+    connector_columns = _get_columns([c[0:7] for c in connectors],
+            len(CONNECTOR_COLUMNS) - 1)
+    connector_columns.append([len(c[7]) for c in connectors])
+    for values, (_, dtype) in zip(connector_columns, CONNECTOR_COLUMNS):
+        body.append(_pack_column(values, dtype))
+
+    links = [link for c in connectors for link in c[7]]
+    link_columns = _get_columns(links, len(LINK_COLUMNS))
+    for values, (_, dtype) in zip(link_columns, LINK_COLUMNS):
+        body.append(_pack_column(values, dtype))
+
+    meta:Dict[str, Any] = {
+        'labels': labels or {},
+        'relation_map': relation_map or {},
+    }
+    if origin:
+        meta['origin'] = origin
+    meta_data = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+    body.append(meta_data + _padding(len(meta_data)))
+
+    block_size = BLOCK_HEADER.size + sum(len(b) for b in body)
+    header = BLOCK_HEADER.pack(block_size, len(treenodes), len(connectors),
+            len(links), len(meta_data), 1 if limit_reached else 0)
+
+    return header + b''.join(body)
+
+
+def encode_blocks(result) -> List[bytes]:
+    """Encode a node query result, including all regular node results of its
+    extra data, as a list of blocks. Skeleton origin data is added to the
+    block of the main result.
+    """
+    extra_data = result[5] if len(result) > 5 else []
+    origin = [row for d in extra_data if is_origin_data(d) for row in d]
+    blocks = [encode_block(result, origin)]
+    for d in extra_data:
+        if d and not is_origin_data(d):
+            blocks.extend(encode_blocks(d))
+    return blocks
+
+
+def get_file_header(n_blocks) -> bytes:
+    return FILE_HEADER.pack(MAGIC, VERSION, 0, n_blocks, 0)
+
+
+def iter_columnar(blocks:List) -> Iterator[bytes]:
+    """Return all chunks of a complete response for the passed in blocks."""
+    yield get_file_header(len(blocks))
+    for block in blocks:
+        yield block
+
+
+def encode_node_result(result) -> bytes:
+    """Encode a complete node query result as columnar response."""
+    return b''.join(iter_columnar(encode_blocks(result)))
+
+
+def _read_columns(buffer, offset, columns, n) -> Tuple[List, int]:
+    values = []
+    for _, dtype in columns:
+        column = np.frombuffer(buffer, dtype=dtype, count=n, offset=offset)
+        values.append(column.tolist())
+        offset += column.nbytes + (-column.nbytes % 8)
+    return values, offset
+
+
+def decode_block(buffer, offset=0) -> Tuple[List, int]:
+    """Decode the block at the passed in offset into a regular node query
+    result. If the block contains skeleton origin information, it is returned
+    as extra data. Returns the result and the offset of the next block.
+    """
+    block_size, n_treenodes, n_connectors, n_links, meta_size, limit_reached = \
+            BLOCK_HEADER.unpack_from(buffer, offset)
+    end = offset + block_size
+    offset += BLOCK_HEADER.size
+
+    treenode_columns, offset = _read_columns(buffer, offset,
+            TREENODE_COLUMNS, n_treenodes)
+    treenode_columns[1] = [None if v == -1 else v for v in treenode_columns[1]]
+    treenodes = list(zip(*treenode_columns)) if n_treenodes else []
+
+    connector_columns, offset = _read_columns(buffer, offset,
+            CONNECTOR_COLUMNS, n_connectors)
+    link_columns, offset = _read_columns(buffer, offset, LINK_COLUMNS, n_links)
+    links = list(zip(*link_columns)) if n_links else []
+
+    connectors = []
+    link_offset = 0
+    for row in zip(*connector_columns):
+        n_connector_links = row[7]
+        connectors.append(row[0:7] +
+                (links[link_offset:link_offset + n_connector_links],))
+        link_offset += n_connector_links
+
+    meta = json.loads(bytes(buffer[offset:offset + meta_size]).decode('utf-8'))
+    labels = {int(k): v for k, v in meta['labels'].items()}
+    relation_map = {int(k): v for k, v in meta['relation_map'].items()}
+
+    result:List = [treenodes, connectors, labels, bool(limit_reached),
+            relation_map]
+    if meta.get('origin'):
+        result.append([meta['origin']])
+
+    return result, end
+
+
+def decode_blocks(buffer) -> Iterable[List]:
+    """Iterate over all node results of a columnar response."""
+    magic, version, _, n_blocks, _ = FILE_HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("Unexpected columnar data format")
+    if version != VERSION:
+        raise ValueError(f"Unsupported columnar data version: {version}")
+    offset = FILE_HEADER.size
+    for _ in range(n_blocks):
+        result, offset = decode_block(buffer, offset)
+        yield result
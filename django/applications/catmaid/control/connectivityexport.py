@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Streaming export of synaptic connectivity matrices. Rows are read from the
+skeleton connectivity table in batches of row skeletons and are written as
+soon as a batch is complete, which keeps memory use bounded by the batch size
+rather than the size of the matrix.
+"""
+
+import csv
+import io
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from django.db import connection
+
+from catmaid.control.common import Echo, get_relation_to_id_map
+
+try:
+    import pyarrow
+    arrow_available = True
+except ImportError:
+    arrow_available = False
+
+
+MATRIX_FORMATS = ('csv', 'coo', 'arrow')
+
+MATRIX_ORDERS = ('input', 'id', 'count')
+
+DEFAULT_ROW_BATCH_SIZE = 1000
+
+
+def get_synapse_relation_ids(project_id, cursor=None) -> Tuple[int, int]:
+    relation_map = get_relation_to_id_map(project_id,
+            ('presynaptic_to', 'postsynaptic_to'), cursor)
+    return relation_map['presynaptic_to'], relation_map['postsynaptic_to']
+
+
+def order_skeletons(project_id, row_skeleton_ids:Sequence[int],
+        col_skeleton_ids:Sequence[int], order:str='input') -> Tuple[List[int], List[int]]:
+    """Return row and column skeleton IDs in the requested order: "input"
+    keeps the passed in order, "id" sorts by skeleton ID and "count" sorts by
+    the total number of synapses within the matrix, largest first. Ties keep
+    the passed in order.
+    """
+    rows, cols = list(row_skeleton_ids), list(col_skeleton_ids)
+    if order == 'input':
+        return rows, cols
+    if order == 'id':
+        return sorted(rows), sorted(cols)
+    if order != 'count':
+        raise ValueError(f"Unknown order: {order}")
+
+    cursor = connection.cursor()
+    pre_rel_id, post_rel_id = get_synapse_relation_ids(project_id, cursor)
+    cursor.execute("""
+        SELECT 0, skeleton_id, SUM(count)
+        FROM catmaid_skeleton_connectivity
+        WHERE skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
+          AND partner_skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
+          AND relation_id = %(pre_rel_id)s
+          AND partner_relation_id = %(post_rel_id)s
+        GROUP BY skeleton_id
+        UNION ALL
+        SELECT 1, partner_skeleton_id, SUM(count)
+        FROM catmaid_skeleton_connectivity
+        WHERE skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
+          AND partner_skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
+          AND relation_id = %(pre_rel_id)s
+          AND partner_relation_id = %(post_rel_id)s
+        GROUP BY partner_skeleton_id
+    """, {
+        'row_skeleton_ids': rows,
+        'col_skeleton_ids': cols,
+        'pre_rel_id': pre_rel_id,
+        'post_rel_id': post_rel_id,
+    })
+    totals:Tuple[Dict[int, int], Dict[int, int]] = ({}, {})
+    for axis, skeleton_id, total in cursor.fetchall():
+        totals[axis][skeleton_id] = total
+
+    # Python's sort is stable, which keeps the input order of ties
+    rows.sort(key=lambda skid: -totals[0].get(skid, 0))
+    cols.sort(key=lambda skid: -totals[1].get(skid, 0))
+    return rows, cols
+
+
+def iter_connectivity_rows(project_id, row_skeleton_ids:Sequence[int],
+        col_skeleton_ids:Sequence[int],
+        batch_size:int=DEFAULT_ROW_BATCH_SIZE) -> Iterator[Tuple[int, Dict[int, int]]]:
+    """Yield the row skeleton ID and a map of column skeleton ID vs synapse
+    count for each row skeleton, in the passed in order. Rows without synapses
+    to any column skeleton have an empty map. Synapse counts are queried for
+    <batch_size> row skeletons at a time.
+    """
+    cursor = connection.cursor()
+    pre_rel_id, post_rel_id = get_synapse_relation_ids(project_id, cursor)
+    col_skeleton_ids = list(set(col_skeleton_ids))
+    for start in range(0, len(row_skeleton_ids), batch_size):
+        batch = row_skeleton_ids[start:start + batch_size]
+        cursor.execute("""
+            SELECT skeleton_id, partner_skeleton_id, count
+            FROM catmaid_skeleton_connectivity
+            WHERE skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
+              AND partner_skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
+              AND relation_id = %(pre_rel_id)s
+              AND partner_relation_id = %(post_rel_id)s
+        """, {
+            'row_skeleton_ids': list(set(batch)),
+            'col_skeleton_ids': col_skeleton_ids,
+            'pre_rel_id': pre_rel_id,
+            'post_rel_id': post_rel_id,
+        })
+        partners:Dict[int, Dict[int, int]] = {}
+        for row_skeleton_id, col_skeleton_id, count in cursor.fetchall():
+            partners.setdefault(row_skeleton_id, {})[col_skeleton_id] = count
+        for row_skeleton_id in batch:
+            yield row_skeleton_id, partners.get(row_skeleton_id, {})
+
+
+def _column_positions(col_skeleton_ids:Sequence[int]) -> Dict[int, List[int]]:
+    positions:Dict[int, List[int]] = {}
+    for i, skeleton_id in enumerate(col_skeleton_ids):
+        positions.setdefault(skeleton_id, []).append(i)
+    return positions
+
+
+def iter_dense_csv(rows:Iterable[Tuple[int, Dict[int, int]]],
+        col_skeleton_ids:Sequence[int], names:Optional[Dict[int, Any]]=None) -> Iterator[str]:
+    """Write a header with all column skeletons and one line per row skeleton
+    with its synapse count to each column skeleton. Skeleton IDs are replaced
+    by the passed in names, if available.
+    """
+    names = names or {}
+    writer = csv.writer(Echo(), quoting=csv.QUOTE_NONNUMERIC)
+    yield writer.writerow([''] + [names.get(skid, skid) for skid in col_skeleton_ids])
+
+    positions = _column_positions(col_skeleton_ids)
+    counts = np.zeros(len(col_skeleton_ids), dtype=np.int64)
+    for row_skeleton_id, partners in rows:
+        counts[:] = 0
+        for col_skeleton_id, count in partners.items():
+            counts[positions[col_skeleton_id]] = count
+        yield writer.writerow([names.get(row_skeleton_id, row_skeleton_id)] + counts.tolist())
+
+
+def _iter_coo_batches(rows:Iterable[Tuple[int, Dict[int, int]]],
+        col_skeleton_ids:Sequence[int],
+        batch_size:int) -> Iterator[Tuple[List[int], List[int], List[int]]]:
+    """Yield row, column and count lists of non-zero matrix entries, for about
+    <batch_size> entries at a time. Entries are ordered by row and column.
+    """
+    positions = _column_positions(col_skeleton_ids)
+    row_ids:List[int] = []
+    col_ids:List[int] = []
+    counts:List[int] = []
+    for row_skeleton_id, partners in rows:
+        entries = sorted((i, col_skeleton_id, count)
+                for col_skeleton_id, count in partners.items()
+                for i in positions[col_skeleton_id])
+        for _, col_skeleton_id, count in entries:
+            row_ids.append(row_skeleton_id)
+            col_ids.append(col_skeleton_id)
+            counts.append(count)
+        if len(counts) >= batch_size:
+            yield row_ids, col_ids, counts
+            row_ids, col_ids, counts = [], [], []
+    if counts:
+        yield row_ids, col_ids, counts
+
+
+def iter_coo_csv(rows:Iterable[Tuple[int, Dict[int, int]]],
+        col_skeleton_ids:Sequence[int],
+        batch_size:int=DEFAULT_ROW_BATCH_SIZE) -> Iterator[str]:
+    """Write one line per non-zero matrix entry: the row skeleton ID, the
+    column skeleton ID and the synapse count.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(['row', 'column', 'count'])
+    for row_ids, col_ids, counts in _iter_coo_batches(rows, col_skeleton_ids, batch_size):
+        yield ''.join(map(writer.writerow, zip(row_ids, col_ids, counts)))
+
+
+def iter_arrow(rows:Iterable[Tuple[int, Dict[int, int]]],
+        col_skeleton_ids:Sequence[int],
+        batch_size:int=DEFAULT_ROW_BATCH_SIZE) -> Iterator[bytes]:
+    """Write non-zero matrix entries as Apache Arrow IPC stream with the int64
+    columns "row" and "column" for skeleton IDs and the int32 column "count"
+    for synapse counts. Each batch of entries is a separate record batch.
+    """
+    if not arrow_available:
+        raise ValueError("Arrow output requires the pyarrow module")
+    schema = pyarrow.schema([('row', pyarrow.int64()),
+            ('column', pyarrow.int64()), ('count', pyarrow.int32())])
+    sink = io.BytesIO()
+
+    def flush() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for row_ids, col_ids, counts in _iter_coo_batches(rows, col_skeleton_ids, batch_size):
+            writer.write_batch(pyarrow.record_batch([
+                pyarrow.array(row_ids, type=pyarrow.int64()),
+                pyarrow.array(col_ids, type=pyarrow.int64()),
+                pyarrow.array(counts, type=pyarrow.int32())], schema=schema))
+            yield flush()
+    # The schema is written with the first batch or on close, followed by the
+    # end of stream marker.
+    yield flush()
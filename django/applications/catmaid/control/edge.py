@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 from typing import List
 
 from django.db import connection, transaction
@@ -515,3 +516,80 @@ def get_intersected_grid_cells(p1, p2, cell_width, cell_height, cell_depth,
                 t_max_z += t_delta_z
 
     return cells
+
+
+def get_intersected_grid_cells_batch(p1, p2, cell_width, cell_height,
+        cell_depth) -> np.ndarray:
+    """Find the grid cells intersected by a set of line segments. <p1> and <p2>
+    are N x 3 arrays with the start and end points of N segments. Like
+    get_intersected_grid_cells(), cells are traversed like in a 3D DDA, but
+    all segments are processed at once: for each segment, the parameters t at
+    which it crosses cell boundaries are computed and sorted and each crossing
+    moves the current cell by one step along the crossed axis. Crossings that
+    are (almost) at the same position are combined into a single diagonal step.
+    Returns a M x 3 array of the unique indices of all intersected cells.
+    """
+    p1 = np.asarray(p1, dtype=np.float64).reshape(-1, 3)
+    p2 = np.asarray(p2, dtype=np.float64).reshape(-1, 3)
+    if len(p1) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+
+    cell_size = np.array([cell_width, cell_height, cell_depth], dtype=np.float64)
+    p1_cells = np.floor_divide(p1, cell_size).astype(np.int64)
+    p2_cells = np.floor_divide(p2, cell_size).astype(np.int64)
+
+    # Segments that start and end in the same cell (the common case) need no
+    # traversal.
+    n_crossings = np.abs(p2_cells - p1_cells)
+    segment_ids, axes = np.nonzero(n_crossings)
+    counts = n_crossings[segment_ids, axes]
+    if len(counts) == 0:
+        return unique_cells(p1_cells)
+
+    # Create one entry per crossed cell boundary
+    seg = np.repeat(segment_ids, counts)
+    axis = np.repeat(axes, counts)
+    nth = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    step = np.sign(p2_cells - p1_cells)[seg, axis]
+    boundary = p1_cells[seg, axis] + np.where(step > 0, nth + 1, -nth)
+    t = (boundary * cell_size[axis] - p1[seg, axis]) / (p2 - p1)[seg, axis]
+
+    # Order crossings along each segment. Segments are already grouped and
+    # 0 < t <= 1, which allows a single sort key that is much faster than a
+    # lexsort.
+    order = np.argsort(seg * 2.0 + t)
+    seg, axis, step, t = seg[order], axis[order], step[order], t[order]
+
+    # The cell entered after each crossing is the start cell plus all steps of
+    # the segment so far.
+    steps = np.zeros((len(seg), 3), dtype=np.int64)
+    steps[np.arange(len(seg)), axis] = step
+    total_steps = np.cumsum(steps, axis=0)
+    segment_start = np.r_[True, seg[1:] != seg[:-1]]
+    offsets = (total_steps - steps)[segment_start]
+    cells = p1_cells[seg] + total_steps - offsets[np.cumsum(segment_start) - 1]
+
+    # If the next crossing of the same segment happens at (almost) the same
+    # position, the cell in between isn't actually entered.
+    entered = np.ones(len(seg), dtype=bool)
+    entered[:-1] = ~((seg[1:] == seg[:-1]) & (t[1:] - t[:-1] < 0.00001))
+
+    return unique_cells(np.concatenate([p1_cells, cells[entered]]))
+
+
+def unique_cells(cells) -> np.ndarray:
+    """Return the unique rows of a N x 3 array of cell indices. Rows are
+    encoded as a single integer, which is much faster than np.unique() with
+    axis=0.
+    """
+    if len(cells) == 0:
+        return cells
+    min_cell = cells.min(axis=0)
+    extent = cells.max(axis=0) - min_cell + 1
+    if np.prod(extent.astype(np.float64)) >= 2**62:
+        return np.unique(cells, axis=0)
+    local = cells - min_cell
+    keys = np.unique((local[:, 0] * extent[1] + local[:, 1]) * extent[2] + local[:, 2])
+    x, rest = np.divmod(keys, extent[1] * extent[2])
+    y, z = np.divmod(rest, extent[2])
+    return np.stack([x, y, z], axis=1) + min_cell
@@ -22,6 +22,7 @@ from catmaid.models import Relation, UserRole
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, get_request_list
 from catmaid.control.link import KNOWN_LINK_PAIRS
+from catmaid.control.morphology import ArrayTree
 from catmaid.control.review import get_treenodes_to_reviews
 from catmaid.control.tree_util import simplify, find_root, reroot, partition, \
         spanning_tree, cable_length
@@ -267,6 +268,8 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
         # as a function of the number of synapses and their location within the arbor.
         # Algorithm by Casey Schneider-Mizell
         # Implemented by Albert Cardona
+        # Arbors are converted only once, even if they have many partners
+        array_arbors:Dict[Any, ArrayTree] = {}
         for pre_arbor, post_arbor, edge_props in circuit.edges_iter(data=True):
             if pre_arbor == post_arbor:
                 # Signal autapse
@@ -274,7 +277,10 @@ def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
                 continue
 
             try:
-                spanning = spanning_tree(post_arbor, edge_props['post_treenodes'])
+                array_arbor = array_arbors.get(post_arbor)
+                if array_arbor is None:
+                    array_arbor = array_arbors[post_arbor] = ArrayTree.from_digraph(post_arbor)
+                spanning = spanning_tree(array_arbor, edge_props['post_treenodes'])
                 # for arbor in whole_arbors[circuit[post_arbor]['skeleton_id']]:
                 #     if post_arbor == arbor:
                 #         tc = arbor.treenode_synapse_counts
@@ -407,16 +413,18 @@ def _node_centrality_by_synapse_db(skeleton_id:Union[int,str]) -> Dict:
                 counts.inputs += 1
                 totalInputs += 1
         if row[1]:
-            tree.add_edge(row[0], row[1])
+            # From parent to child, like tree_util expects
+            tree.add_edge(row[1], row[0])
         else:
             root = row[0]
+            tree.add_node(root)
 
     _node_centrality_by_synapse(tree, nodes, totalOutputs, totalInputs)
 
     return nodes
 
 def _node_centrality_by_synapse(tree, nodes:Dict, totalOutputs:int, totalInputs:int) -> None:
-    """ tree: a DiGraph
+    """ tree: a DiGraph with edges from parent to child
         nodes: a dictionary of treenode ID vs Counts instance
         totalOutputs: the total number of output synapses of the tree
         totalInputs: the total number of input synapses of the tree
@@ -429,10 +437,11 @@ def _node_centrality_by_synapse(tree, nodes:Dict, totalOutputs:int, totalInputs:
             counts.synapse_centrality = -1
         return
 
-    if len(tree.successors(find_root(tree))) > 1:
+    # An array copy is faster to reroot and partition
+    tree = ArrayTree.from_digraph(tree)
+    if len(tree.children(find_root(tree))) > 1:
         # Reroot at the first end node found
-        tree = tree.copy()
-        endNode = next(nodeID for nodeID in nodes.keys() if not tree.successors(nodeID))
+        endNode = next(nodeID for nodeID in nodes.keys() if not tree.children(nodeID))
         reroot(tree, endNode)
 
     # 2. Partition into sequences, sorted from small to large
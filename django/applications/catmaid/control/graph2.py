@@ -1,15 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from collections import defaultdict
+from concurrent import futures
 from functools import partial
 from itertools import count
 import json
 import networkx as nx
 from networkx.algorithms import weakly_connected_component_subgraphs
-from numpy import subtract
-from numpy.linalg import norm
+import numpy as np
 from typing import Any, DefaultDict, Dict, List, Optional, Tuple, Union
 
+from django.conf import settings
 from django.db import connection
 from django.http import JsonResponse
 
@@ -20,8 +21,9 @@ from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import (get_relation_to_id_map, get_request_bool,
         get_request_list)
 from catmaid.control.link import KNOWN_LINK_PAIRS, UNDIRECTED_LINK_TYPES
+from catmaid.control.morphology import ArrayTree, parent_indices
 from catmaid.control.tree_util import simplify
-from catmaid.control.synapseclustering import tree_max_density
+from catmaid.control.synapseclustering import density_maxima
 
 
 def make_new_synapse_count_array() -> List[int]:
@@ -42,30 +44,27 @@ def basic_graph(project_id, skeleton_ids, relations=None,
     undirected_links = source_link in UNDIRECTED_LINK_TYPES and \
             target_link in UNDIRECTED_LINK_TYPES
 
-    # Find all links in the passed in set of skeletons. If a relation is
-    # reciprocal, we need to avoid getting two result rows back for each
-    # treenode-connector-treenode connection. To keep things simple, we will add
-    # a "skeleton ID 1" < "skeleton ID 2" test for reciprocal links.
+    # Find all links in the passed in set of skeletons in the skeleton
+    # connectivity table. If a relation is reciprocal, we need to avoid getting
+    # two result rows back for each skeleton pair. To keep things simple, we
+    # will add a "skeleton ID 1" < "skeleton ID 2" test for reciprocal links.
     cursor.execute(f'''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence)
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
-      AND t1.relation_id = %(source_rel)s
-      AND t1.connector_id = t2.connector_id
-      AND t2.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
-      AND t2.relation_id = %(target_rel)s
-      AND t1.id <> t2.id
-      {'AND t1.skeleton_id < t2.skeleton_id' if undirected_links else ''}
+    SELECT skeleton_id, partner_skeleton_id, confidence_histogram
+    FROM catmaid_skeleton_connectivity
+    WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+      AND relation_id = %(source_rel)s
+      AND partner_skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+      AND partner_relation_id = %(target_rel)s
+      {'AND skeleton_id < partner_skeleton_id' if undirected_links else ''}
     ''', {
         'skeleton_ids': list(skeleton_ids),
         'source_rel': source_rel_id,
         'target_rel': target_rel_id
     })
 
-    edges:DefaultDict = defaultdict(partial(defaultdict, make_new_synapse_count_array))
-    for row in cursor.fetchall():
-        edges[row[0]][row[1]][row[2] - 1] += 1
+    edges:DefaultDict = defaultdict(dict)
+    for source, target, confidence_histogram in cursor.fetchall():
+        edges[source][target] = confidence_histogram
 
     return {
         'edges': tuple((s, t, count)
@@ -245,44 +244,30 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
     ORDER BY skeleton_id
     ''' % (project_id, ",".join(str(int(skid)) for skid in expand)))
 
+    rows_per_skeleton:DefaultDict[Any, List] = defaultdict(list)
+    for row in cursor.fetchall():
+        rows_per_skeleton[row[0]].append(row[1:])
+
     # list of edges among synapse domains
     intraedges:List = []
 
     # list of branch nodes, merely structural
     branch_nodeIDs:List = []
 
-    # reset
-    current_skid = None
-    tree = None
-    locations:Optional[Dict] = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            # mypy cannot prove this will have a value by here
-            locations[row[1]] = row[4:]  # type: ignore
-            if row[2] and row[3] >= confidence_threshold:
-                # mypy cannot prove this will have a value by here
-                tree.add_edge(row[2], row[1])  # type: ignore
-            continue
-
-        if tree:
-            ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-            nodeIDs.extend(ns)
-            branch_nodeIDs.extend(bs)
+    # Splitting doesn't need the database, which allows to split multiple
+    # skeletons in parallel.
+    skids = list(rows_per_skeleton.keys())
+    splits = map_skeletons(split_by_both, skids,
+            [rows_per_skeleton[skid] for skid in skids],
+            [stc[skid] for skid in skids],
+            confidence_threshold=confidence_threshold, bandwidth=bandwidth)
 
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        locations = {}
-        locations[row[1]] = row[4:]
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
+    for ns, bs, cs, es in splits:
         nodeIDs.extend(ns)
         branch_nodeIDs.extend(bs)
-
+        intraedges.extend(es)
+        for connector_id, relation_id, nodeID, confidence in cs:
+            connectors[connector_id][relation_id].append((nodeID, confidence))
 
     # Create the edges of the graph
     edges:DefaultDict = defaultdict(partial(defaultdict, make_new_synapse_count_array))  # pre vs post vs count
@@ -327,56 +312,118 @@ def split_by_confidence(skeleton_id, digraph, cs, connectors) -> Tuple:
     return chunkIDs
 
 
-def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, intraedges) -> Tuple[List, List]:
-    """ Split by confidence and synapse domain. Populates connectors and intraedges (side effects). """
-    nodes = []
-    branch_nodes = []
-
-    chunks, chunkIDs = subgraphs(digraph, skeleton_id)
+def map_skeletons(fn, skeleton_ids, *args, **kwargs) -> List:
+    """ Call fn(skeleton_id, *per_skeleton_args, **kwargs) for each skeleton and
+    return the results in order. The calls are distributed over a pool of
+    SKELETON_GRAPH_WORKERS processes if it is larger than one, which requires
+    fn and its arguments to be picklable. """
+    workers = min(settings.SKELETON_GRAPH_WORKERS, len(skeleton_ids))
+    if workers < 2:
+        return [fn(*job, **kwargs) for job in zip(skeleton_ids, *args)]
+    with futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(partial(fn, **kwargs), skeleton_ids, *args))
+
+
+def split_by_both(skeleton_id, rows, cs, confidence_threshold, bandwidth) -> Tuple[List, List, List, List]:
+    """ Split by confidence and synapse domain. The rows are (id, parent_id,
+    confidence, x, y, z) for each treenode and cs has (treenode_id,
+    connector_id, relation_id, confidence) for each synapse. Returns the node
+    IDs, the branch node IDs, a (connector_id, relation_id, node ID,
+    confidence) tuple for each synapse and the edges among synapse domains. """
+    nodes:List = []
+    branch_nodes:List = []
+    synapses:List = []
+    intraedges:List = []
 
-    for i, chunkID, chunk in zip(count(start=1), chunkIDs, chunks):
-        # Populate edge properties with the weight
-        for parent, child in chunk.edges_iter():
-            chunk[parent][child]['weight'] = norm(subtract(locations[child], locations[parent]))
+    n_rows = len(rows)
+    node_ids = np.fromiter((row[0] for row in rows), np.int64, n_rows)
+    parents = parent_indices(node_ids, [row[1] for row in rows])
+    confidences = np.fromiter((row[2] for row in rows), np.int64, n_rows)
+    locations = np.array([row[3:6] for row in rows], dtype=np.float64).reshape(-1, 3)
+
+    # Break the tree at the low-confidence edges. Only nodes that are part of an
+    # edge are nodes of the graph.
+    children = np.flatnonzero((parents >= 0) & (confidences >= confidence_threshold))
+    if not len(children):
+        return nodes, branch_nodes, synapses, intraedges
+    chunk_parents = np.full(n_rows, -1, dtype=np.int64)
+    chunk_parents[children] = parents[children]
+
+    # The root of each node's chunk, found by pointer jumping
+    roots = np.arange(n_rows)
+    roots[children] = parents[children]
+    while True:
+        next_roots = roots[roots]
+        if np.array_equal(next_roots, roots):
+            break
+        roots = next_roots
+
+    # Chunks are numbered in order of their first node, following the edges
+    # in row order, parent first.
+    edge_nodes = np.column_stack((parents[children], children)).ravel()
+    chunk_roots, first_seen = np.unique(roots[edge_nodes], return_index=True)
+    chunk_roots = chunk_roots[np.argsort(first_seen)]
+    if 1 == len(chunk_roots):
+        chunkIDs:Tuple = (str(skeleton_id),) # Note: Here we're loosening the implicit type
+    else:
+        chunkIDs = tuple('%s_%s' % (skeleton_id, (i+1)) for i in range(len(chunk_roots)))
+
+    # Group the graph nodes and the synapses by chunk root
+    in_graph = np.zeros(n_rows, dtype=bool)
+    in_graph[edge_nodes] = True
+    graph_nodes = np.flatnonzero(in_graph)
+    chunk_nodes:DefaultDict = defaultdict(list)
+    for node, root in zip(graph_nodes.tolist(), roots[graph_nodes].tolist()):
+        chunk_nodes[root].append(node)
+
+    id2index = dict(zip(node_ids.tolist(), range(n_rows)))
+    chunk_synapses:DefaultDict = defaultdict(list)
+    for c in cs:
+        node = id2index.get(c[0])
+        if node is not None and in_graph[node]:
+            chunk_synapses[roots[node]].append((node, ) + tuple(c))
 
+    local = np.full(n_rows, -1, dtype=np.int64)
+    for i, chunkID, root in zip(count(start=1), chunkIDs, chunk_roots.tolist()):
         # Check if need to expand at all
-        blob = tuple(c for c in cs if c[0] in chunk)
-        if 0 == len(blob): # type: ignore
+        blob = chunk_synapses.get(root)
+        if not blob:
             nodes.append(chunkID)
             continue
 
-        treenode_ids, connector_ids, relation_ids, confidences = list(zip(*blob)) # type: ignore
-
-        if 0 == len(connector_ids):
-            nodes.append(chunkID)
-            continue
+        members = np.array(chunk_nodes[root], dtype=np.int64)
+        local[members] = np.arange(len(members))
+        member_children = members[chunk_parents[members] >= 0]
+        member_parents = chunk_parents[member_children]
+        lengths = np.linalg.norm(locations[member_children] - locations[member_parents], axis=1)
 
         # Invoke Casey's magic: split by synapse domain
-        max_density = tree_max_density(chunk.to_undirected(), treenode_ids,
-                connector_ids, relation_ids, [bandwidth])
-        # Get first element of max_density
-        domains = next(iter(max_density.values()))
+        local_max = density_maxima(len(members), local[member_children],
+                local[member_parents], lengths, local[[c[0] for c in blob]],
+                [bandwidth])[bandwidth]
 
-        # domains is a dictionary of index vs SynapseGroup instance
+        # Domains are numbered in order of their first synapse
+        domains:DefaultDict = defaultdict(list)
+        for c, target in zip(blob, local_max.tolist()):
+            domains[target].append(c)
 
         if 1 == len(domains):
-            for connector_id, relation_id, confidence in zip(connector_ids, relation_ids, confidences):
-                connectors[connector_id][relation_id].append((chunkID, confidence))
+            for _, _, connector_id, relation_id, confidence in blob:
+                synapses.append((connector_id, relation_id, chunkID, confidence))
             nodes.append(chunkID)
             continue
 
         # Create edges between domains
         # Pick one treenode from each domain to act as anchor
-        anchors = {d.node_ids[0]: (i+k, d) for k, d in domains.items()}
+        anchors = {d[0][1]: (i+k, d) for k, d in enumerate(domains.values())}
 
         # Create new Graph where the edges are the edges among synapse domains
+        chunk = ArrayTree(node_ids[members], np.where(chunk_parents[members] >= 0,
+                node_ids[chunk_parents[members]], -1))
         mini = simplify(chunk, anchors.keys())
 
-        # Many side effects:
-        # * add internal edges to intraedges
-        # * add each domain to nodes
-        # * custom-apply populate_connectors with the known synapses of each domain
-        #   (rather than having to sift through all in cs)
+        # Add each domain with its synapses to nodes and the internal edges to
+        # intraedges.
         mini_nodes = {}
         for node in mini.nodes_iter():
             nblob = anchors.get(node)
@@ -384,9 +431,8 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
                 index, domain = nblob
                 domainID = '%s_%s' % (chunkID, index)
                 nodes.append(domainID)
-                for connector_id, relation_id in zip(domain.connector_ids, domain.relations):
-                    confidence = confidences[connector_ids.index(connector_id)]
-                    connectors[connector_id][relation_id].append((domainID, confidence))
+                for _, _, connector_id, relation_id, confidence in domain:
+                    synapses.append((connector_id, relation_id, domainID, confidence))
             else:
                 domainID = '%s_%s' % (chunkID, node)
                 branch_nodes.append(domainID)
@@ -395,7 +441,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
         for a1, a2 in mini.edges_iter():
             intraedges.append((mini_nodes[a1], mini_nodes[a2]))
 
-    return nodes, branch_nodes
+    return nodes, branch_nodes, synapses, intraedges
 
 
 def _skeleton_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
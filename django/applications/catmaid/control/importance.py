@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Maintain per-node importance scores and use them to order node query
+results. This allows to fill low level-of-detail (LOD) buckets with the most
+informative nodes first.
+
+The stored score of a node only depends on its local topology: root, branch and
+leaf nodes are more important than nodes in the middle of a branch. Since these
+scores change only for the nodes of an edit and their neighbors, they can be
+updated incrementally by the spatial update worker. When nodes are ordered by
+importance, the stored score is combined with the size and the last edition
+time of the node's skeleton, which are both taken from the skeleton summary
+table. The weights of all three parts are defined by NODE_IMPORTANCE_WEIGHTS.
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db import connection
+
+
+ROOT_SCORE = 1.0
+BRANCH_SCORE = 1.0
+LEAF_SCORE = 0.75
+CONTINUATION_SCORE = 0.0
+
+# Skeletons with at least this cable length (nm) get the full size score,
+# smaller ones a logarithmically scaled part of it.
+REFERENCE_CABLE_LENGTH = 1000000.0
+
+# The recency score of a skeleton is halved after this many seconds without
+# edits.
+RECENCY_HALF_LIFE = 30 * 24 * 3600.0
+
+
+def get_importance_weights() -> Tuple[float, float, float]:
+    weights = settings.NODE_IMPORTANCE_WEIGHTS
+    return float(weights.get('topology', 0)), float(weights.get('size', 0)), \
+            float(weights.get('recency', 0))
+
+
+def get_importance_order_sql(alias:str) -> Tuple[str, str]:
+    """Return a JOIN and an ORDER BY expression that order the treenodes of
+    the query with the passed in alias (which needs to provide an "id" and a
+    "skeleton_id" column) by descending importance.
+    """
+    topology_weight, size_weight, recency_weight = get_importance_weights()
+    join = f"""
+        LEFT JOIN treenode_importance importance
+            ON importance.treenode_id = {alias}.id
+        LEFT JOIN catmaid_skeleton_summary importance_css
+            ON importance_css.skeleton_id = {alias}.skeleton_id
+    """
+    order = f"""
+        ORDER BY (
+            {topology_weight} * COALESCE(importance.score, 0)
+            + {size_weight} * LEAST(1.0, LN(1.0 + COALESCE(importance_css.cable_length, 0))
+                / LN(1.0 + {REFERENCE_CABLE_LENGTH}))
+            + {recency_weight} * COALESCE(EXP(-LN(2.0) * EXTRACT(EPOCH FROM
+                now() - importance_css.last_edition_time) / {RECENCY_HALF_LIFE}), 0)
+        ) DESC, {alias}.id
+    """
+    return join, order
+
+
+def update_node_importance(project_id:int, treenode_ids:Optional[Sequence[int]]=None,
+        cursor=None) -> int:
+    """Recompute the stored importance score of the passed in treenodes or of
+    all treenodes of a project, if no IDs are passed in. Returns the number of
+    updated nodes.
+    """
+    if cursor is None:
+        cursor = connection.cursor()
+
+    if treenode_ids is None:
+        node_filter = ''
+        child_filter = 'AND parent_id IS NOT NULL'
+    else:
+        if not treenode_ids:
+            return 0
+        node_filter = 'AND t.id = ANY(%(treenode_ids)s::bigint[])'
+        child_filter = 'AND parent_id = ANY(%(treenode_ids)s::bigint[])'
+
+    cursor.execute(f"""
+        INSERT INTO treenode_importance (treenode_id, project_id, score)
+        SELECT t.id, t.project_id,
+            CASE WHEN t.parent_id IS NULL THEN %(root_score)s
+                 WHEN c.n_children IS NULL THEN %(leaf_score)s
+                 WHEN c.n_children > 1 THEN %(branch_score)s
+                 ELSE %(continuation_score)s
+            END
+        FROM treenode t
+        LEFT JOIN (
+            SELECT parent_id, COUNT(*) AS n_children
+            FROM treenode
+            WHERE project_id = %(project_id)s
+            {child_filter}
+            GROUP BY parent_id
+        ) c
+            ON c.parent_id = t.id
+        WHERE t.project_id = %(project_id)s
+        {node_filter}
+        ON CONFLICT (treenode_id) DO UPDATE
+        SET score = EXCLUDED.score
+    """, {
+        'project_id': project_id,
+        'treenode_ids': list(treenode_ids) if treenode_ids is not None else None,
+        'root_score': ROOT_SCORE,
+        'leaf_score': LEAF_SCORE,
+        'branch_score': BRANCH_SCORE,
+        'continuation_score': CONTINUATION_SCORE,
+    })
+
+    return cursor.rowcount
+
+
+def find_treenodes_at(project_id:int, points:Sequence[Sequence[float]],
+        cursor=None) -> List[int]:
+    """Return the IDs of all treenodes whose edge (to their parent) has a
+    bounding box that contains any of the passed in points, along with the
+    IDs of their parents. For changed nodes, this includes the node itself, its
+    parent and its children.
+    """
+    if not points:
+        return []
+    if cursor is None:
+        cursor = connection.cursor()
+    x, y, z = zip(*points)
+    cursor.execute("""
+        WITH point AS (
+            SELECT ST_MakePoint(p.x, p.y, p.z) AS geom
+            FROM UNNEST(%(x)s::float8[], %(y)s::float8[], %(z)s::float8[]) p(x, y, z)
+        ), touched AS (
+            SELECT te.id, te.parent_id
+            FROM point p
+            JOIN treenode_edge te
+                ON te.edge &&& ST_MakeLine(p.geom, p.geom)
+            WHERE te.project_id = %(project_id)s
+        )
+        SELECT id FROM touched
+        UNION
+        SELECT parent_id FROM touched WHERE parent_id IS NOT NULL
+    """, {
+        'project_id': project_id,
+        'x': list(x),
+        'y': list(y),
+        'z': list(z),
+    })
+    return [r[0] for r in cursor.fetchall()]
+
+
+def get_update_points(update:Dict) -> List:
+    """Return the node locations referenced by a spatial update event."""
+    data_type = update.get('type')
+    if data_type == 'edge':
+        return [update['p1'], update['p2']]
+    elif data_type == 'edges':
+        return [p for edge in update['edges'] for p in edge]
+    elif data_type == 'point':
+        return [update['p']]
+    return []
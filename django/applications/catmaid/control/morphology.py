@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+"""Array based representation of one or more skeletons, which allows to compute
+morphological properties of many skeletons at once with NumPy.
+"""
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from networkx import DiGraph, Graph
+import numpy as np
+
+
+class ArborArrays():
+    """The nodes of one or more skeletons, stored as arrays. Nodes are
+    addressed by their index. The parent of each node is referenced by its
+    index as well, root nodes have a parent index of -1. Nodes can be in any
+    order, <order> provides a topological order (parents before children).
+    Parent IDs that don't refer to a node in the arrays are treated like root
+    nodes.
+    """
+
+    def __init__(self, node_ids, parent_ids, skeleton_ids, locations):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        self.parents = parent_indices(self.node_ids, parent_ids)
+
+        self.skeleton_ids, self.skeleton_index = np.unique(
+                np.asarray(skeleton_ids, dtype=np.int64), return_inverse=True)
+
+        self._depth:Optional[np.ndarray] = None
+        self._jumps:List[np.ndarray] = []
+
+    @classmethod
+    def from_rows(cls, rows:Iterable[Sequence]) -> "ArborArrays":
+        """Create arrays from (id, parent_id, skeleton_id, x, y, z) rows."""
+        rows = list(rows)
+        if not rows:
+            return cls([], [], [], np.empty((0, 3)))
+        node_ids, parent_ids, skeleton_ids, x, y, z = zip(*rows)
+        return cls(node_ids, parent_ids, skeleton_ids,
+                np.column_stack((x, y, z)))
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    @property
+    def n_skeletons(self) -> int:
+        return len(self.skeleton_ids)
+
+    @property
+    def child_indices(self) -> np.ndarray:
+        """Indices of all nodes that have a parent."""
+        return np.flatnonzero(self.parents >= 0)
+
+    @property
+    def n_children(self) -> np.ndarray:
+        has_parent = self.parents >= 0
+        return np.bincount(self.parents[has_parent], minlength=len(self))
+
+    @property
+    def depth(self) -> np.ndarray:
+        """The number of edges between each node and its root."""
+        if self._depth is None:
+            self._compute_depth()
+        return self._depth # type: ignore
+
+    @property
+    def order(self) -> np.ndarray:
+        """Node indices in topological order, i.e. each node's parent is
+        listed before the node.
+        """
+        return np.argsort(self.depth, kind='stable')
+
+    def _compute_depth(self) -> None:
+        self._depth, self._jumps = _pointer_jumping(self.parents)
+
+    def path_to_root(self, node_indices) -> np.ndarray:
+        """Return a boolean mask of all nodes on the paths from the passed in
+        nodes to their roots, including both.
+        """
+        if self._depth is None:
+            self._compute_depth()
+        return _path_to_root(self._jumps, len(self), node_indices)
+
+    def segment_lengths(self, locations:Optional[np.ndarray]=None) -> np.ndarray:
+        """Return the length of the edge between each node and its parent, zero
+        for root nodes. Optionally, alternative node locations can be used.
+        """
+        if locations is None:
+            locations = self.locations
+        lengths = np.zeros(len(self))
+        children = self.child_indices
+        lengths[children] = np.linalg.norm(locations[children] -
+                locations[self.parents[children]], axis=1)
+        return lengths
+
+    def sum_per_skeleton(self, values) -> np.ndarray:
+        """Sum the passed in per-node values for each skeleton, in the order of
+        <skeleton_ids>.
+        """
+        return np.bincount(self.skeleton_index, weights=values,
+                minlength=self.n_skeletons)
+
+    def count_per_skeleton(self, mask:Optional[np.ndarray]=None) -> np.ndarray:
+        index = self.skeleton_index if mask is None else self.skeleton_index[mask]
+        return np.bincount(index, minlength=self.n_skeletons)
+
+    def cable_lengths(self) -> np.ndarray:
+        """The cable length of each skeleton, in the order of <skeleton_ids>."""
+        return self.sum_per_skeleton(self.segment_lengths())
+
+    def deepest_nodes(self) -> np.ndarray:
+        """Return the index of the node with the most edges to the root for each
+        skeleton, in the order of <skeleton_ids>.
+        """
+        ordering = np.lexsort((self.depth, self.skeleton_index))
+        last_of_skeleton = np.flatnonzero(np.diff(self.skeleton_index[ordering],
+                append=self.n_skeletons))
+        return ordering[last_of_skeleton]
+
+    def smooth_locations(self, self_weight:float=0.4) -> np.ndarray:
+        """Move each slab node, i.e. nodes that are neither root, branch nor
+        end node, to a weighted average of its own location and the average
+        location of its two neighbors, which are weighted by their distance.
+        A root with two children is treated as slab node.
+        """
+        n_nodes = len(self)
+        children = self.child_indices
+        parents = self.parents[children]
+        distances = self.segment_lengths()[children]
+
+        # Each edge contributes the distance weighted location of one end point
+        # to the other end point.
+        weight_sum = np.bincount(parents, weights=distances, minlength=n_nodes) + \
+                np.bincount(children, weights=distances, minlength=n_nodes)
+        weighted = np.empty((n_nodes, 3))
+        for dim in range(3):
+            weighted[:, dim] = \
+                    np.bincount(parents, weights=distances * self.locations[children, dim],
+                            minlength=n_nodes) + \
+                    np.bincount(children, weights=distances * self.locations[parents, dim],
+                            minlength=n_nodes)
+        neighbor_average = np.zeros((n_nodes, 3))
+        nonzero = weight_sum > 0
+        neighbor_average[nonzero] = weighted[nonzero] / weight_sum[nonzero, np.newaxis]
+
+        n_children = self.n_children
+        has_parent = self.parents >= 0
+        slab = (has_parent & (n_children == 1)) | (~has_parent & (n_children == 2))
+
+        smoothed = self.locations.copy()
+        smoothed[slab] = self.locations[slab] * self_weight + \
+                neighbor_average[slab] * (1.0 - self_weight)
+        return smoothed
+
+
+class ArrayTree():
+    """A single tree, stored as arrays of node IDs and parent indices with the
+    children of each node in compressed sparse row (CSR) form: the indices of
+    the children of node i are child_nodes[child_offsets[i]:child_offsets[i+1]].
+    Children and depth are computed when first needed. The operations mirror
+    the ones in tree_util, which accepts instances of this class in place of a
+    networkx DiGraph. Public methods take and return node IDs, nodes are
+    addressed by index internally.
+    """
+
+    __slots__ = ('node_ids', 'parents', 'root', '_index', '_child_offsets',
+            '_child_nodes', '_depth', '_jumps')
+
+    def __init__(self, node_ids, parent_ids):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.parents = parent_indices(self.node_ids, parent_ids)
+        roots = np.flatnonzero(self.parents < 0)
+        if len(self) and 1 != len(roots):
+            raise ValueError("A tree needs exactly one root node, found %s" % len(roots))
+        self.root = int(roots[0]) if len(self) else -1
+        self._index:Optional[Dict[int, int]] = None
+        self._reset()
+
+    @classmethod
+    def from_rows(cls, rows:Sequence[Sequence]) -> "ArrayTree":
+        """Create a tree from (id, parent_id) rows."""
+        n_nodes = len(rows)
+        return cls(np.fromiter((row[0] for row in rows), np.int64, n_nodes),
+                np.fromiter((-1 if row[1] is None else row[1] for row in rows),
+                        np.int64, n_nodes))
+
+    @classmethod
+    def from_digraph(cls, tree:DiGraph) -> "ArrayTree":
+        """Create a tree from a networkx DiGraph with edges from parent to
+        child, the convention of tree_util.
+        """
+        node_ids = list(tree)
+        parents = {child: parent for parent, child in tree.edges()}
+        return cls(node_ids, [parents.get(node_id) for node_id in node_ids])
+
+    def _reset(self) -> None:
+        """Forget everything that depends on the parents."""
+        self._child_offsets:Optional[np.ndarray] = None
+        self._child_nodes:Optional[np.ndarray] = None
+        self._depth:Optional[np.ndarray] = None
+        self._jumps:List[np.ndarray] = []
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def __contains__(self, node_id) -> bool:
+        try:
+            self._index_of(node_id)
+            return True
+        except KeyError:
+            return False
+
+    @property
+    def index(self) -> Dict[int, int]:
+        """A map of node ID vs node index, which is worth creating for many
+        individual lookups.
+        """
+        if self._index is None:
+            self._index = dict(zip(self.node_ids.tolist(), range(len(self))))
+        return self._index
+
+    def _index_of(self, node_id) -> int:
+        if self._index is not None:
+            return self._index[node_id]
+        found = np.flatnonzero(self.node_ids == node_id)
+        if not len(found):
+            raise KeyError(node_id)
+        return int(found[0])
+
+    def indices(self, node_ids:Iterable) -> np.ndarray:
+        """Return the indices of the passed in node IDs, which all have to be
+        part of the tree.
+        """
+        node_ids = np.fromiter(node_ids, dtype=np.int64)
+        if not len(self):
+            if len(node_ids):
+                raise KeyError(node_ids[0])
+            return node_ids
+        sorter = np.argsort(self.node_ids)
+        positions = np.searchsorted(self.node_ids, node_ids, sorter=sorter)
+        positions = sorter[np.minimum(positions, len(self) - 1)]
+        unknown = self.node_ids[positions] != node_ids
+        if unknown.any():
+            raise KeyError(node_ids[unknown][0])
+        return positions
+
+    @property
+    def root_id(self) -> Optional[int]:
+        return int(self.node_ids[self.root]) if len(self) else None
+
+    @property
+    def child_offsets(self) -> np.ndarray:
+        if self._child_offsets is None:
+            self._compute_children()
+        return self._child_offsets # type: ignore
+
+    @property
+    def child_nodes(self) -> np.ndarray:
+        if self._child_nodes is None:
+            self._compute_children()
+        return self._child_nodes # type: ignore
+
+    def _compute_children(self) -> None:
+        children = np.flatnonzero(self.parents >= 0)
+        child_parents = self.parents[children]
+        self._child_nodes = children[np.argsort(child_parents, kind='stable')]
+        self._child_offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(child_parents, minlength=len(self)),
+                out=self._child_offsets[1:])
+
+    @property
+    def n_children(self) -> np.ndarray:
+        if self._child_offsets is not None:
+            return np.diff(self._child_offsets)
+        has_parent = self.parents >= 0
+        return np.bincount(self.parents[has_parent], minlength=len(self))
+
+    @property
+    def depth(self) -> np.ndarray:
+        """The number of edges between each node and the root."""
+        if self._depth is None:
+            self._compute_depth()
+        return self._depth # type: ignore
+
+    def _compute_depth(self) -> None:
+        self._depth, self._jumps = _pointer_jumping(self.parents)
+
+    def parent(self, node_id) -> Optional[int]:
+        parent = self.parents[self.index[node_id]]
+        return None if parent < 0 else int(self.node_ids[parent])
+
+    def children(self, node_id) -> List[int]:
+        i = self.index[node_id]
+        children = self.child_nodes[self.child_offsets[i]:self.child_offsets[i + 1]]
+        return self.node_ids[children].tolist()
+
+    def end_nodes(self) -> List[int]:
+        return self.node_ids[self.n_children == 0].tolist()
+
+    def edges(self) -> List[Tuple[int, int]]:
+        """All (parent ID, child ID) pairs."""
+        children = np.flatnonzero(self.parents >= 0)
+        return list(zip(self.node_ids[self.parents[children]].tolist(),
+                self.node_ids[children].tolist()))
+
+    def path_to_root(self, node_indices) -> np.ndarray:
+        """Return a boolean mask of all nodes on the paths from the passed in
+        node indices to the root, including both.
+        """
+        if self._depth is None:
+            self._compute_depth()
+        return _path_to_root(self._jumps, len(self), node_indices)
+
+    def _ancestors_at(self, node_indices:np.ndarray, distances:np.ndarray) -> np.ndarray:
+        """Return the ancestors of the passed in nodes at the passed in number
+        of edges towards the root, which can't be larger than a node's depth.
+        """
+        if self._depth is None:
+            self._compute_depth()
+        ancestors = np.array(node_indices, dtype=np.int64)
+        for k, jump in enumerate(self._jumps):
+            take = ((distances >> k) & 1).astype(bool)
+            ancestors[take] = jump[ancestors[take]]
+        return ancestors
+
+    def _common_ancestor(self, node_indices:Sequence[int]) -> int:
+        depth = self.depth
+        jumps = self._jumps
+        ancestor = int(node_indices[0])
+        for other in node_indices[1:]:
+            a, b = ancestor, int(other)
+            if depth[a] < depth[b]:
+                a, b = b, a
+            a = int(self._ancestors_at(np.array([a]),
+                    np.array([depth[a] - depth[b]]))[0])
+            if a != b:
+                # Move both up as far as their ancestors differ
+                for jump in reversed(jumps):
+                    if jump[a] != jump[b]:
+                        a, b = jump[a], jump[b]
+                a = self.parents[a]
+            ancestor = int(a)
+        return ancestor
+
+    def edge_count_to_root(self, root_node=None) -> Dict[int, int]:
+        """Return a map of node ID vs the number of nodes on the path to the
+        root, the root itself has a count of one. If <root_node> isn't the
+        root, only the nodes downstream of it are counted.
+        """
+        if not len(self):
+            return {}
+        depth = self.depth
+        if root_node is None or self._index_of(root_node) == self.root:
+            nodes = np.arange(len(self))
+            counts = depth + 1
+        else:
+            nodes = self.downstream(root_node)
+            counts = depth[nodes] - depth[self._index_of(root_node)] + 1
+        return dict(zip(self.node_ids[nodes].tolist(), counts.tolist()))
+
+    def downstream(self, node_id) -> np.ndarray:
+        """Return the indices of the passed in node and all nodes downstream
+        of it.
+        """
+        root = self._index_of(node_id)
+        distances = self.depth - self.depth[root]
+        nodes = np.flatnonzero(distances >= 0)
+        return nodes[self._ancestors_at(nodes, distances[nodes]) == root]
+
+    def common_ancestor(self, node_ids:Sequence) -> Tuple[Any, int]:
+        """Return the nearest common ancestor of the passed in nodes and its
+        edge count to root, see edge_count_to_root().
+        """
+        if 1 == len(node_ids):
+            return node_ids[0], 0
+        ancestor = self._common_ancestor(self.indices(node_ids).tolist())
+        return int(self.node_ids[ancestor]), int(self.depth[ancestor]) + 1
+
+    def common_ancestors(self, node_groups:Iterable[Sequence]) -> Iterator[Tuple[Any, int]]:
+        return (self.common_ancestor(nodes) for nodes in node_groups)
+
+    def reroot(self, new_root) -> None:
+        """Reverse in place the direction of the edges from new_root to root."""
+        new_root = self._index_of(new_root)
+        if self.parents[new_root] < 0:
+            return
+        # From the new root to the old root
+        parents = self.parents
+        path = [new_root]
+        parent = parents[new_root]
+        while parent >= 0:
+            path.append(parent)
+            parent = parents[parent]
+        path_array = np.array(path, dtype=np.int64)
+        parents[path_array[1:]] = path_array[:-1]
+        parents[new_root] = -1
+        self.root = new_root
+        self._reset()
+
+    def partition(self) -> Iterator[List[int]]:
+        """Yield sequences of node IDs from each end node to either the root
+        or a branch node. End nodes are visited from highest to lowest edge
+        count to root, branch nodes end all but the first sequence passing
+        through them.
+        """
+        ends = np.flatnonzero(self.n_children == 0)
+        ends = ends[np.argsort(-self.depth[ends], kind='stable')]
+        parents = self.parents.tolist()
+        node_ids = self.node_ids.tolist()
+        seen = bytearray(len(self))
+        for end in ends.tolist():
+            sequence = [node_ids[end]]
+            parent = parents[end]
+            while parent != -1:
+                sequence.append(node_ids[parent])
+                if seen[parent]:
+                    break
+                seen[parent] = 1
+                parent = parents[parent]
+
+            if len(sequence) > 1:
+                yield sequence
+
+    def simplify(self, keepers) -> Graph:
+        """Create a new tree that only contains the nodes to keep and the
+        branch points between them. Like tree_util.simplify(), this reroots
+        the tree at the first of the keepers, which can't be empty.
+        """
+        keepers = set(keepers)
+        mini = Graph()
+        mini.add_nodes_from(keepers)
+        root = keepers.pop()
+        self.reroot(root)
+
+        node_ids = self.node_ids.tolist()
+        parents = self.parents.tolist()
+        n_children = self.n_children.tolist()
+        in_mini = bytearray(len(self))
+        for i in self.indices(mini).tolist():
+            in_mini[i] = 1
+
+        # For every keeper node, traverse towards the root until finding a
+        # node in the minified tree. Branch nodes on the way are kept if more
+        # than one path reaches them.
+        paths_per_node = [0] * len(self)
+        seen_branch_nodes = bytearray(len(self))
+        paths = []
+        for node in self.indices(keepers).tolist():
+            path = [node]
+            paths.append(path)
+            parent = parents[node]
+            while parent != -1:
+                if in_mini[parent]:
+                    path.append(parent)
+                    break
+                elif n_children[parent] > 1:
+                    paths_per_node[parent] += 1
+                    path.append(parent)
+                    if seen_branch_nodes[parent]:
+                        break
+                    seen_branch_nodes[parent] = 1
+                parent = parents[parent]
+        for path in paths:
+            origin = path[0]
+            for node in path[1:-1]:
+                if paths_per_node[node] > 1:
+                    mini.add_edge(node_ids[origin], node_ids[node])
+                    origin = node
+            mini.add_edge(node_ids[origin], node_ids[path[-1]])
+
+        return mini
+
+    def spanning_tree(self, preserve) -> DiGraph:
+        """Return a new DiGraph with the smallest subtree that contains all
+        nodes to preserve, with edges from parent to child.
+        """
+        preserve = set(preserve)
+        spanning = DiGraph()
+        if 1 == len(preserve):
+            spanning.add_node(next(iter(preserve)))
+            return spanning
+        if not preserve:
+            return spanning
+
+        indices = self.indices(preserve)
+        ancestor = self._common_ancestor(indices.tolist())
+        in_spanning = self.path_to_root(indices)
+        if self.parents[ancestor] >= 0:
+            in_spanning &= ~self.path_to_root([self.parents[ancestor]])
+        nodes = np.flatnonzero(in_spanning)
+        spanning.add_nodes_from(self.node_ids[nodes].tolist())
+        children = nodes[nodes != ancestor]
+        spanning.add_edges_from(zip(self.node_ids[self.parents[children]].tolist(),
+                self.node_ids[children].tolist()))
+        return spanning
+
+
+def segment_lengths(start_locations, end_locations) -> np.ndarray:
+    """Return the lengths of the segments between pairs of locations."""
+    start = np.asarray(start_locations, dtype=np.float64)
+    end = np.asarray(end_locations, dtype=np.float64)
+    if not start.size:
+        return np.zeros(0)
+    return np.linalg.norm(end - start, axis=-1)
+
+
+def parent_indices(node_ids:np.ndarray, parent_ids) -> np.ndarray:
+    """Map parent IDs to indices into <node_ids>. Parent IDs that are None, -1
+    or not in <node_ids> are mapped to -1.
+    """
+    if not isinstance(parent_ids, np.ndarray):
+        parent_ids = [-1 if p is None else p for p in parent_ids]
+    parent_ids = np.asarray(parent_ids, dtype=np.int64)
+    n_nodes = len(node_ids)
+    parents = np.full(n_nodes, -1, dtype=np.int64)
+    if n_nodes:
+        sorter = np.argsort(node_ids)
+        positions = np.searchsorted(node_ids, parent_ids, sorter=sorter)
+        positions = sorter[np.minimum(positions, n_nodes - 1)]
+        known = (parent_ids != -1) & (node_ids[positions] == parent_ids)
+        parents[known] = positions[known]
+    return parents
+
+
+def _pointer_jumping(parents:np.ndarray) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """Return the depth of each node and the ancestor arrays for distances of
+    1, 2, 4, ... edges, -1 where there is no such ancestor.
+    """
+    # In each iteration, every node adds the distance of its current ancestor
+    # and moves on to that ancestor's ancestor. This needs log2(max depth)
+    # iterations.
+    ancestors = parents.copy()
+    depth = (ancestors >= 0).astype(np.int64)
+    jumps = []
+    while True:
+        active = np.flatnonzero(ancestors >= 0)
+        if not len(active):
+            break
+        if len(jumps) > 63:
+            raise ValueError("The skeleton contains a cycle")
+        jumps.append(ancestors.copy())
+        next_ancestors = ancestors[active]
+        depth[active] += depth[next_ancestors]
+        ancestors[active] = ancestors[next_ancestors]
+    return depth, jumps
+
+
+def _path_to_root(jumps:List[np.ndarray], n_nodes:int, node_indices) -> np.ndarray:
+    mask = np.zeros(n_nodes, dtype=bool)
+    current = np.unique(np.asarray(node_indices, dtype=np.int64))
+    mask[current] = True
+    # Ancestors at distances [0, 2^k) are extended by the ones at
+    # [2^k, 2^(k+1)) in each step. Only ancestors that aren't marked yet are
+    # added, which keeps shared ancestors from multiplying. Nodes without an
+    # ancestor at distance 2^k won't find new ones in later steps either.
+    for jump in jumps:
+        ancestors = jump[current]
+        has_ancestor = ancestors >= 0
+        current = current[has_ancestor]
+        ancestors = np.unique(ancestors[has_ancestor])
+        ancestors = ancestors[~mask[ancestors]]
+        # If all ancestors are marked already, later steps can't add any new
+        # ones, because they are composed of the jumps of this step.
+        if not len(ancestors):
+            break
+        mask[ancestors] = True
+        current = np.concatenate((current, ancestors))
+    return mask
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""A per-object cache of dotprops for the NumPy NBLAST backend. The dotprops of
+each object are stored in their own .npy file with one row per point (x, y, z,
+tangent x, y, z, alpha), which is memory mapped when loaded. File names contain
+the edition time of the object (and a digest of the soma tags of skeletons),
+which makes it possible to recompute only objects that changed since they were
+cached. Files are stored in
+
+    MEDIA_ROOT/<MEDIA_CACHE_SUBDIRECTORY>/nblast-dotprops/project-<project-id>/<variant>/<object-id>-<edition-stamp>.npy
+
+where the variant encodes the object type and all parameters the dotprops
+depend on, e.g. "skeleton-k5-resample1-simple10".
+"""
+
+import glob
+import logging
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from django.conf import settings
+from django.db import connection
+
+from catmaid.control.common import batches
+from catmaid.control.nat.nblast import SOMA_TAG_PATTERN, Dotprops, get_dotprops
+
+
+logger = logging.getLogger(__name__)
+
+# The tables that contain the edition time of each cacheable object type
+EDITION_TIME_QUERIES = {
+    # Skeletons are rerooted at their soma, which doesn't change their edition
+    # time. Their stamp therefore also contains a digest of their soma tags.
+    'skeleton': """
+        WITH soma_tag AS (
+            SELECT t.skeleton_id, left(md5(string_agg(t.id || ':' || ci.name,
+                ',' ORDER BY t.id, ci.name)), 12) AS digest
+            FROM treenode_class_instance tci
+            JOIN relation r
+                ON r.id = tci.relation_id
+            JOIN class_instance ci
+                ON ci.id = tci.class_instance_id
+            JOIN treenode t
+                ON t.id = tci.treenode_id
+            WHERE tci.project_id = %(project_id)s
+            AND r.relation_name = 'labeled_as'
+            AND ci.name ~* %(soma_tag_pattern)s
+            AND t.skeleton_id = ANY(%(object_ids)s::bigint[])
+            GROUP BY t.skeleton_id
+        )
+        SELECT css.skeleton_id,
+            (EXTRACT(EPOCH FROM css.last_edition_time) * 1000000)::bigint::text
+                || COALESCE('-' || st.digest, '')
+        FROM catmaid_skeleton_summary css
+        LEFT JOIN soma_tag st
+            ON st.skeleton_id = css.skeleton_id
+        WHERE css.project_id = %(project_id)s
+        AND css.skeleton_id = ANY(%(object_ids)s::bigint[])
+    """,
+    'pointcloud': """
+        SELECT id, (EXTRACT(EPOCH FROM edition_time) * 1000000)::bigint::text
+        FROM pointcloud
+        WHERE project_id = %(project_id)s
+        AND id = ANY(%(object_ids)s::bigint[])
+    """,
+    'pointset': """
+        SELECT id, (EXTRACT(EPOCH FROM edition_time) * 1000000)::bigint::text
+        FROM point_set
+        WHERE project_id = %(project_id)s
+        AND id = ANY(%(object_ids)s::bigint[])
+    """,
+}
+
+
+def get_cache_root() -> str:
+    return os.path.join(settings.MEDIA_ROOT, settings.MEDIA_CACHE_SUBDIRECTORY,
+            'nblast-dotprops')
+
+
+class DotpropsCache:
+    """Store and load the dotprops of individual objects of one type, computed
+    with one set of parameters. Only skeletons are resampled and simplified,
+    <resample_step> (in µm) and <n_branches> are ignored for other types.
+    """
+
+    def __init__(self, project_id, object_type:str, k:int,
+            resample_step:Optional[float]=None,
+            n_branches:Optional[int]=None) -> None:
+        if object_type not in EDITION_TIME_QUERIES:
+            raise ValueError(f"Unsupported object type: {object_type}")
+        self.project_id = int(project_id)
+        self.object_type = object_type
+        variant = f'{object_type}-k{k}'
+        if object_type == 'skeleton':
+            variant += f'-resample{resample_step:g}' if resample_step else '-original'
+            variant += f'-simple{n_branches}' if n_branches is not None else '-full'
+        self.path = os.path.join(get_cache_root(), f'project-{self.project_id}',
+                variant)
+
+    def get_edition_stamps(self, object_ids:Sequence[int]) -> Dict[int, str]:
+        """Get the last edition time of each object in microseconds, followed
+        by a digest of their soma tags for skeletons. Objects without a known
+        edition time are missing in the result.
+        """
+        cursor = connection.cursor()
+        cursor.execute(EDITION_TIME_QUERIES[self.object_type], {
+            'project_id': self.project_id,
+            'object_ids': list(object_ids),
+            'soma_tag_pattern': SOMA_TAG_PATTERN,
+        })
+        return dict(cursor.fetchall())
+
+    def file_name(self, object_id, stamp) -> str:
+        return os.path.join(self.path, f'{object_id}-{stamp}.npy')
+
+    def load(self, object_ids:Sequence[int],
+            stamps:Optional[Dict[int, str]]=None) -> Dict[int, Dotprops]:
+        """Return the memory mapped dotprops of all passed in objects that
+        are cached for their current edition time.
+        """
+        if stamps is None:
+            stamps = self.get_edition_stamps(object_ids)
+        cached = {}
+        for object_id in object_ids:
+            stamp = stamps.get(object_id)
+            if stamp is None:
+                continue
+            try:
+                data = np.load(self.file_name(object_id, stamp), mmap_mode='r')
+            except (IOError, ValueError):
+                continue
+            cached[object_id] = Dotprops(data[:, 0:3], data[:, 3:6], data[:, 6])
+        return cached
+
+    def store(self, object_id, stamp, dps:Dotprops) -> None:
+        """Write the dotprops of an object and remove files of older editions.
+        Files are written under a temporary name first, so that readers never
+        see partial files.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        file_name = self.file_name(object_id, stamp)
+        tmp_file_name = f'{file_name}.{os.getpid()}.tmp'
+        data = np.column_stack((dps.points, dps.vect, dps.alpha))
+        with open(tmp_file_name, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp_file_name, file_name)
+        for old_file_name in glob.glob(os.path.join(self.path, f'{object_id}-*.npy')):
+            if old_file_name != file_name:
+                os.remove(old_file_name)
+
+    def store_all(self, dotprops:Iterable[Tuple[int, Dotprops]],
+            stamps:Dict[int, str]) -> int:
+        """Store the dotprops of all passed in objects that have an edition
+        time. Failures to write are logged rather than raised, because a cache
+        that can't be written shouldn't fail the computation that uses it.
+        Returns the number of stored objects.
+        """
+        n_stored = 0
+        for object_id, dps in dotprops:
+            stamp = stamps.get(object_id)
+            if stamp is None:
+                continue
+            try:
+                self.store(object_id, stamp, dps)
+                n_stored += 1
+            except OSError as e:
+                logger.warning(f'Could not write dotprops cache file for '
+                        f'{self.object_type} {object_id}: {e}')
+                break
+        return n_stored
+
+    def cached_object_ids(self) -> List[int]:
+        """Return the IDs of all objects with a cache file, regardless of its
+        edition time.
+        """
+        object_ids = set()
+        for file_name in glob.glob(os.path.join(self.path, '*-*.npy')):
+            object_id, _ = os.path.basename(file_name).split('-', 1)
+            object_ids.add(int(object_id))
+        return sorted(object_ids)
+
+    def remove(self, object_ids:Iterable[int]) -> None:
+        for object_id in object_ids:
+            for file_name in glob.glob(os.path.join(self.path, f'{object_id}-*.npy')):
+                os.remove(file_name)
+
+
+def update_cache(project_id, object_type:str, object_ids:Sequence[int], k:int,
+        resample_step:Optional[float]=None, n_branches:Optional[int]=None,
+        clean:bool=False, batch_size:int=1000, workers:int=1,
+        progress:Optional[Callable[[int, int], None]]=None) -> Dict[str, int]:
+    """Compute and store dotprops for all passed in objects that aren't cached
+    for their current edition time, in batches of <batch_size> objects. With
+    <clean>, cache files of objects that aren't passed in are removed. The
+    optional progress callback is called with the number of processed and the
+    total number of objects after each batch. Returns the number of up-to-date,
+    updated, failed and removed objects.
+    """
+    cache = DotpropsCache(project_id, object_type, k, resample_step, n_branches)
+    result = {'current': 0, 'updated': 0, 'failed': 0, 'removed': 0}
+
+    if clean:
+        valid_ids = set(object_ids)
+        stale_ids = [object_id for object_id in cache.cached_object_ids()
+                if object_id not in valid_ids]
+        cache.remove(stale_ids)
+        result['removed'] = len(stale_ids)
+
+    n_done = 0
+    for batch in batches(object_ids, batch_size):
+        stamps = cache.get_edition_stamps(batch)
+        cached = cache.load(batch, stamps)
+        result['current'] += len(cached)
+        missing = [object_id for object_id in batch
+                if object_id not in cached and object_id in stamps]
+        result['failed'] += len(batch) - len(cached) - len(missing)
+        if missing:
+            ids_in_use, dps = get_dotprops(project_id, missing, object_type, k,
+                    resample_step, n_branches, omit_failures=True,
+                    workers=workers)
+            result['updated'] += cache.store_all(zip(ids_in_use, dps), stamps)
+            result['failed'] += len(missing) - len(ids_in_use)
+        n_done += len(batch)
+        if progress:
+            progress(n_done, len(object_ids))
+
+    return result
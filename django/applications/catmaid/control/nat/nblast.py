@@ -0,0 +1,879 @@
+# -*- coding: utf-8 -*-
+"""A NumPy/SciPy implementation of NBLAST, which can be used instead of the R
+based implementation in catmaid.control.nat.r. It is modeled after the nat and
+nat.nblast R packages, but hasn't been validated against them: objects are
+converted to µm, skeletons are optionally simplified to their main branches
+(like elmr's simplify_neuron) and resampled, and each point gets a tangent
+vector and a collinearity measure (alpha) from its nearest neighbors (like
+nat's dotprops). Scores are looked up in a scoring matrix, indexed by the
+nearest neighbor distance and the absolute dot product of tangent vectors, and
+summed up per query object. Results may differ from those of the R backend.
+
+Nothing in here requires R, which makes it possible to run NBLAST on workers
+without an R installation. Work on individual objects and on chunks of query
+objects is distributed over MAX_PARALLEL_ASYNC_WORKERS processes.
+"""
+
+from concurrent import futures
+from functools import partial
+import logging
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+        Sequence, Tuple)
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from django.conf import settings
+from django.db import connection
+
+from catmaid.control import pointcloud
+from catmaid.control.common import batches
+from catmaid.control.morphology import parent_indices
+from catmaid.models import (NblastConfig, NblastConfigDefaultDistanceBreaks,
+        NblastConfigDefaultDotBreaks, PointSet)
+
+
+logger = logging.getLogger(__name__)
+
+# NAT works mostly in um space and CATMAID in nm.
+nm_to_um = 1e-3
+
+# The number of skeletons loaded with a single query
+DEFAULT_BATCH_SIZE = 500
+
+# Skeletons are rerooted at a node with a tag matching this pattern (ignoring
+# case), if there is one.
+SOMA_TAG_PATTERN = '(cell body|soma)'
+
+
+class NoValidObjectsError(Exception):
+    """Raised by both NBLAST backends if none of the query or none of the
+    target objects can be used for a computation.
+    """
+
+
+class Dotprops:
+    """Points in µm with a unit tangent vector and a measure of local
+    collinearity (alpha, between 0 and 1) for each point.
+    """
+    __slots__ = ('points', 'vect', 'alpha', '_tree')
+
+    def __init__(self, points:np.ndarray, vect:np.ndarray, alpha:np.ndarray) -> None:
+        self.points = points
+        self.vect = vect
+        self.alpha = alpha
+        self._tree:Optional[cKDTree] = None
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def __getstate__(self):
+        # The KD-tree is rebuilt on demand rather than pickled.
+        return self.points, self.vect, self.alpha
+
+    def __setstate__(self, state) -> None:
+        self.points, self.vect, self.alpha = state
+        self._tree = None
+
+    @property
+    def tree(self) -> cKDTree:
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+
+def dotprops(points, k:int=20) -> Dotprops:
+    """Compute the tangent vector and alpha value for each point from the
+    principal components of its <k> nearest neighbors, including the point
+    itself. Alpha is (l1 - l2) / (l1 + l2 + l3) for the eigenvalues l1 >= l2 >=
+    l3 and the tangent vector is the eigenvector of l1.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    n_points = len(points)
+    if n_points < k:
+        raise ValueError(f"Too few points to compute tangent vectors: need {k}, found {n_points}")
+
+    _, neighbors = cKDTree(points).query(points, k=k)
+    neighborhoods = points[neighbors.reshape(n_points, k)]
+    centered = neighborhoods - neighborhoods.mean(axis=1, keepdims=True)
+    inertia = np.einsum('nki,nkj->nij', centered, centered) / k
+
+    # Eigenvalues are returned in ascending order
+    values, vectors = np.linalg.eigh(inertia)
+    total = values.sum(axis=1)
+    alpha = np.zeros(n_points)
+    spread = total > 0
+    alpha[spread] = (values[spread, 2] - values[spread, 1]) / total[spread]
+
+    return Dotprops(points, vectors[:, :, 2].copy(), alpha)
+
+
+def _edge_lengths(parents:np.ndarray, locations:np.ndarray) -> np.ndarray:
+    lengths = np.zeros(len(parents))
+    children = np.flatnonzero(parents >= 0)
+    lengths[children] = np.linalg.norm(locations[children] -
+            locations[parents[children]], axis=1)
+    return lengths
+
+
+def resample_arbor(parents:np.ndarray, locations:np.ndarray, step:float) -> np.ndarray:
+    """Return the points of an arbor resampled to a spacing of <step> along
+    each segment. Like nat's resample, roots, branch nodes and leaves are kept
+    and all other nodes are replaced with points interpolated at multiples of
+    <step> from the segment start.
+    """
+    n_nodes = len(parents)
+    has_parent = parents >= 0
+    n_children = np.bincount(parents[has_parent], minlength=n_nodes)
+    starts_segment = ~has_parent | (n_children > 1)
+    ends_segment = n_children != 1
+    lengths = _edge_lengths(parents, locations)
+
+    # The cable distance of each node to the start of its segment, using
+    # pointer jumping in a forest that is cut at segment starts.
+    ancestors = np.where(has_parent, parents, -1)
+    ancestors[has_parent & starts_segment[np.maximum(parents, 0)]] = -1
+    distances = lengths.copy()
+    while True:
+        active = np.flatnonzero(ancestors >= 0)
+        if not len(active):
+            break
+        next_ancestors = ancestors[active]
+        distances[active] += distances[next_ancestors]
+        ancestors[active] = ancestors[next_ancestors]
+
+    # Each edge (parent, child) covers the segment distances [d0, d1]. Samples
+    # are placed at multiples of step in (d0, d1], or (d0, d1) if the child
+    # ends a segment, because it is kept anyway.
+    children = np.flatnonzero(has_parent)
+    edge_parents = parents[children]
+    d0 = np.where(starts_segment[edge_parents], 0.0, distances[edge_parents])
+    d1 = distances[children]
+    first = np.floor(d0 / step).astype(np.int64) + 1
+    last = np.where(ends_segment[children],
+            np.ceil(d1 / step).astype(np.int64) - 1,
+            np.floor(d1 / step).astype(np.int64))
+    counts = np.maximum(last - first + 1, 0)
+
+    edge_index = np.repeat(np.arange(len(children)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = (first[edge_index] + offsets) * step
+    extent = d1 - d0
+    t = (positions - d0[edge_index]) / extent[edge_index]
+    start = locations[edge_parents[edge_index]]
+    end = locations[children[edge_index]]
+    samples = start + t[:, np.newaxis] * (end - start)
+
+    return np.concatenate((locations[starts_segment | ends_segment], samples))
+
+
+def reroot_arbor(parents:np.ndarray, new_root:int) -> np.ndarray:
+    """Return the parent indices of an arbor after making the node with index
+    <new_root> its root, which reverses the path from it to the old root.
+    """
+    parents = parents.copy()
+    node, parent = new_root, parents[new_root]
+    parents[new_root] = -1
+    while parent >= 0:
+        next_parent = parents[parent]
+        parents[parent] = node
+        node, parent = parent, next_parent
+    return parents
+
+
+def find_soma(parents:np.ndarray, candidates:Sequence[int]) -> Optional[int]:
+    """Pick the soma among the indices of the nodes with a soma tag, like the
+    R backend: if only one of them is a root, it is used, otherwise the first
+    one. Returns None without candidates.
+    """
+    if not len(candidates):
+        return None
+    roots = [index for index in candidates if parents[index] < 0]
+    return roots[0] if len(roots) == 1 else candidates[0]
+
+
+def simplify_arbor(parents:np.ndarray, locations:np.ndarray,
+        n_branches:int) -> Tuple[np.ndarray, np.ndarray]:
+    """Reduce an arbor to its longest path and up to <n_branches> branches,
+    like elmr's simplify_neuron. Branches are added greedily, each time with
+    the path to the leaf farthest away from the already kept arbor. Returns
+    the parent indices and locations of the kept nodes.
+    """
+    n_nodes = len(parents)
+    children = np.flatnonzero(parents >= 0)
+    if not len(children):
+        return parents, locations
+
+    # Zero length edges would be treated as missing edges.
+    lengths = np.maximum(_edge_lengths(parents, locations)[children], 1e-9)
+    graph = csr_matrix((lengths, (children, parents[children])),
+            shape=(n_nodes, n_nodes))
+
+    kept = np.zeros(n_nodes, dtype=bool)
+
+    def keep_path(predecessors, node):
+        while node >= 0 and not kept[node]:
+            kept[node] = True
+            node = predecessors[node]
+
+    root = np.flatnonzero(parents < 0)[0]
+    distances = dijkstra(graph, directed=False, indices=root)
+    distances[~np.isfinite(distances)] = -1
+    first_end = int(np.argmax(distances))
+    distances, predecessors = dijkstra(graph, directed=False,
+            indices=first_end, return_predecessors=True)
+    distances[~np.isfinite(distances)] = -1
+    keep_path(predecessors, int(np.argmax(distances)))
+
+    for _ in range(n_branches):
+        distances, predecessors, _ = dijkstra(graph, directed=False,
+                indices=np.flatnonzero(kept), min_only=True,
+                return_predecessors=True)
+        distances[~np.isfinite(distances)] = 0
+        farthest = int(np.argmax(distances))
+        if distances[farthest] == 0:
+            break
+        keep_path(predecessors, farthest)
+
+    new_index = np.cumsum(kept) - 1
+    kept_parents = parents[kept]
+    connected = kept_parents >= 0
+    connected[connected] = kept[kept_parents[connected]]
+    new_parents = np.where(connected, new_index[np.maximum(kept_parents, 0)], -1)
+    return new_parents, locations[kept]
+
+
+def arbor_dotprops(parents:np.ndarray, locations:np.ndarray, k:int=20,
+        resample_step:Optional[float]=None,
+        n_branches:Optional[int]=None) -> Dotprops:
+    """Compute dotprops for an arbor with locations in µm, optionally after
+    simplifying it to <n_branches> branches and resampling it. This has to be
+    a module level function to be usable in worker processes.
+    """
+    if len(parents) < 2:
+        raise ValueError("Skeletons need at least two nodes")
+    if n_branches is not None:
+        parents, locations = simplify_arbor(parents, locations, n_branches)
+    points = resample_arbor(parents, locations, resample_step) \
+            if resample_step else locations
+    return dotprops(points, k)
+
+
+def _call_or_error(fn:Callable, *args) -> Any:
+    try:
+        return fn(*args)
+    except ValueError as e:
+        return e
+
+
+def map_objects(fn:Callable, items:Sequence, workers:int=1) -> List:
+    """Call fn(*item) for each item and return the results in order, with
+    ValueErrors returned rather than raised. The calls are distributed over a
+    process pool if there is more than one worker.
+    """
+    workers = min(workers, len(items))
+    if workers < 2:
+        return [_call_or_error(fn, *item) for item in items]
+    with futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(partial(_call_or_error, fn), *zip(*items),
+                chunksize=max(1, len(items) // (4 * workers))))
+
+
+def get_skeleton_arbors(project_id, skeleton_ids:Sequence[int],
+        batch_size:int=DEFAULT_BATCH_SIZE) -> Iterable[Tuple[int, np.ndarray, np.ndarray]]:
+    """Yield (skeleton ID, parent indices, locations in µm) for each passed in
+    skeleton, loading the treenodes of <batch_size> skeletons at a time. Like
+    in the R backend, skeletons are rerooted at their soma, a node tagged with
+    "soma" or, if there is none, with a tag that contains "soma" or "cell
+    body" (ignoring case).
+    """
+    cursor = connection.cursor()
+    for batch in batches(skeleton_ids, batch_size):
+        cursor.execute("""
+            SELECT t.skeleton_id, t.id, ci.name = 'soma'
+            FROM treenode_class_instance tci
+            JOIN relation r
+                ON r.id = tci.relation_id
+            JOIN class_instance ci
+                ON ci.id = tci.class_instance_id
+            JOIN treenode t
+                ON t.id = tci.treenode_id
+            WHERE tci.project_id = %(project_id)s
+            AND r.relation_name = 'labeled_as'
+            AND ci.name ~* %(soma_tag_pattern)s
+            AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            ORDER BY t.id
+        """, {
+            'project_id': project_id,
+            'skeleton_ids': batch,
+            'soma_tag_pattern': SOMA_TAG_PATTERN,
+        })
+        soma_tagged:Dict[int, List[Tuple[int, bool]]] = {}
+        for skeleton_id, node_id, is_soma in cursor.fetchall():
+            soma_tagged.setdefault(skeleton_id, []).append((node_id, is_soma))
+
+        cursor.execute("""
+            SELECT t.skeleton_id, t.id, COALESCE(t.parent_id, -1),
+                t.location_x, t.location_y, t.location_z
+            FROM treenode t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON skeleton.id = t.skeleton_id
+            WHERE t.project_id = %(project_id)s
+            ORDER BY t.skeleton_id
+        """, {
+            'project_id': project_id,
+            'skeleton_ids': batch,
+        })
+        rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 6)
+        skeleton_column = rows[:, 0].astype(np.int64)
+        for skeleton_id in batch:
+            start = np.searchsorted(skeleton_column, skeleton_id, 'left')
+            end = np.searchsorted(skeleton_column, skeleton_id, 'right')
+            node_ids = rows[start:end, 1].astype(np.int64)
+            parents = parent_indices(node_ids, rows[start:end, 2].astype(np.int64))
+            tagged = soma_tagged.get(skeleton_id)
+            if tagged:
+                # Nodes tagged "soma" take precedence over other soma tags.
+                if any(is_soma for _, is_soma in tagged):
+                    tagged = [t for t in tagged if t[1]]
+                candidates = np.flatnonzero(np.isin(node_ids,
+                        [node_id for node_id, _ in tagged]))
+                candidates = candidates[np.argsort(node_ids[candidates])]
+                soma = find_soma(parents, candidates.tolist())
+                if soma is not None:
+                    parents = reroot_arbor(parents, soma)
+            yield skeleton_id, parents, rows[start:end, 3:6] * nm_to_um
+
+
+def get_pointcloud_points(project_id, pointcloud_ids:Sequence[int]) -> Dict[int, np.ndarray]:
+    """Get the points of each point cloud in µm."""
+    points = pointcloud.get_pointcloud_points(project_id, pointcloud_ids)
+    return {pointcloud_id: p * nm_to_um for pointcloud_id, p in points.items()}
+
+
+def get_pointset_points(project_id, pointset_ids:Sequence[int]) -> Dict[int, np.ndarray]:
+    """Get the points of each point set in µm."""
+    pointsets = dict(PointSet.objects.filter(project_id=project_id,
+            id__in=pointset_ids).values_list('id', 'points'))
+    missing = set(pointset_ids) - set(pointsets.keys())
+    if missing:
+        raise ValueError(f"Could not find point sets: {', '.join(map(str, sorted(missing)))}")
+    return {pointset_id: np.array(pointsets[pointset_id], dtype=np.float64).reshape(-1, 3) * nm_to_um
+            for pointset_id in pointset_ids}
+
+
+def get_dotprops(project_id, object_ids:Sequence[int], object_type:str='skeleton',
+        k:int=20, resample_step:Optional[float]=None,
+        n_branches:Optional[int]=None, omit_failures:bool=True,
+        workers:int=1, use_cache:bool=False) -> Tuple[List[int], List[Dotprops]]:
+    """Load objects of the passed in type and compute their dotprops.
+    Skeletons are resampled to <resample_step> µm and simplified to
+    <n_branches> branches if requested, point clouds and point sets are used
+    as they are. Returns the IDs of the objects that could be processed and
+    their dotprops. Objects that can't be processed are skipped if
+    <omit_failures> is set, otherwise a ValueError is raised. With
+    <use_cache>, dotprops of objects that didn't change since they were cached
+    are loaded from the dotprops cache and all others are added to it.
+    """
+    object_ids = list(object_ids)
+    cached:Dict[int, Dotprops] = {}
+    if use_cache:
+        # A circular dependency would be the result of a top level import
+        from catmaid.control.nat.dotprops_cache import DotpropsCache
+        cache = DotpropsCache(project_id, object_type, k, resample_step,
+                n_branches)
+        stamps = cache.get_edition_stamps(object_ids)
+        cached = cache.load(object_ids, stamps)
+        logger.debug(f'Found {len(cached)} of {len(object_ids)} {object_type} dotprops in cache')
+    missing_ids = [object_id for object_id in object_ids if object_id not in cached]
+
+    if not missing_ids:
+        items:List[Tuple] = []
+    elif object_type == 'skeleton':
+        fn:Callable = partial(arbor_dotprops, k=k, resample_step=resample_step,
+                n_branches=n_branches)
+        items = [(parents, locations) for _, parents, locations in
+                get_skeleton_arbors(project_id, missing_ids)]
+    elif object_type in ('pointcloud', 'pointset'):
+        fn = partial(dotprops, k=k)
+        if object_type == 'pointcloud':
+            points = get_pointcloud_points(project_id, missing_ids)
+        else:
+            points = get_pointset_points(project_id, missing_ids)
+        items = [(points[object_id],) for object_id in missing_ids]
+    else:
+        raise ValueError(f"Unknown object type: {object_type}")
+
+    computed = {}
+    results = map_objects(fn, items, workers) if items else []
+    for object_id, result in zip(missing_ids, results):
+        if isinstance(result, ValueError):
+            error = f"Could not compute dotprops for {object_type} {object_id}: {result}"
+            if not omit_failures:
+                raise ValueError(error)
+            logger.debug(error)
+        else:
+            computed[object_id] = result
+
+    if use_cache and computed:
+        cache.store_all(computed.items(), stamps)
+
+    ids_in_use, dps = [], []
+    for object_id in object_ids:
+        object_dps = cached.get(object_id, computed.get(object_id))
+        if object_dps is not None:
+            ids_in_use.append(object_id)
+            dps.append(object_dps)
+
+    return ids_in_use, dps
+
+
+def find_bins(values:np.ndarray, breaks:np.ndarray) -> np.ndarray:
+    """Find the bin of each value, values outside of the breaks are put into
+    the first or last bin (like R's findInterval with all.inside=TRUE).
+    """
+    return np.clip(np.searchsorted(breaks, values, 'right') - 1, 0,
+            len(breaks) - 2)
+
+
+def dists_dotprods(query:Dotprops, target:Dotprops,
+        use_alpha:bool=False) -> Tuple[np.ndarray, np.ndarray]:
+    """For each query point, return the distance to the nearest target point
+    and the absolute dot product of both tangent vectors, optionally weighted
+    by the geometric mean of both alpha values.
+    """
+    distances, nearest = target.tree.query(query.points)
+    # Rounding errors can make dot products of unit vectors exceed 1.
+    dots = np.minimum(np.abs(np.einsum('ij,ij->i', query.vect,
+            target.vect[nearest])), 1.0)
+    if use_alpha:
+        dots *= np.sqrt(query.alpha * target.alpha[nearest])
+    return distances, dots
+
+
+class NblastScorer:
+    """Score pairs of dotprops with a scoring matrix, which has one row per
+    distance bin and one column per dot product bin.
+    """
+    def __init__(self, scoring, distance_breaks, dot_breaks,
+            use_alpha:bool=False) -> None:
+        self.scoring = np.asarray(scoring, dtype=np.float64)
+        self.distance_breaks = np.asarray(distance_breaks, dtype=np.float64)
+        self.dot_breaks = np.asarray(dot_breaks, dtype=np.float64)
+        self.use_alpha = use_alpha
+        expected_shape = (len(self.distance_breaks) - 1, len(self.dot_breaks) - 1)
+        if self.scoring.shape != expected_shape:
+            raise ValueError(f"Expected a scoring matrix of shape {expected_shape}, "
+                    f"found {self.scoring.shape}")
+
+    @staticmethod
+    def from_config(config:NblastConfig, use_alpha:bool=False) -> 'NblastScorer':
+        return NblastScorer(config.scoring, config.distance_breaks,
+                config.dot_breaks, use_alpha)
+
+    def score(self, query:Dotprops, target:Dotprops) -> float:
+        distances, dots = dists_dotprods(query, target, self.use_alpha)
+        return float(self.scoring[find_bins(distances, self.distance_breaks),
+                find_bins(dots, self.dot_breaks)].sum())
+
+    def self_score(self, dps:Dotprops) -> float:
+        return self.score(dps, dps)
+
+
+# Objects shared by the scoring functions of all processes. They are set
+# before a process pool is created and are inherited by forked workers, which
+# avoids sending all dotprops along with each chunk of work.
+_shared:Dict[str, Any] = {}
+
+
+def _score_chunk(query_indices:Sequence[int], forward:bool, backward:bool,
+        normalized:bool) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    """Compute forward scores (query to target) and backward scores (target to
+    query) of the passed in queries against all targets, normalized by the
+    self-score of the respective query object if requested.
+    """
+    scorer:NblastScorer = _shared['scorer']
+    queries:List[Dotprops] = _shared['queries']
+    targets:List[Dotprops] = _shared['targets']
+
+    n_targets = len(targets)
+    forward_scores = np.zeros((len(query_indices), n_targets)) if forward else None
+    backward_scores = np.zeros((len(query_indices), n_targets)) if backward else None
+    for row, query_index in enumerate(query_indices):
+        query = queries[query_index]
+        if forward_scores is not None:
+            forward_scores[row] = [scorer.score(query, t) for t in targets]
+            if normalized:
+                forward_scores[row] /= scorer.self_score(query)
+        if backward_scores is not None:
+            backward_scores[row] = [scorer.score(t, query) for t in targets]
+            if normalized:
+                backward_scores[row] /= _shared['target_self_scores']
+    return forward_scores, backward_scores
+
+
+def _combine_scores(forward_scores:Optional[np.ndarray],
+        backward_scores:Optional[np.ndarray], normalized:str,
+        reverse:bool) -> np.ndarray:
+    if normalized == 'mean':
+        return (forward_scores + backward_scores) / 2.0
+    if normalized == 'geometric-mean':
+        # Clamp negative scores to zero, so that two negative scores don't
+        # result in a positive one.
+        return np.sqrt(np.maximum(forward_scores, 0) * np.maximum(backward_scores, 0))
+    return backward_scores if reverse else forward_scores
+
+
+def iter_nblast_matrix(queries:List[Dotprops], targets:List[Dotprops],
+        scorer:NblastScorer, normalized:str='raw', reverse:bool=False,
+        workers:int=1, block_size:Optional[int]=None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Compute the rows of the NBLAST score matrix of nblast_matrix() in
+    blocks of at most <block_size> consecutive query objects. Yields the
+    indices of the query objects of a block along with its score rows, in
+    query order and as soon as a block is computed.
+    """
+    if normalized not in ('raw', 'normalized', 'mean', 'geometric-mean'):
+        raise ValueError(f"Unknown normalization: {normalized}")
+    both = normalized in ('mean', 'geometric-mean')
+    forward = both or not reverse
+    backward = both or reverse
+    normalize = normalized != 'raw'
+
+    workers = max(1, min(workers, len(queries)))
+    n_blocks = 4 * workers if workers > 1 else 1
+    if block_size:
+        n_blocks = max(n_blocks, int(np.ceil(len(queries) / block_size)))
+    blocks = [b for b in np.array_split(np.arange(len(queries)), n_blocks)
+            if len(b)]
+
+    # KD-trees and self-scores are computed before workers are forked so that
+    # they are shared rather than computed by each worker.
+    for dps in (targets if forward else []) + (queries if backward else []):
+        dps.tree
+    _shared.clear()
+    _shared.update(scorer=scorer, queries=queries, targets=targets)
+    if normalize and backward:
+        _shared['target_self_scores'] = np.array([scorer.self_score(t)
+                for t in targets])
+    score = partial(_score_chunk, forward=forward, backward=backward,
+            normalized=normalize)
+    try:
+        if workers < 2:
+            for block in blocks:
+                yield block, _combine_scores(*score(block), normalized, reverse)
+        else:
+            with futures.ProcessPoolExecutor(workers) as executor:
+                for block, result in zip(blocks, executor.map(score, blocks)):
+                    yield block, _combine_scores(*result, normalized, reverse)
+    finally:
+        _shared.clear()
+
+
+def nblast_matrix(queries:List[Dotprops], targets:List[Dotprops],
+        scorer:NblastScorer, normalized:str='raw', reverse:bool=False,
+        workers:int=1) -> np.ndarray:
+    """Compute a matrix of NBLAST scores with one row per query object and
+    one column per target object. By default, each score measures how well the
+    query matches the target. With <reverse>, the target is matched against
+    the query instead. Scores are either 'raw', 'normalized' by the self-score
+    of the object that is matched, or the 'mean' or 'geometric-mean' of both
+    normalized directions.
+    """
+    blocks = [scores for _, scores in iter_nblast_matrix(queries, targets,
+            scorer, normalized, reverse, workers)]
+    return np.concatenate(blocks) if blocks else np.zeros((0, len(targets)))
+
+
+def cut(values:np.ndarray, breaks:np.ndarray) -> np.ndarray:
+    """Find the bin of each value, like R's cut() with include.lowest=TRUE:
+    bins are closed on the right, the first bin is closed on both sides and
+    values outside of the breaks get the invalid bin -1 or len(breaks) - 1.
+    """
+    bins = np.searchsorted(breaks, values, 'left') - 1
+    bins[values == breaks[0]] = 0
+    return bins
+
+
+def _pair_counts(pairs:Sequence[Tuple[int, int]]) -> np.ndarray:
+    """Count (distance, dot product) combinations for the nearest neighbors of
+    all points of the first element of each pair of dotprops indices in the
+    second element.
+    """
+    dps:List[Dotprops] = _shared['dotprops']
+    distance_breaks:np.ndarray = _shared['distance_breaks']
+    dot_breaks:np.ndarray = _shared['dot_breaks']
+    n_distance_bins, n_dot_bins = len(distance_breaks) - 1, len(dot_breaks) - 1
+    counts = np.zeros(n_distance_bins * n_dot_bins, dtype=np.int64)
+    for query_index, target_index in pairs:
+        distances, dots = dists_dotprods(dps[query_index], dps[target_index])
+        distance_bins = cut(distances, distance_breaks)
+        dot_bins = cut(dots, dot_breaks)
+        valid = (distance_bins >= 0) & (distance_bins < n_distance_bins) & \
+                (dot_bins >= 0) & (dot_bins < n_dot_bins)
+        counts += np.bincount(distance_bins[valid] * n_dot_bins + dot_bins[valid],
+                minlength=len(counts))
+    return counts.reshape(n_distance_bins, n_dot_bins)
+
+
+def pair_histogram(dps:List[Dotprops], pairs:Sequence[Tuple[int, int]],
+        distance_breaks, dot_breaks, workers:int=1) -> np.ndarray:
+    """Count the nearest neighbor distances and absolute dot products of all
+    passed in pairs of dotprops indices in a 2D histogram with one row per
+    distance bin.
+    """
+    for query_index, target_index in pairs:
+        dps[target_index].tree
+    _shared.clear()
+    _shared.update(dotprops=dps,
+            distance_breaks=np.asarray(distance_breaks, dtype=np.float64),
+            dot_breaks=np.asarray(dot_breaks, dtype=np.float64))
+    try:
+        workers = min(workers, len(pairs))
+        if workers < 2:
+            return _pair_counts(pairs)
+        chunks = [list(pairs[i::4 * workers]) for i in range(4 * workers)]
+        with futures.ProcessPoolExecutor(workers) as executor:
+            return sum(executor.map(_pair_counts, [c for c in chunks if c]))
+    finally:
+        _shared.clear()
+
+
+def score_matrix(matching_histogram:np.ndarray, random_histogram:np.ndarray,
+        epsilon:float=1e-6) -> np.ndarray:
+    """Compute the log2 odds ratio of the matching and random probabilities
+    of each histogram bin, like nat.nblast's calc_score_matrix.
+    """
+    matching_probability = matching_histogram / matching_histogram.sum()
+    random_probability = random_histogram / random_histogram.sum()
+    return np.log2((matching_probability + epsilon) / (random_probability + epsilon))
+
+
+def all_pairs(n:int) -> List[Tuple[int, int]]:
+    """All ordered pairs of <n> objects, without self-pairs."""
+    return [(a, b) for a in range(n) for b in range(n) if a != b]
+
+
+def compute_scoring_matrix(project_id, user_id, matching_sample,
+        random_sample, distbreaks=NblastConfigDefaultDistanceBreaks,
+        dotbreaks=NblastConfigDefaultDotBreaks, resample_step=1000,
+        tangent_neighbors=5, omit_failures=True, resample_by=1e3,
+        use_http=False) -> Dict[str, Any]:
+    """Create an NBLAST scoring matrix for a set of matching objects and a set
+    of random skeletons, with the same parameters and result as
+    catmaid.control.nat.r.compute_scoring_matrix(). Matching objects are
+    skeletons, point sets and point clouds with a similar morphology, e.g. KCy
+    in FAFB. All ordered pairs of matching objects are compared, unless the
+    matching sample defines subsets of similar objects, and all ordered pairs
+    of random skeletons are compared. <use_http> isn't supported, objects are
+    always read from the database.
+    """
+    errors:List[str] = []
+    similarity = None
+    matching_histogram = None
+    random_histogram = None
+    matching_probability = None
+    random_probability = None
+    try:
+        workers = settings.MAX_PARALLEL_ASYNC_WORKERS
+        get = partial(get_dotprops, project_id, k=tangent_neighbors,
+                omit_failures=omit_failures, workers=workers)
+
+        logger.debug(f'Computing dotprops for {len(matching_sample.sample_neurons)} matching skeletons')
+        matching_keys:List[Tuple[int, int]] = []
+        matching_dps:List[Dotprops] = []
+        # Subsets refer to skeletons with type 0, point sets with type 1 and
+        # point clouds with type 2.
+        for object_type, type_key, object_ids, resample in (
+                ('skeleton', 0, matching_sample.sample_neurons, resample_by * nm_to_um),
+                ('pointset', 1, matching_sample.sample_pointsets, None),
+                ('pointcloud', 2, matching_sample.sample_pointclouds, None)):
+            if not object_ids:
+                continue
+            ids_in_use, dps = get(object_ids, object_type,
+                    resample_step=resample)
+            matching_keys.extend((type_key, object_id) for object_id in ids_in_use)
+            matching_dps.extend(dps)
+
+        logger.debug(f'Computing dotprops for {len(random_sample.sample_neurons)} random skeletons')
+        _, random_dps = get(random_sample.sample_neurons, 'skeleton',
+                resample_step=resample_by * nm_to_um)
+
+        if len(matching_dps) < 2:
+            raise ValueError("Need at least two valid matching objects")
+        if len(random_dps) < 2:
+            raise ValueError("Need at least two valid random skeletons")
+
+        # Matches are provided as subsets of objects that are similar to each
+        # other (within each set).
+        if matching_sample.subset:
+            index = {key: i for i, key in enumerate(matching_keys)}
+            matching_pairs = []
+            for subset in matching_sample.subset:
+                elements = [index.get((int(t), int(k))) for t, k in subset]
+                elements = [e for e in elements if e is not None]
+                for i, a in enumerate(elements):
+                    matching_pairs.extend((a, b) for b in elements[i+1:])
+            logger.debug(f'Found {len(matching_pairs)} subset pairs')
+        else:
+            matching_pairs = all_pairs(len(matching_dps))
+
+        logger.debug('Computing matching skeleton probability distribution')
+        match_hist = pair_histogram(matching_dps, matching_pairs, distbreaks,
+                dotbreaks, workers)
+
+        logger.debug('Computing random skeleton probability distribution')
+        rand_hist = pair_histogram(random_dps, all_pairs(len(random_dps)),
+                distbreaks, dotbreaks, workers)
+
+        logger.debug('Computing scoring matrix')
+        smat = score_matrix(match_hist, rand_hist)
+
+        similarity = smat.tolist()
+        matching_histogram = match_hist.tolist()
+        random_histogram = rand_hist.tolist()
+        matching_probability = (match_hist / match_hist.sum()).tolist()
+        random_probability = (rand_hist / rand_hist.sum()).tolist()
+    except (IOError, OSError, ValueError) as e:
+        errors.append(str(e))
+
+    return {
+        "errors": errors,
+        "similarity": similarity,
+        "matching_histogram": matching_histogram,
+        "random_histogram": random_histogram,
+        "matching_probability": matching_probability,
+        "random_probability": random_probability
+    }
+
+
+def top_n_columns(scores:np.ndarray, top_n:int) -> np.ndarray:
+    """Return the indices of all columns that are among the <top_n> highest
+    scores of any row, in their original order.
+    """
+    if scores.shape[1] <= top_n:
+        return np.arange(scores.shape[1])
+    top = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+    return np.unique(top)
+
+
+def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
+        query_type='skeleton', target_type='skeleton', omit_failures=True,
+        normalized='raw', use_alpha=False, remove_target_duplicates=True,
+        min_nodes=500, min_soma_nodes=20, simplify=True, required_branches=10,
+        soma_tags=('soma', ), use_cache=True, reverse=False, top_n=0,
+        resample_by=1e3, use_http=False,
+        on_block:Optional[Callable[[List[int], List[int], np.ndarray], None]]=None,
+        block_size:int=DEFAULT_BATCH_SIZE) -> Dict[str, Any]:
+    """Compute NBLAST scores for query objects against target objects, with
+    the same parameters and result as catmaid.control.nat.r.nblast(). The
+    similarity matrix has one row per query object and one column per target
+    object. With <top_n>, only target objects that are among the top N
+    matches of any query object are kept. With <use_cache>, dotprops are read
+    from and added to the per-object dotprops cache. <use_http> isn't
+    supported, objects are always read from the database.
+
+    If <on_block> is passed, no similarity matrix is returned. Instead, blocks
+    of at most <block_size> rows are passed to it as soon as they are
+    computed, along with the query object IDs of the rows and all target
+    object IDs. <top_n> is ignored then, filtering is up to the callback.
+
+    Raises NoValidObjectsError if there are no valid query or target objects,
+    other errors are returned.
+    """
+    similarity = None
+    query_object_ids_in_use = None
+    target_object_ids_in_use = None
+    errors:List[str] = []
+    try:
+        config = NblastConfig.objects.get(project_id=project_id, pk=config_id)
+        workers = settings.MAX_PARALLEL_ASYNC_WORKERS
+
+        # Indicate an all-by-all computation. This disabled <remove_target_duplicates>.
+        all_by_all = not query_object_ids and not target_object_ids and \
+                query_type == target_type
+        if all_by_all:
+            logger.debug('Disabling remove_target_duplicates option due to all-by-all computation')
+            remove_target_duplicates = False
+
+        # In case either query_object_ids or target_object_ids is not given, the
+        # value will be filled in with all objects of the respective type.
+        from catmaid.control.similarity import get_all_object_ids
+        if all_by_all:
+            query_object_ids = get_all_object_ids(project_id, user_id,
+                    query_type, min_nodes, min_soma_nodes, soma_tags)
+            target_object_ids = query_object_ids
+        else:
+            if not query_object_ids:
+                query_object_ids = get_all_object_ids(project_id, user_id,
+                        query_type, min_nodes, min_soma_nodes, soma_tags)
+            if not target_object_ids:
+                target_object_ids = get_all_object_ids(project_id, user_id,
+                        target_type, min_nodes, min_soma_nodes, soma_tags)
+
+        # If both query and target IDs are of the same type, the target list of
+        # object IDs can't contain any of the query IDs.
+        if query_type == target_type and remove_target_duplicates:
+            query_id_set = set(query_object_ids)
+            target_object_ids = [object_id for object_id in target_object_ids
+                    if object_id not in query_id_set]
+
+        get = partial(get_dotprops, project_id, k=config.tangent_neighbors,
+                n_branches=required_branches if simplify else None,
+                omit_failures=omit_failures, workers=workers,
+                use_cache=use_cache)
+
+        logger.debug(f'Computing dotprops for {len(query_object_ids)} query objects')
+        query_object_ids_in_use, query_dps = get(query_object_ids, query_type,
+                resample_step=resample_by * nm_to_um)
+
+        if all_by_all:
+            target_object_ids_in_use, target_dps = query_object_ids_in_use, query_dps
+        else:
+            logger.debug(f'Computing dotprops for {len(target_object_ids)} target objects')
+            target_object_ids_in_use, target_dps = get(target_object_ids,
+                    target_type, resample_step=resample_by * nm_to_um)
+
+        if len(query_dps) == 0:
+            raise NoValidObjectsError("No valid query objects found")
+
+        if len(target_dps) == 0:
+            raise NoValidObjectsError("No valid target objects found")
+
+        logger.debug('Computing score (alpha: {a}, noramlized: {n}, reverse: {r}, top N: {tn})'.format(**{
+            'a': 'Yes' if use_alpha else 'No',
+            'n': 'No' if normalized == 'raw' else f'Yes ({normalized})',
+            'r': 'Yes' if reverse else 'No',
+            'tn': top_n if top_n else '-',
+        }))
+
+        scorer = NblastScorer.from_config(config, use_alpha)
+        if on_block:
+            for rows, scores in iter_nblast_matrix(query_dps, target_dps,
+                    scorer, normalized, reverse, workers, block_size):
+                on_block([query_object_ids_in_use[i] for i in rows],
+                        target_object_ids_in_use, scores)
+        else:
+            scores = nblast_matrix(query_dps, target_dps, scorer, normalized,
+                    reverse, workers)
+
+            if top_n:
+                columns = top_n_columns(scores, top_n)
+                scores = scores[:, columns]
+                target_object_ids_in_use = [target_object_ids_in_use[i] for i in columns]
+
+            similarity = scores.tolist()
+
+            # We expect a result at this point
+            if not similarity:
+                raise ValueError("Could not compute similarity")
+    except (IOError, OSError, ValueError) as e:
+        errors.append(str(e))
+
+    return {
+        "errors": errors,
+        "similarity": similarity,
+        "query_object_ids": query_object_ids_in_use,
+        "target_object_ids": target_object_ids_in_use,
+    }
@@ -19,9 +19,11 @@ from django.http import HttpRequest, HttpResponse, JsonResponse
 from catmaid.apps import get_system_user
 from catmaid.control.common import get_request_bool, urljoin
 from catmaid.control.authentication import requires_user_role
+from catmaid.control.nat.nblast import NoValidObjectsError
+from catmaid.control.pointcloud import get_pointcloud_points
 from catmaid.models import (Message, User, UserRole, NblastConfig,
         NblastConfigDefaultDistanceBreaks, NblastConfigDefaultDotBreaks,
-        PointCloud, PointSet)
+        PointSet)
 
 from celery.task import task
 from celery.utils.log import get_task_logger
@@ -393,16 +395,7 @@ def compute_scoring_matrix(project_id, user_id, matching_sample,
         # Get matching point clouds. They are combined with matching neurons
         # into one cloud.
         if matching_sample.sample_pointclouds:
-            pointclouds = []
-            for pcid in matching_sample.sample_pointclouds:
-                target_pointcloud = PointCloud.objects.prefetch_related('points').get(pk=pcid)
-                points_flat = list(chain.from_iterable(
-                        (p.location_x, p.location_y, p.location_z)
-                        for p in target_pointcloud.points.all()))
-                n_points = len(points_flat) / 3
-                point_data = Matrix(rinterface.FloatSexpVector(points_flat),
-                        nrow=n_points, byrow=True)
-                pointclouds.append(point_data)
+            pointclouds = pointcloud_matrices(project_id, matching_sample.sample_pointclouds)
 
             pointcloud_objects = rnat.as_neuronlist(pointclouds)
             effective_pointcloud_object_ids = list(map(
@@ -675,16 +668,7 @@ def create_dps_data_cache(project_id, object_type, tangent_neighbors=20,
             logger.info("No pointclouds found to populate cache from")
             return
         logger.debug(f'Fetching {len(object_ids)} query point clouds')
-        pointclouds = []
-        for pcid in object_ids:
-            target_pointcloud = PointCloud.objects.prefetch_related('points').get(pk=pcid)
-            points_flat = list(chain.from_iterable(
-                    (p.location_x, p.location_y, p.location_z)
-                    for p in target_pointcloud.points.all()))
-            n_points = len(points_flat) / 3
-            point_data = Matrix(rinterface.FloatSexpVector(points_flat),
-                    nrow=n_points, byrow=True)
-            pointclouds.append(point_data)
+        pointclouds = pointcloud_matrices(project_id, object_ids)
 
         objects = rnat.as_neuronlist(pointclouds)
         effective_object_ids = list(map(
@@ -729,6 +713,9 @@ def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
     query_dp = dotprops(query, resample=1, k=5)
     target_dp = dotprops(target, resample=1, k=5)
     neurons.similarity = nblast_allbyall.neuronlist(neurons.dps, smat, FALSE, 'raw')
+
+    Raises NoValidObjectsError if there are no valid query or target objects,
+    other errors are returned.
     """
     # TODO: Break up this function
     timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
@@ -903,16 +890,7 @@ def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
 
             logger.debug(f'Fetching {len(effective_query_object_ids)} query point clouds ({cache_hits} cache hits)')
             if effective_query_object_ids:
-                pointclouds = []
-                for pcid in effective_query_object_ids:
-                    target_pointcloud = PointCloud.objects.prefetch_related('points').get(pk=pcid)
-                    points_flat = list(chain.from_iterable(
-                            (p.location_x, p.location_y, p.location_z)
-                            for p in target_pointcloud.points.all()))
-                    n_points = len(points_flat) / 3
-                    point_data = Matrix(rinterface.FloatSexpVector(points_flat),
-                            nrow=n_points, byrow=True)
-                    pointclouds.append(point_data)
+                pointclouds = pointcloud_matrices(project_id, effective_query_object_ids)
 
                 query_objects = rnat.as_neuronlist(pointclouds)
                 non_cache_typed_query_object_ids = list(map(
@@ -1069,16 +1047,7 @@ def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
 
                 logger.debug(f'Fetching {len(effective_target_object_ids)} target point clouds ({cache_hits} cache hits)')
                 if effective_target_object_ids:
-                    pointclouds = []
-                    for pcid in effective_target_object_ids:
-                        target_pointcloud = PointCloud.objects.prefetch_related('points').get(pk=pcid)
-                        points_flat = list(chain.from_iterable(
-                                (p.location_x, p.location_y, p.location_z)
-                                for p in target_pointcloud.points.all()))
-                        n_points = len(points_flat) / 3
-                        point_data = Matrix(rinterface.FloatSexpVector(points_flat),
-                                nrow=n_points, byrow=True)
-                        pointclouds.append(point_data)
+                    pointclouds = pointcloud_matrices(project_id, effective_target_object_ids)
 
                     target_objects = rnat.as_neuronlist(pointclouds)
                     non_cache_typed_target_object_ids = list(map(
@@ -1134,10 +1103,10 @@ def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
                 raise ValueError(f"Unknown target type: {target_type}")
 
         if len(query_dps) == 0:
-            raise ValueError("No valid query objects found")
+            raise NoValidObjectsError("No valid query objects found")
 
         if len(target_dps) == 0:
-            raise ValueError("No valid target objects found")
+            raise NoValidObjectsError("No valid target objects found")
 
         # Restore R matrix for use with nat.nblast.
         cells = list(chain.from_iterable(config.scoring))
@@ -1370,6 +1339,16 @@ def as_matrix(scores, a, b, transposed=False):
     raise ValueError(f"Can't convert to matrix, unknown type: {score_type}")
 
 
+def pointcloud_matrices(project_id, pointcloud_ids) -> List:
+    """Return an R matrix with one row per point for each passed in point
+    cloud, in the same order. Points are read from their packed form.
+    """
+    points = get_pointcloud_points(project_id, pointcloud_ids)
+    return [robjects.r.matrix(rinterface.FloatSexpVector(
+            points[pcid].astype(numpy.float64).ravel()),
+            nrow=len(points[pcid]), byrow=True) for pcid in pointcloud_ids]
+
+
 def neuronlist_for_skeletons(project_id, skeleton_ids, omit_failures=False,
         scale=None, conn=None, progress=False):
     """Get the R dotprops data structure for a set of skeleton IDs.
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Split NBLAST similarity computations into blocks of query and target
+objects, which are computed by individual tasks. Blocks are sized so that the
+dotprops of their objects and their score matrix fit into the memory that is
+available to a single task.
+"""
+
+import math
+import os
+from typing import List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.db import connection
+
+
+# Rough memory use of a single dotprops point (location, tangent vector,
+# alpha, spatial index and temporary distance data) in bytes. R objects carry
+# considerably more overhead than NumPy arrays.
+BYTES_PER_POINT = {
+    'numpy': 256,
+    'r': 1024,
+}
+
+# Memory use of a single score in bytes. Forward and backward scores are held
+# at the same time for mean normalizations.
+BYTES_PER_SCORE = 16
+
+# Used if the number of points of objects can't be estimated
+DEFAULT_POINTS_PER_OBJECT = 1000
+
+# Used if neither NBLAST_BLOCK_MEMORY is set nor the available memory is known
+DEFAULT_BLOCK_MEMORY = 1024 ** 3
+
+
+def get_available_memory() -> Optional[int]:
+    """Return the memory in bytes that is available for new allocations
+    without swapping, or None if it is unknown.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_block_memory() -> int:
+    """Return the memory in bytes a single block may use. This is either the
+    NBLAST_BLOCK_MEMORY setting (in MB) or half of the available memory shared
+    by MAX_PARALLEL_ASYNC_WORKERS processes.
+    """
+    block_memory = getattr(settings, 'NBLAST_BLOCK_MEMORY', None)
+    if block_memory:
+        return int(block_memory * 1024 ** 2)
+    available_memory = get_available_memory()
+    if not available_memory:
+        return DEFAULT_BLOCK_MEMORY
+    return available_memory // (2 * max(1, settings.MAX_PARALLEL_ASYNC_WORKERS))
+
+
+def estimate_points_per_object(project_id, object_type:str,
+        object_ids:Sequence[int], resample_step:float) -> float:
+    """Estimate the average number of dotprops points of the passed in
+    objects. Skeletons are estimated by their cable length and the resampling
+    step (in nm), other objects by their number of points.
+    """
+    cursor = connection.cursor()
+    if object_type == 'skeleton':
+        cursor.execute("""
+            SELECT AVG(cable_length) / %(resample_step)s + 1
+            FROM catmaid_skeleton_summary
+            WHERE project_id = %(project_id)s
+            AND skeleton_id = ANY(%(object_ids)s::bigint[])
+        """, {
+            'project_id': project_id,
+            'object_ids': list(object_ids),
+            'resample_step': resample_step,
+        })
+    elif object_type == 'pointcloud':
+        cursor.execute("""
+            SELECT COUNT(*)::float / NULLIF(COUNT(DISTINCT pointcloud_id), 0)
+            FROM pointcloud_point
+            WHERE project_id = %(project_id)s
+            AND pointcloud_id = ANY(%(object_ids)s::bigint[])
+        """, {
+            'project_id': project_id,
+            'object_ids': list(object_ids),
+        })
+    elif object_type == 'pointset':
+        cursor.execute("""
+            SELECT AVG(array_length(points, 1) / 3)
+            FROM point_set
+            WHERE project_id = %(project_id)s
+            AND id = ANY(%(object_ids)s::bigint[])
+        """, {
+            'project_id': project_id,
+            'object_ids': list(object_ids),
+        })
+    else:
+        raise ValueError(f"Unsupported object type: {object_type}")
+    n_points = cursor.fetchone()[0]
+    return float(n_points) if n_points else DEFAULT_POINTS_PER_OBJECT
+
+
+def get_block_shape(n_queries:int, n_targets:int, points_per_object:float,
+        memory:int, backend:str='numpy') -> Tuple[int, int]:
+    """Return the number of query and target objects of a block, so that the
+    dotprops of all its objects and its scores fit into <memory> bytes. Blocks
+    are square, unless all query or all target objects fit into one block, in
+    which case the other dimension is extended.
+    """
+    object_memory = points_per_object * BYTES_PER_POINT[backend]
+    # Solve 2 * n * object_memory + n^2 * BYTES_PER_SCORE = memory for n.
+    n = (math.sqrt(object_memory ** 2 + BYTES_PER_SCORE * memory) -
+            object_memory) / BYTES_PER_SCORE
+    n = max(1, int(n))
+
+    def extend(n_fixed, n_total):
+        n_other = (memory - n_fixed * object_memory) / \
+                (object_memory + n_fixed * BYTES_PER_SCORE)
+        return min(n_total, max(n, int(n_other)))
+
+    n_block_queries, n_block_targets = min(n, n_queries), min(n, n_targets)
+    if n_block_queries < n:
+        n_block_targets = extend(n_block_queries, n_targets)
+    elif n_block_targets < n:
+        n_block_queries = extend(n_block_targets, n_queries)
+    return max(1, n_block_queries), max(1, n_block_targets)
+
+
+def split_into_blocks(query_ids:Sequence[int], target_ids:Sequence[int],
+        n_block_queries:int, n_block_targets:int) -> List[Tuple[List[int], List[int]]]:
+    """Split the query × target matrix into blocks of at most the passed in
+    size. Blocks are returned row by row.
+    """
+    return [(list(query_ids[i:i + n_block_queries]),
+            list(target_ids[j:j + n_block_targets]))
+            for i in range(0, len(query_ids), n_block_queries)
+            for j in range(0, len(target_ids), n_block_targets)]
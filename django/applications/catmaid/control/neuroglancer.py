@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""Export of skeletons as neuroglancer precomputed skeleton sources, either
+one file per skeleton or sharded. See neuroglancer's documentation of the
+precomputed format for details:
+
+https://github.com/google/neuroglancer/tree/master/src/neuroglancer/datasource/precomputed
+"""
+
+import json
+import os
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from django.db import connection
+
+from catmaid.control.common import batches
+from catmaid.control.morphology import parent_indices
+
+
+NODE_DTYPE = np.dtype([('skeleton_id', np.int64), ('id', np.int64),
+        ('parent_id', np.int64), ('x', np.float64), ('y', np.float64),
+        ('z', np.float64)])
+
+
+def get_skeleton_info(sharding:Optional[Dict[str, Any]]=None) -> Dict[str, Any]:
+    """The content of the info file of a skeleton source. Vertex positions are
+    stored in nanometers, which makes a transform unnecessary.
+    """
+    info:Dict[str, Any] = {
+        '@type': 'neuroglancer_skeletons',
+        'vertex_attributes': [],
+    }
+    if sharding:
+        info['sharding'] = sharding
+    return info
+
+
+def get_sharding(preshift_bits:int=0, minishard_bits:int=6,
+        shard_bits:int=0) -> Dict[str, Any]:
+    """Sharding parameters for skeleton IDs. Skeleton IDs are already well
+    distributed, which is why they are used as hash directly.
+    """
+    return {
+        '@type': 'neuroglancer_uint64_sharded_v1',
+        'hash': 'identity',
+        'preshift_bits': preshift_bits,
+        'minishard_bits': minishard_bits,
+        'shard_bits': shard_bits,
+        'minishard_index_encoding': 'raw',
+        'data_encoding': 'raw',
+    }
+
+
+def get_default_sharding(n_skeletons:int, skeletons_per_shard:int=10000,
+        skeletons_per_minishard:int=64) -> Dict[str, Any]:
+    """Sharding parameters that result in shards and minishards of about the
+    passed in size, assuming consecutive skeleton IDs.
+    """
+    def bits(n):
+        return max(0, int(np.ceil(np.log2(max(1, n)))))
+    minishard_bits = bits(min(n_skeletons, skeletons_per_shard) / skeletons_per_minishard)
+    shard_bits = bits(n_skeletons / skeletons_per_shard)
+    return get_sharding(minishard_bits=minishard_bits, shard_bits=shard_bits)
+
+
+def get_shards(skeleton_ids, sharding:Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the shard and minishard numbers of the passed in skeleton IDs."""
+    if sharding['hash'] != 'identity':
+        raise ValueError("Unsupported sharding hash: " + sharding['hash'])
+    hashed = np.asarray(skeleton_ids, dtype=np.uint64) >> np.uint64(sharding['preshift_bits'])
+    minishards = hashed & np.uint64((1 << sharding['minishard_bits']) - 1)
+    shards = (hashed >> np.uint64(sharding['minishard_bits'])) & \
+            np.uint64((1 << sharding['shard_bits']) - 1)
+    return shards, minishards
+
+
+def get_shard_filename(shard:int, sharding:Dict[str, Any]) -> str:
+    digits = (sharding['shard_bits'] + 3) // 4
+    return format(int(shard), 'x').zfill(digits) + '.shard'
+
+
+def encode_shard(skeletons:Dict[int, bytes], sharding:Dict[str, Any]) -> bytes:
+    """Encode the passed in skeleton ID vs encoded skeleton map as a single
+    shard, all skeletons have to belong to the same shard. The data of each
+    minishard is followed by its index, all offsets are relative to the end
+    of the shard index.
+    """
+    skeleton_ids = np.array(sorted(skeletons), dtype=np.uint64)
+    _, minishards = get_shards(skeleton_ids, sharding)
+    n_minishards = 1 << sharding['minishard_bits']
+    shard_index = np.zeros((n_minishards, 2), dtype='<u8')
+
+    parts:List[bytes] = []
+    offset = 0
+    for minishard in np.unique(minishards).tolist():
+        chunk_ids = skeleton_ids[minishards == minishard]
+        sizes = np.array([len(skeletons[skid]) for skid in chunk_ids.tolist()],
+                dtype=np.uint64)
+        ends = offset + np.cumsum(sizes, dtype=np.uint64)
+        starts = ends - sizes
+        parts.extend(skeletons[skid] for skid in chunk_ids.tolist())
+
+        # Chunk IDs and start offsets are delta encoded, the latter relative
+        # to the end of the previous chunk.
+        minishard_index = np.empty((3, len(chunk_ids)), dtype='<u8')
+        minishard_index[0] = np.diff(chunk_ids, prepend=np.uint64(0))
+        minishard_index[1] = starts - np.concatenate((np.zeros(1, dtype=np.uint64), ends[:-1]))
+        minishard_index[2] = sizes
+        offset = int(ends[-1])
+
+        shard_index[minishard] = offset, offset + minishard_index.nbytes
+        parts.append(minishard_index.tobytes())
+        offset += minishard_index.nbytes
+
+    return b''.join([shard_index.tobytes()] + parts)
+
+
+def encode_skeletons(nodes:np.ndarray) -> Dict[int, bytes]:
+    """Encode nodes of the NODE_DTYPE in neuroglancer's skeleton format:
+    vertex and edge count (uint32), vertex positions (float32, 3 per vertex)
+    and edges from child to parent vertex (uint32, 2 per edge), all little
+    endian. Return a map of skeleton ID vs encoded skeleton.
+    """
+    nodes = nodes[np.argsort(nodes['skeleton_id'], kind='stable')]
+    parents = parent_indices(nodes['id'], nodes['parent_id'])
+    vertices = np.column_stack((nodes['x'], nodes['y'], nodes['z'])).astype('<f4')
+    skeleton_ids = nodes['skeleton_id']
+    starts = np.flatnonzero(np.diff(skeleton_ids, prepend=-1))
+    ends = np.append(starts[1:], len(nodes))
+
+    encoded = {}
+    for skeleton_id, start, end in zip(skeleton_ids[starts].tolist(),
+            starts.tolist(), ends.tolist()):
+        skeleton_parents = parents[start:end]
+        children = np.flatnonzero(skeleton_parents >= 0)
+        edges = np.column_stack((children, skeleton_parents[children] - start)).astype('<u4')
+        header = np.array([end - start, len(edges)], dtype='<u4')
+        encoded[skeleton_id] = b''.join((header.data, vertices[start:end].data,
+                edges.data))
+    return encoded
+
+
+def get_skeleton_nodes(project_id, skeleton_ids) -> np.ndarray:
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT skeleton_id, id, COALESCE(parent_id, -1),
+            location_x, location_y, location_z
+        FROM treenode
+        WHERE project_id = %(project_id)s
+        AND skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+    """, {
+        'project_id': project_id,
+        'skeleton_ids': list(skeleton_ids),
+    })
+    return np.array(cursor.fetchall(), dtype=NODE_DTYPE)
+
+
+def get_encoded_skeletons(project_id, skeleton_ids) -> Dict[int, bytes]:
+    """Return a map of skeleton ID vs the skeleton in neuroglancer's format.
+    Skeletons without nodes are not part of the result.
+    """
+    return encode_skeletons(get_skeleton_nodes(project_id, skeleton_ids))
+
+
+def write_skeletons(project_id, skeleton_ids:Iterable[int], path:str,
+        sharding:Optional[Dict[str, Any]]=None, batch_size:int=500,
+        progress:Optional[Callable[[int], None]]=None) -> int:
+    """Write a precomputed skeleton source for the passed in skeletons to the
+    passed in directory: an info file and either one file per skeleton or, if
+    sharding parameters are passed in, one file per shard. Skeletons are
+    loaded <batch_size> at a time. Returns the number of written skeletons.
+    The optional progress callback is called with the number of written
+    skeletons so far.
+    """
+    skeleton_ids = sorted(set(skeleton_ids))
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'info'), 'w') as f:
+        json.dump(get_skeleton_info(sharding), f)
+
+    n_written = 0
+    if not sharding:
+        for batch in batches(skeleton_ids, batch_size):
+            for skeleton_id, data in get_encoded_skeletons(project_id, batch).items():
+                with open(os.path.join(path, str(skeleton_id)), 'wb') as f:
+                    f.write(data)
+                n_written += 1
+            if progress:
+                progress(n_written)
+        return n_written
+
+    # Only one shard is kept in memory at a time
+    shards, _ = get_shards(skeleton_ids, sharding)
+    skeleton_id_array = np.array(skeleton_ids, dtype=np.uint64)
+    for shard in np.unique(shards).tolist():
+        shard_skeleton_ids = skeleton_id_array[shards == shard].tolist()
+        skeletons:Dict[int, bytes] = {}
+        for batch in batches(shard_skeleton_ids, batch_size):
+            skeletons.update(get_encoded_skeletons(project_id, batch))
+        if skeletons:
+            with open(os.path.join(path, get_shard_filename(shard, sharding)), 'wb') as f:
+                f.write(encode_shard(skeletons, sharding))
+        n_written += len(skeletons)
+        if progress:
+            progress(n_written)
+    return n_written
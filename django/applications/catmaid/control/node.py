@@ -2,47 +2,78 @@
 
 from abc import ABCMeta
 from aggdraw import Draw, Pen, Brush, Font
-from collections import defaultdict
+from collections import defaultdict, deque, namedtuple
 from concurrent import futures
 import copy
+import itertools
 import json
+import logging
 import math
 import msgpack
+import numpy as np
+import os
 from PIL import Image, ImageDraw
 import progressbar
 import psycopg2.extras
 import struct
-from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple, Union
+import threading
+import time
+from io import BytesIO
+from typing import (Any, DefaultDict, Dict, Iterator, List, Optional, Set,
+        Tuple, Union)
 import ujson
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
-from django.db import connection, connections
-from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.db import (close_old_connections, connection, connections,
+        transaction)
+from django.http import (HttpRequest, HttpResponse, JsonResponse,
+        StreamingHttpResponse)
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
 
 from rest_framework.decorators import api_view
 
 from catmaid import state
+from catmaid.control import columnar
+from catmaid.cache import LRUCache, NotificationListener, TileCache
 from catmaid.models import (ClassInstance, UserRole, Treenode,
         ClassInstanceClassInstance, Review, Project)
 from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail
 from catmaid.control.common import (batches, get_relation_to_id_map,
         get_request_bool, get_request_list)
+from catmaid.control.edge import get_intersected_grid_cells
+from catmaid.control.importance import get_importance_order_sql
 
 
 
+logger = logging.getLogger(__name__)
+
 ORIENTATIONS = {
     'xy': 0,
     'xz': 1,
     'zy': 2
 }
 
+_jsonb_decoder_registered = False
+
+
+def register_jsonb_decoder() -> None:
+    """For JSONB type caches, use ujson to decode, this is roughly 2x faster.
+    The decoder is registered globally, which is only needed once per process.
+    """
+    global _jsonb_decoder_registered
+    if not _jsonb_decoder_registered:
+        psycopg2.extras.register_default_jsonb(loads=ujson.loads)
+        _jsonb_decoder_registered = True
+
+
 class BasicNodeProvider(object):
 
     def __init__(self, *args, **kwargs):
+        # Used to report statistics, defaults to the configured provider name.
+        self.name = kwargs.get('name', type(self).__name__)
         self.enabled = kwargs.get('enabled', True)
         self.project_id = kwargs.get('project_id')
         self.orientation = kwargs.get('orientation')
@@ -122,8 +153,7 @@ class CachedJsonNodeNodeProvder(CachedNodeProvider):
             explicit_connector_ids, include_labels, with_relation_map,
             with_origin) -> Tuple[Any, Optional[str]]:
         cursor = connection.cursor()
-        # For JSONB type cache, use ujson to decode, this is roughly 2x faster
-        psycopg2.extras.register_default_jsonb(loads=ujson.loads)
+        register_jsonb_decoder()
         cursor.execute("""
             SELECT json_data FROM node_query_cache
             WHERE project_id = %s AND depth = %s
@@ -238,6 +268,145 @@ class CachedMsgpackNodeProvder(CachedNodeProvider):
             return None, None
 
 
+# A per-process cache of encoded node grid cache cells. Entries are keyed by
+# (grid_id, x_index, y_index, z_index, lod_min, lod_max, data_type) and tagged
+# with their cell so that they can be invalidated on "catmaid.dirty-cache"
+# database events.
+grid_cell_cache = LRUCache(settings.NODE_GRID_CELL_CACHE_SIZE,
+        settings.NODE_GRID_CELL_CACHE_MAX_AGE)
+
+# Field of views that cover more cells than this are not looked up in the cell
+# cache, but are queried from the database directly.
+GRID_CELL_CACHE_MAX_FOV_CELLS = 4096
+
+# A cache of rendered node overlay tiles, kept in memory by each process and
+# optionally on disk. Tiles are tagged with (grid_id, zoom, z_index, column,
+# row) and are invalidated along with the grid cells they cover.
+overlay_tile_cache = TileCache(settings.NODE_OVERLAY_TILE_CACHE_SIZE,
+        settings.NODE_OVERLAY_TILE_CACHE_PATH)
+
+# Placeholder for cells that aren't cached yet. Cells that don't exist in the
+# database are cached as None.
+_UNCACHED = object()
+
+
+NodeGridInfo = namedtuple('NodeGridInfo', ['id', 'orientation',
+        'cell_width', 'cell_height', 'cell_depth', 'cell_volume', 'n_lod_levels',
+        'data_types', 'enabled'])
+
+
+class NodeGridCacheRegistry():
+    """Keep the grid cache definitions of each project in memory. Grids change
+    rarely, which allows to select a grid for a node query without a database
+    round-trip. A project's grids are loaded on first use and reloaded after a
+    "catmaid.grid-cache-update" event or once they are older than <max_age>
+    seconds.
+    """
+
+    def __init__(self, max_age:Optional[float]=None):
+        self.max_age = max_age
+        self._grids:Dict[int, Tuple[float, List[NodeGridInfo]]] = {}
+        self._lock = threading.Lock()
+
+    def clear(self, project_id:Optional[int]=None) -> None:
+        with self._lock:
+            if project_id is None:
+                self._grids.clear()
+            else:
+                self._grids.pop(project_id, None)
+
+    def get_grids(self, project_id:int, cursor=None) -> List[NodeGridInfo]:
+        entry = self._grids.get(project_id)
+        if entry is None or (self.max_age is not None and \
+                time.time() - entry[0] > self.max_age):
+            load_time = time.time()
+            grids = self.load_grids(project_id, cursor)
+            with self._lock:
+                self._grids[project_id] = (load_time, grids)
+            return grids
+        return entry[1]
+
+    def load_grids(self, project_id:int, cursor=None) -> List[NodeGridInfo]:
+        if not cursor:
+            cursor = connection.cursor()
+        cursor.execute("""
+            SELECT id, orientation, cell_width, cell_height, cell_depth,
+                n_lod_levels, has_json_data, has_json_text_data,
+                has_msgpack_data, has_columnar_data, enabled
+            FROM node_grid_cache
+            WHERE project_id = %(project_id)s
+        """, {
+            'project_id': project_id,
+        })
+        grids = []
+        for row in cursor.fetchall():
+            data_types = frozenset(t for t, available in zip(
+                    ('json', 'json_text', 'msgpack', 'columnar'), row[6:10]) if available)
+            if not data_types:
+                logger.warning(f'Grid cache {row[0]} has no data type flags set, '
+                        'it is matched with requests of any data type. Please '
+                        'set its has_*_data fields.')
+            grids.append(NodeGridInfo(row[0], row[1], row[2], row[3], row[4],
+                    float(row[2]) * float(row[3]) * float(row[4]), row[5],
+                    data_types, row[10]))
+        return grids
+
+    def find_grid(self, project_id:int, volume:float, data_type:Optional[str]=None,
+            grid_id:Optional[int]=None, cursor=None) -> Optional[NodeGridInfo]:
+        """Find the enabled grid that has a cell volume closest to the passed in
+        volume and that contains data of the passed in type. Grids without any
+        data type flag set (e.g. created before these flags were maintained)
+        are considered to contain data of every type, like before.
+        """
+        candidates = [g for g in self.get_grids(project_id, cursor) if g.enabled
+                and (data_type is None or not g.data_types or data_type in g.data_types)
+                and (grid_id is None or g.id == grid_id)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda g: abs(g.cell_volume - volume))
+
+
+grid_cache_registry = NodeGridCacheRegistry(settings.NODE_GRID_REGISTRY_MAX_AGE)
+
+
+def _invalidate_grid_cell(notify) -> None:
+    try:
+        data = ujson.loads(notify.payload)
+        grid_id, cell = data['grid_id'], (data['x'], data['y'], data['z'])
+    except (ValueError, KeyError, TypeError):
+        # Without knowing what changed, no cached cell can be trusted.
+        grid_cell_cache.clear()
+        overlay_tile_cache.clear()
+        return
+    grid_cell_cache.invalidate_tag((grid_id,) + cell)
+    invalidate_overlay_tiles(grid_id, [cell])
+
+
+def _invalidate_grid_definitions(notify) -> None:
+    # Rendered tiles depend on the grid definition, but grids change rarely.
+    overlay_tile_cache.clear()
+    try:
+        grid_cache_registry.clear(int(notify.payload))
+    except ValueError:
+        grid_cache_registry.clear()
+
+
+def _reset_node_caches() -> None:
+    grid_cell_cache.clear()
+    grid_cache_registry.clear()
+    overlay_tile_cache.clear()
+
+
+_node_cache_handlers = {
+    'catmaid.grid-cache-update': _invalidate_grid_definitions,
+}
+if grid_cell_cache.enabled or overlay_tile_cache.memory.enabled:
+    _node_cache_handlers['catmaid.dirty-cache'] = _invalidate_grid_cell
+
+node_cache_listener = NotificationListener(_node_cache_handlers,
+        _reset_node_caches)
+
+
 def get_pack_array_header(n) -> bytes:
     """Return binary header for msgpack conform array header. This is size
     dependent. See:
@@ -252,66 +421,99 @@ def get_pack_array_header(n) -> bytes:
     raise ValueError("Array is too large")
 
 
-class GridCachedNodeProvider(CachedNodeProvider):
-    """Find nodes in node grid caches.
+class EncodedNodeResult():
+    """A node query result that is composed of encoded partial results, like
+    the LOD levels of multiple grid cells. The first part is a complete node
+    result (a five element list). All other parts and optional extra results
+    that aren't encoded are added as sixth element. This allows to write the
+    result in chunks without decoding any part if the requested format matches
+    the encoding. Otherwise, each part is transcoded separately. In the
+    columnar format, each part is written as a separate block.
     """
 
-    data_type = 'json'
-
-    def update_tuples(self, target, decoded_extra_tuples, encoded_extra_tuples=None) -> bytes:
-        if self.data_type == 'json':
-            if len(target) == 5:
-                target.append([])
-            extra_tuples = target[5]
-            extra_tuples.extend(encoded_extra_tuples)
-            extra_tuples.extend(decoded_extra_tuples)
-            return target
-        elif self.data_type == 'json_text':
-            target_json = json.dumps(decoded_extra_tuples)
-            if encoded_extra_tuples:
-                for eet in encoded_extra_tuples:
-                    if eet:
-                        if eet[-1] == ']':
-                            target_json = '[' + eet + ', ' + target_json[1:]
-                        else:
-                            raise ValueError("Unexpected encoded JSON text tuple format")
-            if target[-2] == '}':
-                # If cached response doesn't contain any extra nodes, add a
-                # new field
-                return target[0:-1] + ', ' + target_json + ']'
-            elif target[-2] == ']':
-                return target[0:-2] + ', ' + target_json[1:] + ']'
-            else:
+    def __init__(self, encoding, parts, decoded_extra_parts=None):
+        if encoding == 'json':
+            if parts[0][-2:] != '}]':
                 raise ValueError("Unexpected cached JSON text tuple format")
-        elif self.data_type == 'msgpack':
-            total_extra_tuples = len(decoded_extra_tuples)
-            if encoded_extra_tuples:
-                total_extra_tuples += len(encoded_extra_tuples)
-            # To inject msgpack data, we first check the binary data
-            # representing the list length. In the eaiest case, we have five
-            # elements (\x95) and we can just append the data and change the
-            # list length.
-            if target[0] == b'\x95':
-                # Construct a new msgpack array manually to not create
-                # unnecessary copies.
-                extra_msgpack = b''
-                if encoded_extra_tuples:
-                    extra_msgpack = b''.join(t for t in encoded_extra_tuples if t)
-                    total_extra_tuples -= sum(1 for t in encoded_extra_tuples if not t)
-                else:
-                    extra_msgpack = b''
-
-                for det in decoded_extra_tuples:
-                    extra_msgpack += msgpack.packb(det)
-                bin_len = get_pack_array_header(total_extra_tuples)
-
-                # Extend the five-element list with extra tuples by making it a
-                # six element list and just appending the extra list
-                return bytes(b'\x96' + target[1:] + bin_len + extra_msgpack)
-            else:
+        elif encoding == 'msgpack':
+            if parts[0][:1] != b'\x95':
                 raise ValueError("Unexpected cached Msgpack tuple format")
+        elif encoding == 'columnar':
+            if len(parts[0]) < columnar.BLOCK_HEADER.size:
+                raise ValueError("Unexpected cached columnar tuple format")
         else:
-            raise ValueError("Unexpected cached JSON tuple format")
+            raise ValueError(f"Unknown encoding: {encoding}")
+        self.encoding = encoding
+        self.parts = parts
+        self.decoded_extra_parts = decoded_extra_parts or []
+
+    def decode_part(self, part) -> Any:
+        if self.encoding == 'msgpack':
+            return msgpack.unpackb(part, use_list=False)
+        elif self.encoding == 'columnar':
+            return columnar.decode_block(part)[0]
+        return ujson.loads(part)
+
+    def to_json(self, part) -> str:
+        if self.encoding == 'json':
+            return part
+        return ujson.dumps(self.decode_part(part))
+
+    def to_msgpack(self, part) -> bytes:
+        if self.encoding == 'msgpack':
+            return part
+        return msgpack.packb(self.decode_part(part))
+
+    def to_columnar(self, part) -> bytes:
+        if self.encoding == 'columnar':
+            return part
+        return columnar.encode_block(self.decode_part(part))
+
+    def iter_json(self) -> Iterator[str]:
+        # Replace the closing bracket of the first part with the extra list
+        yield self.to_json(self.parts[0])[:-1] + ', ['
+        separator = ''
+        for part in itertools.islice(self.parts, 1, None):
+            yield separator + self.to_json(part)
+            separator = ', '
+        for part in self.decoded_extra_parts:
+            yield separator + ujson.dumps(part)
+            separator = ', '
+        yield ']]'
+
+    def iter_msgpack(self) -> Iterator[bytes]:
+        # Extend the five element list of the first part to a six element list
+        # by changing its header and appending the extra list.
+        yield b'\x96' + self.to_msgpack(self.parts[0])[1:]
+        yield get_pack_array_header(len(self.parts) - 1 + len(self.decoded_extra_parts))
+        for part in itertools.islice(self.parts, 1, None):
+            yield self.to_msgpack(part)
+        for part in self.decoded_extra_parts:
+            yield msgpack.packb(part)
+
+    def iter_columnar(self) -> Iterator[bytes]:
+        extra_blocks = [b for part in self.decoded_extra_parts
+                for b in columnar.encode_blocks(part)]
+        yield columnar.get_file_header(len(self.parts) + len(extra_blocks))
+        for part in self.parts:
+            yield self.to_columnar(part)
+        for block in extra_blocks:
+            yield block
+
+    def decode(self) -> List:
+        result = list(self.decode_part(self.parts[0]))
+        extra = [self.decode_part(p) for p in itertools.islice(self.parts, 1, None)]
+        extra.extend(self.decoded_extra_parts)
+        result.append(extra)
+        return result
+
+
+class GridCachedNodeProvider(CachedNodeProvider):
+    """Find nodes in node grid caches. Results are returned as
+    EncodedNodeResult, which references the encoded cell data.
+    """
+
+    data_type = 'json'
 
     def get_tuples(self, params, project_id, explicit_treenode_ids,
             explicit_connector_ids, include_labels, with_relation_map,
@@ -321,23 +523,19 @@ class GridCachedNodeProvider(CachedNodeProvider):
         params['volume'] = (params['right'] - params['left']) * \
                 (params['bottom'] - params['top']) * (params['z2'] - params['z1'])
 
-        # For JSONB type cache, use ujson to decode, this is roughly 2x faster
-        psycopg2.extras.register_default_jsonb(loads=ujson.loads)
-        # Find grid that has a cell configuration closest to what we are looking for.
-        cursor.execute("""
-            SELECT id, cell_width, cell_height, cell_depth, n_lod_levels
-            FROM node_grid_cache g
-            WHERE project_id = %(project_id)s
-            ORDER BY @((g.cell_width::double precision * g.cell_height::double precision * g.cell_depth::double precision) - %(volume)s::double precision) ASC
-            LIMIT 1;
-        """, params)
+        # Apply all pending grid definition and cell updates. If no events can
+        # be received, the in-memory state is reset and the cell cache isn't
+        # used.
+        listening = node_cache_listener.poll()
 
-        grid_data = cursor.fetchone()
-        if not grid_data:
+        # Find grid that has a cell configuration closest to what we are looking for.
+        grid = grid_cache_registry.find_grid(project_id, params['volume'],
+                self.data_type, self.cache_id, cursor)
+        if not grid:
             return None, None
 
-        grid_id, cell_width, cell_height, cell_depth, lod_levels = grid_data[0], \
-                grid_data[1], grid_data[2], grid_data[3], grid_data[4]
+        grid_id, cell_width, cell_height, cell_depth, lod_levels = grid.id, \
+                grid.cell_width, grid.cell_height, grid.cell_depth, grid.n_lod_levels
 
         min_w_i = int(params['left'] // cell_width)
         min_h_i = int(params['top'] // cell_height)
@@ -371,52 +569,18 @@ class GridCachedNodeProvider(CachedNodeProvider):
         else:
             raise ValueError(f"Unknown LOD type: {lod_type}")
 
-        # Do the actual grid cell lookup in a separate query, to only use
-        # constant values in the index checks. The Z index condition is slightly
-        # special, because the parameter is exclusive
-        cursor.execute("""
-            SELECT {data_type_column}[%(lod_min)s:%(lod_max)s]
-            FROM node_grid_cache_cell c
-            LEFT JOIN dirty_node_grid_cache_cell dc
-                -- Alternative: use ON dc.id = c.id and have update function
-                -- create ID entries in the dirty table.
-                ON dc.grid_id = c.grid_id
-                AND dc.x_index = c.x_index
-                AND dc.y_index = c.y_index
-                AND dc.z_index = c.z_index
-            WHERE c.grid_id = %(grid_id)s
-                AND c.x_index >= %(min_x_index)s AND c.x_index <= %(max_x_index)s
-                AND c.y_index >= %(min_y_index)s AND c.y_index <= %(max_y_index)s
-                AND c.z_index >= %(min_z_index)s AND c.z_index < %(max_z_index)s
-                AND {data_type_column} IS NOT NULL
-        """.format(**{
-            'data_type_column': self.data_type + '_data',
-        }), {
-            'grid_id': grid_id,
-            'min_x_index': min_w_i,
-            'min_y_index': min_h_i,
-            'min_z_index': min_d_i,
-            'max_x_index': max_w_i,
-            'max_y_index': max_h_i,
-            'max_z_index': max_d_i,
-            'lod_min': lod_min,
-            'lod_max': lod_max,
-        })
-        rows = cursor.fetchall()
-
-
-        if rows and rows[0]:
-            # It is the first LOD of the LOD set of the first result cell.
-            first_cell_lods = rows[0][0]
-            tuples = first_cell_lods[0]
-
-            # All extra LODs that are included are transmitted as extra tuples.
-            extra_lod_cells = first_cell_lods[1:]
-            encoded_extra_tuples = [r for r in extra_lod_cells if r]
+        cells = self.get_cell_data(cursor, grid_id, lod_min, lod_max,
+                min_w_i, min_h_i, min_d_i, max_w_i, max_h_i, max_d_i,
+                use_cache=listening)
 
-            # Add all result LODs of each returned grid cell to extra tuples
-            for extra_row in rows[1:]:
-                encoded_extra_tuples.extend(r for r in extra_row[0])
+        if cells:
+            # The first LOD of the LOD set of the first result cell is the
+            # main result. All other included LODs of all returned grid cells
+            # are transmitted as extra tuples.
+            parts = [cells[0][0]]
+            parts.extend(r for r in cells[0][1:] if r)
+            for extra_cell in cells[1:]:
+                parts.extend(r for r in extra_cell if r)
 
             # If there are exta nodes required, query them explicitely using a
             # regular Postgis 2D query. Inject the result into cached data.
@@ -428,14 +592,161 @@ class GridCachedNodeProvider(CachedNodeProvider):
                 if extra_type != 'json':
                     raise ValueError("Unexpected type")
 
-            tuples = self.update_tuples(tuples,
-                    [decoded_extra_tuples] if decoded_extra_tuples else [],
-                    encoded_extra_tuples)
-
-            return tuples, self.data_type
+            encoding = 'json' if self.data_type == 'json_text' else self.data_type
+            return EncodedNodeResult(encoding, parts,
+                    [decoded_extra_tuples] if decoded_extra_tuples else []), \
+                    self.data_type
         else:
             return None, None
 
+    def get_cell_data(self, cursor, grid_id, lod_min, lod_max, min_x_index,
+            min_y_index, min_z_index, max_x_index, max_y_index, max_z_index,
+            use_cache=True) -> List:
+        """Return the selected LOD range of all materialized cells in the passed
+        in index range in their encoded form (JSON text or msgpack). The maximum
+        Z index is exclusive. If the grid cell cache is enabled, cells are
+        looked up in memory first and the database is only queried if at least
+        one cell isn't cached yet.
+        """
+        n_cells = (max_x_index - min_x_index + 1) * \
+                (max_y_index - min_y_index + 1) * (max_z_index - min_z_index)
+        use_cache = use_cache and grid_cell_cache.enabled and \
+                0 < n_cells <= GRID_CELL_CACHE_MAX_FOV_CELLS
+
+        if not use_cache:
+            cursor.execute(self.get_cell_query(), {
+                'grid_id': grid_id,
+                'min_x_index': min_x_index,
+                'min_y_index': min_y_index,
+                'min_z_index': min_z_index,
+                'max_x_index': max_x_index,
+                'max_y_index': max_y_index,
+                'max_z_index': max_z_index,
+                'lod_min': lod_min,
+                'lod_max': lod_max,
+            })
+            return [r[0] for r in cursor.fetchall()]
+
+        cell_keys = [(grid_id, x, y, z, lod_min, lod_max, self.data_type)
+                for z in range(min_z_index, max_z_index)
+                for y in range(min_y_index, max_y_index + 1)
+                for x in range(min_x_index, max_x_index + 1)]
+        cached_cells = [grid_cell_cache.get(k, _UNCACHED) for k in cell_keys]
+
+        if any(c is _UNCACHED for c in cached_cells):
+            cell_map = self.fetch_cells_into_cache(cursor, grid_id, lod_min,
+                    lod_max, min_x_index, min_y_index, min_z_index, max_x_index,
+                    max_y_index, max_z_index)
+            cached_cells = [cell_map.get(k[1:4]) for k in cell_keys]
+
+        return [c for c in cached_cells if c]
+
+    def fetch_cells_into_cache(self, cursor, grid_id, lod_min, lod_max,
+            min_x_index, min_y_index, min_z_index, max_x_index, max_y_index,
+            max_z_index) -> Dict[Tuple[int, int, int], Optional[Tuple]]:
+        """Query all cells in the passed in index range from the database and
+        add them to the grid cell cache. Cells that don't exist are cached as
+        None so that empty areas don't require a database query either. Cells
+        that are currently marked dirty are returned, but not cached, because
+        their update won't emit another event.
+        """
+        query_params = {
+            'grid_id': grid_id,
+            'min_x_index': min_x_index,
+            'min_y_index': min_y_index,
+            'min_z_index': min_z_index,
+            'max_x_index': max_x_index,
+            'max_y_index': max_y_index,
+            'max_z_index': max_z_index,
+            'lod_min': lod_min,
+            'lod_max': lod_max,
+        }
+        # Read the dirty cells before the cell data. A cell that is marked
+        # dirty after this query is updated by the cache worker later on,
+        # which invalidates whatever is cached from the cell query below. In
+        # the reverse order, a cell that is changed and cleaned in between both
+        # queries would be cached with stale data.
+        cursor.execute("""
+            SELECT x_index, y_index, z_index
+            FROM dirty_node_grid_cache_cell
+            WHERE grid_id = %(grid_id)s
+                AND x_index >= %(min_x_index)s AND x_index <= %(max_x_index)s
+                AND y_index >= %(min_y_index)s AND y_index <= %(max_y_index)s
+                AND z_index >= %(min_z_index)s AND z_index < %(max_z_index)s
+        """, query_params)
+        dirty_cells = set(cursor.fetchall())
+
+        cursor.execute(self.get_cell_query(with_index=True), query_params)
+        rows = cursor.fetchall()
+
+        cell_map:Dict[Tuple[int, int, int], Optional[Tuple]] = {}
+        for x, y, z, lods in rows:
+            if self.data_type in ('msgpack', 'columnar'):
+                lods = tuple(None if v is None else bytes(v) for v in lods)
+            else:
+                lods = tuple(lods)
+            cell_map[(x, y, z)] = lods
+
+        for z in range(min_z_index, max_z_index):
+            for y in range(min_y_index, max_y_index + 1):
+                for x in range(min_x_index, max_x_index + 1):
+                    cell = (x, y, z)
+                    if cell in dirty_cells:
+                        continue
+                    lods = cell_map.get(cell)
+                    size = sum(len(v) for v in lods if v) if lods else 0
+                    grid_cell_cache.set((grid_id, x, y, z, lod_min, lod_max,
+                            self.data_type), lods, size, (grid_id, x, y, z))
+
+        return cell_map
+
+    def get_cell_query(self, with_index=False) -> str:
+        """Get the grid cell lookup query. It uses only constant values in the
+        index checks. The Z index condition is slightly special, because the
+        parameter is exclusive.
+        """
+        data_type_column = self.data_type + '_data'
+        data_column = f'{data_type_column}[%(lod_min)s:%(lod_max)s]'
+        # Return JSON data in its encoded form
+        if self.data_type == 'json':
+            data_column += '::text[]'
+        if with_index:
+            data_column = 'c.x_index, c.y_index, c.z_index, ' + data_column
+
+        return f"""
+            SELECT {data_column}
+            FROM node_grid_cache_cell c
+            WHERE c.grid_id = %(grid_id)s
+                AND c.x_index >= %(min_x_index)s AND c.x_index <= %(max_x_index)s
+                AND c.y_index >= %(min_y_index)s AND c.y_index <= %(max_y_index)s
+                AND c.z_index >= %(min_z_index)s AND c.z_index < %(max_z_index)s
+                AND {data_type_column} IS NOT NULL
+            ORDER BY c.z_index, c.y_index, c.x_index
+        """
+
+
+def get_grid_cell_cache_stats() -> Dict[str, Any]:
+    """Return usage statistics of the grid cell cache of this process."""
+    return grid_cell_cache.stats()
+
+
+def get_dirty_grid_cell_stats(cursor=None) -> Dict[str, Any]:
+    """Return the number of grid cache cells that wait for an update
+    (queue_depth) and the time in seconds since the oldest of them has been
+    marked dirty (lag).
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute("""
+        SELECT COUNT(*), EXTRACT(EPOCH FROM now() - MIN(invalidation_time))
+        FROM dirty_node_grid_cache_cell
+    """)
+    queue_depth, lag = cursor.fetchone()
+    return {
+        'queue_depth': queue_depth,
+        'lag': float(lag) if lag is not None else 0.0,
+    }
+
 
 class GridCachedJsonNodeProvider(GridCachedNodeProvider):
     data_type = 'json'
@@ -448,12 +759,10 @@ class GridCachedJsonTextNodeProvider(GridCachedNodeProvider):
 class GridCachedMsgpackNodeProvider(GridCachedNodeProvider):
     data_type = 'msgpack'
 
-    def get_tuples(self, *args, **kwargs) -> Tuple[Any, Optional[str]]:
-        tuples, dt = super().get_tuples(*args, **kwargs)
-        if tuples:
-            return bytes(tuples), dt
-        else:
-            return tuples, dt
+
+class GridCachedColumnarNodeProvider(GridCachedNodeProvider):
+    data_type = 'columnar'
+
 
 class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
 
@@ -564,11 +873,15 @@ class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
             min_skeleton_nodes = params.get('min_skeleton_nodes')
             ordering = params.get('ordering')
 
-            if ordering and ordering not in ('cable-asc', 'cable-desc'):
+            if ordering and ordering not in ('cable-asc', 'cable-desc', 'importance'):
                 raise ValueError('Unknown ordering: ' + ordering)
 
             limit = n_largest_skeletons_limit + n_last_edited_skeletons_limit
 
+            if ordering == 'importance' and limit:
+                raise ValueError('The importance ordering can not be combined '
+                        'with skeleton limits')
+
             query = self.treenode_query_psycopg
 
             if limit:
@@ -640,7 +953,17 @@ class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
                 """
 
             result_order = ''
-            if ordering:
+            if ordering == 'importance':
+                # The node limit is applied after ordering, so that the most
+                # important nodes are returned.
+                limit_clause = '\nLIMIT %(limit)s'
+                if self.managed_limit and query.endswith(limit_clause):
+                    query = query[:-len(limit_clause)]
+                importance_join, result_order = get_importance_order_sql('basic_query')
+                if self.managed_limit and settings.NODE_LIST_MAXIMUM_COUNT:
+                    result_order += limit_clause
+                extra_join += importance_join
+            elif ordering:
                 if ordering == 'cable-asc':
                     result_order = 'ORDER BY length.cable_length ASC'
                 elif ordering == 'cable-desc':
@@ -1392,6 +1715,7 @@ AVAILABLE_NODE_PROVIDERS = {
     'cached_json_grid': GridCachedJsonNodeProvider,
     'cached_json_text_grid': GridCachedJsonTextNodeProvider,
     'cached_msgpack_grid': GridCachedMsgpackNodeProvider,
+    'cached_columnar_grid': GridCachedColumnarNodeProvider,
 }
 
 
@@ -1431,7 +1755,9 @@ def get_configured_node_providers(provider_entries, connection=None,
         include = options.get('enabled', True) or not enabled_only
         if Provider:
             if include:
-                node_providers.append(Provider(connection, **options))
+                provider_options = dict(options)
+                provider_options.setdefault('name', key)
+                node_providers.append(Provider(connection, **provider_options))
         else:
             raise ValueError('Unknown node provider: ' + key)
 
@@ -1442,13 +1768,13 @@ def update_node_query_cache(node_providers=None, log=print, force=False) -> None
     if not node_providers:
         node_providers = get_node_provider_configs()
 
-    for np in node_providers:
-        log(f"Checking node provider {np}")
-        if type(np) in (list, tuple):
-            key = np[0]
-            options = np[1]
+    for node_provider in node_providers:
+        log(f"Checking node provider {node_provider}")
+        if type(node_provider) in (list, tuple):
+            key = node_provider[0]
+            options = node_provider[1]
         else:
-            key = np
+            key = node_provider
             options = {}
 
         project_id = options.get('project_id')
@@ -1763,18 +2089,23 @@ def update_cache(project_id, data_type, orientations, steps, node_limit=None,
 def process_batch(cell_defs, project_id, grid_id, cell_width, cell_height,
         cell_depth, params, allow_empty, lod_levels,
         lod_bucket_size, lod_strategy, update_json_cache,
-        update_json_text_cache, update_msgpack_cache):
+        update_json_text_cache, update_msgpack_cache, dry_run=False,
+        provider=None, cursor=None, update_columnar_cache=False):
     created_in_process = 0
     processed = 0
-    for w_i, h_i, d_i in cell_defs:
-        added = update_grid_cell(project_id, grid_id, w_i,
-            h_i, d_i, cell_width, cell_height, cell_depth, params,
-            allow_empty, lod_levels, lod_bucket_size, lod_strategy,
-            update_json_cache, update_json_text_cache,
-            update_msgpack_cache)
-        processed += 1
-        if added:
-            created_in_process += 1
+    with transaction.atomic():
+        for w_i, h_i, d_i in cell_defs:
+            added = update_grid_cell(project_id, grid_id, w_i,
+                h_i, d_i, cell_width, cell_height, cell_depth, params,
+                allow_empty, lod_levels, lod_bucket_size, lod_strategy,
+                update_json_cache, update_json_text_cache,
+                update_msgpack_cache, provider=provider, cursor=cursor,
+                update_columnar_cache=update_columnar_cache)
+            processed += 1
+            if added:
+                created_in_process += 1
+        if dry_run:
+            transaction.set_rollback(True)
     return processed, created_in_process
 
 
@@ -1787,9 +2118,20 @@ def update_grid_cache(project_id, data_type, orientations,
         delete=False, bb_limits=None, log=print, progress=True,
         allow_empty=False, lod_levels=1, lod_bucket_size=500,
         lod_strategy='quadratic', jobs=1, depth_steps=1, chunksize=10,
-        ordering=None) -> None:
-    if data_type not in ('json', 'json_text', 'msgpack'):
-        raise ValueError('Type must be one of: json, json_text, msgpack')
+        ordering=None, slab_size=None, checkpoint=None, dry_run=False) -> None:
+    """Populate a grid cache for a project. By default each cell is queried
+    individually and <chunksize> cells are processed by each task in a parallel
+    run. If a <slab_size> is passed in, cells are processed in slabs of up to
+    this many cells of the same depth, each one computed with a single spatial
+    query and written with multi-row upserts. In a parallel run, each task
+    processes one slab. If a <checkpoint> file path is passed in, completed
+    work units are recorded in it and skipped when the update is run again with
+    the same slab and chunk size. The file is removed after a complete run. If
+    <dry_run> is true, all cell updates are rolled back, which is mainly useful
+    for benchmarking.
+    """
+    if data_type not in ('json', 'json_text', 'msgpack', 'columnar'):
+        raise ValueError('Type must be one of: json, json_text, msgpack, columnar')
     if project_id is None:
         raise ValueError('Need project ID')
     if not cell_width:
@@ -1867,12 +2209,20 @@ def update_grid_cache(project_id, data_type, orientations,
     update_json_cache = 'json' in data_types
     update_json_text_cache = 'json_text' in data_types
     update_msgpack_cache = 'msgpack' in data_types
+    update_columnar_cache = 'columnar' in data_types
 
     provider = Postgis3dNodeProvider()
     types = ', '.join(data_types)
 
+    if slab_size and not supports_grid_cell_batches(params):
+        log(' -> Skeleton limits depend on the field of view, cells in slabs are queried individually')
+
     executor = futures.ProcessPoolExecutor(jobs)
 
+    if checkpoint:
+        checkpoint = GridCacheCheckpoint(checkpoint, slab_size, chunksize)
+        log(f' -> Resuming from checkpoint with {len(checkpoint.completed)} completed work units')
+
     for o in orientations:
         orientation_id = ORIENTATIONS[o]
         log(f' -> Populating grid cache for orientation {o} with block size {(cell_width, cell_height, cell_depth)} (x, y, z) for types: {types}')
@@ -1898,7 +2248,22 @@ def update_grid_cache(project_id, data_type, orientations,
         })
         grid_ids = cursor.fetchall()
         if grid_ids:
-            grid_id = grid_ids[0]
+            grid_id = grid_ids[0][0]
+            # Make sure the grid is known to provide the updated data type
+            cursor.execute("""
+                UPDATE node_grid_cache
+                SET has_json_data = has_json_data OR %(has_json_data)s,
+                    has_json_text_data = has_json_text_data OR %(has_json_text_data)s,
+                    has_msgpack_data = has_msgpack_data OR %(has_msgpack_data)s,
+                    has_columnar_data = has_columnar_data OR %(has_columnar_data)s
+                WHERE id = %(grid_id)s
+            """, {
+                'grid_id': grid_id,
+                'has_json_data': update_json_cache,
+                'has_json_text_data': update_json_text_cache,
+                'has_msgpack_data': update_msgpack_cache,
+                'has_columnar_data': update_columnar_cache,
+            })
         else:
             cursor.execute("""
                 INSERT INTO node_grid_cache (project_id, orientation,
@@ -1906,13 +2271,13 @@ def update_grid_cache(project_id, data_type, orientations,
                     n_last_edited_skeletons_limit, hidden_last_editor_id,
                     n_lod_levels, lod_min_bucket_size, lod_strategy, allow_empty,
                     has_json_data, has_json_text_data, has_msgpack_data,
-                    ordering)
+                    has_columnar_data, ordering)
                 VALUES (%(project_id)s, %(orientation)s, %(cell_width)s,
                     %(cell_height)s, %(cell_depth)s, %(n_largest_sk_limit)s,
                     %(n_last_edit_limit)s, %(hidden_last_editor_id)s,
                     %(n_lod_levels)s, %(lod_min_bucket_size)s, %(lod_strategy)s,
                     %(allow_empty)s, %(has_json_data)s, %(has_json_text_data)s,
-                    %(has_msgpack_data)s, %(ordering)s)
+                    %(has_msgpack_data)s, %(has_columnar_data)s, %(ordering)s)
                 RETURNING id;
             """, {
                 'project_id': project_id,
@@ -1930,6 +2295,7 @@ def update_grid_cache(project_id, data_type, orientations,
                 'has_json_data': update_json_cache,
                 'has_json_text_data': update_json_text_cache,
                 'has_msgpack_data': update_msgpack_cache,
+                'has_columnar_data': update_columnar_cache,
                 'ordering': ordering,
             })
             grid_id = cursor.fetchone()[0]
@@ -1960,6 +2326,7 @@ def update_grid_cache(project_id, data_type, orientations,
 
         counter = 0
         created = 0
+        start_time = time.time()
 
         # If the effective bounding box should be reavaluated
         for depth_section in range(depth_steps):
@@ -2028,51 +2395,99 @@ def update_grid_cache(project_id, data_type, orientations,
                         for w_i in range(local_min_w_i, local_max_w_i + 1):
                             yield w_i, h_i, d_i
 
+            def iterate_slabs():
+                """A generator to iterate the local cell space in slabs of at
+                most <slab_size> cells. A slab covers complete rows of the same
+                depth, if possible.
+                """
+                n_row_cells = local_max_w_i - local_min_w_i + 1
+                n_slab_rows = max(1, slab_size // n_row_cells)
+                n_slab_cols = min(n_row_cells, slab_size)
+                for d_i in range(local_min_d_i, local_max_d_i + 1):
+                    for h_start in range(local_min_h_i, local_max_h_i + 1, n_slab_rows):
+                        h_end = min(h_start + n_slab_rows, local_max_h_i + 1)
+                        for w_start in range(local_min_w_i, local_max_w_i + 1, n_slab_cols):
+                            w_end = min(w_start + n_slab_cols, local_max_w_i + 1)
+                            yield [(w_i, h_i, d_i) for h_i in range(h_start, h_end)
+                                    for w_i in range(w_start, w_end)]
+
+            if slab_size:
+                work_units = iterate_slabs()
+                process = process_slab
+            else:
+                work_units = batches(iterate_space(), chunksize)
+                process = process_batch
+
+            def pending(work_units):
+                nonlocal counter
+                for cell_defs in work_units:
+                    if checkpoint and checkpoint.is_done(grid_id, cell_defs):
+                        if progress:
+                            counter += len(cell_defs)
+                            bar.update(counter)
+                        continue
+                    yield cell_defs
+
             if jobs > 1:
                 # We need to close all database connections to not accidentally
                 # share the file descriptors of current connections with forks.
                 connections.close_all()
 
-                tasks = [executor.submit(process_batch, cell_defs, project_id,
+                tasks = {executor.submit(process, cell_defs, project_id,
                         grid_id, cell_width, cell_height, cell_depth, params,
                         allow_empty, lod_levels, lod_bucket_size, lod_strategy,
                         update_json_cache, update_json_text_cache,
-                        update_msgpack_cache)
-                    for cell_defs in batches(iterate_space(), chunksize)]
+                        update_msgpack_cache, dry_run,
+                        update_columnar_cache=update_columnar_cache): cell_defs
+                    for cell_defs in pending(work_units)}
 
                 for future in futures.as_completed(tasks):
                     result = future.result()
+                    if checkpoint:
+                        checkpoint.mark_done(grid_id, tasks[future])
                     if progress:
                         counter += result[0]
                         bar.update(counter)
                     created += result[1]
             else:
-                for w_i, h_i, d_i in iterate_space():
+                cursor = connection.cursor()
+                for cell_defs in pending(work_units):
+                    result = process(cell_defs, project_id, grid_id,
+                            cell_width, cell_height, cell_depth, params,
+                            allow_empty, lod_levels, lod_bucket_size,
+                            lod_strategy, update_json_cache,
+                            update_json_text_cache, update_msgpack_cache,
+                            dry_run, provider=provider, cursor=cursor,
+                            update_columnar_cache=update_columnar_cache)
+                    if checkpoint:
+                        checkpoint.mark_done(grid_id, cell_defs)
                     if progress:
-                        counter += 1
+                        counter += result[0]
                         bar.update(counter)
+                    created += result[1]
 
-                    added = update_grid_cell(project_id, grid_id, w_i, h_i, d_i,
-                            cell_width, cell_height, cell_depth, provider,
-                            params, allow_empty, lod_levels, lod_bucket_size,
-                            lod_strategy, update_json_cache,
-                            update_json_text_cache, update_msgpack_cache, cursor)
-                    if added:
-                        created += 1
-
+        duration = time.time() - start_time
         log(f' -> Materialized {created} grid cells')
+        if not dry_run and overlay_tile_cache.path:
+            overlay_tile_cache.clear((grid_id,), delete_files=True)
+        log(f' -> Processed {counter} grid cells in {duration:.2f}s ({counter / max(duration, 1e-9):.2f} cells/s)')
         if progress:
             bar.finish()
 
+    # All work units are complete, a later update starts from scratch.
+    if checkpoint:
+        checkpoint.remove()
+
 
 def update_grid_cell(project_id, grid_id, w_i, h_i, d_i, cell_width,
         cell_height, cell_depth, params, allow_empty, lod_levels,
         lod_bucket_size, lod_strategy, update_json_cache,
-        update_json_text_cache, update_msgpack_cache, provider=None, cursor=None) -> bool:
+        update_json_text_cache, update_msgpack_cache, provider=None,
+        cursor=None, update_columnar_cache=False) -> bool:
     params['left'] = w_i * cell_width
     params['right'] = (w_i + 1) * cell_width
     params['top'] = h_i * cell_height
-    params['bottom'] = (h_i + 1) * cell_width
+    params['bottom'] = (h_i + 1) * cell_height
     params['z1'] = d_i * cell_depth
     params['z2'] = (d_i + 1) * cell_depth
 
@@ -2139,9 +2554,314 @@ def update_grid_cell(project_id, grid_id, w_i, h_i, d_i, cell_width,
             'data':  [None if not v else psycopg2.Binary(msgpack.packb(v)) for v in result_buckets],
         })
 
+    if update_columnar_cache:
+        cursor.execute("""
+            INSERT INTO node_grid_cache_cell (grid_id,
+                x_index, y_index, z_index, update_time, columnar_data)
+            VALUES (%(grid_id)s, %(x_index)s, %(y_index)s, %(z_index)s,
+                now(), %(data)s)
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET columnar_data = EXCLUDED.columnar_data, update_time = EXCLUDED.update_time;
+        """, {
+            'grid_id': grid_id,
+            'x_index': w_i,
+            'y_index': h_i,
+            'z_index': d_i,
+            'data':  [None if not v else psycopg2.Binary(columnar.encode_block(v)) for v in result_buckets],
+        })
+
     return True
 
 
+def supports_grid_cell_batches(params) -> bool:
+    """Whether cells can be computed from a single query for a group of cells.
+    Limits that select skeletons relative to a particular field of view (e.g.
+    the N largest skeletons in view) require a separate query for each cell.
+    """
+    return not (params.get('n_largest_skeletons_limit') or
+            params.get('n_last_edited_skeletons_limit'))
+
+
+def partition_node_result(result_tuple, cells, cell_width, cell_height,
+        cell_depth, node_limit=None) -> Dict[Tuple[int, int, int], List]:
+    """Split the result of a node query for a volume into results for the
+    passed in grid cells. A treenode and its parent are added to every cell
+    that the edge between them intersects, a root node to the cell it is
+    located in. Treenodes whose parent isn't part of the result are skipped. A
+    connector is added to the cell it is located in and to every cell that one
+    of its links to a treenode of the result intersects. In the latter case,
+    the linked treenode is added as well and only links intersecting the cell
+    are kept. Labels are only added for treenodes located in a cell and for
+    connectors in its Z range. Treenodes keep their original order and are
+    truncated to <node_limit> per cell. This doesn't exactly match querying
+    each cell individually, because the spatial query and its limits are
+    applied to the whole volume. Returns a dictionary that maps each cell
+    index tuple to a result in the regular node list format.
+    """
+    treenodes, connectors, labels = result_tuple[0], result_tuple[1], result_tuple[2]
+    relation_map = result_tuple[4] if len(result_tuple) > 4 else {}
+
+    cell_treenodes:Dict[Tuple[int, int, int], Set] = {c: set() for c in cells}
+    cell_connectors:DefaultDict[Tuple[int, int, int], List] = defaultdict(list)
+
+    def intersected(p1, p2):
+        if p1 == p2:
+            cell = (int(p1[0] // cell_width), int(p1[1] // cell_height),
+                    int(p1[2] // cell_depth))
+            return (cell,) if cell in cell_treenodes else ()
+        return [c for c in map(tuple, get_intersected_grid_cells(p1, p2,
+                cell_width, cell_height, cell_depth)) if c in cell_treenodes]
+
+    locations = {t[0]: (t[2], t[3], t[4]) for t in treenodes}
+    for t in treenodes:
+        location = locations[t[0]]
+        parent_location = locations.get(t[1]) if t[1] else location
+        if parent_location is None:
+            continue
+        for cell in intersected(location, parent_location):
+            cell_treenodes[cell].add(t[0])
+            if t[1]:
+                cell_treenodes[cell].add(t[1])
+
+    for c in connectors:
+        location = (c[1], c[2], c[3])
+        cell_links:Dict[Tuple[int, int, int], List] = {}
+        for cell in intersected(location, location):
+            cell_links[cell] = []
+        for link in c[7]:
+            treenode_location = locations.get(link[0])
+            if treenode_location is None:
+                continue
+            for cell in intersected(treenode_location, location):
+                cell_links.setdefault(cell, []).append(link)
+                cell_treenodes[cell].add(link[0])
+        for cell, links in cell_links.items():
+            cell_connectors[cell].append(c[0:7] + (links,))
+
+    # Keep the order of the original result in each cell
+    treenode_index = {t[0]: i for i, t in enumerate(treenodes)}
+
+    cell_results = {}
+    for cell, treenode_ids in cell_treenodes.items():
+        left, top, z1 = cell[0] * cell_width, cell[1] * cell_height, cell[2] * cell_depth
+        right, bottom, z2 = left + cell_width, top + cell_height, z1 + cell_depth
+        cell_nodes = [treenodes[i] for i in sorted(treenode_index[n] for n in treenode_ids)]
+        limit_reached = False
+        if node_limit and len(cell_nodes) >= node_limit:
+            cell_nodes = cell_nodes[:node_limit]
+            limit_reached = True
+        connector_rows = cell_connectors.get(cell, [])
+        cell_labels = {}
+        used_relations = {}
+        if labels:
+            for t in cell_nodes:
+                if t[0] in labels and left <= t[2] < right and \
+                        top <= t[3] < bottom and z1 <= t[4] < z2:
+                    cell_labels[t[0]] = labels[t[0]]
+            for c in connector_rows:
+                if c[0] in labels and z1 <= c[3] < z2:
+                    cell_labels[c[0]] = labels[c[0]]
+        for c in connector_rows:
+            for link in c[7]:
+                if link[1] in relation_map:
+                    used_relations[link[1]] = relation_map[link[1]]
+        cell_results[cell] = [cell_nodes, connector_rows, cell_labels,
+                limit_reached, used_relations]
+
+    return cell_results
+
+
+def update_grid_cells(project_id, grid_id, cells, cell_width, cell_height,
+        cell_depth, params, allow_empty, lod_levels, lod_bucket_size,
+        lod_strategy, update_json_cache, update_json_text_cache,
+        update_msgpack_cache, provider=None, cursor=None,
+        update_columnar_cache=False) -> Tuple[int, int]:
+    """Update a group of grid cells using a single spatial query for their
+    bounding box. The result is partitioned into cells on the client and
+    written using multi-row upserts. Cells that became empty are removed,
+    unless empty cells are allowed. Returns a two-tuple with the number of
+    written and removed cells.
+    """
+    if not cells:
+        return 0, 0
+
+    if not provider:
+        provider = Postgis3dNodeProvider()
+
+    if not cursor:
+        cursor = connection.cursor()
+
+    cells = [tuple(c) for c in cells]
+
+    empty_cells = []
+
+    # Fall back to individual cell queries if cell results depend on the
+    # field of view.
+    if not supports_grid_cell_batches(params):
+        for w_i, h_i, d_i in cells:
+            if not update_grid_cell(project_id, grid_id, w_i, h_i, d_i,
+                    cell_width, cell_height, cell_depth, params, allow_empty,
+                    lod_levels, lod_bucket_size, lod_strategy,
+                    update_json_cache, update_json_text_cache,
+                    update_msgpack_cache, provider=provider, cursor=cursor,
+                    update_columnar_cache=update_columnar_cache):
+                empty_cells.append((w_i, h_i, d_i))
+        return len(cells) - len(empty_cells), \
+                delete_grid_cells(grid_id, empty_cells, cursor)
+
+    query_params = dict(params)
+    query_params.update({
+        'left': min(c[0] for c in cells) * cell_width,
+        'right': (max(c[0] for c in cells) + 1) * cell_width,
+        'top': min(c[1] for c in cells) * cell_height,
+        'bottom': (max(c[1] for c in cells) + 1) * cell_height,
+        'z1': min(c[2] for c in cells) * cell_depth,
+        'z2': (max(c[2] for c in cells) + 1) * cell_depth,
+        # The node limit is applied to each cell individually
+        'limit': None,
+    })
+    result_tuple = _node_list_tuples_query(query_params, project_id, provider,
+            include_labels=True)
+    cell_results = partition_node_result(result_tuple, cells, cell_width,
+            cell_height, cell_depth, params.get('limit'))
+
+    json_rows, json_text_rows, msgpack_rows, columnar_rows = [], [], [], []
+    for (w_i, h_i, d_i), cell_result in cell_results.items():
+        if not (allow_empty or cell_result[0] or cell_result[1]):
+            empty_cells.append((w_i, h_i, d_i))
+            continue
+
+        result_buckets = get_lod_buckets(cell_result, lod_levels,
+                lod_bucket_size, lod_strategy)
+
+        if update_json_cache or update_json_text_cache:
+            data = [None if not v else json.dumps(v) for v in result_buckets]
+            if update_json_cache:
+                json_rows.append((grid_id, w_i, h_i, d_i, data))
+            if update_json_text_cache:
+                json_text_rows.append((grid_id, w_i, h_i, d_i, data))
+
+        if update_msgpack_cache:
+            msgpack_rows.append((grid_id, w_i, h_i, d_i,
+                    [None if not v else psycopg2.Binary(msgpack.packb(v)) for v in result_buckets]))
+
+        if update_columnar_cache:
+            columnar_rows.append((grid_id, w_i, h_i, d_i,
+                    [None if not v else psycopg2.Binary(columnar.encode_block(v)) for v in result_buckets]))
+
+    for column, cast, rows in (('json_data', 'jsonb[]', json_rows),
+            ('json_text_data', 'text[]', json_text_rows),
+            ('msgpack_data', 'bytea[]', msgpack_rows),
+            ('columnar_data', 'bytea[]', columnar_rows)):
+        if not rows:
+            continue
+        psycopg2.extras.execute_values(cursor, f"""
+            INSERT INTO node_grid_cache_cell (grid_id,
+                x_index, y_index, z_index, update_time, {column})
+            VALUES %s
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET {column} = EXCLUDED.{column}, update_time = EXCLUDED.update_time;
+        """, rows, template=f"(%s, %s, %s, %s, now(), %s::{cast})", page_size=500)
+
+    return len(cell_results) - len(empty_cells), \
+            delete_grid_cells(grid_id, empty_cells, cursor)
+
+
+def delete_grid_cells(grid_id, cells, cursor=None) -> int:
+    """Remove the passed in cells from a grid cache and return the number of
+    removed cells.
+    """
+    if not cells:
+        return 0
+
+    if not cursor:
+        cursor = connection.cursor()
+
+    cursor.execute("""
+        DELETE FROM node_grid_cache_cell c
+        USING UNNEST(%(x_index)s::int[], %(y_index)s::int[], %(z_index)s::int[])
+            empty(x_index, y_index, z_index)
+        WHERE c.grid_id = %(grid_id)s
+            AND c.x_index = empty.x_index
+            AND c.y_index = empty.y_index
+            AND c.z_index = empty.z_index
+    """, {
+        'grid_id': grid_id,
+        'x_index': [c[0] for c in cells],
+        'y_index': [c[1] for c in cells],
+        'z_index': [c[2] for c in cells],
+    })
+    return cursor.rowcount
+
+
+def process_slab(cells, project_id, grid_id, cell_width, cell_height,
+        cell_depth, params, allow_empty, lod_levels, lod_bucket_size,
+        lod_strategy, update_json_cache, update_json_text_cache,
+        update_msgpack_cache, dry_run=False, provider=None,
+        cursor=None, update_columnar_cache=False) -> Tuple[int, int]:
+    """Update all cells of a slab in a separate transaction. If <dry_run> is
+    true, the transaction is rolled back. Returns the number of processed and
+    written cells.
+    """
+    with transaction.atomic():
+        written, _ = update_grid_cells(project_id, grid_id, cells, cell_width,
+                cell_height, cell_depth, params, allow_empty, lod_levels,
+                lod_bucket_size, lod_strategy, update_json_cache,
+                update_json_text_cache, update_msgpack_cache,
+                provider=provider, cursor=cursor,
+                update_columnar_cache=update_columnar_cache)
+        if dry_run:
+            transaction.set_rollback(True)
+    return len(cells), written
+
+
+class GridCacheCheckpoint():
+    """Keep track of completed work units of a grid cache update in a file, so
+    that an interrupted update can be resumed. Each line of the file stores the
+    grid ID, the slab size and chunk size of the update, the first cell and the
+    number of cells of a completed unit. Units of runs with other parameters
+    therefore don't match. The file is removed once an update is complete.
+    """
+
+    def __init__(self, path, slab_size=None, chunksize=None):
+        self.path = path
+        # Slabs and chunks are mutually exclusive, only the used one matters.
+        self.params = (slab_size or 0, 0 if slab_size else (chunksize or 0))
+        self.completed:Set[Tuple[int, ...]] = set()
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self.completed.add(tuple(int(v) for v in line.split()))
+        except FileNotFoundError:
+            pass
+        self._file = open(path, 'a')
+
+    def key(self, grid_id, cells) -> Tuple[int, ...]:
+        return (grid_id,) + self.params + tuple(cells[0]) + (len(cells),)
+
+    def is_done(self, grid_id, cells) -> bool:
+        return self.key(grid_id, cells) in self.completed
+
+    def mark_done(self, grid_id, cells) -> None:
+        key = self.key(grid_id, cells)
+        self.completed.add(key)
+        self._file.write(' '.join(map(str, key)) + '\n')
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def remove(self) -> None:
+        """Close and delete the checkpoint file, e.g. after a complete run."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
 def prepare_db_statements(connection) -> None:
     node_providers = get_configured_node_providers(get_node_provider_configs(), connection)
     for node_provider in node_providers:
@@ -2249,7 +2969,9 @@ def node_list_tuples(request:HttpRequest, project_id=None, provider=None) -> Htt
       paramType: form
     - name: format
       description: |
-        Either "json" (default) or "msgpack", optional.
+        Either "json" (default), "msgpack" or "columnar", optional. The
+        columnar format stores node properties as typed little endian
+        arrays, its layout is documented in catmaid.control.columnar.
       required: false
       type: string
       paramType: form
@@ -2297,8 +3019,10 @@ def node_list_tuples(request:HttpRequest, project_id=None, provider=None) -> Htt
       paramType: form
     - name: order
       description: |
-        Either empty, cable-asc or cable-desc. Will return in a particular
-        order. By default, no ordering is applied.
+        Either empty, cable-asc, cable-desc or importance. Will return in a
+        particular order. With importance ordering, root, branch and leaf nodes
+        of large and recently edited skeletons are returned first and the node
+        limit is applied after ordering. By default, no ordering is applied.
       required: false
       type: string
       paramType: form
@@ -2556,23 +3280,232 @@ def compile_node_list_result(project_id, node_providers, params,
     override_provider is not passed in, the list of node_providers will be
     iterated until a result is found.
     """
-    result_tuple, data_type = None, None
-    for node_provider in node_providers:
-        if node_provider.matches(params):
-            result = node_provider.get_tuples(params, project_id,
-                explicit_treenode_ids, explicit_connector_ids, include_labels,
-                with_relation_map, with_origin)
-            result_tuple, data_type = result
+    result_tuple, data_type = get_node_list_result(project_id, node_providers,
+            params, explicit_treenode_ids, explicit_connector_ids,
+            include_labels, with_relation_map, with_origin)
 
-            if result_tuple and data_type:
-                break
+    return create_node_response(result_tuple, params, target_format, target_options, data_type)
+
+class NodeProviderStats():
+    """Collect per-process request, hit, error and latency statistics for each
+    node provider. Latency percentiles are computed from the last <window>
+    requests of a provider.
+    """
+
+    def __init__(self, window:int=1000):
+        self.window = window
+        self._lock = threading.Lock()
+        self._stats:Dict[str, Dict[str, Any]] = {}
+
+    def record(self, name:str, duration:float, hit:bool, error:bool=False,
+            cancelled:bool=False) -> None:
+        """Record a provider request. Cancelled requests are those that were
+        still running when another provider returned a result first.
+        """
+        with self._lock:
+            entry = self._stats.get(name)
+            if entry is None:
+                entry = self._stats[name] = {
+                    'requests': 0,
+                    'hits': 0,
+                    'errors': 0,
+                    'cancelled': 0,
+                    'total_time': 0.0,
+                    'durations': deque(maxlen=self.window),
+                }
+            entry['requests'] += 1
+            entry['total_time'] += duration
+            entry['durations'].append(duration)
+            if hit:
+                entry['hits'] += 1
+            if error:
+                entry['errors'] += 1
+            if cancelled:
+                entry['cancelled'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            result = {}
+            for name, entry in self._stats.items():
+                durations = sorted(entry['durations'])
+                n = len(durations)
+                result[name] = {
+                    'requests': entry['requests'],
+                    'hits': entry['hits'],
+                    'errors': entry['errors'],
+                    'cancelled': entry['cancelled'],
+                    'hit_rate': entry['hits'] / entry['requests'],
+                    'mean_time': entry['total_time'] / entry['requests'],
+                    'p50_time': durations[n // 2] if n else None,
+                    'p95_time': durations[min(n - 1, int(n * 0.95))] if n else None,
+                    'max_time': durations[-1] if n else None,
+                }
+            return result
+
+
+node_provider_stats = NodeProviderStats()
+
+# Threads that run hedged node provider requests, each one uses its own
+# database connection.
+_hedge_executor:Optional[futures.ThreadPoolExecutor] = None
+_hedge_executor_lock = threading.Lock()
+
+
+def get_hedge_executor() -> futures.ThreadPoolExecutor:
+    global _hedge_executor
+    with _hedge_executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = futures.ThreadPoolExecutor(
+                    settings.NODE_PROVIDER_HEDGE_THREADS,
+                    thread_name_prefix='node-provider')
+        return _hedge_executor
+
+
+def get_node_provider_stats() -> Dict[str, Dict[str, Any]]:
+    """Return latency and hit statistics of all node providers used by this
+    process.
+    """
+    return node_provider_stats.stats()
+
+
+def get_node_list_result(project_id, node_providers, params,
+        explicit_treenode_ids=tuple(), explicit_connector_ids=tuple(),
+        include_labels=False, with_relation_map=True,
+        with_origin=False, hedge_delay=None) -> Tuple[Any, str]:
+    """Return the result and data type of the first node provider that matches
+    the passed in query and returns a result. If a hedge delay (in seconds) is
+    passed in or configured with NODE_PROVIDER_HEDGE_DELAY, providers are
+    queried concurrently (see get_hedged_node_list_result()).
+    """
+    if hedge_delay is None:
+        hedge_delay = settings.NODE_PROVIDER_HEDGE_DELAY
+    matching_providers = [p for p in node_providers if p.matches(params)]
+    if hedge_delay is not None and len(matching_providers) > 1:
+        return get_hedged_node_list_result(project_id, matching_providers,
+                params, explicit_treenode_ids, explicit_connector_ids,
+                include_labels, with_relation_map, with_origin, hedge_delay)
+
+    result_tuple, data_type = None, None
+    for node_provider in matching_providers:
+        start = time.perf_counter()
+        try:
+            result_tuple, data_type = node_provider.get_tuples(params,
+                    project_id, explicit_treenode_ids, explicit_connector_ids,
+                    include_labels, with_relation_map, with_origin)
+        except Exception:
+            node_provider_stats.record(node_provider.name,
+                    time.perf_counter() - start, False, error=True)
+            raise
+        hit = bool(result_tuple and data_type)
+        node_provider_stats.record(node_provider.name,
+                time.perf_counter() - start, hit)
+        if hit:
+            break
 
     if not (result_tuple and data_type):
         raise ValueError("Could not find matching node provider for request")
 
-    return create_node_response(result_tuple, params, target_format, target_options, data_type)
+    return result_tuple, data_type
+
+
+def get_hedged_node_list_result(project_id, node_providers, params,
+        explicit_treenode_ids, explicit_connector_ids, include_labels,
+        with_relation_map, with_origin, hedge_delay) -> Tuple[Any, str]:
+    """Query the passed in node providers concurrently, each one in a separate
+    thread with its own database connection. The first provider starts
+    immediately, every following provider starts if no result is available
+    after <hedge_delay> seconds or once all running providers missed or
+    failed. The first result wins. Results of slower providers are discarded.
+    Errors are only raised if no provider returns a result.
+    """
+    executor = get_hedge_executor()
+    # Requests that didn't finish before another provider returned a result
+    # are recorded as cancelled.
+    winner_found = threading.Event()
+
+    def query(node_provider):
+        close_old_connections()
+        start = time.perf_counter()
+        try:
+            # Providers can add information to the query parameters.
+            result = node_provider.get_tuples(dict(params), project_id,
+                    explicit_treenode_ids, explicit_connector_ids,
+                    include_labels, with_relation_map, with_origin)
+        except Exception:
+            node_provider_stats.record(node_provider.name,
+                    time.perf_counter() - start, False, error=True,
+                    cancelled=winner_found.is_set())
+            raise
+        finally:
+            close_old_connections()
+        hit = bool(result[0] and result[1])
+        node_provider_stats.record(node_provider.name,
+                time.perf_counter() - start, hit,
+                cancelled=winner_found.is_set())
+        return result
+
+    remaining = list(node_providers)
+    pending:Set[futures.Future] = set()
+    errors = []
+    while remaining or pending:
+        if remaining and (not pending or hedge_delay == 0):
+            pending.add(executor.submit(query, remaining.pop(0)))
+            if hedge_delay == 0:
+                continue
+        done, pending = futures.wait(pending,
+                timeout=hedge_delay if remaining else None,
+                return_when=futures.FIRST_COMPLETED)
+        if not done and remaining:
+            # No result within the hedge delay, start the next provider.
+            pending.add(executor.submit(query, remaining.pop(0)))
+            continue
+        for future in done:
+            try:
+                result_tuple, data_type = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if result_tuple and data_type:
+                winner_found.set()
+                for f in pending:
+                    f.cancel()
+                return result_tuple, data_type
+
+    if errors:
+        raise errors[0]
+    raise ValueError("Could not find matching node provider for request")
+
+def decode_node_result(result, data_type) -> List:
+    """Return the passed in node query result as regular list."""
+    if isinstance(result, EncodedNodeResult):
+        return result.decode()
+    elif data_type == 'json':
+        return result
+    elif data_type == 'json_text':
+        return ujson.loads(result)
+    elif data_type == 'msgpack':
+        return msgpack.unpackb(result, use_list=False)
+    else:
+        raise ValueError(f"Unknown data type: {data_type}")
 
 def create_node_response(result, params, target_format, target_options, data_type) -> HttpResponse:
+    if isinstance(result, EncodedNodeResult):
+        # Write encoded results in chunks, transcoding is done part by part.
+        if target_format == 'json':
+            return StreamingHttpResponse(result.iter_json(),
+                    content_type='application/json')
+        elif target_format == 'msgpack':
+            return StreamingHttpResponse(result.iter_msgpack(),
+                    content_type='application/octet-stream')
+        elif target_format == 'columnar':
+            return StreamingHttpResponse(result.iter_columnar(),
+                    content_type='application/octet-stream')
+        result, data_type = result.decode(), 'json'
+
     if target_format == 'json':
         if data_type == 'json':
             data = ujson.dumps(result)
@@ -2593,15 +3526,18 @@ def create_node_response(result, params, target_format, target_options, data_typ
         else:
             raise ValueError(f"Unknown data type: {data_type}")
         return HttpResponse(data, content_type='application/octet-stream')
-    elif target_format == 'png' or target_format == 'gif':
+    elif target_format == 'columnar':
         if data_type == 'json':
-            data = result
+            data = columnar.encode_node_result(result)
         elif data_type == 'json_text':
-            data = ujson.loads(result)
+            data = columnar.encode_node_result(ujson.loads(result))
         elif data_type == 'msgpack':
-            data = msgpack.unpackb(result, use_list=False)
+            data = columnar.encode_node_result(msgpack.unpackb(result, use_list=False))
         else:
             raise ValueError(f"Unknown data type: {data_type}")
+        return HttpResponse(data, content_type='application/octet-stream')
+    elif target_format == 'png' or target_format == 'gif':
+        data = decode_node_result(result, data_type)
         width = target_options['view_width']
         height = target_options['view_height']
         view_min_x = params['left']
@@ -2611,98 +3547,397 @@ def create_node_response(result, params, target_format, target_options, data_typ
         image = render_nodes_xy(data, params, width, height, view_min_x,
                 view_min_y, xscale, yscale)
         # serialize to HTTP response
-        if target_format == 'png':
-            response = HttpResponse(content_type="image/png")
-            image.save(response, "PNG")
-        else:
-            response = HttpResponse(content_type="image/gif")
-            image.save(response, 'GIF', transparency=0, optimize=True)
+        response = HttpResponse(content_type=f"image/{target_format}")
+        save_image(image, target_format, response)
         return response
     else:
         raise ValueError(f"Unknown target format: {target_format}")
 
+def save_image(image, image_format, target) -> None:
+    """Write the passed in image as PNG or GIF to a file-like target."""
+    if image_format == 'png':
+        image.save(target, "PNG")
+    elif image_format == 'gif':
+        image.save(target, 'GIF', transparency=0, optimize=True)
+    else:
+        raise ValueError(f"Unknown image format: {image_format}")
+
+OverlayGeometry = namedtuple('OverlayGeometry', ['nodes', 'is_root',
+        'virtual_nodes', 'edges', 'connectors', 'links', 'link_types'])
+
+# Link types of overlay geometry, other relations are drawn in a neutral color.
+OVERLAY_LINK_TYPES = {
+    'presynaptic_to': 0,
+    'postsynaptic_to': 1,
+}
+OVERLAY_OTHER_LINK_TYPE = 2
+
+
+def collect_node_result_rows(node_data) -> Tuple[List, List, Dict[int, str]]:
+    """Return all treenode and connector rows and the merged relation map of
+    a node query result, including all node results in its extra data.
+    """
+    treenodes, connectors = list(node_data[0]), list(node_data[1])
+    relation_map = {int(k): v for k, v in (node_data[4] or {}).items()} \
+            if len(node_data) > 4 else {}
+    extra_data = node_data[5] if len(node_data) > 5 else []
+    for extra in extra_data:
+        if extra and not columnar.is_origin_data(extra):
+            extra_treenodes, extra_connectors, extra_relations = \
+                    collect_node_result_rows(extra)
+            treenodes.extend(extra_treenodes)
+            connectors.extend(extra_connectors)
+            relation_map.update(extra_relations)
+    return treenodes, connectors, relation_map
+
+
+def get_overlay_geometry(node_data, params) -> OverlayGeometry:
+    """Project the treenodes, edges and connectors of a node query result onto
+    the XY plane of the section defined by the passed in bounding box. Edges
+    that cross the section without having a node in it are represented by a
+    virtual node where they intersect the section's Z1 plane. All coordinates
+    are returned in project space, edges and links as rows of the form
+    [x1, y1, x2, y2].
+    """
+    treenodes, connectors, relation_map = collect_node_result_rows(node_data)
+    left, right = params['left'], params['right']
+    top, bottom = params['top'], params['bottom']
+    z1, z2 = params['z1'], params['z2']
+
+    n_treenodes = len(treenodes)
+    node_ids = np.fromiter((t[0] for t in treenodes), np.int64, n_treenodes)
+    parent_ids = np.fromiter((-1 if t[1] is None else t[1] for t in treenodes),
+            np.int64, n_treenodes)
+    locations = np.array([t[2:5] for t in treenodes], dtype=np.float64).reshape(-1, 3)
+
+    # Cells of a grid cache can contain the same node more than once.
+    node_ids, unique_index = np.unique(node_ids, return_index=True)
+    parent_ids, locations = parent_ids[unique_index], locations[unique_index]
+
+    def in_view(xyz):
+        return (xyz[:, 0] >= left) & (xyz[:, 0] < right) & \
+                (xyz[:, 1] >= top) & (xyz[:, 1] < bottom) & \
+                (xyz[:, 2] >= z1) & (xyz[:, 2] < z2)
+
+    visible = in_view(locations)
+
+    # Find the parent of each node in the (sorted) node ID list.
+    parent_index = np.searchsorted(node_ids, parent_ids).clip(0, max(len(node_ids) - 1, 0))
+    has_parent = (parent_ids != -1)
+    if len(node_ids):
+        has_parent &= node_ids[parent_index] == parent_ids
+    a = locations[has_parent]
+    b = locations[parent_index[has_parent]]
+
+    # Like in the tracing overlay, edges are drawn if at least one of their
+    # nodes is in the section or if they cross it.
+    z_min = np.minimum(a[:, 2], b[:, 2])
+    z_max = np.maximum(a[:, 2], b[:, 2])
+    intersecting = (z_min < z2) & (z_max >= z1)
+    edges = np.hstack([a[intersecting, 0:2], b[intersecting, 0:2]])
+
+    # Edges that cross the section without a node in it get a virtual node
+    # where they intersect the section's Z1 plane.
+    crossing = (z_min < z1) & (z_max >= z2)
+    ca, cb = a[crossing], b[crossing]
+    t = (z1 - ca[:, 2]) / (cb[:, 2] - ca[:, 2])
+    virtual_nodes = ca[:, 0:2] + t[:, None] * (cb[:, 0:2] - ca[:, 0:2])
+
+    n_connectors = len(connectors)
+    connector_locations = np.array([c[1:4] for c in connectors],
+            dtype=np.float64).reshape(-1, 3)
+    visible_connectors = in_view(connector_locations)
+
+    # Links of visible connectors to treenodes that are part of the result.
+    n_links = np.fromiter((len(c[7]) for c in connectors), np.int64, n_connectors)
+    link_rows = [link for c in connectors for link in c[7]]
+    link_treenode_ids = np.fromiter((link[0] for link in link_rows), np.int64, len(link_rows))
+    link_types = np.fromiter((OVERLAY_LINK_TYPES.get(relation_map.get(link[1]),
+            OVERLAY_OTHER_LINK_TYPE) for link in link_rows), np.int8, len(link_rows))
+    link_connectors = np.repeat(np.arange(n_connectors), n_links)
+    link_nodes = np.searchsorted(node_ids, link_treenode_ids).clip(0, max(len(node_ids) - 1, 0))
+    valid_links = visible_connectors[link_connectors]
+    if len(node_ids):
+        valid_links &= node_ids[link_nodes] == link_treenode_ids
+    else:
+        valid_links[:] = False
+    links = np.hstack([connector_locations[link_connectors[valid_links], 0:2],
+            locations[link_nodes[valid_links], 0:2]])
+
+    return OverlayGeometry(locations[visible, 0:2], parent_ids[visible] == -1,
+            virtual_nodes, edges, connector_locations[visible_connectors, 0:2],
+            links, link_types[valid_links])
+
+
 def render_nodes_xy(node_data, params, width, height, view_min_x=0, view_min_y=0,
         xscale=1.0, yscale=1.0) -> Image:
-    """Render the passed in node data to an image.
+    """Render the passed in node data to an image. Node positions are projected
+    using NumPy, drawing is done with aggdraw.
     """
-    import random
     background = (255, 0, 0, 0)
     image = Image.new('RGBA', (width, height), background)
 
     radius = 4
     hr = radius / 2.0
+    edge_pen = Pen((255, 255, 0), 1)
     node_pen = Pen((255, 0, 255), 1)
     root_pen = Pen('red', 1)
-    # leaf_pen = Pen('red', 1)
     node_brush = Brush((255, 0, 255))
     root_brush = Brush('red')
-    # leaf_brush = Brush('red')
-
-    virtual_nodes = True
+    virtual_brush = Brush((255, 255, 0))
+    connector_pen = Pen((0, 0, 0), 1)
+    connector_brush = Brush((255, 255, 255))
+    link_pens = {
+        0: Pen((200, 0, 0), 1),
+        1: Pen((0, 217, 232), 1),
+        OVERLAY_OTHER_LINK_TYPE: Pen((128, 128, 128), 1),
+    }
 
-    left, right = params['left'], params['right']
-    top, bottom = params['top'], params['bottom']
-    z1, z2 = params['z1'], params['z2']
+    geometry = get_overlay_geometry(node_data, params)
+    scale = np.array([xscale, yscale, xscale, yscale])
+    offset = np.array([view_min_x, view_min_y, view_min_x, view_min_y])
 
-    # Map parents to children
-    nodes = dict()
-    treenodes = node_data[0]
-    for tn in treenodes:
-        nodes[tn[0]] = tn
+    def to_image(xy):
+        return (xy - offset[:xy.shape[1]]) * scale[:xy.shape[1]]
 
     draw = Draw(image)
-    # Add treenodes:
-    for tn in treenodes:
-        parent_id = tn[1]
-        x, y, z = tn[2], tn[3], tn[4]
-        xs, ys = None, None
-        virtual_node_created = False
-
-        is_outside = x < left or x >= right or y < top \
-                or y >= bottom or z < z1 or z >= z2
-
-        # If this node and its parent are outside, create a virtual node
-        # location and replace current coordinates.
-        if is_outside:
-            if virtual_nodes and parent_id:
-                parent_node = nodes.get(parent_id)
-                if parent_node:
-                    px, py, pz = parent_node[2], parent_node[3], parent_node[4]
-                    p_is_outside = px < left or px >= right or py < top \
-                            or py >= bottom or pz < z1 or pz >= z2
-
-                    # If the parent ist outside, too, find virtual node
-                    # location.
-                    if p_is_outside:
-                        dx, dy, dz = px - x, py - y, pz - z
-                        if dz > -0.0001 and dz < 0.0001:
-                            continue
-                        t = (z1 - z) / dz
-
-                        x = x + t * dx
-                        y = y + t * dy
-                        z = z1
-                        virtual_node_created = True
-
-            if not virtual_node_created:
-                continue
+    for edge in to_image(geometry.edges).tolist():
+        draw.line(edge, edge_pen)
+    for link, link_type in zip(to_image(geometry.links).tolist(),
+            geometry.link_types.tolist()):
+        draw.line(link, link_pens[link_type])
+    for xs, ys in to_image(geometry.virtual_nodes).tolist():
+        draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), edge_pen, virtual_brush)
+    for (xs, ys), is_root in zip(to_image(geometry.nodes).tolist(),
+            geometry.is_root.tolist()):
+        if is_root:
+            draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), root_pen, root_brush)
+        else:
+            draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), node_pen, node_brush)
+    for xs, ys in to_image(geometry.connectors).tolist():
+        draw.rectangle((xs - radius, ys - radius, xs + radius, ys + radius),
+                connector_pen, connector_brush)
+    draw.flush()
 
-        xs = xscale * (x - view_min_x)
-        ys = yscale * (y - view_min_y)
+    return image
 
-        if parent_id:
-            pen = node_pen
-            brush = node_brush
-        else:
-            pen = root_pen
-            brush = root_brush
 
-        # Render node or virtual node
-        draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), pen, brush)
+def get_overlay_tile_cells(zoom, col, row) -> Tuple[int, int, int, int]:
+    """Return the minimum and maximum (inclusive) X and Y cell indices of the
+    grid cells covered by an overlay tile. A tile of zoom level N covers
+    2^N x 2^N cells of a single section of cells.
+    """
+    n = 2 ** zoom
+    return col * n, row * n, (col + 1) * n - 1, (row + 1) * n - 1
+
+
+def get_overlay_tile_bounds(grid:NodeGridInfo, zoom, col, row,
+        z_index) -> Dict[str, float]:
+    min_x, min_y, max_x, max_y = get_overlay_tile_cells(zoom, col, row)
+    return {
+        'left': min_x * grid.cell_width,
+        'top': min_y * grid.cell_height,
+        'z1': z_index * grid.cell_depth,
+        'right': (max_x + 1) * grid.cell_width,
+        'bottom': (max_y + 1) * grid.cell_height,
+        'z2': (z_index + 1) * grid.cell_depth,
+    }
+
 
-    draw.flush()
+def invalidate_overlay_tiles(grid_id, cells, delete_files=False) -> None:
+    """Remove the cached overlay tiles of all zoom levels that cover any of the
+    passed in (x, y, z) grid cells.
+    """
+    if not overlay_tile_cache.enabled:
+        return
+    tags = set((grid_id, zoom, z, x >> zoom, y >> zoom) for x, y, z in cells
+            for zoom in range(settings.NODE_OVERLAY_ZOOM_LEVELS))
+    for tag in tags:
+        overlay_tile_cache.invalidate_tag(tag, delete_files)
 
-    return image
+
+def has_dirty_overlay_tile_cells(grid_id, zoom, col, row, z_index,
+        cursor=None) -> bool:
+    """Return whether any grid cell covered by an overlay tile is currently
+    marked dirty.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    min_x, min_y, max_x, max_y = get_overlay_tile_cells(zoom, col, row)
+    cursor.execute("""
+        SELECT EXISTS(
+            SELECT 1 FROM dirty_node_grid_cache_cell
+            WHERE grid_id = %(grid_id)s
+                AND x_index >= %(min_x)s AND x_index <= %(max_x)s
+                AND y_index >= %(min_y)s AND y_index <= %(max_y)s
+                AND z_index = %(z_index)s)
+    """, {
+        'grid_id': grid_id,
+        'min_x': min_x,
+        'min_y': min_y,
+        'max_x': max_x,
+        'max_y': max_y,
+        'z_index': z_index,
+    })
+    return cursor.fetchone()[0]
+
+
+def render_overlay_tile(project_id, grid:NodeGridInfo, zoom, col, row, z_index,
+        image_format, cursor=None) -> Tuple[bytes, bool]:
+    """Render the nodes of a single overlay tile, using the configured node
+    providers. Returns the encoded image and whether it can be cached, which is
+    not the case if any of the covered grid cells is marked dirty before or
+    after the tile is rendered.
+    """
+    if not cursor:
+        cursor = connection.cursor()
+    # Like for grid cells, dirty cells are looked up before the cell data is
+    # read. A cell that is dirty at this point can be cleaned while the tile
+    # is rendered, which a check after rendering wouldn't notice.
+    had_dirty_cells = has_dirty_overlay_tile_cells(grid.id, zoom, col, row,
+            z_index, cursor)
+
+    params:Dict[str, Any] = get_overlay_tile_bounds(grid, zoom, col, row, z_index)
+    params.update({
+        'limit': settings.NODE_LIST_MAXIMUM_COUNT,
+        'n_largest_skeletons_limit': 0,
+        'n_last_edited_skeletons_limit': 0,
+        'hidden_last_editor_id': None,
+        'min_skeleton_length': 0,
+        'min_skeleton_nodes': 0,
+        'ordering': None,
+        'project_id': project_id,
+        'width': params['right'] - params['left'],
+        'height': params['bottom'] - params['top'],
+        'depth': params['z2'] - params['z1'],
+        'orientation': 'xy',
+        'lod': 'max',
+        'lod_type': 'absolute',
+    })
+
+    node_providers = get_configured_node_providers(get_node_provider_configs())
+    result, data_type = get_node_list_result(project_id, node_providers,
+            params, with_relation_map='used')
+    data = decode_node_result(result, data_type)
+
+    tile_size = settings.NODE_OVERLAY_TILE_SIZE
+    image = render_nodes_xy(data, params, tile_size, tile_size, params['left'],
+            params['top'], tile_size / params['width'],
+            tile_size / params['height'])
+    buffer = BytesIO()
+    save_image(image, image_format, buffer)
+
+    has_dirty_cells = had_dirty_cells or has_dirty_overlay_tile_cells(grid.id,
+            zoom, col, row, z_index, cursor)
+
+    return buffer.getvalue(), not has_dirty_cells
+
+
+def get_overlay_tile_cache_stats() -> Dict[str, Any]:
+    """Return usage statistics of the overlay tile cache of this process."""
+    return overlay_tile_cache.stats()
+
+
+@api_view(['GET'])
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def overlay_tile(request:HttpRequest, project_id=None) -> HttpResponse:
+    """Get a rendered image of all nodes in an overlay tile.
+
+    Overlay tiles are aligned to the cells of a node grid cache with XY
+    orientation. A tile of zoom level N covers 2^N x 2^N cells of a single
+    section of cells and is rendered with NODE_OVERLAY_TILE_SIZE pixels in
+    width and height. Tiles are cached if NODE_OVERLAY_TILE_CACHE_SIZE or
+    NODE_OVERLAY_TILE_CACHE_PATH are set and are invalidated together with the
+    grid cells they cover. The project space bounding box of a tile is returned
+    in the X-Overlay-Tile-Bounds header (left, top, z1, right, bottom, z2).
+    ---
+    parameters:
+    - name: project_id
+      description: Project of the nodes
+      type: integer
+      paramType: path
+      required: true
+    - name: zoom
+      description: |
+        The zoom level of the tile, 0 is the highest resolution. Must be lower
+        than NODE_OVERLAY_ZOOM_LEVELS.
+      type: integer
+      paramType: form
+      required: false
+      defaultValue: 0
+    - name: col
+      description: The column of the tile in its zoom level.
+      type: integer
+      paramType: form
+      required: true
+    - name: row
+      description: The row of the tile in its zoom level.
+      type: integer
+      paramType: form
+      required: true
+    - name: z_index
+      description: The Z index of the grid cells covered by the tile.
+      type: integer
+      paramType: form
+      required: true
+    - name: grid_id
+      description: |
+        The grid cache the tile is aligned to. By default, the enabled XY grid
+        with the smallest cells is used.
+      type: integer
+      paramType: form
+      required: false
+    - name: format
+      description: Either "png" (default) or "gif".
+      type: string
+      paramType: form
+      required: false
+    """
+    project_id = int(project_id)
+    zoom = int(request.GET.get('zoom', 0))
+    if zoom < 0 or zoom >= settings.NODE_OVERLAY_ZOOM_LEVELS:
+        raise ValueError(f"Zoom level needs to be between 0 and {settings.NODE_OVERLAY_ZOOM_LEVELS - 1}")
+    for param in ('col', 'row', 'z_index'):
+        if param not in request.GET:
+            raise ValueError(f"Need {param} parameter")
+    col = int(request.GET['col'])
+    row = int(request.GET['row'])
+    z_index = int(request.GET['z_index'])
+    grid_id = int(request.GET['grid_id']) if 'grid_id' in request.GET else None
+    image_format = request.GET.get('format', 'png')
+    if image_format not in ('png', 'gif'):
+        raise ValueError("Format needs to be png or gif")
+
+    # Cached tiles are only used from memory if invalidation events can be
+    # received. Tiles on disk are removed by the cache update worker.
+    listening = node_cache_listener.poll()
+
+    grids = [g for g in grid_cache_registry.get_grids(project_id)
+            if g.enabled and g.orientation == ORIENTATIONS['xy']
+            and (grid_id is None or g.id == grid_id)]
+    if not grids:
+        raise ValueError("Could not find an enabled XY node grid cache")
+    grid = min(grids, key=lambda g: g.cell_volume)
+
+    tag = (grid.id, zoom, z_index, col, row)
+    data = overlay_tile_cache.get(tag, image_format, use_memory=listening)
+    if data is None:
+        generation = overlay_tile_cache.generation(tag)
+        data, cacheable = render_overlay_tile(project_id, grid, zoom, col, row,
+                z_index, image_format)
+        if cacheable:
+            # Invalidations that arrive while the tile is rendered make it
+            # stale, set() ignores it then.
+            if listening:
+                node_cache_listener.poll()
+            overlay_tile_cache.set(tag, image_format, data,
+                    use_memory=listening, generation=generation)
+
+    bounds = get_overlay_tile_bounds(grid, zoom, col, row, z_index)
+    response = HttpResponse(data, content_type=f"image/{image_format}")
+    response['X-Overlay-Tile-Bounds'] = ','.join(str(bounds[k]) for k in
+            ('left', 'top', 'z1', 'right', 'bottom', 'z2'))
+    return response
 
 
 @requires_user_role(UserRole.Annotate)
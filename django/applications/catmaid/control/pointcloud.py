@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from typing import Any, Dict, List, Union
+from collections import OrderedDict
+from typing import Any, Dict, List, Sequence, Tuple, Union
 from io import StringIO, BytesIO
 import json
 import logging
+import threading
 from PIL import Image
 
+import numpy as np
+from scipy.spatial import cKDTree
+
 from django.conf import settings
 from django.db import connection
 from django.http import HttpRequest, HttpResponse, JsonResponse
@@ -26,6 +31,19 @@ from catmaid.models import (Group, Point, PointCloud, PointCloudPoint, ImageData
 
 logger = logging.getLogger('__name__')
 
+# Points of a point cloud are additionally stored as a packed array of
+# big-endian float32 X, Y, Z triples, ordered by point ID. The point and
+# pointcloud_point rows are authoritative, the packed array is only written
+# when a point cloud is created. Code that changes the points of an existing
+# point cloud has to rewrite or reset (NULL) it, point clouds without packed
+# points are read from their rows.
+PACKED_POINT_DTYPE = np.dtype('>f4')
+
+# Cached KD-trees of point clouds, keyed by point cloud ID. Each entry is an
+# (edition time, tree) tuple so that trees of changed point clouds are rebuilt.
+_pointcloud_trees:'OrderedDict[int, Tuple[Any, cKDTree]]' = OrderedDict()
+_pointcloud_trees_lock = threading.Lock()
+
 
 def serialize_pointcloud(pointcloud, simple=False) -> Dict[str, Any]:
     if simple:
@@ -72,6 +90,181 @@ def serialize_image_data(image, simple=False) -> Dict[str, Any]:
         }
 
 
+def pack_points(points) -> bytes:
+    """Pack a list of X, Y, Z locations into the binary point cloud format."""
+    return np.asarray(points, dtype=PACKED_POINT_DTYPE).reshape(-1, 3).tobytes()
+
+
+def unpack_points(data) -> np.ndarray:
+    """Return an N×3 array from points in the binary point cloud format."""
+    return np.frombuffer(data, dtype=PACKED_POINT_DTYPE).reshape(-1, 3) \
+            .astype(np.float64)
+
+
+def get_pointcloud_points(project_id, pointcloud_ids:Sequence[int]) -> Dict[int, np.ndarray]:
+    """Get the points of each point cloud in project space (nm), ordered by
+    point ID. Packed points are used where available, otherwise the individual
+    points of a point cloud are read. Unknown point clouds have no points.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT pc.id, pc.packed_points
+        FROM pointcloud pc
+        WHERE pc.project_id = %(project_id)s
+        AND pc.id = ANY(%(pointcloud_ids)s::bigint[])
+    """, {
+        'project_id': project_id,
+        'pointcloud_ids': list(pointcloud_ids),
+    })
+    points:Dict[int, np.ndarray] = {pointcloud_id: np.empty((0, 3))
+            for pointcloud_id in pointcloud_ids}
+    unpacked_ids = []
+    for pointcloud_id, packed_points in cursor.fetchall():
+        if packed_points is None:
+            unpacked_ids.append(pointcloud_id)
+        else:
+            points[pointcloud_id] = unpack_points(packed_points)
+
+    if unpacked_ids:
+        cursor.execute("""
+            SELECT pcp.pointcloud_id, p.location_x, p.location_y, p.location_z
+            FROM pointcloud_point pcp
+            JOIN point p
+                ON p.id = pcp.point_id
+            WHERE pcp.project_id = %(project_id)s
+            AND pcp.pointcloud_id = ANY(%(pointcloud_ids)s::bigint[])
+            ORDER BY pcp.pointcloud_id, p.id
+        """, {
+            'project_id': project_id,
+            'pointcloud_ids': unpacked_ids,
+        })
+        locations:Dict[int, List] = {pointcloud_id: [] for pointcloud_id in unpacked_ids}
+        for row in cursor.fetchall():
+            locations[row[0]].append(row[1:])
+        for pointcloud_id, pointcloud_locations in locations.items():
+            points[pointcloud_id] = np.array(pointcloud_locations,
+                    dtype=np.float64).reshape(-1, 3)
+
+    return points
+
+
+def get_pointcloud_trees(project_id, pointcloud_ids:Sequence[int]) -> Dict[int, cKDTree]:
+    """Return a KD-tree of the points (in nm) of each passed in point cloud.
+    The trees of the POINTCLOUD_TREE_CACHE_SIZE most recently used point
+    clouds are kept in memory and rebuilt if a point cloud was changed.
+    """
+    edition_times = dict(PointCloud.objects.filter(project_id=project_id,
+            id__in=pointcloud_ids).values_list('id', 'edition_time'))
+    missing = set(pointcloud_ids) - set(edition_times.keys())
+    if missing:
+        raise ValueError(f"Could not find point clouds: {', '.join(map(str, sorted(missing)))}")
+
+    trees:Dict[int, cKDTree] = {}
+    with _pointcloud_trees_lock:
+        for pointcloud_id in pointcloud_ids:
+            entry = _pointcloud_trees.get(pointcloud_id)
+            if entry and entry[0] == edition_times[pointcloud_id]:
+                _pointcloud_trees.move_to_end(pointcloud_id)
+                trees[pointcloud_id] = entry[1]
+
+    outdated_ids = [pcid for pcid in pointcloud_ids if pcid not in trees]
+    if outdated_ids:
+        points = get_pointcloud_points(project_id, outdated_ids)
+        for pointcloud_id in outdated_ids:
+            trees[pointcloud_id] = cKDTree(points[pointcloud_id])
+
+        cache_size = max(0, getattr(settings, 'POINTCLOUD_TREE_CACHE_SIZE', 0))
+        with _pointcloud_trees_lock:
+            for pointcloud_id in outdated_ids:
+                _pointcloud_trees[pointcloud_id] = (edition_times[pointcloud_id],
+                        trees[pointcloud_id])
+                _pointcloud_trees.move_to_end(pointcloud_id)
+            while len(_pointcloud_trees) > cache_size:
+                _pointcloud_trees.popitem(last=False)
+
+    return trees
+
+
+def find_nearest_pointcloud_points(project_id, pointcloud_ids:Sequence[int],
+        locations:np.ndarray, radius:float, k:int=1) -> List[List]:
+    """Find for each location the <k> nearest points of each passed in point
+    cloud that are at most <radius> nm away. Returns a list of [location
+    index, point cloud ID, point index, x, y, z, distance] rows, ordered by
+    location index, point cloud and distance.
+    """
+    trees = get_pointcloud_trees(project_id, pointcloud_ids)
+    results = []
+    for pointcloud_id in pointcloud_ids:
+        tree = trees[pointcloud_id]
+        if tree.n == 0 or len(locations) == 0:
+            continue
+        # The upper bound is exclusive, points exactly <radius> away are found
+        # like by find_nearest_nodes().
+        distances, indices = tree.query(locations, k=k,
+                distance_upper_bound=np.nextafter(radius, np.inf))
+        distances = distances.reshape(len(locations), -1)
+        indices = indices.reshape(len(locations), -1)
+        for location_index, point_index in zip(*np.nonzero(indices < tree.n)):
+            index = indices[location_index, point_index]
+            results.append([int(location_index), pointcloud_id, int(index)] +
+                    tree.data[index].tolist() +
+                    [float(distances[location_index, point_index])])
+    results.sort(key=lambda r: r[0])
+    return results
+
+
+def find_nearest_nodes(project_id, locations:np.ndarray, radius:float, k:int=1,
+        skeleton_ids:Sequence[int]=None) -> List[List]:
+    """Find for each location the <k> nearest treenodes that are at most
+    <radius> nm away, optionally constrained to the passed in skeletons.
+    Returns a list of [location index, skeleton ID, node ID, x, y, z, distance]
+    rows, ordered by location index and distance. Candidates are found through
+    the spatial index of the treenode_edge table.
+    """
+    if len(locations) == 0:
+        return []
+    extra_where = []
+    if skeleton_ids:
+        extra_where.append('AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])')
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT q.idx - 1, nearest.skeleton_id, nearest.id, nearest.location_x,
+            nearest.location_y, nearest.location_z, nearest.distance
+        FROM UNNEST(%(x)s::float8[], %(y)s::float8[], %(z)s::float8[])
+            WITH ORDINALITY q(x, y, z, idx)
+        CROSS JOIN LATERAL (
+            SELECT t.id, t.skeleton_id, t.location_x, t.location_y,
+                t.location_z, d.distance
+            FROM treenode_edge te
+            JOIN treenode t
+                ON t.id = te.id
+            CROSS JOIN LATERAL (
+                SELECT sqrt((t.location_x - q.x) ^ 2 +
+                    (t.location_y - q.y) ^ 2 + (t.location_z - q.z) ^ 2)
+            ) d(distance)
+            WHERE te.edge &&& ST_MakeLine(
+                ST_MakePoint(q.x - %(radius)s, q.y - %(radius)s, q.z - %(radius)s),
+                ST_MakePoint(q.x + %(radius)s, q.y + %(radius)s, q.z + %(radius)s))
+            AND te.project_id = %(project_id)s
+            AND d.distance <= %(radius)s
+            {extra_where}
+            ORDER BY d.distance
+            LIMIT %(k)s
+        ) nearest
+        ORDER BY q.idx, nearest.distance
+    """.format(extra_where='\n'.join(extra_where)), {
+        'project_id': project_id,
+        'x': locations[:, 0].tolist(),
+        'y': locations[:, 1].tolist(),
+        'z': locations[:, 2].tolist(),
+        'radius': radius,
+        'k': k,
+        'skeleton_ids': list(skeleton_ids) if skeleton_ids else None,
+    })
+    return [list(row) for row in cursor.fetchall()]
+
+
 def list_pointclouds(project_id, user_id, simple, with_images=False,
         with_points=True, sample_ratio=1.0, pointcloud_ids=None, order_by='id') -> List[Dict[str, Any]]:
     extra_select = []
@@ -435,6 +628,24 @@ class PointCloudList(APIView):
             "points": points,
         })
 
+        # Packed points are ordered by point ID, which isn't necessarily the
+        # order they were passed in.
+        cursor.execute("""
+            UPDATE pointcloud pc
+            SET packed_points = (
+                SELECT string_agg(float4send(p.location_x::real) ||
+                    float4send(p.location_y::real) ||
+                    float4send(p.location_z::real), ''::bytea ORDER BY p.id)
+                FROM pointcloud_point pcp
+                JOIN point p
+                    ON p.id = pcp.point_id
+                WHERE pcp.pointcloud_id = pc.id
+            )
+            WHERE pc.id = %(pointcloud_id)s
+        """, {
+            "pointcloud_id": pc.id,
+        })
+
 
         # If images are provided, store them in the database and link them to the
         # point cloud.
@@ -527,7 +738,9 @@ class PointCloudDetail(APIView):
             required: false
             defaultValue: false
           - name: with_points
-            description: Wheter linked points should returned as well.
+            description: |
+              Wheter linked points should returned as well. Without sampling,
+              locations are returned with float32 precision.
             type: bool
             paramType: form
             required: false
@@ -553,8 +766,15 @@ class PointCloudDetail(APIView):
 
         if with_points:
             if sample_ratio == 1.0:
-                points = [serialize_point(p, compact=True) for p in pointcloud.points.all()]
-                pointcloud_data['points'] = points
+                # Locations are read from the packed points, which are ordered
+                # by point ID like the IDs read here.
+                point_ids = PointCloudPoint.objects.filter(
+                        pointcloud_id=pointcloud.id).order_by('point_id') \
+                        .values_list('point_id', flat=True)
+                locations = get_pointcloud_points(project_id,
+                        [pointcloud.id])[pointcloud.id]
+                pointcloud_data['points'] = [[point_id] + location
+                        for point_id, location in zip(point_ids, locations.tolist())]
             else:
                 n_points = PointCloudPoint.objects.filter(pointcloud_id=pointcloud.id).count()
                 n_sample = int(n_points * sample_ratio)
@@ -598,3 +818,136 @@ class PointCloudDetail(APIView):
             'deleted': True,
             'pointcloud_id': pointcloud.id
         })
+
+
+@api_view(['GET'])
+@requires_user_role(UserRole.Browse)
+def pointcloud_points(request:HttpRequest, project_id, pointcloud_id) -> HttpResponse:
+    """Return the points of a point cloud as binary data. Points are encoded
+    as big-endian 32 bit float X, Y, Z triples in project space, ordered by
+    point ID.
+    ---
+    parameters:
+      - name: project_id
+        description: Project of the point cloud
+        type: integer
+        paramType: path
+        required: true
+      - name: pointcloud_id
+        description: The point cloud to return the points of
+        type: integer
+        paramType: path
+        required: true
+    """
+    pointcloud = PointCloud.objects.get(pk=pointcloud_id, project_id=project_id)
+
+    # Check permissions. If there are no read permission assigned at all,
+    # everyone can read.
+    if 'can_read' not in get_perms(request.user, pointcloud) and \
+            len(get_users_with_perms(pointcloud)) > 0:
+        raise PermissionError(f'User "{request.user.username}" not allowed to read point cloud #{pointcloud.id}')
+
+    points = get_pointcloud_points(project_id, [pointcloud.id])[pointcloud.id]
+    return HttpResponse(pack_points(points),
+            content_type='application/octet-stream')
+
+
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def nearest(request:HttpRequest, project_id) -> JsonResponse:
+    """Find the nearest points of point clouds and/or the nearest skeleton
+    nodes for a batch of query locations.
+
+    For each location and point cloud, the <k> nearest points within <radius>
+    are returned as [location index, point cloud ID, point index, x, y, z,
+    distance] rows in the "pointclouds" field. The point index refers to the
+    order of the points returned by the points endpoint of a point cloud. If
+    <with_nodes> is true, the <k> nearest treenodes within <radius> of each
+    location are returned in the "nodes" field as [location index, skeleton
+    ID, node ID, x, y, z, distance] rows, optionally constrained to a set of
+    skeletons. Point cloud KD-trees are cached by the server.
+    ---
+    parameters:
+      - name: project_id
+        description: Project to query
+        type: integer
+        paramType: path
+        required: true
+      - name: locations
+        description: A list of X, Y, Z locations in project space. Can be a stringified JSON array.
+        type: array
+        paramType: form
+        required: true
+      - name: radius
+        description: Maximum distance (nm) of returned points and nodes.
+        type: number
+        paramType: form
+        required: true
+      - name: k
+        description: Maximum number of returned points or nodes per location (and point cloud).
+        type: integer
+        paramType: form
+        required: false
+        defaultValue: 1
+      - name: pointcloud_ids
+        description: Point clouds to query.
+        type: array
+        paramType: form
+        required: false
+      - name: with_nodes
+        description: Whether the nearest skeleton nodes should be returned.
+        type: boolean
+        paramType: form
+        required: false
+        defaultValue: false
+      - name: skeleton_ids
+        description: Optional skeletons the nearest nodes are constrained to.
+        type: array
+        paramType: form
+        required: false
+    """
+    if 'locations' in request.POST:
+        locations = json.loads(request.POST['locations'])
+    else:
+        locations = get_request_list(request.POST, 'locations', map_fn=float)
+    if not locations:
+        raise ValueError("Need at least one location")
+    locations = np.array(locations, dtype=np.float64).reshape(-1, 3)
+
+    radius = request.POST.get('radius')
+    if radius is None:
+        raise ValueError("Need radius")
+    radius = float(radius)
+    if radius < 0:
+        raise ValueError("The radius can't be negative")
+
+    k = int(request.POST.get('k', 1))
+    if k < 1:
+        raise ValueError("Need k >= 1")
+
+    pointcloud_ids = get_request_list(request.POST, 'pointcloud_ids', [],
+            map_fn=int)
+    with_nodes = get_request_bool(request.POST, 'with_nodes', False)
+    skeleton_ids = get_request_list(request.POST, 'skeleton_ids', None,
+            map_fn=int)
+
+    pointcloud_results:List[List] = []
+    if pointcloud_ids:
+        readable = list_pointclouds(project_id, request.user.id, simple=True,
+                pointcloud_ids=pointcloud_ids)
+        unreadable = set(pointcloud_ids) - set(pc['id'] for pc in readable)
+        if unreadable:
+            raise PermissionError(f'User "{request.user.username}" not allowed '
+                    f'to read point clouds: {", ".join(map(str, sorted(unreadable)))}')
+        pointcloud_results = find_nearest_pointcloud_points(project_id,
+                pointcloud_ids, locations, radius, k)
+
+    node_results:List[List] = []
+    if with_nodes or skeleton_ids:
+        node_results = find_nearest_nodes(project_id, locations, radius, k,
+                skeleton_ids)
+
+    return JsonResponse({
+        'pointclouds': pointcloud_results,
+        'nodes': node_results,
+    })
@@ -4,12 +4,15 @@ from itertools import chain
 import json
 import logging
 from timeit import default_timer as timer
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 from celery.task import task
 from celery.utils.log import get_task_logger
+from django.conf import settings
 from django.contrib.gis.db import models as spatial_models
 from django.db import connection, transaction
+from django.db.models import F
 from django.http import HttpRequest, HttpResponse, JsonResponse
 from django.utils.decorators import method_decorator
 
@@ -25,15 +28,33 @@ from catmaid.control.common import (insert_into_log, get_class_to_id_map,
         get_relation_to_id_map, _create_relation, get_request_bool,
         get_request_list)
 from catmaid.models import (NblastConfig, NblastSample, Project, PointSet,
-        NblastConfigDefaultDistanceBreaks, NblastConfigDefaultDotBreaks,
-        NblastSimilarity, PointCloud, UserRole)
+        NblastConfigBackends, NblastConfigDefaultDistanceBreaks,
+        NblastConfigDefaultDotBreaks, NblastSimilarity, NblastSimilarityBlock,
+        NblastSimilarityStorageModes, PointCloud, UserRole)
+from catmaid.control.nat import nblast as numpy_nblast
+from catmaid.control.nat.nblast import NoValidObjectsError
 from catmaid.control.nat.r import (compute_scoring_matrix, nblast,
         test_environment, setup_environment)
+from catmaid.control.nat.scheduling import (estimate_points_per_object,
+        get_block_memory, get_block_shape, split_into_blocks)
 from catmaid.control.pointcloud import list_pointclouds
+from catmaid.control.skeletonimport import copy_rows
 
 
 logger = get_task_logger(__name__)
 
+# The number of query objects whose scores are written at a time with sparse
+# similarity storage.
+SPARSE_SCORE_BLOCK_SIZE = 500
+
+# The number of times a block of a similarity is claimed by a task, before it is
+# given up on. Blocks whose worker is lost, e.g. because it runs out of memory,
+# are redelivered otherwise forever.
+MAX_NBLAST_BLOCK_ATTEMPTS = 3
+
+# The maximum number of scores returned by a single request for similarity
+# scores.
+MAX_SCORE_PAGE_SIZE = 10000
 
 def serialize_sample(sample) -> Dict[str, Any]:
     return {
@@ -74,6 +95,7 @@ def serialize_config(config, simple=False) -> Dict[str, Any]:
             'scoring': config.scoring,
             'resample_step': config.resample_step,
             'tangent_neighbors': config.tangent_neighbors,
+            'backend': config.backend,
         }
 
 
@@ -104,6 +126,8 @@ def serialize_similarity(similarity, with_scoring=False, with_objects=False) ->
         ) if similarity.initial_target_objects else None,
         'reverse': similarity.reverse,
         'top_n': similarity.top_n,
+        'storage': similarity.storage,
+        'min_score': similarity.min_score,
     }
 
     if with_objects:
@@ -257,6 +281,13 @@ class ConfigurationList(APIView):
             required: false
             defaultValue: 20
             paramType: form
+          - name: backend
+            description: |
+                The NBLAST implementation to use for this configuration and
+                all similarities computed with it, either "r" (nat.nblast) or
+                "numpy". Defaults to the NBLAST_DEFAULT_BACKEND setting.
+            required: false
+            paramType: form
           - name: matching_skeleton_ids
             description: A list of matching skeleton IDs if <source> is not "data".
             required: false
@@ -314,6 +345,9 @@ class ConfigurationList(APIView):
 
         source = request.data.get('source', 'backend-random')
         tangent_neighbors = int(request.data.get('tangent_neighbors', '20'))
+        backend = request.data.get('backend', settings.NBLAST_DEFAULT_BACKEND)
+        if backend not in NblastConfigBackends:
+            raise ValueError(f"Unknown NBLAST backend: {backend}")
         matching_sample_id = int(request.data.get('matching_sample_id')) \
                 if 'matching_sample_id' in request.data else None
         random_sample_id = int(request.data.get('random_sample_id')) \
@@ -388,7 +422,8 @@ class ConfigurationList(APIView):
 
         if scoring:
             config = self.add_from_raw_data(project_id, request.user.id, name,
-                    scoring, distance_breaks, dot_breaks, tangent_neighbors)
+                    scoring, distance_breaks, dot_breaks, tangent_neighbors,
+                    backend)
             return Response(serialize_config(config))
         elif source == 'request':
             if not matching_skeleton_ids and not matching_pointset_ids:
@@ -398,7 +433,7 @@ class ConfigurationList(APIView):
             config = self.add_delayed(project_id, user_id, name, matching_skeleton_ids,
                     matching_pointset_ids, random_skeleton_ids, distance_breaks,
                     dot_breaks, tangent_neighbors=tangent_neighbors,
-                    matching_subset=matching_subset)
+                    matching_subset=matching_subset, backend=backend)
             return Response(serialize_config(config))
         elif source == 'backend-random':
             if not matching_skeleton_ids and not matching_pointset_ids:
@@ -416,7 +451,7 @@ class ConfigurationList(APIView):
                     matching_skeleton_ids, matching_pointset_ids,
                     matching_pointcloud_ids, distance_breaks, dot_breaks, None,
                     None, n_random_skeletons, min_length, min_nodes,
-                    tangent_neighbors, matching_subset)
+                    tangent_neighbors, matching_subset, backend)
             return Response(serialize_config(config))
         else:
             raise ValueError("Unknown source: " + source)
@@ -425,21 +460,23 @@ class ConfigurationList(APIView):
     def add_from_raw_data(self, project_id, user_id, name, scoring,
             distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks,
-            tangent_neighbors=20):
+            tangent_neighbors=20, backend='r'):
         """Add a scoring matrix based on the passed in array of arrays and
         dimensions.
         """
         return NblastConfig.objects.create(project_id=project_id,
             user_id=user_id, name=name, status='complete',
             distance_breaks=distance_breaks, dot_breaks=dot_breaks,
-            match_sample=None, random_sample=None, scoring=scoring)
+            match_sample=None, random_sample=None, scoring=scoring,
+            backend=backend)
 
 
     def add_delayed(self, project_id, user_id, name, matching_skeleton_ids,
             matching_pointset_ids, random_skeleton_ids,
             distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks, match_sample_id=None,
-            random_sample_id=None, tangent_neighbors=20, matching_subset=None):
+            random_sample_id=None, tangent_neighbors=20, matching_subset=None,
+            backend='r'):
         """Create and queue a new Celery task to create the scoring matrix.
         """
         histogram:List = []
@@ -466,7 +503,7 @@ class ConfigurationList(APIView):
             user=user_id, name=name, status='queued',
             distance_breaks=distance_breaks, dot_breaks=dot_breaks,
             match_sample=match_sample, random_sample=random_sample,
-            scoring=None, tangent_neighbors=tangent_neighbors)
+            scoring=None, tangent_neighbors=tangent_neighbors, backend=backend)
 
         # Queue recomputation task
         task = recompute_config.delay(config.id)
@@ -478,7 +515,8 @@ class ConfigurationList(APIView):
             matching_pointcloud_ids, distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks, match_sample_id=None,
             random_sample_id=None, n_random_skeletons=5000, min_length=0,
-            min_nodes=100, tangent_neighbors=20, matching_subset=None):
+            min_nodes=100, tangent_neighbors=20, matching_subset=None,
+            backend='r'):
         """Select a random set of neurons, optionally of a minimum length and
         queue a job to compute the scoring matrix.
         """
@@ -547,7 +585,8 @@ class ConfigurationList(APIView):
                 user_id=user_id, name=name, status='queued',
                 distance_breaks=distance_breaks, dot_breaks=dot_breaks,
                 match_sample=match_sample, random_sample=random_sample,
-                scoring=None, tangent_neighbors=tangent_neighbors)
+                scoring=None, tangent_neighbors=tangent_neighbors,
+                backend=backend)
 
             transaction.on_commit(lambda: compute_nblast_config.delay(config.id,
                     user_id))
@@ -581,7 +620,12 @@ def compute_nblast_config(config_id, user_id, use_cache=True) -> str:
             config.status = 'computing'
             config.save()
 
-        scoring_info = compute_scoring_matrix(config.project_id, user_id,
+        if config.backend == 'numpy':
+            compute = numpy_nblast.compute_scoring_matrix
+        else:
+            compute = compute_scoring_matrix
+
+        scoring_info = compute(config.project_id, user_id,
                 config.match_sample, config.random_sample,
                 config.distance_breaks, config.dot_breaks,
                 config.resample_step, config.tangent_neighbors)
@@ -662,9 +706,148 @@ def get_all_object_ids(project_id, user_id, object_type, min_nodes=500,
                 "isn't supported yet")
 
 
+def sparsify_scores(scores:np.ndarray, top_n:int=0,
+        min_score:Optional[float]=None) -> np.ndarray:
+    """Return a boolean mask of all entries of a block of score rows that
+    should be kept with sparse storage: the <top_n> highest scores of each row
+    (all if zero) that are at least <min_score> (if given).
+    """
+    keep = np.ones(scores.shape, dtype=bool)
+    if top_n and top_n < scores.shape[1]:
+        keep[:] = False
+        top = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+        keep[np.arange(scores.shape[0])[:, np.newaxis], top] = True
+    if min_score is not None:
+        keep &= scores >= min_score
+    return keep
+
+
+def store_sparse_scores(similarity_id, query_object_ids:Sequence[int],
+        target_object_ids:Sequence[int], scores, top_n:int=0,
+        min_score:Optional[float]=None) -> int:
+    """Write the entries of a block of score rows that pass the top N and
+    minimum score filters into the sparse score table. Rows correspond to
+    query objects and columns to target objects. Returns the number of
+    written scores.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    rows, cols = np.nonzero(sparsify_scores(scores, top_n, min_score))
+    if len(rows):
+        cursor = connection.cursor()
+        copy_rows(cursor, 'nblast_similarity_score', ('similarity_id',
+                'query_object_id', 'target_object_id', 'score'),
+                ((similarity_id, query_object_ids[r], target_object_ids[c],
+                    float(scores[r, c])) for r, c in zip(rows, cols)))
+    return len(rows)
+
+
+def prune_sparse_scores(similarity_id, top_n:int) -> None:
+    """Remove all but the <top_n> highest stored scores of each query object.
+    Blocks only keep the top N scores of their own target objects.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        DELETE FROM nblast_similarity_score s
+        USING (
+            SELECT id, row_number() OVER (PARTITION BY query_object_id
+                    ORDER BY score DESC) AS rank
+            FROM nblast_similarity_score
+            WHERE similarity_id = %(similarity_id)s
+        ) ranked
+        WHERE s.id = ranked.id
+        AND ranked.rank > %(top_n)s
+    """, {
+        'similarity_id': similarity_id,
+        'top_n': top_n,
+    })
+
+
+def create_nblast_blocks(similarity, query_object_ids:List[int],
+        target_object_ids:List[int]) -> List[NblastSimilarityBlock]:
+    """Split the query × target matrix of a similarity into blocks that fit
+    into the memory available to a single task and store them. Existing blocks
+    and sparse scores of the similarity are removed.
+    """
+    config = similarity.config
+    NblastSimilarityBlock.objects.filter(similarity_id=similarity.id).delete()
+    if similarity.storage == 'sparse':
+        cursor = connection.cursor()
+        cursor.execute("""
+            DELETE FROM nblast_similarity_score
+            WHERE similarity_id = %(similarity_id)s
+        """, {
+            'similarity_id': similarity.id,
+        })
+
+    points_per_object = max(
+            estimate_points_per_object(similarity.project_id,
+                similarity.query_type_id, query_object_ids, config.resample_step),
+            estimate_points_per_object(similarity.project_id,
+                similarity.target_type_id, target_object_ids, config.resample_step))
+    n_block_queries, n_block_targets = get_block_shape(len(query_object_ids),
+            len(target_object_ids), points_per_object, get_block_memory(),
+            config.backend)
+    logger.debug(f'Splitting similarity {similarity.id} into blocks of '
+            f'{n_block_queries} × {n_block_targets} objects')
+
+    return NblastSimilarityBlock.objects.bulk_create([
+            NblastSimilarityBlock(similarity_id=similarity.id,
+                query_objects=query_ids, target_objects=target_ids)
+            for query_ids, target_ids in split_into_blocks(query_object_ids,
+                target_object_ids, n_block_queries, n_block_targets)])
+
+
+def report_nblast_progress(user_id, similarity_id) -> Tuple[int, int]:
+    """Update the detailed status of a similarity that is computed with the
+    number of complete blocks and notify the user. Returns the number of
+    complete blocks and the total number of blocks.
+    """
+    blocks = NblastSimilarityBlock.objects.filter(similarity_id=similarity_id)
+    n_blocks = blocks.count()
+    n_complete_blocks = blocks.filter(status='complete').count()
+    NblastSimilarity.objects.filter(pk=similarity_id, status='computing').update(
+            detailed_status=f'Computed {n_complete_blocks} of {n_blocks} blocks')
+    status = NblastSimilarity.objects.filter(pk=similarity_id).values_list(
+            'status', flat=True).first()
+
+    msg_user(user_id, 'similarity-update', {
+        'similarity_id': similarity_id,
+        'similarity_status': status,
+        'n_complete_blocks': n_complete_blocks,
+        'n_blocks': n_blocks,
+    })
+
+    return n_complete_blocks, n_blocks
+
+
+def fail_nblast(user_id, similarity_id, error:str, duration:float=0) -> None:
+    """Mark a similarity as failed and notify the user.
+    """
+    similarities = NblastSimilarity.objects.filter(pk=similarity_id)
+    if len(similarities) > 0:
+        similarity = similarities[0]
+        similarity.status = 'error'
+        similarity.detailed_status = error
+        similarity.computation_time = duration
+        similarity.save()
+
+        msg_user(user_id, 'similarity-update', {
+            'similarity_id': similarity.id,
+            'similarity_status': similarity.status,
+        })
+
+
 @task()
 def compute_nblast(project_id, user_id, similarity_id, remove_target_duplicates,
-        simplify=True, required_branches=10, use_cache=True, use_http=False) -> str:
+        simplify=True, required_branches=10, use_cache=True, use_http=False,
+        resume=False) -> str:
+    """Split the computation of a similarity into blocks of query and target
+    objects and queue a task for each of them. With <resume>, blocks of an
+    earlier computation of the similarity that are complete are kept and only
+    the remaining blocks are queued. Blocks that are still marked as computing
+    are expected to be interrupted and are queued again as well. Resumed
+    blocks start over with their attempts.
+    """
     start_time = timer()
     try:
         # TODO This should be configurable.
@@ -679,100 +862,288 @@ def compute_nblast(project_id, user_id, similarity_id, remove_target_duplicates,
             similarity.status = 'computing'
             similarity.save()
 
-        query_object_ids = similarity.initial_query_objects
-        target_object_ids = similarity.initial_target_objects
-
-        # Fill in object IDs, if not yet present
-        updated = False
-        if not query_object_ids:
-            query_object_ids = get_all_object_ids(project_id, user_id,
-                    similarity.query_type_id, min_nodes, min_soma_nodes,
-                    soma_tags)
-        if not target_object_ids:
-            target_object_ids = get_all_object_ids(project_id, user_id,
-                    similarity.target_type_id, min_nodes, min_soma_nodes,
-                    soma_tags)
-
-        similarity.target_objects = target_object_ids
-        similarity.query_objects = query_object_ids
-        similarity.save()
-
         config = similarity.config
         if not config.status == 'complete':
-            raise ValueError("NBLAST config #" + config.id +
-                "isn't marked as complete")
+            raise ValueError(f"NBLAST config #{config.id} isn't marked as complete")
 
         # Make sure we have a scoring matrix
         if not config.scoring:
             raise ValueError(f"NBLAST config #{config.id}" +
                 " does not have a computed scoring.")
 
-        scoring_info = nblast(project_id, user_id, config.id,
-                query_object_ids, target_object_ids,
-                similarity.query_type_id, similarity.target_type_id,
-                normalized=similarity.normalized,
-                use_alpha=similarity.use_alpha,
-                remove_target_duplicates=remove_target_duplicates,
-                simplify=simplify, required_branches=required_branches,
-                use_cache=use_cache, reverse=similarity.reverse,
-                top_n=similarity.top_n, use_http=use_http)
+        if resume:
+            resumed_blocks = NblastSimilarityBlock.objects.filter(
+                    similarity_id=similarity.id).exclude(status='complete')
+            resumed_blocks.filter(status='computing').update(status='queued')
+            resumed_blocks.update(n_attempts=0)
+            blocks = list(NblastSimilarityBlock.objects.filter(
+                    similarity_id=similarity.id).order_by('id'))
+        else:
+            blocks = []
+
+        if not blocks:
+            query_object_ids = similarity.initial_query_objects
+            target_object_ids = similarity.initial_target_objects
+
+            # Indicate an all-by-all computation. This disables
+            # <remove_target_duplicates>.
+            all_by_all = not query_object_ids and not target_object_ids and \
+                    similarity.query_type_id == similarity.target_type_id
+
+            # Fill in object IDs, if not yet present
+            if not query_object_ids:
+                query_object_ids = get_all_object_ids(project_id, user_id,
+                        similarity.query_type_id, min_nodes, min_soma_nodes,
+                        soma_tags)
+            if not target_object_ids:
+                target_object_ids = get_all_object_ids(project_id, user_id,
+                        similarity.target_type_id, min_nodes, min_soma_nodes,
+                        soma_tags)
+
+            # If both query and target IDs are of the same type, the target
+            # list of object IDs can't contain any of the query IDs.
+            if similarity.query_type_id == similarity.target_type_id and \
+                    remove_target_duplicates and not all_by_all:
+                query_id_set = set(query_object_ids)
+                target_object_ids = [object_id for object_id in target_object_ids
+                        if object_id not in query_id_set]
+
+            if not query_object_ids:
+                raise NoValidObjectsError("No valid query objects found")
+            if not target_object_ids:
+                raise NoValidObjectsError("No valid target objects found")
+
+            similarity.query_objects = query_object_ids
+            similarity.target_objects = target_object_ids
+            similarity.save()
 
-        duration = timer() - start_time
+            blocks = create_nblast_blocks(similarity, query_object_ids,
+                    target_object_ids)
 
-        # Update config and samples
-        if scoring_info.get('errors'):
-            raise ValueError("Errors during computation: {}".format(
-                    ', '.join(str(i) for i in scoring_info['errors'])))
+        incomplete_blocks = [b for b in blocks if b.status != 'complete']
+        if incomplete_blocks:
+            report_nblast_progress(user_id, similarity.id)
+            for block in incomplete_blocks:
+                compute_nblast_block.delay(project_id, user_id, similarity.id,
+                        block.id, simplify, required_branches, use_cache,
+                        use_http)
         else:
-            similarity.status = 'complete'
-            similarity.scoring = scoring_info['similarity']
-            similarity.detailed_status = ("Computed scoring for {} query " +
-                    "skeletons vs {} target skeletons.").format(
-                            len(similarity.query_objects) if similarity.query_objects is not None else '?',
-                            len(similarity.target_objects) if similarity.target_objects is not None else '?')
-
-            if scoring_info['query_object_ids']:
-                invalid_query_objects = set(similarity.query_objects) - set(scoring_info['query_object_ids'])
-                similarity.invalid_query_objects = list(invalid_query_objects)
-                similarity.query_objects = scoring_info['query_object_ids']
-            else:
-                similarity.invalid_query_objects = None
+            finalize_nblast(user_id, similarity.id)
 
-            if scoring_info['target_object_ids']:
-                invalid_target_objects = set(similarity.target_objects) - set(scoring_info['target_object_ids'])
-                similarity.invalid_target_objects = list(invalid_target_objects)
-                similarity.target_objects = scoring_info['target_object_ids']
-            else:
-                similarity.invalid_target_objects = None
+        return (f"Queued {len(incomplete_blocks)} of {len(blocks)} blocks " +
+                f"of NBLAST similarity {similarity.id}")
+    except Exception as ex:
+        fail_nblast(user_id, similarity_id, str(ex), timer() - start_time)
 
-            similarity.computation_time = duration
-            similarity.save()
+        import traceback
+        logger.info(traceback.format_exc())
 
-        msg_user(user_id, 'similarity-update', {
-            'similarity_id': similarity.id,
-            'similarity_status': similarity.status,
-        })
+        return "Computing new NBLAST similarity failed"
 
-        return f"Computed new NBLAST similarity for config {config.id}"
-    except Exception as ex:
-        duration = timer() - start_time
-        similarities = NblastSimilarity.objects.filter(pk=similarity_id)
-        if len(similarities) > 0:
-            similarity = similarities[0]
-            similarity.status = 'error'
-            similarity.detailed_status = str(ex)
-            similarity.computation_time = duration
-            similarity.save()
 
-            msg_user(user_id, 'similarity-update', {
+@task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def compute_nblast_block(self, project_id, user_id, similarity_id, block_id,
+        simplify=True, required_branches=10, use_cache=True,
+        use_http=False) -> str:
+    """Compute the scores of a single block of a similarity and store them
+    with the block or, with sparse storage, in the sparse score table. The
+    task is acknowledged only after it finished and is requeued if its worker
+    is lost, so that it is run again. Blocks are claimed atomically: a block
+    that is complete or computed by another task is skipped, only a
+    redelivered task can take over a block that is marked as computing. A
+    block that was claimed more than MAX_NBLAST_BLOCK_ATTEMPTS times fails the
+    similarity. Once all blocks are complete, the similarity is finalized. If
+    this fails, only the similarity is marked as failed.
+    """
+    start_time = timer()
+    try:
+        blocks = NblastSimilarityBlock.objects.filter(pk=block_id,
+                similarity_id=similarity_id).exclude(status='complete')
+        delivery_info = self.request.delivery_info or {}
+        if not delivery_info.get('redelivered'):
+            blocks = blocks.exclude(status='computing')
+        if not blocks.update(status='computing', n_attempts=F('n_attempts') + 1):
+            return f"Block {block_id} of NBLAST similarity {similarity_id} " + \
+                    "is already complete or computed by another task"
+        block = NblastSimilarityBlock.objects.get(pk=block_id)
+        if block.n_attempts > MAX_NBLAST_BLOCK_ATTEMPTS:
+            raise ValueError(f"Giving up after {MAX_NBLAST_BLOCK_ATTEMPTS} attempts")
+
+        similarity = NblastSimilarity.objects.select_related('config').get(
+                project_id=project_id, pk=similarity_id)
+        config = similarity.config
+        if config.backend == 'numpy':
+            compute = numpy_nblast.nblast
+        else:
+            compute = nblast
+
+        # With sparse storage, scores are filtered per query object and
+        # written while they are computed, if the backend supports it. Scores
+        # of earlier attempts to compute this block are removed first.
+        sparse = similarity.storage == 'sparse'
+        compute_options = {}
+        if sparse:
+            cursor = connection.cursor()
+            cursor.execute("""
+                DELETE FROM nblast_similarity_score
+                WHERE similarity_id = %(similarity_id)s
+                AND query_object_id = ANY(%(query_object_ids)s::bigint[])
+                AND target_object_id = ANY(%(target_object_ids)s::bigint[])
+            """, {
                 'similarity_id': similarity.id,
-                'similarity_status': similarity.status,
+                'query_object_ids': block.query_objects,
+                'target_object_ids': block.target_objects,
             })
 
+            def store_block(query_ids, target_ids, scores):
+                store_sparse_scores(similarity.id, query_ids, target_ids,
+                        scores, similarity.top_n, similarity.min_score)
+
+            if config.backend == 'numpy':
+                compute_options['on_block'] = store_block
+                compute_options['block_size'] = SPARSE_SCORE_BLOCK_SIZE
+
+        # Duplicates were removed when blocks were created. Blocks on the
+        # diagonal of an all-by-all computation need their self-matches. A
+        # block without any valid query or target objects is complete, its
+        # objects are invalid. Other errors fail the block.
+        try:
+            scoring_info = compute(project_id, user_id, config.id,
+                    block.query_objects, block.target_objects,
+                    similarity.query_type_id, similarity.target_type_id,
+                    normalized=similarity.normalized,
+                    use_alpha=similarity.use_alpha,
+                    remove_target_duplicates=False,
+                    simplify=simplify, required_branches=required_branches,
+                    use_cache=use_cache, reverse=similarity.reverse,
+                    top_n=0, use_http=use_http, **compute_options)
+        except NoValidObjectsError:
+            scoring_info = {
+                'errors': [],
+                'similarity': None,
+                'query_object_ids': [],
+                'target_object_ids': [],
+            }
+
+        if scoring_info['errors']:
+            raise ValueError("Errors during computation: {}".format(
+                    ', '.join(str(i) for i in scoring_info['errors'])))
+
+        block.valid_query_objects = scoring_info['query_object_ids']
+        block.valid_target_objects = scoring_info['target_object_ids']
+        if not sparse:
+            block.scoring = scoring_info['similarity']
+        elif scoring_info['similarity']:
+            # Backends that don't stream results return the complete block,
+            # which is written in parts as well.
+            scores = scoring_info['similarity']
+            for i in range(0, len(scores), SPARSE_SCORE_BLOCK_SIZE):
+                store_block(block.valid_query_objects[i:i + SPARSE_SCORE_BLOCK_SIZE],
+                        block.valid_target_objects,
+                        scores[i:i + SPARSE_SCORE_BLOCK_SIZE])
+
+        block.status = 'complete'
+        block.detailed_status = None
+        block.computation_time = timer() - start_time
+        block.save()
+
+        n_complete_blocks, n_blocks = report_nblast_progress(user_id, similarity.id)
+    except Exception as ex:
+        duration = timer() - start_time
+        NblastSimilarityBlock.objects.filter(pk=block_id).update(
+                status='error', detailed_status=str(ex), computation_time=duration)
+        fail_nblast(user_id, similarity_id, f"Block {block_id} failed: {ex}")
+
         import traceback
         logger.info(traceback.format_exc())
 
-        return "Computing new NBLAST similarity failed"
+        return f"Computing block {block_id} of NBLAST similarity {similarity_id} failed"
+
+    # The block is complete, even if the similarity can't be finalized.
+    if n_complete_blocks == n_blocks:
+        try:
+            finalize_nblast(user_id, similarity_id)
+        except Exception as ex:
+            fail_nblast(user_id, similarity_id, str(ex))
+
+            import traceback
+            logger.info(traceback.format_exc())
+
+            return f"Finalizing NBLAST similarity {similarity_id} failed"
+
+    return f"Computed block {block_id} of NBLAST similarity {similarity_id}"
+
+
+def finalize_nblast(user_id, similarity_id) -> bool:
+    """Combine the results of all blocks of a similarity, once all of them are
+    complete, and mark the similarity as complete. With dense storage, the
+    scoring matrix is assembled from the block scores. With sparse storage,
+    scores are limited to the top N of each query object. Blocks are removed
+    afterwards. Returns whether the similarity was finalized, which happens
+    only once, even if multiple tasks try.
+    """
+    with transaction.atomic():
+        similarity = NblastSimilarity.objects.select_for_update().get(
+                pk=similarity_id)
+        if similarity.status == 'complete':
+            return False
+        blocks = list(NblastSimilarityBlock.objects.filter(
+                similarity_id=similarity.id).order_by('id'))
+        if not blocks or any(b.status != 'complete' for b in blocks):
+            return False
+
+        valid_query_objects = set(chain.from_iterable(b.valid_query_objects
+                for b in blocks))
+        valid_target_objects = set(chain.from_iterable(b.valid_target_objects
+                for b in blocks))
+        query_object_ids = [object_id for object_id in similarity.query_objects
+                if object_id in valid_query_objects]
+        target_object_ids = [object_id for object_id in similarity.target_objects
+                if object_id in valid_target_objects]
+        if not query_object_ids:
+            raise NoValidObjectsError("No valid query objects found")
+        if not target_object_ids:
+            raise NoValidObjectsError("No valid target objects found")
+
+        if similarity.storage == 'sparse':
+            if similarity.top_n:
+                prune_sparse_scores(similarity.id, similarity.top_n)
+            similarity.scoring = None
+        else:
+            rows = {object_id: i for i, object_id in enumerate(query_object_ids)}
+            cols = {object_id: i for i, object_id in enumerate(target_object_ids)}
+            scores = np.zeros((len(query_object_ids), len(target_object_ids)))
+            for block in blocks:
+                if block.scoring:
+                    scores[np.ix_([rows[o] for o in block.valid_query_objects],
+                            [cols[o] for o in block.valid_target_objects])] = block.scoring
+            if similarity.top_n:
+                columns = numpy_nblast.top_n_columns(scores, similarity.top_n)
+                scores = scores[:, columns]
+                target_object_ids = [target_object_ids[i] for i in columns]
+            similarity.scoring = scores.tolist()
+
+        similarity.invalid_query_objects = list(set(similarity.query_objects) -
+                set(query_object_ids))
+        similarity.invalid_target_objects = list(set(similarity.target_objects) -
+                set(valid_target_objects))
+        similarity.query_objects = query_object_ids
+        similarity.target_objects = target_object_ids
+        similarity.status = 'complete'
+        similarity.detailed_status = ("Computed scoring for {} query " +
+                "skeletons vs {} target skeletons in {} blocks.").format(
+                        len(query_object_ids), len(target_object_ids), len(blocks))
+        similarity.computation_time = sum(b.computation_time for b in blocks)
+        similarity.save()
+
+        NblastSimilarityBlock.objects.filter(similarity_id=similarity.id).delete()
+
+    msg_user(user_id, 'similarity-update', {
+        'similarity_id': similarity.id,
+        'similarity_status': similarity.status,
+    })
+
+    return True
 
 
 @api_view(['POST'])
@@ -883,6 +1254,23 @@ def compare_skeletons(request:HttpRequest, project_id) -> JsonResponse:
         type: int
         required: false
         defaultValue: 0
+      - name: storage
+        description: |
+            How scores are stored. 'dense' stores the complete scoring matrix
+            with the similarity. 'sparse' stores only the top N scores of each
+            query object (if top_n is set) that are at least min_score (if
+            set) in a separate table, while they are computed. Sparse scores
+            are available through the scores endpoint of a similarity.
+        type: string
+        enum: [dense, sparse]
+        required: false
+        defaultValue: dense
+      - name: min_score
+        description: |
+            With sparse storage, only scores that are at least this value
+            are stored.
+        type: number
+        required: false
     """
     name = request.POST.get('name', None)
     if not name:
@@ -947,6 +1335,14 @@ def compare_skeletons(request:HttpRequest, project_id) -> JsonResponse:
     reverse = get_request_bool(request.POST, 'reverse', True)
     use_alpha = get_request_bool(request.POST, 'use_alpha', False)
     top_n = int(request.POST.get('top_n', 0))
+    storage = request.POST.get('storage', 'dense')
+    if storage not in NblastSimilarityStorageModes:
+        raise ValueError(f"Need valid storage mode ({', '.join(NblastSimilarityStorageModes)})")
+    min_score = request.POST.get('min_score')
+    if min_score is not None:
+        if storage != 'sparse':
+            raise ValueError("A minimum score is only supported with sparse storage")
+        min_score = float(min_score)
     remove_target_duplicates = get_request_bool(request.POST,
             'remove_target_duplicates', True)
 
@@ -988,7 +1384,7 @@ def compare_skeletons(request:HttpRequest, project_id) -> JsonResponse:
                 initial_target_objects=target_ids,
                 query_type_id=query_type_id, target_type_id=target_type_id,
                 normalized=normalized, reverse=reverse, use_alpha=use_alpha,
-                top_n=top_n)
+                top_n=top_n, storage=storage, min_score=min_score)
         similarity.save()
 
     task = compute_nblast.delay(project_id, request.user.id, similarity.id,
@@ -1079,7 +1475,7 @@ class SimilarityList(APIView):
                     FROM (
                         SELECT id, user_id, creation_time, edition_time, project_id,
                             config_id, name, status, use_alpha, normalized, detailed_status,
-                            computation_time, reverse, top_n,
+                            computation_time, reverse, top_n, storage, min_score,
                             query_type_id AS query_type,
                             target_type_id AS target_type,
                             -- No scoreing is included, but return an empty list instead.
@@ -1164,6 +1560,190 @@ class SimilarityDetail(APIView):
         })
 
 
+# The sort orders of similarity scores, for sparse and dense storage. Dense
+# orders are lists of keys for numpy.lexsort(), the last being the primary one.
+SCORE_ORDERS = {
+    'query': ('query_object_id, score DESC, target_object_id',
+            lambda q, t, v: (t, -v, q)),
+    'target': ('target_object_id, score DESC, query_object_id',
+            lambda q, t, v: (q, -v, t)),
+    'score': ('score DESC, query_object_id, target_object_id',
+            lambda q, t, v: (t, q, -v)),
+}
+
+
+def get_dense_scores(similarity, query_ids:Optional[List[int]],
+        target_ids:Optional[List[int]], min_score:Optional[float],
+        order:str, limit:int, offset:int) -> List[List]:
+    """Page through the scoring matrix of a densely stored similarity. Only
+    the selected rows and columns of the matrix are flattened.
+    """
+    if not similarity.scoring:
+        return []
+    scores = np.asarray(similarity.scoring, dtype=np.float64)
+    query_objects = np.asarray(similarity.query_objects, dtype=np.int64)
+    target_objects = np.asarray(similarity.target_objects, dtype=np.int64)
+    rows = np.flatnonzero(np.isin(query_objects, query_ids)) \
+            if query_ids is not None else np.arange(len(query_objects))
+    cols = np.flatnonzero(np.isin(target_objects, target_ids)) \
+            if target_ids is not None else np.arange(len(target_objects))
+
+    values = scores[np.ix_(rows, cols)]
+    q = np.repeat(query_objects[rows], len(cols))
+    t = np.tile(target_objects[cols], len(rows))
+    v = values.ravel()
+    if min_score is not None:
+        keep = v >= min_score
+        q, t, v = q[keep], t[keep], v[keep]
+
+    page = np.lexsort(SCORE_ORDERS[order][1](q, t, v))[offset:offset + limit]
+    return [[int(q[i]), int(t[i]), float(v[i])] for i in page]
+
+
+def get_sparse_scores(similarity_id, query_ids:Optional[List[int]],
+        target_ids:Optional[List[int]], min_score:Optional[float],
+        order:str, limit:int, offset:int) -> List[List]:
+    """Page through the stored scores of a sparsely stored similarity.
+    """
+    constraints = ['similarity_id = %(similarity_id)s']
+    if query_ids is not None:
+        constraints.append('query_object_id = ANY(%(query_ids)s::bigint[])')
+    if target_ids is not None:
+        constraints.append('target_object_id = ANY(%(target_ids)s::bigint[])')
+    if min_score is not None:
+        constraints.append('score >= %(min_score)s')
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT query_object_id, target_object_id, score
+        FROM nblast_similarity_score
+        WHERE {constraints}
+        ORDER BY {order}
+        LIMIT %(limit)s
+        OFFSET %(offset)s
+    """.format(**{
+        'constraints': ' AND '.join(constraints),
+        'order': SCORE_ORDERS[order][0],
+    }), {
+        'similarity_id': similarity_id,
+        'query_ids': query_ids,
+        'target_ids': target_ids,
+        'min_score': min_score,
+        'limit': limit,
+        'offset': offset,
+    })
+    return [list(row) for row in cursor.fetchall()]
+
+
+@api_view(['GET'])
+@requires_user_role(UserRole.Browse)
+def similarity_scores(request:HttpRequest, project_id, similarity_id) -> JsonResponse:
+    """Page through the scores of a similarity query result, optionally
+    limited to some query and target objects. Passing a single query object
+    returns its row of the similarity matrix, passing a single target object
+    its column. Sparsely stored similarities are read from an index without
+    loading all scores. Scores can be read while a sparse similarity is still
+    computed.
+    ---
+    parameters:
+      - name: project_id
+        description: Project of the similarity
+        type: integer
+        paramType: path
+        required: true
+      - name: similarity_id
+        description: The similarity to read scores from.
+        type: integer
+        paramType: path
+        required: true
+      - name: query_ids
+        description: Only return scores of these query objects.
+        type: array
+        items:
+          type: integer
+        paramType: form
+        required: false
+      - name: target_ids
+        description: Only return scores of these target objects.
+        type: array
+        items:
+          type: integer
+        paramType: form
+        required: false
+      - name: min_score
+        description: Only return scores that are at least this value.
+        type: number
+        paramType: form
+        required: false
+      - name: order
+        description: |
+            Sort scores by query object, by target object (both with the
+            highest score first) or by score only.
+        type: string
+        enum: [query, target, score]
+        paramType: form
+        required: false
+        defaultValue: query
+      - name: limit
+        description: The maximum number of returned scores.
+        type: integer
+        paramType: form
+        required: false
+        defaultValue: 1000
+      - name: offset
+        description: The number of scores to skip.
+        type: integer
+        paramType: form
+        required: false
+        defaultValue: 0
+    type:
+      scores:
+        type: array
+        items:
+          type: array
+          items:
+            type: string
+        description: List of [query object ID, target object ID, score] entries
+        required: true
+      has_more:
+        type: boolean
+        description: Whether more scores are available after this page
+        required: true
+    """
+    query_ids = get_request_list(request.query_params, 'query_ids', map_fn=int)
+    target_ids = get_request_list(request.query_params, 'target_ids', map_fn=int)
+    min_score = request.query_params.get('min_score')
+    if min_score is not None:
+        min_score = float(min_score)
+    order = request.query_params.get('order', 'query')
+    if order not in SCORE_ORDERS:
+        raise ValueError(f"Need valid order ({', '.join(SCORE_ORDERS)})")
+    limit = int(request.query_params.get('limit', 1000))
+    if limit < 1 or limit > MAX_SCORE_PAGE_SIZE:
+        raise ValueError(f"The limit has to be between 1 and {MAX_SCORE_PAGE_SIZE}")
+    offset = int(request.query_params.get('offset', 0))
+    if offset < 0:
+        raise ValueError("The offset can't be negative")
+
+    similarity = NblastSimilarity.objects.only('id', 'storage').get(
+            pk=similarity_id, project_id=project_id)
+
+    # One more score than requested is fetched to know if there are more.
+    if similarity.storage == 'sparse':
+        scores = get_sparse_scores(similarity.id, query_ids, target_ids,
+                min_score, order, limit + 1, offset)
+    else:
+        similarity = NblastSimilarity.objects.only('scoring', 'query_objects',
+                'target_objects').get(pk=similarity.id)
+        scores = get_dense_scores(similarity, query_ids, target_ids,
+                min_score, order, limit + 1, offset)
+
+    return JsonResponse({
+        'scores': scores[:limit],
+        'has_more': len(scores) > limit,
+    })
+
+
 @requires_user_role(UserRole.QueueComputeTask)
 def recompute_similarity(request:HttpRequest, project_id, similarity_id) -> JsonResponse:
     """Recompute the similarity matrix of the passed in NBLAST configuration.
@@ -1172,9 +1752,11 @@ def recompute_similarity(request:HttpRequest, project_id, similarity_id) -> Json
     required_branches = int(request.GET.get('required_branches', '10'))
     can_edit_or_fail(request.user, similarity_id, 'nblast_similarity')
     use_cache = get_request_bool(request.GET, 'use_cache', True)
+    resume = get_request_bool(request.GET, 'resume', False)
     task = compute_nblast.delay(project_id, request.user.id, similarity_id,
             remove_target_duplicates=True, simplify=simplify,
-            required_branches=required_branches, use_cache=use_cache)
+            required_branches=required_branches, use_cache=use_cache,
+            resume=resume)
 
     return JsonResponse({
         'status': 'queued',
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 
 from collections import defaultdict
-import csv
 from datetime import datetime, timedelta
 from itertools import chain
 import dateutil.parser
@@ -15,13 +14,13 @@ from django.conf import settings
 from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, Http404, \
         JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.db import connection
+from django.db import connection, transaction
 from django.db.models import Q
 from django.views.decorators.cache import never_cache
 
 from rest_framework.decorators import api_view
 
-from catmaid.control import tracing
+from catmaid.control import connectivityexport, skeletonimport, tracing
 from catmaid.models import (Project, UserRole, Class, ClassInstance, Review,
         ClassInstanceClassInstance, Relation, Sampler, Treenode,
         TreenodeConnector, SamplerDomain, SkeletonSummary, SamplerDomainEnd,
@@ -33,8 +32,9 @@ from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail, can_edit_all_or_fail
 from catmaid.control.common import (insert_into_log, get_class_to_id_map,
         get_relation_to_id_map, _create_relation, get_request_bool,
-        get_request_list, Echo)
+        get_request_list)
 from catmaid.control.link import LINK_TYPES
+from catmaid.control.morphology import ArrayTree
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.annotation import (annotations_for_skeleton,
         create_annotation_query, _annotate_entities, _update_neuron_annotations)
@@ -127,34 +127,23 @@ def _open_leaves(project_id, skeleton_id, tnid=None):
         WHERE t.skeleton_id = %s
         ''', (int(skeleton_id),))
 
-    # Some entries repeated, when a node has more than one tag
-    # Create a graph with edges from parent to child, and accumulate parents.
-    tree = nx.DiGraph()
-    n_nodes = 0
-    for row in cursor.fetchall():
-        n_nodes += 1
-        node_id = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], node_id)
-        else:
-            tree.add_node(node_id)
+    rows = cursor.fetchall()
+    n_nodes = len(rows)
+    tree = ArrayTree.from_rows(rows)
 
-            # Default to root node
-            if not tnid:
-                tnid = node_id
+    # Default to root node
+    if not tnid:
+        tnid = find_root(tree)
 
     if tnid not in tree:
         raise ValueError("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
     reroot(tree, tnid)
     distances = edge_count_to_root(tree, root_node=tnid)
-    leaves = set()
-
-    for node_id, out_degree in tree.out_degree_iter():
-        if 0 == out_degree or node_id == tnid and 1 == out_degree:
-            # Found an end node
-            leaves.add(node_id)
+    leaves = set(tree.end_nodes())
+    if 1 == len(tree.children(tnid)):
+        # The new root is an end node, too
+        leaves.add(tnid)
 
     # Select all nodes and their tags
     cursor.execute('''
@@ -283,24 +272,17 @@ def _find_labels(project_id, skeleton_id, label_regex, tnid=None,
             ''', (labeled_as, label_regex, int(skeleton_id)))
 
     # Some entries repeated, when a node has more than one matching label
-    # Create a graph with edges from parent to child, and accumulate parents
-    tree = nx.DiGraph()
+    parents = {}
+    locations = {}
+    tags:DefaultDict[Any, List] = defaultdict(list)
     for row in cursor.fetchall():
         nodeID = row[0]
-        if row[1]:
-            # It is ok to add edges that already exist: DiGraph doesn't keep duplicates
-            tree.add_edge(row[1], nodeID)
-        else:
-            tree.add_node(nodeID)
-        tree.node[nodeID]['loc'] = (row[2], row[3], row[4])
+        parents[nodeID] = row[1]
+        locations[nodeID] = (row[2], row[3], row[4])
         if row[5]:
-            props = tree.node[nodeID]
-            tags = props.get('tags')
-            if tags:
-                tags.append(row[5])
-            else:
-                props['tags'] = [row[5]]
+            tags[nodeID].append(row[5])
 
+    tree = ArrayTree(list(parents.keys()), list(parents.values()))
     if tnid not in tree:
         raise ValueError("Could not find %s in skeleton %s" % (tnid, int(skeleton_id)))
 
@@ -311,18 +293,17 @@ def _find_labels(project_id, skeleton_id, label_regex, tnid=None,
     leaves = set()
 
     if only_leaves:
-        for node_id, out_degree in tree.out_degree_iter():
-            if 0 == out_degree or node_id == tnid and 1 == out_degree:
-                # Found an end node
-                leaves.add(node_id)
+        leaves.update(tree.end_nodes())
+        if 1 == len(tree.children(tnid)):
+            # The new root is an end node, too
+            leaves.add(tnid)
 
-    for nodeID, props in tree.nodes_iter(data=True):
+    for nodeID, node_tags in tags.items():
         if only_leaves and nodeID not in leaves:
             continue
-        if 'tags' in props:
-            # Found a node with a matching label
-            d = distances[nodeID]
-            nearest.append([nodeID, props['loc'], d, props['tags']])
+        # Found a node with a matching label
+        d = distances[nodeID]
+        nearest.append([nodeID, locations[nodeID], d, node_tags])
 
     nearest.sort(key=lambda n: n[2])
 
@@ -1011,49 +992,51 @@ def connectivity_counts(request:HttpRequest, project_id=None) -> JsonResponse:
 
     relations = dict(Relation.objects.filter(project_id=project_id).values_list('relation_name', 'id'))
 
-    source_relation_ids = map(lambda r: relations[r], source_relations)
-    target_relation_ids = map(lambda r: relations[r], target_relations)
+    source_relation_ids = [relations[r] for r in source_relations]
+    target_relation_ids = [relations[r] for r in target_relations]
 
-    extra_select = []
+    cursor = connection.cursor()
     if count_partner_links:
-        if target_relation_ids:
-            extra_target_check = """
-                AND tc2.relation_id IN ({})
-            """.format(','.join(map(str, target_relation_ids)))
-        else:
-            extra_target_check = ""
-
-        extra_select.append(f"""
-            JOIN treenode_connector tc2
-                ON tc.connector_id = tc2.connector_id
-                AND tc.id <> tc2.id
-                {extra_target_check}
-        """)
-
-    if source_relation_ids:
-        extra_source_check = """
-            AND tc.relation_id IN ({})
-        """.format(','.join(map(str, source_relation_ids)))
+        # Partner links are counted in the skeleton connectivity table
+        extra_source_check = 'AND sc.relation_id = ANY(%(source_relation_ids)s::bigint[])' \
+                if source_relation_ids else ''
+        extra_target_check = 'AND sc.partner_relation_id = ANY(%(target_relation_ids)s::bigint[])' \
+                if target_relation_ids else ''
+        cursor.execute("""
+            SELECT sc.skeleton_id, sc.relation_id, SUM(sc.count)
+            FROM catmaid_skeleton_connectivity sc
+            WHERE sc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            AND sc.project_id = %(project_id)s
+            {extra_source_check}
+            {extra_target_check}
+            GROUP BY sc.skeleton_id, sc.relation_id
+        """.format(**{
+            'extra_source_check': extra_source_check,
+            'extra_target_check': extra_target_check,
+        }), {
+            'project_id': project_id,
+            'skeleton_ids': skeleton_ids,
+            'source_relation_ids': source_relation_ids,
+            'target_relation_ids': target_relation_ids,
+        })
     else:
-        extra_source_check = ""
-
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT tc.skeleton_id, tc.relation_id, COUNT(tc)
-        FROM treenode_connector tc
-        JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
-            ON skeleton.id = tc.skeleton_id
-        {extra_select}
-        WHERE tc.project_id = %(project_id)s
-        {extra_source_check}
-        GROUP BY tc.skeleton_id, tc.relation_id
-    """.format(**{
-        'extra_select': '\n'.join(extra_select),
-        'extra_source_check': extra_source_check,
-    }), {
-        'project_id': project_id,
-        'skeleton_ids': skeleton_ids,
-    })
+        extra_source_check = 'AND tc.relation_id = ANY(%(source_relation_ids)s::bigint[])' \
+                if source_relation_ids else ''
+        cursor.execute("""
+            SELECT tc.skeleton_id, tc.relation_id, COUNT(tc)
+            FROM treenode_connector tc
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON skeleton.id = tc.skeleton_id
+            WHERE tc.project_id = %(project_id)s
+            {extra_source_check}
+            GROUP BY tc.skeleton_id, tc.relation_id
+        """.format(**{
+            'extra_source_check': extra_source_check,
+        }), {
+            'project_id': project_id,
+            'skeleton_ids': skeleton_ids,
+            'source_relation_ids': source_relation_ids,
+        })
 
     connectivity:Dict = {}
     seen_relations = set()
@@ -1571,25 +1554,38 @@ def _connected_skeletons(skeleton_ids, op, relation_id_1, relation_id_2,
     partners:DefaultDict[Any, Partner] = defaultdict(newPartner)
 
     # Obtain the synapses made by all skeleton_ids considering the desired
-    # direction of the synapse, as specified by relation_id_1 and relation_id_2:
-    cursor.execute('''
-    SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence),
-        t1.treenode_id, t2.treenode_id
-    FROM treenode_connector t1,
-         treenode_connector t2
-    WHERE t1.skeleton_id = ANY(%s::bigint[])
-      AND t1.relation_id = %s
-      AND t1.connector_id = t2.connector_id
-      AND t1.id != t2.id
-      AND t2.relation_id = %s
-    ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
-
-    # Sum the number of synapses
-    for srcID, partnerID, confidence, tn1, tn2 in cursor.fetchall():
-        partner = partners[partnerID]
-        partner.skids[srcID][confidence - 1] += 1
-        if with_nodes:
+    # direction of the synapse, as specified by relation_id_1 and relation_id_2.
+    # Individual links are only needed if nodes are requested, otherwise the
+    # synapse counts are read from the skeleton connectivity table.
+    if with_nodes:
+        cursor.execute('''
+        SELECT t1.skeleton_id, t2.skeleton_id, LEAST(t1.confidence, t2.confidence),
+            t1.treenode_id, t2.treenode_id
+        FROM treenode_connector t1,
+             treenode_connector t2
+        WHERE t1.skeleton_id = ANY(%s::bigint[])
+          AND t1.relation_id = %s
+          AND t1.connector_id = t2.connector_id
+          AND t1.id != t2.id
+          AND t2.relation_id = %s
+        ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
+
+        # Sum the number of synapses
+        for srcID, partnerID, confidence, tn1, tn2 in cursor.fetchall():
+            partner = partners[partnerID]
+            partner.skids[srcID][confidence - 1] += 1
             partner.links.append([tn1, tn2, srcID])
+    else:
+        cursor.execute('''
+        SELECT skeleton_id, partner_skeleton_id, confidence_histogram
+        FROM catmaid_skeleton_connectivity
+        WHERE skeleton_id = ANY(%s::bigint[])
+          AND relation_id = %s
+          AND partner_relation_id = %s
+        ''', (list(skeleton_ids), int(relation_id_1), int(relation_id_2)))
+
+        for srcID, partnerID, confidence_histogram in cursor.fetchall():
+            partners[partnerID].skids[srcID] = confidence_histogram
 
     # There may not be any synapses
     if not partners:
@@ -1881,36 +1877,124 @@ def connectivity_matrix_csv(request:HttpRequest, project_id) -> StreamingHttpRes
         type: array
         items:
             type: string
+      - name: order
+        description: |
+          The order of rows and columns: "input" keeps the order of the passed
+          in skeletons, "id" sorts by skeleton ID and "count" by the number of
+          synapses within the matrix, largest first.
+        required: false
+        default: input
+        type: string
+        enum: [input, id, count]
+        paramType: form
     """
     # sanitize arguments
     project_id = int(project_id)
     rows = tuple(get_request_list(request.POST, 'rows', [], map_fn=int))
     cols = tuple(get_request_list(request.POST, 'columns', [], map_fn=int))
     names:Dict = dict(map(lambda x: (int(x[0]), x[1]), get_request_list(request.POST, 'names', [])))
+    order = request.POST.get('order', 'input')
+
+    return _connectivity_matrix_response(project_id, rows, cols, 'csv',
+            order, names)
+
+
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def connectivity_matrix_export(request:HttpRequest, project_id) -> StreamingHttpResponse:
+    """
+    Stream the synaptic connectivity matrix of a set of row skeletons and a set
+    of column skeletons. Rows are written as soon as the synapse counts of a
+    batch of row skeletons are known, which makes this endpoint suitable for
+    large matrices.
+    ---
+    parameters:
+      - name: project_id
+        description: Project of skeletons
+        type: integer
+        paramType: path
+        required: true
+      - name: rows
+        description: IDs of row skeletons
+        required: true
+        type: array
+        items:
+          type: integer
+        paramType: form
+      - name: columns
+        description: IDs of column skeletons
+        required: true
+        type: array
+        items:
+          type: integer
+        paramType: form
+      - name: format
+        description: |
+          The output format: "csv" for a dense CSV matrix with a header line
+          of column skeletons and one line per row skeleton, "coo" for a
+          sparse CSV list of row skeleton, column skeleton and count of each
+          connected pair or "arrow" for the same sparse list as Apache Arrow
+          IPC stream (if pyarrow is installed).
+        required: false
+        default: csv
+        type: string
+        enum: [csv, coo, arrow]
+        paramType: form
+      - name: order
+        description: |
+          The order of rows and columns: "input" keeps the order of the passed
+          in skeletons, "id" sorts by skeleton ID and "count" by the number of
+          synapses within the matrix, largest first.
+        required: false
+        default: input
+        type: string
+        enum: [input, id, count]
+        paramType: form
+      - name: names
+        description: |
+            An optional mapping of skeleton IDs versus names, used for the
+            dense CSV format. Represented as a list of two-element lists. Each
+            inner list follows the form [<skeleton-id>, <name>].
+        required: false
+        type: array
+        items:
+            type: string
+    """
+    project_id = int(project_id)
+    rows = tuple(get_request_list(request.POST, 'rows', [], map_fn=int))
+    cols = tuple(get_request_list(request.POST, 'columns', [], map_fn=int))
+    names:Dict = dict(map(lambda x: (int(x[0]), x[1]), get_request_list(request.POST, 'names', [])))
+    matrix_format = request.POST.get('format', 'csv')
+    order = request.POST.get('order', 'input')
 
-    matrix = get_connectivity_matrix(project_id, rows, cols)
+    return _connectivity_matrix_response(project_id, rows, cols, matrix_format,
+            order, names)
 
-    csv_data = []
-    header = [''] + list(map(lambda x: names.get(x, x), cols))
-    csv_data.append(header)
 
-    for n, skid_a in enumerate(rows):
-        # Add row header skeleton ID
-        row = [names.get(skid_a, skid_a)]
-        csv_data.append(row)
-        # Add connectivity information
-        for m, skid_b in enumerate(cols):
-            p = matrix.get(skid_a, {})
-            c = p.get(skid_b, 0)
-            row.append(c)
+def _connectivity_matrix_response(project_id, rows, cols, matrix_format,
+        order, names) -> StreamingHttpResponse:
+    if matrix_format not in connectivityexport.MATRIX_FORMATS:
+        raise ValueError(f"Unknown format: {matrix_format}")
+    if order not in connectivityexport.MATRIX_ORDERS:
+        raise ValueError(f"Unknown order: {order}")
+    if matrix_format == 'arrow' and not connectivityexport.arrow_available:
+        raise ValueError("Arrow output requires the pyarrow module")
 
-    pseudo_buffer = Echo()
-    writer = csv.writer(pseudo_buffer, quoting=csv.QUOTE_NONNUMERIC)
+    rows, cols = connectivityexport.order_skeletons(project_id, rows, cols, order)
+    matrix_rows = connectivityexport.iter_connectivity_rows(project_id, rows, cols)
 
-    response = StreamingHttpResponse((writer.writerow(row) for row in csv_data), # type: ignore
-            content_type='text/csv')
+    if matrix_format == 'arrow':
+        response = StreamingHttpResponse(connectivityexport.iter_arrow(
+                matrix_rows, cols), content_type='application/vnd.apache.arrow.stream')
+        filename = 'catmaid-connectivity-matrix.arrow'
+    else:
+        if matrix_format == 'coo':
+            lines = connectivityexport.iter_coo_csv(matrix_rows, cols)
+        else:
+            lines = connectivityexport.iter_dense_csv(matrix_rows, cols, names)
+        response = StreamingHttpResponse(lines, content_type='text/csv')
+        filename = 'catmaid-connectivity-matrix.csv'
 
-    filename = 'catmaid-connectivity-matrix.csv'
     response['Content-Disposition'] = f'attachment; filename={filename}'
 
     return response
@@ -1930,39 +2014,32 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids,
     post_rel_id = relation_map['postsynaptic_to']
     pre_rel_id = relation_map['presynaptic_to']
 
-    if with_locations:
-        extra_select = ', c.id, c.location_x, c.location_y, c.location_z'
-        extra_join = 'JOIN connector c ON c.id = t2.connector_id'
-    else:
-        extra_select = ''
-        extra_join = ''
-
-    # Obtain all synapses made between row skeletons and column skeletons.
-    cursor.execute('''
-        SELECT t1.skeleton_id, t2.skeleton_id
-            {extra_select}
-        FROM treenode_connector t1,
-             treenode_connector t2
-            {extra_join}
-        WHERE t1.skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
-          AND t2.skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
-          AND t1.connector_id = t2.connector_id
-          AND t1.relation_id = %(pre_rel_id)s
-          AND t2.relation_id = %(post_rel_id)s
-    '''.format(extra_select=extra_select, extra_join=extra_join), {
-        'row_skeleton_ids': list(row_skeleton_ids),
-        'col_skeleton_ids': list(col_skeleton_ids),
-        'pre_rel_id': pre_rel_id,
-        'post_rel_id': post_rel_id
-    })
-
     # Build a sparse connectivity representation. For all skeletons requested
     # map a dictionary of partner skeletons and the number of synapses
     # connecting to each partner. If locations should be returned as well, an
     # object with the fields 'count' and 'locations' is returned instead of a
     # single count.
+    outgoing:DefaultDict[Any, Dict] = defaultdict(dict)
     if with_locations:
-        outgoing:DefaultDict[Any, Dict] = defaultdict(dict)
+        # Obtain all synapses made between row skeletons and column skeletons.
+        cursor.execute('''
+            SELECT t1.skeleton_id, t2.skeleton_id,
+                c.id, c.location_x, c.location_y, c.location_z
+            FROM treenode_connector t1,
+                 treenode_connector t2
+                JOIN connector c ON c.id = t2.connector_id
+            WHERE t1.skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
+              AND t2.skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
+              AND t1.connector_id = t2.connector_id
+              AND t1.relation_id = %(pre_rel_id)s
+              AND t2.relation_id = %(post_rel_id)s
+        ''', {
+            'row_skeleton_ids': list(row_skeleton_ids),
+            'col_skeleton_ids': list(col_skeleton_ids),
+            'pre_rel_id': pre_rel_id,
+            'post_rel_id': post_rel_id
+        })
+
         for r in cursor.fetchall():
             source, target = r[0], r[1]
             mapping = outgoing[source]
@@ -1983,12 +2060,23 @@ def get_connectivity_matrix(project_id, row_skeleton_ids, col_skeleton_ids,
             else:
                 info['locations'][connector_id]['count'] += 1
     else:
-        outgoing = defaultdict(dict)
-        for r in cursor.fetchall():
-            source, target = r[0], r[1]
-            mapping = outgoing[source]
-            count = mapping.get(target, 0)
-            mapping[target] = count + 1
+        # Synapse counts are available from the skeleton connectivity table.
+        cursor.execute('''
+            SELECT skeleton_id, partner_skeleton_id, count
+            FROM catmaid_skeleton_connectivity
+            WHERE skeleton_id = ANY(%(row_skeleton_ids)s::bigint[])
+              AND partner_skeleton_id = ANY(%(col_skeleton_ids)s::bigint[])
+              AND relation_id = %(pre_rel_id)s
+              AND partner_relation_id = %(post_rel_id)s
+        ''', {
+            'row_skeleton_ids': list(row_skeleton_ids),
+            'col_skeleton_ids': list(col_skeleton_ids),
+            'pre_rel_id': pre_rel_id,
+            'post_rel_id': post_rel_id
+        })
+
+        for source, target, count in cursor.fetchall():
+            outgoing[source][target] = count
 
     return outgoing
 
@@ -2914,6 +3002,82 @@ def import_skeleton(request:HttpRequest, project_id=None) -> Union[HttpResponse,
     return HttpResponseBadRequest('No file received.')
 
 
+@api_view(['POST'])
+@requires_user_role(UserRole.Import)
+def import_skeletons(request:HttpRequest, project_id=None) -> Union[JsonResponse, HttpResponseBadRequest]:
+    """Import many neurons modeled by skeletons from uploaded SWC and eSWC
+    files, or ZIP and tar archives of them.
+
+    Each file is imported as a new neuron with a single skeleton, both named
+    after the file name without extension. Skeletons are written in batches
+    with COPY, which is much faster than importing files individually. Either
+    all files are imported or none.
+    ---
+    consumes: multipart/form-data
+    parameters:
+      - name: annotations
+        description: >
+            An optional list of annotation names that is added to all imported
+            neurons. Counting patterns are not supported.
+        paramType: form
+        type: array
+        items:
+          type: string
+      - name: source_url
+        description: >
+            If specified together with source_project_id, skeletons whose file
+            name is a number are recorded as originating from the source
+            skeleton with this ID.
+        paramType: form
+        type: string
+      - name: source_project_id
+        description: >
+            If specified, this source project ID will be saved and mapped to the
+            new skeleton IDs. This is only valid together with source_url.
+        paramType: form
+        type: integer
+      - name: source_type
+        description: >
+            Can be either 'skeleton' or 'segmentation', to further specify of
+            what type the origin data is.
+        paramType: form
+        type: string
+      - name: file
+        required: true
+        description: >
+            One or more SWC, eSWC, ZIP or tar files. Archives are searched for
+            SWC and eSWC files.
+        paramType: body
+        dataType: File
+    type:
+        skeletons:
+            type: array
+            required: true
+            description: >
+                A list of objects with the fields name, neuron_id, skeleton_id
+                and n_nodes, one for each imported skeleton.
+    """
+    annotations = get_request_list(request.POST, 'annotations', ['Import'])
+    source_url = request.POST.get('source_url', None)
+    source_project_id = request.POST.get('source_project_id', None)
+    source_type = request.POST.get('source_type', 'skeleton')
+
+    files = [(f.name, f) for key in request.FILES for f in request.FILES.getlist(key)]
+    if not files:
+        return HttpResponseBadRequest('No file received.')
+
+    skeletons = skeletonimport.iter_swc_skeletons(skeletonimport.iter_swc_files(
+            files, settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE))
+    with transaction.atomic():
+        imported = skeletonimport.bulk_import(request.user, project_id,
+                skeletons, annotations, source_url, source_project_id,
+                source_type)
+
+    return JsonResponse({
+        'skeletons': imported,
+    })
+
+
 def import_skeleton_swc(user, project_id, swc_string, neuron_id=None,
         skeleton_id=None, name=None, annotations=['Import'], force=False,
         auto_id=True, source_id=None, source_url=None, source_project_id=None,
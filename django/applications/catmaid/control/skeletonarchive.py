@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""Streaming export of many skeletons as a ZIP or tar archive of SWC, eSWC or
+JSON files. Treenodes are read in batches of skeletons with one query per
+batch and each skeleton is serialized on its own, optionally in a pool of
+worker processes. Archive data is returned as soon as a file is written, which
+keeps memory use bounded by the batch size rather than the number of
+skeletons.
+"""
+
+from collections import defaultdict, deque
+from concurrent import futures
+from functools import partial
+import json
+import tarfile
+import time
+from io import BytesIO
+from typing import (Any, Callable, DefaultDict, Deque, Dict, Iterable,
+        Iterator, List, Sequence, Tuple)
+import zipfile
+
+from django.db import connection
+
+from catmaid.control.annotation import get_annotated_entities
+from catmaid.control.common import batches
+
+
+FILE_FORMATS = ('swc', 'eswc', 'json')
+
+ARCHIVE_FORMATS = ('zip', 'tar', 'tar.gz')
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def find_skeleton_ids(project_id, params) -> List[int]:
+    """Return the skeletons of all neurons matching an annotation query, the
+    same parameters the annotation query-targets API accepts.
+    """
+    entities, _ = get_annotated_entities(project_id, params,
+            allowed_classes=['neuron'], with_annotations=False,
+            with_skeletons=True)
+    skeleton_ids:List[int] = []
+    for entity in entities:
+        skeleton_ids.extend(entity.get('skeleton_ids') or [])
+    return list(dict.fromkeys(skeleton_ids))
+
+
+def linearize_swc_rows(rows:List[List]) -> List[List]:
+    """Renumber the nodes of SWC rows in breadth-first order, starting with
+    1 for the root, and sort rows by their new ID.
+    """
+    successors:DefaultDict[Any, List] = defaultdict(list)
+    root = None
+    for row in rows:
+        node, parent = row[0], row[6]
+        if parent == -1:
+            root = node
+        else:
+            successors[parent].append(node)
+    # Map each node to a new incremental ID
+    id_map = dict()
+    working_set = deque([root])
+    count = 1
+    while working_set:
+        node = working_set.popleft()
+        id_map[node] = count
+        count += 1
+        working_set.extend(successors[node])
+    # Replace each original ID with the mapped ID
+    for row in rows:
+        row[0] = id_map[row[0]]
+        row[6] = id_map[row[6]] if row[6] != -1 else -1
+    # Sort based on node ID
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+def serialize_skeleton(rows:Sequence[Tuple], file_format:str='swc',
+        linearize_ids:bool=False) -> bytes:
+    """Encode the treenode rows of iter_skeleton_rows() as SWC, eSWC or JSON.
+    JSON files contain a list of [id, parent_id, user_id, location_x,
+    location_y, location_z, radius, confidence] rows, like the compact-skeleton
+    API. This has to be a module level function to be usable in worker
+    processes.
+    """
+    if file_format == 'json':
+        return json.dumps([[r[0], r[1], r[7], r[2], r[3], r[4], r[5], r[6]]
+                for r in rows], separators=(',', ':')).encode('utf-8')
+
+    swc_rows = []
+    for r in rows:
+        swc_row = [r[0], 0, r[2], r[3], r[4], max(r[5], 0),
+                -1 if r[1] is None else r[1]]
+        if file_format == 'eswc':
+            swc_row.extend((r[8], r[9].isoformat(), r[10], r[11].isoformat(),
+                    r[6]))
+        swc_rows.append(swc_row)
+
+    if linearize_ids:
+        swc_rows = linearize_swc_rows(swc_rows)
+
+    return ''.join(' '.join(map(str, row)) + '\n'
+            for row in swc_rows).encode('utf-8')
+
+
+def iter_skeleton_rows(project_id, skeleton_ids:Sequence[int],
+        with_history_columns:bool=False,
+        batch_size:int=DEFAULT_BATCH_SIZE) -> Iterator[List[Tuple[int, List[Tuple]]]]:
+    """Yield lists of (skeleton ID, treenode rows) for batches of skeletons,
+    in the passed in order. Each treenode row is [id, parent_id, location_x,
+    location_y, location_z, radius, confidence, user_id], followed by the
+    creator name, creation time, editor name and edition time if
+    <with_history_columns> is true.
+    """
+    extra_select, extra_join = '', ''
+    if with_history_columns:
+        extra_select = ', creator.username, t.creation_time, editor.username, t.edition_time'
+        extra_join = """
+            JOIN auth_user creator
+                ON creator.id = t.user_id
+            JOIN auth_user editor
+                ON editor.id = t.editor_id
+        """
+
+    cursor = connection.cursor()
+    for batch in batches(skeleton_ids, batch_size):
+        cursor.execute(f"""
+            SELECT t.skeleton_id, t.id, t.parent_id, t.location_x,
+                t.location_y, t.location_z, t.radius, t.confidence,
+                t.user_id {extra_select}
+            FROM treenode t
+            JOIN UNNEST(%(skeleton_ids)s::bigint[]) skeleton(id)
+                ON skeleton.id = t.skeleton_id
+            {extra_join}
+            WHERE t.project_id = %(project_id)s
+            ORDER BY t.skeleton_id, t.id
+        """, {
+            'project_id': project_id,
+            'skeleton_ids': batch,
+        })
+        rows:Dict[int, List[Tuple]] = {skeleton_id: [] for skeleton_id in batch}
+        for row in cursor.fetchall():
+            rows[row[0]].append(row[1:])
+        yield [(skeleton_id, rows[skeleton_id]) for skeleton_id in batch]
+
+
+def iter_serialized(skeleton_batches:Iterable[List[Tuple[int, List[Tuple]]]],
+        serialize:Callable[[List[Tuple]], bytes],
+        workers:int=1) -> Iterator[Tuple[int, bytes]]:
+    """Yield (skeleton ID, data) for each skeleton of the passed in batches.
+    With more than one worker, skeletons are serialized in a process pool,
+    while the next batch is loaded.
+    """
+    if workers <= 1:
+        for batch in skeleton_batches:
+            for skeleton_id, rows in batch:
+                yield skeleton_id, serialize(rows)
+        return
+
+    with futures.ProcessPoolExecutor(workers) as executor:
+        pending:Deque[List[Tuple[int, futures.Future]]] = deque()
+        for batch in skeleton_batches:
+            pending.append([(skeleton_id, executor.submit(serialize, rows))
+                    for skeleton_id, rows in batch])
+            # Keep one batch in flight while the next one is loaded.
+            while len(pending) > 1:
+                for skeleton_id, future in pending.popleft():
+                    yield skeleton_id, future.result()
+        while pending:
+            for skeleton_id, future in pending.popleft():
+                yield skeleton_id, future.result()
+
+
+class StreamBuffer:
+    """A write-only file object that collects written data until it is taken
+    out. Archive writers treat it as unseekable stream.
+    """
+    def __init__(self) -> None:
+        self.chunks:List[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_archive(files:Iterable[Tuple[str, bytes]],
+        archive_format:str='zip') -> Iterator[bytes]:
+    """Write (name, data) files into a ZIP or (optionally gzip compressed) tar
+    archive and yield the archive in chunks, at least one per file.
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format: {archive_format}")
+
+    buffer = StreamBuffer()
+    now = time.time()
+    if archive_format == 'zip':
+        archive:Any = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
+        date_time = time.localtime(now)[:6]
+
+        def add_file(name, data):
+            info = zipfile.ZipInfo(name, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            archive.writestr(info, data)
+    else:
+        mode = 'w|gz' if archive_format == 'tar.gz' else 'w|'
+        archive = tarfile.open(fileobj=buffer, mode=mode)
+
+        def add_file(name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(now)
+            info.mode = 0o644
+            archive.addfile(info, BytesIO(data))
+
+    with archive:
+        for name, data in files:
+            add_file(name, data)
+            chunk = buffer.take()
+            if chunk:
+                yield chunk
+    yield buffer.take()
+
+
+def iter_skeleton_archive(project_id, skeleton_ids:Sequence[int],
+        file_format:str='swc', archive_format:str='zip',
+        linearize_ids:bool=False, batch_size:int=DEFAULT_BATCH_SIZE,
+        workers:int=1) -> Iterator[bytes]:
+    """Yield an archive with one file per skeleton, named after the skeleton
+    ID, in chunks.
+    """
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"Unknown file format: {file_format}")
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format: {archive_format}")
+
+    skeleton_batches = iter_skeleton_rows(project_id, skeleton_ids,
+            file_format == 'eswc', batch_size)
+    serialize = partial(serialize_skeleton, file_format=file_format,
+            linearize_ids=linearize_ids)
+    files = ((f'{skeleton_id}.{file_format}', data) for skeleton_id, data
+            in iter_serialized(skeleton_batches, serialize, workers))
+
+    return iter_archive(files, archive_format)
@@ -1,37 +1,47 @@
 # -*- coding: utf-8 -*-
 
-import array
 from collections import defaultdict, deque
 from datetime import datetime
 from functools import partial
 import json
 import logging
-from math import sqrt
 import msgpack
 import networkx as nx
+import numpy as np
 from psycopg2.extras import DateTimeTZRange
 import pytz
-import struct
-from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple, Union
+from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Set, Tuple, Union
 
+from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
-from django.http import HttpRequest, HttpResponse, JsonResponse, Http404
+from django.http import (HttpRequest, HttpResponse, JsonResponse, Http404,
+        StreamingHttpResponse)
 from django.db.models.query import QuerySet
 
 from rest_framework.decorators import api_view
 
+from catmaid.cache import VersionedCache
 from catmaid.models import UserRole, ClassInstance, Treenode, \
         TreenodeClassInstance, ConnectorClassInstance, Review, User
-from catmaid.control import export_NeuroML_Level3
+from catmaid.control import (export_NeuroML_Level3, neuroglancer,
+        skeletonarchive)
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import (get_relation_to_id_map, get_request_bool,
         get_request_list)
+from catmaid.control.morphology import ArborArrays
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
-from catmaid.control.tree_util import edge_count_to_root, partition
+from catmaid.control.tree_util import edge_count_to_root
 
 
+# A cache of encoded compact skeletons. Entries are keyed by
+# ('compact-skeleton', project_id, skeleton_id, options) and store the version
+# stamp of the skeleton they were created from, see
+# get_skeleton_version_stamps().
+skeleton_payload_cache = VersionedCache(settings.SKELETON_PAYLOAD_CACHE_SIZE,
+        settings.SKELETON_PAYLOAD_CACHE_PATH)
+
 try:
     from exportneuroml import neuroml_single_cell, neuroml_network
 except ImportError:
@@ -166,30 +176,7 @@ def get_swc_string(project_id, skeleton_id, treenodes_qs:QuerySet, linearize_ids
         all_rows.append(swc_row)
 
     if linearize_ids:
-        # Find successors for each node
-        successors:DefaultDict[Any, List] = defaultdict(list)
-        root = None
-        for tn in all_rows:
-            node, parent = tn[0], tn[6]
-            if parent == -1:
-                root = node
-            else:
-                successors[parent].append(node)
-        # Map each node to a new incremental ID
-        id_map = dict()
-        working_set = deque([root])
-        count = 1
-        while working_set:
-            node = working_set.popleft()
-            id_map[node] = count
-            count += 1
-            working_set.extend(successors[node])
-        # Replace each original ID with the mapped ID
-        for tn in all_rows:
-            tn[0] = id_map[tn[0]]
-            tn[6] = id_map[tn[6]] if tn[6] != -1 else -1
-        # Sort based on node ID
-        all_rows.sort(key=lambda tn: tn[0])
+        all_rows = skeletonarchive.linearize_swc_rows(all_rows)
 
     result = ""
     for row in all_rows:
@@ -340,24 +327,22 @@ def compact_skeleton_detail(request:HttpRequest, project_id=None, skeleton_id=No
     return_format = request.GET.get('format', 'json')
     ordered = get_request_bool(request.GET, "ordered", False)
 
-    result = _compact_skeleton(project_id, skeleton_id, with_connectors,
-                               with_tags, with_history, with_merge_history,
-                               with_reviews, with_annotations, with_user_info,
-                               ordered)
+    if return_format != 'msgpack':
+        return_format = 'json'
+
+    data = get_compact_skeleton_payloads(project_id, [skeleton_id],
+            return_format, with_connectors, with_tags, with_history,
+            with_merge_history, with_reviews, with_annotations, with_user_info,
+            ordered)[skeleton_id]
 
     if return_format == 'msgpack':
-        data = msgpack.packb(result)
         return HttpResponse(data, content_type='application/octet-stream')
     else:
-        return JsonResponse(result, safe=False,
-                json_dumps_params={
-                    'separators': (',', ':'),
-                    'default': default
-                })
+        return HttpResponse(data, content_type='application/json')
 
 @requires_user_role(UserRole.Browse)
 def compact_skeleton(request:HttpRequest, project_id=None, skeleton_id=None,
-        with_connectors=None, with_tags=None) -> JsonResponse:
+        with_connectors=None, with_tags=None) -> HttpResponse:
     """Get a compact treenode representation of a skeleton, optionally with the
     history of individual nodes and connectors. This does exactly the same as
     compact_skeleton_detail(), but provides a slightly different interface. This
@@ -378,16 +363,11 @@ def compact_skeleton(request:HttpRequest, project_id=None, skeleton_id=None,
     with_user_info = get_request_bool(request.GET, "with_user_info", False)
     ordered = get_request_bool(request.GET, "ordered", False)
 
-    result = _compact_skeleton(project_id, skeleton_id, with_connectors,
-                               with_tags, with_history, with_merge_history,
-                               with_reviews, with_annotations, with_user_info,
-                               ordered)
+    data = get_compact_skeleton_payloads(project_id, [skeleton_id], 'json',
+            with_connectors, with_tags, with_history, with_merge_history,
+            with_reviews, with_annotations, with_user_info, ordered)[skeleton_id]
 
-    return JsonResponse(result, safe=False,
-            json_dumps_params={
-                'separators': (',', ':'),
-                'default': default
-            })
+    return HttpResponse(data, content_type='application/json')
 
 
 @api_view(['POST'])
@@ -419,6 +399,11 @@ def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> Union[
     data. This requires the client to do slightly more work, but unfortunately
     the original creation time is needed for data that was created without
     history tables enabled.
+
+    All skeletons are loaded together, using one query per kind of data.
+    Requests for more than SKELETON_DETAIL_BATCH_SIZE skeletons are loaded in
+    batches of this size and are streamed to the client, one skeleton at a
+    time.
     ---
     parameters:
     - skeleton_ids:
@@ -499,24 +484,187 @@ def compact_skeleton_detail_many(request:HttpRequest, project_id=None) -> Union[
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
 
-    skeletons = {}
-    for skeleton_id in skeleton_ids:
-        skeletons[skeleton_id] = _compact_skeleton(project_id, skeleton_id,
-                with_connectors, with_tags, with_history, with_merge_history,
-                with_reviews, with_annotations, with_user_info, ordered)
-
-    result = {
-        "skeletons": skeletons
-    }
+    if return_format != 'msgpack':
+        return_format = 'json'
+
+    # Remove duplicates, but keep the order
+    skeleton_ids = list(dict.fromkeys(skeleton_ids))
+    batch_size = max(1, settings.SKELETON_DETAIL_BATCH_SIZE)
+
+    def get_batches():
+        for i in range(0, len(skeleton_ids), batch_size):
+            yield get_compact_skeleton_payloads(project_id,
+                    skeleton_ids[i:i + batch_size], return_format,
+                    with_connectors, with_tags, with_history, with_merge_history,
+                    with_reviews, with_annotations, with_user_info, ordered)
+
+    if len(skeleton_ids) > batch_size:
+        # Large requests are streamed batch by batch. Errors can't be reported
+        # anymore once streaming started, which is why all skeletons are
+        # checked first.
+        existing_ids = set(ClassInstance.objects.filter(
+                pk__in=skeleton_ids).values_list('id', flat=True))
+        for skeleton_id in skeleton_ids:
+            if skeleton_id not in existing_ids:
+                raise Http404(f"Skeleton #{skeleton_id} doesn't exist")
+
+        if return_format == 'msgpack':
+            return StreamingHttpResponse(_iter_compact_skeletons_msgpack(
+                    get_batches(), len(skeleton_ids)),
+                    content_type='application/octet-stream')
+        else:
+            return StreamingHttpResponse(_iter_compact_skeletons_json(
+                    get_batches()), content_type='application/json')
 
     if return_format == 'msgpack':
-        data = msgpack.packb(result)
+        data = b''.join(_iter_compact_skeletons_msgpack(get_batches(),
+                len(skeleton_ids)))
         return HttpResponse(data, content_type='application/octet-stream')
     else:
-        return JsonResponse(result, safe=False, json_dumps_params={
-            'separators': (',', ':'),
-            'default': default
-        })
+        data = b''.join(_iter_compact_skeletons_json(get_batches()))
+        return HttpResponse(data, content_type='application/json')
+
+
+def _iter_compact_skeletons_json(batches) -> Iterator[bytes]:
+    """Return the JSON encoding of a {"skeletons": {}} result in chunks, one
+    chunk per skeleton. Batches map skeleton IDs to encoded skeletons.
+    """
+    yield b'{"skeletons":{'
+    separator = ''
+    for batch in batches:
+        for skeleton_id, data in batch.items():
+            yield f'{separator}"{skeleton_id}":'.encode('utf-8') + data
+            separator = ','
+    yield b'}}'
+
+
+def _iter_compact_skeletons_msgpack(batches, n_skeletons) -> Iterator[bytes]:
+    """Return the msgpack encoding of a {"skeletons": {}} result in chunks, one
+    chunk per skeleton. Batches map skeleton IDs to encoded skeletons.
+    """
+    packer = msgpack.Packer()
+    yield packer.pack_map_header(1) + packer.pack('skeletons') + \
+            packer.pack_map_header(n_skeletons)
+    for batch in batches:
+        for skeleton_id, data in batch.items():
+            yield packer.pack(skeleton_id) + data
+
+
+def encode_compact_skeleton(skeleton, return_format:str='json') -> bytes:
+    """Encode a result of _compact_skeleton() as JSON or msgpack."""
+    if return_format == 'msgpack':
+        return msgpack.packb(skeleton)
+    return json.dumps(skeleton, cls=DjangoJSONEncoder, separators=(',', ':'),
+            default=default).encode('utf-8')
+
+
+def get_skeleton_version_stamps(skeleton_ids, with_connectors:bool=False,
+        with_tags:bool=False, with_reviews:bool=False,
+        with_annotations:bool=False, cursor=None) -> Dict[int, str]:
+    """Return a version stamp for each passed in skeleton, which changes when
+    the skeleton's nodes or any other requested kind of data change. Each part
+    of a stamp consists of the number of rows involved and the sum of their
+    transaction IDs. The database sets the transaction ID of a row on each
+    insert and update, and deletions change the number of rows. This is much
+    cheaper than loading and encoding the data itself.
+    """
+    parts = ['''
+        SELECT concat(count(*), '/', sum(t.txid))
+        FROM treenode t
+        WHERE t.skeleton_id = s.id
+    ''']
+    if with_connectors:
+        parts.append('''
+            SELECT concat(count(*), '/', sum(tc.txid + c.txid))
+            FROM treenode_connector tc
+            JOIN connector c
+                ON c.id = tc.connector_id
+            WHERE tc.skeleton_id = s.id
+        ''')
+    if with_tags:
+        parts.append('''
+            SELECT concat(count(*), '/', sum(tci.txid + ci.txid))
+            FROM treenode t
+            JOIN treenode_class_instance tci
+                ON tci.treenode_id = t.id
+            JOIN class_instance ci
+                ON ci.id = tci.class_instance_id
+            WHERE t.skeleton_id = s.id
+        ''')
+    if with_reviews:
+        parts.append('''
+            SELECT concat(count(*), '/', sum(extract(epoch FROM r.review_time)))
+            FROM review r
+            WHERE r.skeleton_id = s.id
+        ''')
+    if with_annotations:
+        parts.append('''
+            SELECT concat(count(*), '/', sum(neuron_link.txid + annotation_link.txid))
+            FROM class_instance_class_instance neuron_link
+            JOIN class_instance_class_instance annotation_link
+                ON annotation_link.class_instance_a = neuron_link.class_instance_b
+            WHERE neuron_link.class_instance_a = s.id
+        ''')
+
+    if not cursor:
+        cursor = connection.cursor()
+    cursor.execute('''
+        SELECT s.id, concat_ws(';', {})
+        FROM UNNEST(%(skeleton_ids)s::bigint[]) s(id)
+    '''.format(', '.join(f'({p})' for p in parts)), {
+        'skeleton_ids': list(skeleton_ids),
+    })
+    return dict(cursor.fetchall())
+
+
+def get_compact_skeleton_payloads(project_id, skeleton_ids,
+        return_format:str='json', with_connectors=True, with_tags=True,
+        with_history=False, with_merge_history=True, with_reviews=False,
+        with_annotations=False, with_user_info=False, ordered=False,
+        scale=None) -> Dict[int, bytes]:
+    """Return a dictionary that maps each passed in skeleton ID to its encoded
+    compact representation (see _compact_skeleton()), either as JSON or msgpack.
+    If the skeleton payload cache is enabled, skeletons that didn't change
+    since they were last encoded with the same options are read from the
+    cache. All other skeletons are loaded together.
+    """
+    if not skeleton_payload_cache.enabled:
+        skeletons = _compact_skeletons(project_id, skeleton_ids,
+                with_connectors, with_tags, with_history, with_merge_history,
+                with_reviews, with_annotations, with_user_info, ordered, scale)
+        return {skeleton_id: encode_compact_skeleton(skeleton, return_format)
+                for skeleton_id, skeleton in skeletons.items()}
+
+    options = '-'.join(str(int(bool(o))) for o in (with_connectors, with_tags,
+            with_history, with_merge_history, with_reviews, with_annotations,
+            with_user_info, ordered))
+    if scale:
+        options += f'-{scale}'
+    options += f'.{return_format}'
+
+    versions = get_skeleton_version_stamps(skeleton_ids, with_connectors,
+            with_tags, with_reviews, with_annotations)
+    payloads = {}
+    for skeleton_id in skeleton_ids:
+        payloads[skeleton_id] = skeleton_payload_cache.get(('compact-skeleton',
+                int(project_id), skeleton_id, options), versions[skeleton_id])
+
+    missing_ids = [skid for skid, data in payloads.items() if data is None]
+    if missing_ids:
+        skeletons = _compact_skeletons(project_id, missing_ids,
+                with_connectors, with_tags, with_history, with_merge_history,
+                with_reviews, with_annotations, with_user_info, ordered, scale)
+        for skeleton_id, skeleton in skeletons.items():
+            data = encode_compact_skeleton(skeleton, return_format)
+            skeleton_payload_cache.set(('compact-skeleton', int(project_id),
+                    skeleton_id, options), versions[skeleton_id], data)
+            payloads[skeleton_id] = data
+
+    return payloads
+
+
+def get_skeleton_payload_cache_stats() -> Dict[str, Any]:
+    return skeleton_payload_cache.stats()
 
 
 def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
@@ -542,29 +690,55 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
     the original creation time is needed for data that was created without
     history tables enabled.
     """
+    skeletons = _compact_skeletons(project_id, [skeleton_id], with_connectors,
+            with_tags, with_history, with_merge_history, with_reviews,
+            with_annotations, with_user_info, ordered, scale)
+    return skeletons[skeleton_id]
+
+
+def _group_by_skeleton(rows, skeleton_ids) -> Dict[int, List]:
+    """Group rows by their first element, the skeleton ID, which is removed
+    from each row. The order of rows within a group is preserved.
+    """
+    groups:Dict[int, List] = {skeleton_id: [] for skeleton_id in skeleton_ids}
+    for row in rows:
+        groups[row[0]].append(row[1:])
+    return groups
+
 
+def _compact_skeletons(project_id, skeleton_ids, with_connectors=True,
+        with_tags=True, with_history=False, with_merge_history=True,
+        with_reviews=False, with_annotations=False, with_user_info=False,
+        ordered=False, scale=None) -> Dict[int, Tuple[Tuple, Tuple, DefaultDict[Any, List], List, List]]:
+    """Get the compact representation of _compact_skeleton() for multiple
+    skeletons at once. Each kind of data is retrieved for all skeletons with a
+    single query and is grouped by skeleton afterwards. Returns a dictionary
+    that maps each skeleton ID to its compact representation. If a skeleton
+    doesn't exist, Http404 is raised.
+    """
+    skeleton_ids = list(skeleton_ids)
     cursor = connection.cursor()
 
     if not with_history:
         cursor.execute('''
-            SELECT id, parent_id, user_id,
+            SELECT skeleton_id, id, parent_id, user_id,
                 location_x{scale}, location_y{scale}, location_z{scale},
                 radius{scale}, confidence
             FROM treenode
-            WHERE skeleton_id = %(skeleton_id)s
+            WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
             {order}
         '''.format(**{
             'order': 'ORDER BY id' if ordered else '',
             'scale': '*%(scale)s' if scale else '',
         }), {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'scale': scale,
         })
 
-        nodes = tuple(cursor.fetchall())
+        nodes = _group_by_skeleton(cursor.fetchall(), skeleton_ids)
     else:
         params = {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'scale': scale,
         }
         # Get present and historic nodes. If a historic validity range is empty
@@ -573,6 +747,7 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         # happened.
         query = '''
             SELECT
+                treenode.skeleton_id,
                 treenode.id,
                 treenode.parent_id,
                 treenode.user_id,
@@ -585,9 +760,10 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 treenode.creation_time,
                 1 as ordering
             FROM treenode
-            WHERE treenode.skeleton_id = %(skeleton_id)s
+            WHERE treenode.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
             UNION ALL
             SELECT
+                treenode__history.skeleton_id,
                 treenode__history.id,
                 treenode__history.parent_id,
                 treenode__history.user_id,
@@ -600,16 +776,19 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 COALESCE(upper(treenode__history.sys_period), treenode__history.edition_time),
                 2 as ordering
             FROM treenode__history
-            WHERE treenode__history.skeleton_id = %(skeleton_id)s
+            WHERE treenode__history.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
         '''.format(**{
             'scale': '*%(scale)s' if scale else '',
         })
 
         if with_merge_history:
+            # Historic rows of merged in arbors are attributed to the skeleton
+            # the node is part of now.
             query = '''
                 {query}
                 UNION ALL
                 SELECT
+                    t.skeleton_id,
                     th.id,
                     th.parent_id,
                     th.user_id,
@@ -624,7 +803,7 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 FROM treenode__history th
                 JOIN treenode t
                     ON th.id = t.id
-                    AND t.skeleton_id = %(skeleton_id)s
+                    AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     AND th.skeleton_id <> t.skeleton_id
             '''.format(**{
                 'query': query,
@@ -636,22 +815,26 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
             {order}
         """.format(**{
             'query': query,
-            'order': 'ORDER BY treenode.id, ordering' if ordered else 'ORDER BY ordering',
+            'order': 'ORDER BY 2, ordering' if ordered else 'ORDER BY ordering',
         })
 
         cursor.execute(query, params)
 
-        nodes = tuple(cursor.fetchall())
+        nodes = _group_by_skeleton(cursor.fetchall(), skeleton_ids)
 
-    if 0 == len(nodes):
-        # Check if the skeleton exists
-        if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-            raise Http404(f"Skeleton #{skeleton_id} doesn't exist")
-        # Otherwise returns an empty list of nodes
+    empty_skeleton_ids = [skid for skid, rows in nodes.items() if not rows]
+    if empty_skeleton_ids:
+        # Check if the skeletons exist, otherwise return an empty list of nodes
+        existing_ids = set(ClassInstance.objects.filter(
+                pk__in=empty_skeleton_ids).values_list('id', flat=True))
+        for skeleton_id in empty_skeleton_ids:
+            if skeleton_id not in existing_ids:
+                raise Http404(f"Skeleton #{skeleton_id} doesn't exist")
 
-    connectors:Tuple = ()
-    tags:DefaultDict[Any, List] = defaultdict(list)
-    reviews = []
+    connectors:Dict[int, List] = {skid: [] for skid in skeleton_ids}
+    tags:Dict[int, DefaultDict[Any, List]] = {skid: defaultdict(list) for skid in skeleton_ids}
+    reviews:Dict[int, List] = {skid: [] for skid in skeleton_ids}
+    annotations:Dict[int, List] = {skid: [] for skid in skeleton_ids}
 
     if with_connectors or with_tags or with_annotations:
         # postgres is caching this query
@@ -668,33 +851,28 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         if not with_history:
             user_select = ', tc.user_id' if with_user_info else ''
             cursor.execute('''
-                SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id, tc.relation_id,
                     c.location_x{scale}, c.location_y{scale}, c.location_z{scale}
                     {user_select}
                 FROM treenode_connector tc,
                     connector c
-                WHERE tc.skeleton_id = %(skeleton_id)s
+                WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                 AND tc.connector_id = c.id
                 AND tc.relation_id IN (%(pre_id)s, %(post_id)s, %(gj_id)s, %(dm_id)s)
             '''.format(**{
                 'user_select': user_select,
                 'scale': '*%(scale)s' if scale else '',
             }), {
-                'skeleton_id': skeleton_id,
+                'skeleton_ids': skeleton_ids,
                 'pre_id': pre,
                 'post_id': post,
                 'gj_id': gj,
                 'dm_id': dm,
                 'scale': scale,
             })
-
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5]) for row in cursor.fetchall())
         else:
             params = {
-                'skeleton_id': skeleton_id,
+                'skeleton_ids': skeleton_ids,
                 'pre': pre,
                 'post': post,
                 'gj': gj,
@@ -708,43 +886,43 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
             # edition time is taken for both start and end validity, because
             # this is what actually happened.
             query = '''
-                SELECT links.treenode_id, links.connector_id, links.relation_id,
+                SELECT links.skeleton_id, links.treenode_id, links.connector_id,
+                        links.relation_id,
                         c.location_x{scale}, c.location_y{scale}, c.location_z{scale},
                         links.valid_from, links.valid_to
                         {user_select}
                 FROM (
                     SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
                         tc.edition_time, tc.creation_time, tc.user_id,
-                        1 AS ordering
+                        tc.skeleton_id, 1 AS ordering
                     FROM treenode_connector tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
+                    WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     UNION ALL
                     SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
                         COALESCE(lower(tc.sys_period), tc.edition_time),
                         COALESCE(upper(tc.sys_period), tc.edition_time),
-                        tc.user_id, 2 AS ordering
+                        tc.user_id, tc.skeleton_id, 2 AS ordering
                     FROM treenode_connector__history tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
+                    WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     {extra_query}
                     {order}
-                ) links(treenode_id, connector_id, relation_id, valid_from, valid_to, user_id)
+                ) links(treenode_id, connector_id, relation_id, valid_from, valid_to, user_id, skeleton_id)
                 JOIN connector__with_history c
                     ON links.connector_id = c.id
                 WHERE links.relation_id IN (%(pre)s, %(post)s, %(gj)s, %(dm)s)
             '''
 
             if with_merge_history:
-                merge_user_select = ', tch.user_id' if with_user_info else ''
                 extra_query = '''
                     UNION ALL
                     SELECT tch.treenode_id, tch.connector_id, tch.relation_id,
                         COALESCE(lower(tch.sys_period), tch.edition_time),
                         COALESCE(upper(tch.sys_period), tch.edition_time),
-                        tch.user_id, 3 AS ordering
+                        tch.user_id, tc.skeleton_id, 3 AS ordering
                     FROM treenode_connector__history tch
                     JOIN treenode_connector tc
                         ON tc.id = tch.id
-                        AND tc.skeleton_id = %(skeleton_id)s
+                        AND tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                         AND tch.skeleton_id <> tc.skeleton_id
                 '''
             else:
@@ -757,10 +935,9 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 'scale': '*%(scale)s' if scale else '',
             }), params)
 
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7], row[8]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7]) for row in cursor.fetchall())
+        for skeleton_id, rows in _group_by_skeleton(cursor.fetchall(), skeleton_ids).items():
+            connectors[skeleton_id] = [(row[0], row[1],
+                    relation_index.get(row[2], -1)) + row[3:] for row in rows]
 
     if with_tags:
         history_suffix = '__with_history' if with_history else ''
@@ -768,13 +945,13 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         user_select = ', tci.user_id' if with_user_info else ''
         # Fetch all node tags
         cursor.execute('''
-            SELECT c.name, tci.treenode_id
+            SELECT t.skeleton_id, c.name, tci.treenode_id
                    {history_query}
                    {user_select}
             FROM treenode{history_suffix} t,
                  treenode_class_instance{history_suffix} tci,
                  class_instance{history_suffix} c
-            WHERE t.skeleton_id = %(skeleton_id)s
+            WHERE t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
               AND t.id = tci.treenode_id
               AND tci.relation_id = %(relation_id)s
               AND c.id = tci.class_instance_id
@@ -785,62 +962,58 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
             'user_select': user_select,
             'order': 'ORDER BY tci.treenode_id ASC' if ordered else '',
         }), {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'relation_id': relations['labeled_as'],
         })
 
-        if with_history:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2], row[3]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
+        if with_history or with_user_info:
+            for row in cursor.fetchall():
+                tags[row[0]][row[1]].append(list(row[2:]))
         else:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append(row[1])
+            for row in cursor.fetchall():
+                tags[row[0]][row[1]].append(row[2])
 
     if with_reviews:
         r_history_query = ', r.review_time' if with_history else ''
         history_suffix = '__with_history' if with_history else ''
         cursor.execute(f"""
-            SELECT r.treenode_id, r.id, r.reviewer_id{r_history_query}
+            SELECT r.skeleton_id, r.treenode_id, r.id, r.reviewer_id{r_history_query}
             FROM review{history_suffix} r
-            WHERE r.skeleton_id = %s
-        """, [skeleton_id])
+            WHERE r.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        """, {
+            'skeleton_ids': skeleton_ids,
+        })
 
-        for r in cursor.fetchall():
-            reviews.append(r)
+        reviews = _group_by_skeleton(cursor.fetchall(), skeleton_ids)
 
-    annotations:List[Optional[Tuple]] = []
     if with_annotations:
         history_suffix = '__with_history' if with_history else ''
         link_history_query = ', annotation_link.edition_time' if with_history else ''
         user_select = ', neuron_link.user_id' if with_user_info else ''
-        # Fetch all node tags
+        # Fetch all skeleton annotations
         cursor.execute(f'''
-            SELECT annotation_link.class_instance_b
+            SELECT neuron_link.class_instance_a,
+                   annotation_link.class_instance_b
                    {link_history_query}
                    {user_select}
             FROM class_instance_class_instance{history_suffix} neuron_link
             JOIN class_instance_class_instance{history_suffix} annotation_link
                 ON annotation_link.class_instance_a = neuron_link.class_instance_b
-            WHERE neuron_link.class_instance_a = %(skeleton_id)s
+            WHERE neuron_link.class_instance_a = ANY(%(skeleton_ids)s::bigint[])
               AND neuron_link.relation_id = %(model_of)s
               AND annotation_link.relation_id = %(annotated_with)s
         ''', {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'model_of': relations['model_of'],
             'annotated_with': relations['annotated_with']
         })
 
-        annotations = list(cursor.fetchall())
+        annotations = _group_by_skeleton(cursor.fetchall(), skeleton_ids)
 
-    return nodes, connectors, tags, reviews, annotations
+    return {skeleton_id: (tuple(nodes[skeleton_id]),
+            tuple(connectors[skeleton_id]), tags[skeleton_id],
+            reviews[skeleton_id], annotations[skeleton_id])
+            for skeleton_id in skeleton_ids}
 
 
 def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
@@ -1158,33 +1331,19 @@ def _measure_skeletons(skeleton_ids) -> Dict[Any, Any]:
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
 
-    skids_string = ",".join(map(str, skeleton_ids))
-
+    skeleton_ids = list(skeleton_ids)
     cursor = connection.cursor()
     cursor.execute('''
     SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
     FROM treenode
-    WHERE skeleton_id IN (%s)
-    ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x  # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children:Dict[Any, float] = {}  # node ID vs distance - is first type an int or an str?
+    WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+    ''', {
+        'skeleton_ids': skeleton_ids,
+    })
 
     class Skeleton():
         def __init__(self):
-            self.nodes:Dict[Any, Node] = {}
+            self.n_nodes = 0
             self.raw_cable = 0.0
             self.smooth_cable = 0.0
             self.principal_branch_cable = 0.0
@@ -1193,91 +1352,51 @@ def _measure_skeletons(skeleton_ids) -> Dict[Any, Any]:
             self.n_pre = 0
             self.n_post = 0
 
-    skeletons:Dict[Any, Skeleton] = {}  # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        if row[2] not in skeletons:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        else:
-            skeleton = skeletons[row[2]]
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in skeletons.values():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.items():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.items():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.values())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.items():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.items():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
+    # All skeletons are measured at once. Slab nodes are smoothed by moving
+    # them towards their neighbors. The principal branch is the path from the
+    # node farthest away from the root (in edges) to the root.
+    arbors = ArborArrays.from_rows(cursor.fetchall())
+    children = arbors.child_indices
+    raw_lengths = arbors.segment_lengths()
+    smooth_lengths = arbors.segment_lengths(arbors.smooth_locations())
+    principal_branch = arbors.path_to_root(arbors.deepest_nodes())
+
+    n_children = arbors.n_children
+    has_parent = arbors.parents >= 0
+    ends = (has_parent & (n_children == 0)) | (~has_parent & (n_children == 1))
+    branches = (has_parent & (n_children > 1)) | (~has_parent & (n_children > 2))
+
+    raw_cable = arbors.sum_per_skeleton(raw_lengths)
+    smooth_cable = arbors.sum_per_skeleton(smooth_lengths)
+    principal_branch_cable = arbors.sum_per_skeleton(
+            np.where(principal_branch, smooth_lengths, 0))
+    n_nodes = arbors.count_per_skeleton()
+    n_ends = arbors.count_per_skeleton(ends)
+    n_branch = arbors.count_per_skeleton(branches)
+
+    skeletons:Dict[Any, Skeleton] = {}
+    for i, skeleton_id in enumerate(arbors.skeleton_ids.tolist()):
+        skeleton = Skeleton()
+        skeleton.n_nodes = int(n_nodes[i])
+        skeleton.raw_cable = float(raw_cable[i])
+        skeleton.smooth_cable = float(smooth_cable[i])
+        skeleton.principal_branch_cable = float(principal_branch_cable[i])
+        skeleton.n_ends = int(n_ends[i])
+        skeleton.n_branch = int(n_branch[i])
+        skeletons[skeleton_id] = skeleton
 
     # Count inputs
     cursor.execute('''
     SELECT tc.skeleton_id, count(tc.skeleton_id)
     FROM treenode_connector tc,
          relation r
-    WHERE tc.skeleton_id IN (%s)
+    WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
       AND tc.relation_id = r.id
       AND r.relation_name = 'postsynaptic_to'
     GROUP BY tc.skeleton_id
-    ''' % skids_string)
+    ''', {
+        'skeleton_ids': skeleton_ids,
+    })
 
     for row in cursor.fetchall():
         skeletons[row[0]].n_pre = row[1]
@@ -1289,14 +1408,16 @@ def _measure_skeletons(skeleton_ids) -> Dict[Any, Any]:
          treenode_connector tc2,
          relation r1,
          relation r2
-    WHERE tc1.skeleton_id IN (%s)
+    WHERE tc1.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
       AND tc1.connector_id = tc2.connector_id
       AND tc1.relation_id = r1.id
       AND r1.relation_name = 'presynaptic_to'
       AND tc2.relation_id = r2.id
       AND r2.relation_name = 'postsynaptic_to'
       GROUP BY tc1.skeleton_id
-    ''' % skids_string)
+    ''', {
+        'skeleton_ids': skeleton_ids,
+    })
 
     for row in cursor.fetchall():
         skeletons[row[0]].n_post = row[1]
@@ -1309,7 +1430,7 @@ def measure_skeletons(request:HttpRequest, project_id=None) -> JsonResponse:
     skeleton_ids = tuple(int(v) for k,v in request.POST.items() if k.startswith('skeleton_ids['))
 
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
+        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, sk.n_nodes, sk.n_branch, sk.n_ends, sk.principal_branch_cable)
     return JsonResponse([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).items()], safe=False)
 
 
@@ -1483,6 +1604,92 @@ def skeleton_eswc(*args, **kwargs):
     return export_skeleton_response(*args, **kwargs)
 
 
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def export_skeleton_archive(request:HttpRequest, project_id=None) -> StreamingHttpResponse:
+    """Stream an archive with one SWC, eSWC or JSON file per skeleton.
+
+    Skeletons are either passed in directly or are the skeletons of all neurons
+    matching an annotation query, which accepts the same parameters as the
+    annotations/query-targets API (annotated_with, not_annotated_with,
+    sub_annotated_with and annotation_reference). Files are named after the
+    skeleton ID. Treenodes are loaded in batches of skeletons and the archive
+    is streamed while it is written, starting with the first skeleton.
+    ---
+    parameters:
+      - name: project_id
+        description: Project of skeletons
+        type: integer
+        paramType: path
+        required: true
+      - name: skeleton_ids
+        description: IDs of the skeletons to export
+        required: false
+        type: array
+        items:
+          type: integer
+        paramType: form
+      - name: format
+        description: |
+          The file format of individual skeletons. JSON files contain a list
+          of [id, parent_id, user_id, x, y, z, radius, confidence] rows.
+        required: false
+        default: swc
+        type: string
+        enum: [swc, eswc, json]
+        paramType: form
+      - name: archive
+        description: The archive format
+        required: false
+        default: zip
+        type: string
+        enum: [zip, tar, tar.gz]
+        paramType: form
+      - name: linearize_ids
+        description: |
+          Whether SWC node IDs should be renumbered in breadth-first order,
+          starting with 1 for the root.
+        required: false
+        default: false
+        type: boolean
+        paramType: form
+    """
+    project_id = int(project_id)
+    skeleton_ids = get_request_list(request.POST, 'skeleton_ids', [], map_fn=int)
+    file_format = request.POST.get('format', 'swc')
+    archive_format = request.POST.get('archive', 'zip')
+    linearize_ids = get_request_bool(request.POST, 'linearize_ids', False)
+
+    if file_format not in skeletonarchive.FILE_FORMATS:
+        raise ValueError(f"Unknown format: {file_format}")
+    if archive_format not in skeletonarchive.ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format: {archive_format}")
+
+    if not skeleton_ids:
+        if not any(key.startswith('annotated_with') for key in request.POST):
+            raise ValueError("Need either skeleton IDs or an annotation query")
+        skeleton_ids = skeletonarchive.find_skeleton_ids(project_id, request.POST)
+    else:
+        # Errors can't be reported anymore once streaming started, which is
+        # why all skeletons are checked first.
+        skeleton_ids = list(dict.fromkeys(skeleton_ids))
+        existing_ids = set(ClassInstance.objects.filter(project_id=project_id,
+                pk__in=skeleton_ids).values_list('id', flat=True))
+        for skeleton_id in skeleton_ids:
+            if skeleton_id not in existing_ids:
+                raise Http404(f"Skeleton #{skeleton_id} doesn't exist")
+
+    response = StreamingHttpResponse(skeletonarchive.iter_skeleton_archive(
+            project_id, skeleton_ids, file_format, archive_format,
+            linearize_ids, settings.SKELETON_EXPORT_BATCH_SIZE,
+            settings.SKELETON_EXPORT_WORKERS),
+            content_type='application/zip' if archive_format == 'zip' else 'application/x-tar')
+    response['Content-Disposition'] = \
+            f'attachment; filename=catmaid-skeletons.{archive_format}'
+
+    return response
+
+
 def _export_review_skeleton(project_id=None, skeleton_id=None,
                             subarbor_node_id:Optional[int]=None) -> List[Dict]:
     """ Returns a list of segments for the requested skeleton. Each segment
@@ -1880,37 +2087,27 @@ def connector_polyadicity(request:HttpRequest, project_id=None) -> JsonResponse:
 
 @api_view(['GET'])
 @requires_user_role(UserRole.Browse)
-def neuroglancer_skeleton(request:HttpRequest, project_id=None, skeleton_id=None) -> JsonResponse:
+def neuroglancer_skeleton(request:HttpRequest, project_id=None, skeleton_id=None) -> HttpResponse:
     """Export a morphology-only skeleton in neuroglancer's binary format.
-    """
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT id, parent_id, location_x, location_y, location_z
-        FROM treenode
-        WHERE project_id = %s AND skeleton_id = %s
-    """, (project_id, skeleton_id))
-
-    rows = cursor.fetchall()
 
-    num_vertices = cursor.rowcount
-    id_map = {row[0]: i for i, row in enumerate(rows)}
-
-    vertices = [row[2:] for row in rows]
-    edges = [[i, id_map[row[1]]] for i, row in enumerate(rows) if row[1] is not None]
-
-    total_size = (16 + 12*num_vertices + 8*(num_vertices - 1))
-    buff = array.array('c', b'\x00'*total_size)
+    Together with the info endpoint, skeletons can be used as neuroglancer
+    precomputed skeleton source with the URL
+    `precomputed://<catmaid-url>/<project-id>/skeletons/neuroglancer`.
+    """
+    skeleton_id = int(skeleton_id)
+    encoded = neuroglancer.get_encoded_skeletons(project_id, [skeleton_id])
+    if skeleton_id not in encoded:
+        raise Http404(f'Skeleton {skeleton_id} not found')
+    return HttpResponse(encoded[skeleton_id], content_type='application/octet-stream')
 
-    struct.pack_into('3I', buff, 0, num_vertices, 0, num_vertices - 1)
-    offset = 16
-    for v in vertices:
-        struct.pack_into('3f', buff, offset, *v)
-        offset += 12
-    for e in edges:
-        struct.pack_into('2I', buff, offset, *e)
-        offset += 8
 
-    return JsonResponse(buff, safe=False)
+@api_view(['GET'])
+@requires_user_role(UserRole.Browse)
+def neuroglancer_skeleton_info(request:HttpRequest, project_id=None) -> JsonResponse:
+    """The info file of a neuroglancer precomputed skeleton source that serves
+    individual skeletons.
+    """
+    return JsonResponse(neuroglancer.get_skeleton_info())
 
 @api_view(['GET'])
 @requires_user_role(UserRole.Browse)
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""Bulk import of many skeletons from SWC and eSWC files. Instead of creating
+each skeleton through individual model operations, IDs are allocated in blocks
+and neurons, skeletons, their links, treenodes, annotations and skeleton
+origins are written with one COPY statement per table and batch of skeletons.
+The statement level triggers on the treenode table update the edge and
+skeleton summary tables once for each batch.
+"""
+
+from io import StringIO
+import os
+import re
+import tarfile
+from typing import (Any, Callable, Dict, IO, Iterable, Iterator, List,
+        Optional, Sequence, Tuple)
+import zipfile
+
+import dateutil.parser
+import numpy as np
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.utils import timezone
+
+from catmaid.control.common import (batches, get_class_to_id_map,
+        get_relation_to_id_map, insert_into_log)
+from catmaid.control.morphology import ArrayTree
+from catmaid.control.provenance import get_data_source
+from catmaid.history import add_log_entry
+from catmaid.models import ClassInstance
+
+
+SWC_EXTENSIONS = ('swc', 'eswc')
+
+DEFAULT_BATCH_SIZE = 500
+
+
+class SwcSkeleton():
+    """The nodes of a single skeleton from an SWC or eSWC file as arrays, in
+    file order. Only eSWC files have the user, time and confidence columns.
+    The source ID is the file name, if it is a number.
+    """
+
+    __slots__ = ('name', 'source_id', 'node_ids', 'parent_ids', 'locations',
+            'radii', 'user_ids', 'creation_times', 'editor_ids',
+            'edition_times', 'confidences')
+
+    def __init__(self, name, node_ids, parent_ids, locations, radii):
+        self.name = name
+        self.source_id = int(name) if name.isdigit() else None
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.parent_ids = np.asarray(parent_ids, dtype=np.int64)
+        self.locations = np.asarray(locations, dtype=np.float64).reshape(-1, 3)
+        self.radii = np.asarray(radii, dtype=np.float64)
+        self.user_ids:Optional[List[int]] = None
+        self.creation_times:Optional[List] = None
+        self.editor_ids:Optional[List[int]] = None
+        self.edition_times:Optional[List] = None
+        self.confidences:Optional[List[int]] = None
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def parent_indices(self) -> np.ndarray:
+        """Return the index of each node's parent, -1 for the root. Raise a
+        ValueError if the nodes don't form a single tree.
+        """
+        if not len(self):
+            raise ValueError(f'SWC skeleton "{self.name}" contains no nodes.')
+        if len(np.unique(self.node_ids)) != len(self):
+            raise ValueError(f'SWC skeleton "{self.name}" is malformed: it '
+                    'contains duplicate node IDs.')
+        try:
+            tree = ArrayTree(self.node_ids, self.parent_ids)
+            tree.depth
+        except ValueError as e:
+            raise ValueError(f'SWC skeleton "{self.name}" is malformed: {e}')
+        return tree.parents
+
+
+def parse_swc(name, swc_string) -> SwcSkeleton:
+    """Read a skeleton in SWC format."""
+    node_ids, parent_ids, locations, radii = [], [], [], []
+    for line in swc_string.splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+        row = line.strip().split()
+        if len(row) != 7:
+            raise ValueError(f'SWC has a malformed line: {line}')
+        node_ids.append(int(row[0]))
+        parent_ids.append(int(row[6]))
+        locations.append((float(row[2]), float(row[3]), float(row[4])))
+        radii.append(float(row[5]))
+    return SwcSkeleton(name, node_ids, parent_ids, locations, radii)
+
+
+def parse_eswc(name, swc_string, user_map:Dict[str, int]) -> SwcSkeleton:
+    """Read a skeleton in eSWC format. Users are looked up by name in
+    <user_map>, unknown users are created as deactivated users and added to it.
+    """
+    parse_time = dateutil.parser.parse
+    node_ids, parent_ids, locations, radii = [], [], [], []
+    user_ids:List[int] = []
+    editor_ids:List[int] = []
+    creation_times:List = []
+    edition_times:List = []
+    confidences:List[int] = []
+    for line in swc_string.splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+        row = line.strip().split()
+        if len(row) != 12:
+            raise ValueError(f'eSWC has a malformed line ({len(row)} instead of 12 columns): {line}')
+
+        for username in (row[7], row[9]):
+            if username not in user_map:
+                # Create deactivated user with this username
+                user_map[username] = User.objects.create(username=username,
+                        is_active=False).id
+
+        node_ids.append(int(row[0]))
+        parent_ids.append(int(row[6]))
+        locations.append((float(row[2]), float(row[3]), float(row[4])))
+        radii.append(float(row[5]))
+        user_ids.append(user_map[row[7]])
+        creation_times.append(parse_time(row[8]))
+        editor_ids.append(user_map[row[9]])
+        edition_times.append(parse_time(row[10]))
+        confidences.append(int(row[11]))
+
+    skeleton = SwcSkeleton(name, node_ids, parent_ids, locations, radii)
+    skeleton.user_ids = user_ids
+    skeleton.creation_times = creation_times
+    skeleton.editor_ids = editor_ids
+    skeleton.edition_times = edition_times
+    skeleton.confidences = confidences
+    return skeleton
+
+
+def split_extension(filename) -> Tuple[str, str]:
+    """Return the base name of a file without its extension and the lower case
+    extension. Compressed tar archives have extensions like "tar.gz".
+    """
+    name = os.path.basename(filename)
+    lower_name = name.lower()
+    for tar_extension in ('.tar.gz', '.tar.bz2', '.tar.xz'):
+        if lower_name.endswith(tar_extension):
+            return name[:-len(tar_extension)], tar_extension[1:]
+    name, extension = os.path.splitext(name)
+    return name, extension[1:].lower()
+
+
+def is_archive(extension) -> bool:
+    return extension in ('zip', 'tar', 'tgz') or extension.startswith('tar.')
+
+
+def iter_swc_files(files:Iterable[Tuple[str, IO]],
+        max_file_size:Optional[int]=None) -> Iterator[Tuple[str, str, str]]:
+    """Yield (name, extension, text) for each SWC and eSWC file in <files>, a
+    sequence of (file name, binary file object) tuples. ZIP and tar archives
+    are searched for SWC and eSWC files, other files are ignored. Files larger
+    than <max_file_size> bytes lead to a ValueError.
+    """
+    def check_size(filename, size):
+        if max_file_size is not None and size > max_file_size:
+            raise ValueError(f'File "{filename}" is too large. Maximum file '
+                    f'size is {max_file_size} bytes.')
+
+    for filename, fileobj in files:
+        name, extension = split_extension(filename)
+        if extension in SWC_EXTENSIONS:
+            data = fileobj.read()
+            check_size(filename, len(data))
+            yield name, extension, data.decode('utf-8')
+        elif extension == 'zip':
+            with zipfile.ZipFile(fileobj) as archive:
+                for info in archive.infolist():
+                    name, extension = split_extension(info.filename)
+                    if info.is_dir() or extension not in SWC_EXTENSIONS:
+                        continue
+                    check_size(info.filename, info.file_size)
+                    yield name, extension, archive.read(info).decode('utf-8')
+        elif is_archive(extension):
+            with tarfile.open(fileobj=fileobj, mode='r:*') as archive:
+                for member in archive:
+                    name, extension = split_extension(member.name)
+                    if not member.isfile() or extension not in SWC_EXTENSIONS:
+                        continue
+                    check_size(member.name, member.size)
+                    yield name, extension, archive.extractfile(member).read().decode('utf-8') # type: ignore
+        else:
+            raise ValueError(f'File type "{extension}" not understood. Known '
+                    'file types: swc, eswc, zip, tar')
+
+
+def iter_swc_skeletons(files:Iterable[Tuple[str, str, str]]) -> Iterator[SwcSkeleton]:
+    """Parse the (name, extension, text) tuples of iter_swc_files()."""
+    user_map:Optional[Dict[str, int]] = None
+    for name, extension, text in files:
+        if 'eswc' == extension:
+            if user_map is None:
+                user_map = dict(User.objects.all().values_list('username', 'id'))
+            yield parse_eswc(name, text, user_map)
+        else:
+            yield parse_swc(name, text)
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t') \
+                .replace('\n', '\\n').replace('\r', '\\r')
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def copy_rows(cursor, table, columns:Sequence[str], rows:Iterable[Sequence]) -> None:
+    """Write rows into a table with COPY in PostgreSQL's text format."""
+    data = StringIO()
+    for row in rows:
+        data.write('\t'.join(map(_copy_value, row)))
+        data.write('\n')
+    data.seek(0)
+    cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', data)
+
+
+def allocate_ids(cursor, sequence, n) -> List[int]:
+    """Return a block of <n> new IDs from a sequence."""
+    cursor.execute("""
+        SELECT nextval(%(sequence)s::regclass) FROM generate_series(1, %(n)s)
+    """, {
+        'sequence': sequence,
+        'n': n,
+    })
+    return [row[0] for row in cursor.fetchall()]
+
+
+def bulk_import(user, project_id, skeletons:Iterable[SwcSkeleton],
+        annotations:Sequence[str]=('Import',), source_url=None,
+        source_project_id=None, source_type='skeleton',
+        batch_size:int=DEFAULT_BATCH_SIZE,
+        progress:Optional[Callable[[int], None]]=None) -> List[Dict[str, Any]]:
+    """Create a neuron and a skeleton for each of the passed in skeletons and
+    annotate all neurons with <annotations>. If a source URL and source project
+    ID are provided, skeletons with a numeric name are recorded as originating
+    from the source skeleton with this ID. Skeletons are written in batches of
+    <batch_size>, each in its own transaction or savepoint. After each batch,
+    <progress> is called with the number of imported skeletons. Returns the
+    name, neuron ID, skeleton ID and number of nodes for each skeleton.
+    """
+    project_id = int(project_id)
+    counting_pattern = re.compile(r"\{n\d*\}")
+    for annotation in annotations:
+        if counting_pattern.search(annotation):
+            raise ValueError("Counting patterns are not supported for bulk "
+                    f"imports: {annotation}")
+
+    cursor = connection.cursor()
+    relation_map = get_relation_to_id_map(project_id,
+            ('model_of', 'annotated_with'), cursor)
+    class_map = get_class_to_id_map(project_id,
+            ('neuron', 'skeleton', 'annotation'), cursor)
+
+    annotation_ids = []
+    for annotation in annotations:
+        ci, _ = ClassInstance.objects.get_or_create(project_id=project_id,
+                name=annotation, class_column_id=class_map['annotation'],
+                defaults={'user_id': user.id})
+        annotation_ids.append(ci.id)
+
+    data_source = None
+    if source_url and source_project_id:
+        data_source = get_data_source(project_id, source_url,
+                source_project_id, user.id)
+
+    imported:List[Dict[str, Any]] = []
+    for batch in batches(skeletons, batch_size):
+        with transaction.atomic():
+            # Label each batch as import, so that imported nodes are counted as
+            # such, also outside of requests.
+            add_log_entry(user.id, 'skeletons.import', project_id)
+            imported.extend(_import_batch(cursor, user, project_id, batch,
+                    relation_map, class_map, annotation_ids, data_source,
+                    source_type))
+        if progress:
+            progress(len(imported))
+
+    return imported
+
+
+def _import_batch(cursor, user, project_id, skeletons:List[SwcSkeleton],
+        relation_map, class_map, annotation_ids, data_source,
+        source_type) -> List[Dict[str, Any]]:
+    parents = [skeleton.parent_indices() for skeleton in skeletons]
+    n_skeletons = len(skeletons)
+    now = timezone.now()
+
+    concept_ids = allocate_ids(cursor, 'concept_id_seq', 2 * n_skeletons)
+    neuron_ids, skeleton_ids = concept_ids[:n_skeletons], concept_ids[n_skeletons:]
+    names = [(s.name or f'neuron {nid}', s.name or f'skeleton {sid}')
+            for s, nid, sid in zip(skeletons, neuron_ids, skeleton_ids)]
+
+    copy_rows(cursor, 'class_instance', ('id', 'user_id', 'project_id',
+            'class_id', 'name'), [(nid, user.id, project_id,
+                    class_map['neuron'], name[0])
+                for nid, name in zip(neuron_ids, names)] +
+            [(sid, user.id, project_id, class_map['skeleton'], name[1])
+                for sid, name in zip(skeleton_ids, names)])
+
+    cici_columns = ('user_id', 'project_id', 'relation_id', 'class_instance_a',
+            'class_instance_b')
+    copy_rows(cursor, 'class_instance_class_instance', cici_columns,
+            [(user.id, project_id, relation_map['model_of'], sid, nid)
+                for sid, nid in zip(skeleton_ids, neuron_ids)])
+
+    # Treenode IDs for all skeletons of the batch, parent IDs are the new IDs
+    # of the parent indices.
+    treenode_ids = np.array(allocate_ids(cursor, 'location_id_seq',
+            sum(map(len, skeletons))), dtype=np.int64)
+
+    def treenode_rows():
+        offset = 0
+        for skeleton, skeleton_parents, skeleton_id in zip(skeletons, parents, skeleton_ids):
+            n_nodes = len(skeleton)
+            ids = treenode_ids[offset:offset + n_nodes]
+            offset += n_nodes
+            parent_ids = np.where(skeleton_parents >= 0, ids[skeleton_parents], -1)
+            locations = skeleton.locations.tolist()
+            if skeleton.confidences is None:
+                user_ids = editor_ids = [user.id] * n_nodes
+                creation_times = edition_times = [now] * n_nodes
+                confidences = [5] * n_nodes
+            else:
+                user_ids, editor_ids = skeleton.user_ids, skeleton.editor_ids
+                creation_times = skeleton.creation_times
+                edition_times = skeleton.edition_times
+                confidences = skeleton.confidences
+            for row in zip(ids.tolist(), locations, skeleton.radii.tolist(),
+                    parent_ids.tolist(), user_ids, creation_times, editor_ids,
+                    edition_times, confidences):
+                yield (row[0], project_id, row[1][0], row[1][1], row[1][2],
+                        row[2], None if row[3] < 0 else row[3], skeleton_id,
+                        row[4], row[5], row[6], row[7], row[8])
+
+    copy_rows(cursor, 'treenode', ('id', 'project_id', 'location_x',
+            'location_y', 'location_z', 'radius', 'parent_id', 'skeleton_id',
+            'user_id', 'creation_time', 'editor_id', 'edition_time',
+            'confidence'), treenode_rows())
+
+    # New neurons can't have any annotations yet, all links are new.
+    if annotation_ids:
+        copy_rows(cursor, 'class_instance_class_instance', cici_columns,
+                [(user.id, project_id, relation_map['annotated_with'], nid, aid)
+                    for nid in neuron_ids for aid in annotation_ids])
+
+    if data_source:
+        copy_rows(cursor, 'skeleton_origin', ('skeleton_id', 'user_id',
+                'project_id', 'data_source_id', 'source_id', 'source_type'),
+                [(sid, user.id, project_id, data_source.id, s.source_id,
+                        source_type)
+                    for s, sid in zip(skeletons, skeleton_ids)
+                    if s.source_id is not None])
+
+    first_root = skeletons[0].locations[np.flatnonzero(parents[0] < 0)[0]]
+    insert_into_log(project_id, user.id, 'create_neuron', first_root.tolist(),
+            f'Create {n_skeletons} neurons and skeletons via bulk import, '
+            f'first neuron {neuron_ids[0]} and skeleton {skeleton_ids[0]}.')
+
+    return [{
+        'name': skeleton.name,
+        'neuron_id': nid,
+        'skeleton_id': sid,
+        'n_nodes': len(skeleton),
+    } for skeleton, nid, sid in zip(skeletons, neuron_ids, skeleton_ids)]
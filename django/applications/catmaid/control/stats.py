@@ -22,6 +22,10 @@ from rest_framework.views import APIView
 
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, get_request_bool
+from catmaid.control.node import (get_dirty_grid_cell_stats,
+        get_grid_cell_cache_stats, get_node_provider_stats,
+        get_overlay_tile_cache_stats)
+from catmaid.control.skeletonexport import get_skeleton_payload_cache_stats
 from catmaid.models import ClassInstance, Connector, Treenode, User, UserRole, \
         Review, Relation, TreenodeConnector
 
@@ -1298,6 +1302,11 @@ class ServerStats(APIView):
     def get_server_stats(self) -> Dict[str, Any]:
         return {
             'load_avg': os.getloadavg(),
+            'node_grid_cell_cache': get_grid_cell_cache_stats(),
+            'node_grid_cell_update_queue': get_dirty_grid_cell_stats(),
+            'node_overlay_tile_cache': get_overlay_tile_cache_stats(),
+            'node_providers': get_node_provider_stats(),
+            'skeleton_payload_cache': get_skeleton_payload_cache_stats(),
         }
 
     def get_database_stats(self) -> Dict[str, Any]:
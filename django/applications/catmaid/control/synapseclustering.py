@@ -6,11 +6,12 @@ import networkx as nx
 import numpy as np
 from numpy import array, float32
 from numpy.linalg import norm
-from typing import Any, DefaultDict, Dict, List, NamedTuple, Tuple
+from typing import Any, DefaultDict, Dict, List, Tuple
 
 logger = logging.getLogger(__name__)
 
 try:
+    from scipy.sparse import csr_matrix
     from scipy.sparse.csgraph import dijkstra
 except ImportError:
     logger.warning("CATMAID was unable to load the scipy module. "
@@ -28,6 +29,24 @@ def synapse_clustering(skeleton_id, h_list) -> Dict:
     return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
 
 
+SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
+
+# Synapses further away than this many bandwidths contribute less than exp(-64)
+# to the density of a node, which is below the precision of any density that
+# is compared during hill climbing. Distances are therefore only computed up to
+# this limit.
+DENSITY_CUTOFF = 8
+
+# Densities that differ by less than this fraction are considered equal. This
+# makes the hill climbing independent of the order in which the contributions
+# of synapses are summed up, e.g. for symmetrically placed synapses.
+DENSITY_TOLERANCE = 1e-12
+
+# The number of synapse nodes for which geodesic distances are computed at once,
+# which bounds the memory needed to (batch size x number of nodes) floats.
+DISTANCE_BATCH_SIZE = 256
+
+
 def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list) -> Dict:
     """ Gwud: networkx graph were the edges are weighted by length, and undirected.
         synNodes: list of node IDs where there is a synapse.
@@ -35,79 +54,108 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list) -> Dict:
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
     """
+    node_ids = list(Gwud.nodes())
+    id2index = {node: i for i, node in enumerate(node_ids)}
+    edges = list(Gwud.edges(data='weight', default=1))
+    starts = np.fromiter((id2index[e[0]] for e in edges), np.int64, len(edges))
+    ends = np.fromiter((id2index[e[1]] for e in edges), np.int64, len(edges))
+    lengths = np.fromiter((e[2] for e in edges), np.float64, len(edges))
+    synapse_indices = np.fromiter((id2index[node] for node in synNodes),
+            np.int64, len(synNodes))
+
+    maxima = density_maxima(len(node_ids), starts, ends, lengths,
+            synapse_indices, h_list)
+
+    return {h: synapse_groups(node_ids, synNodes, connector_ids, relations,
+            local_max) for h, local_max in maxima.items()}
+
+
+def synapse_groups(node_ids, synNodes, connector_ids, relations, local_max) -> Dict:
+    """Group synapses by the index of the local density maximum they reach,
+    <local_max> is synchronized with the other lists. Returns a dictionary of
+    group index vs SynapseGroup, groups are numbered in order of their first
+    synapse.
+    """
+    groups:Dict = {}
+    loc2group:Dict = {}
+    for node, connector_id, relation, target in zip(synNodes, connector_ids,
+            relations, local_max.tolist()):
+        gi = loc2group.get(target)
+        if gi is None:
+            gi = loc2group[target] = len(groups)
+            groups[gi] = SynapseGroup([], [], [], node_ids[target])
+        groups[gi].node_ids.append(node)
+        groups[gi].connector_ids.append(connector_id)
+        groups[gi].relations.append(relation)
+    return groups
+
+
+def density_maxima(n_nodes, edge_starts, edge_ends, edge_lengths,
+        synapse_indices, h_list) -> Dict[Any, np.ndarray]:
+    """Hill climb the synapse density of a tree from each synapse node. The
+    tree has <n_nodes> nodes, which are connected by undirected edges between
+    <edge_starts> and <edge_ends> with the passed in lengths. The density of a
+    node is the sum of exp(-d²/h²) over all distinct synapse nodes, with d being
+    the geodesic distance. From each synapse node, the hill climbing moves to
+    the first neighbor of highest density as long as it is higher than the current
+    node's, ignoring differences below DENSITY_TOLERANCE. Returns a dictionary
+    of bandwidth h vs an array with the index of the local maximum reached from
+    each element of <synapse_indices>.
+    """
+    synapse_indices = np.asarray(synapse_indices, dtype=np.int64)
+    starts = np.concatenate((edge_starts, edge_ends)).astype(np.int64)
+    ends = np.concatenate((edge_ends, edge_starts)).astype(np.int64)
+    lengths = np.concatenate((edge_lengths, edge_lengths)).astype(np.float64)
+    graph = csr_matrix((lengths, (starts, ends)), shape=(n_nodes, n_nodes))
+
+    densities = {h: np.zeros(n_nodes) for h in h_list}
+    if not densities:
+        return {}
+    limit = DENSITY_CUTOFF * max(h_list)
+    sources = np.unique(synapse_indices)
+    for offset in range(0, len(sources), DISTANCE_BATCH_SIZE):
+        D = dijkstra(graph, directed=False, limit=limit,
+                indices=sources[offset:offset + DISTANCE_BATCH_SIZE])
+        D = np.multiply(D, D)
+        for h, density in densities.items():
+            density += np.exp(-1 * D / (h * h)).sum(axis=0)
+
+    # Group the neighbors of each node, keeping the order of edges
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], ends[order]
+
+    return {h: _climb(density, starts, ends)[synapse_indices]
+            for h, density in densities.items()}
+
+
+def _climb(density, starts, ends) -> np.ndarray:
+    """Return the index of the local density maximum reached from each node,
+    given the edges of the tree in both directions, sorted by start node.
+    """
+    step = np.arange(len(density))
+    if not len(starts):
+        return step
+
+    # Find for each node the first of its neighbors with the highest density.
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = starts[1:] != starts[:-1]
+    neighbor_density = density[ends]
+    highest = np.maximum.reduceat(neighbor_density, np.flatnonzero(first))
+    candidates = np.flatnonzero(neighbor_density >=
+            highest[np.cumsum(first) - 1] * (1 - DENSITY_TOLERANCE))
+    best_from, best = np.unique(starts[candidates], return_index=True)
+    best_to = ends[candidates[best]]
+    higher = density[best_to] > density[best_from] * (1 + DENSITY_TOLERANCE)
+    step[best_from[higher]] = best_to[higher]
+
+    # Density increases strictly along each step, there are no cycles. Each
+    # iteration doubles the distance covered.
+    while True:
+        next_step = step[step]
+        if np.array_equal(next_step, step):
+            return step
+        step = next_step
 
-    D, id2index = distanceMatrix(Gwud, synNodes)
-
-    SynapseGroup:NamedTuple = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
-    synapseGroups:Dict = {}
-
-    for h in h_list:
-        expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
-
-        targLoc:Dict = {}           # targLocs hosts the final destination nodes of the hill climbing
-        densityField:Dict = {}      # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:
-                currNode = startNode
-                allOnPath = []
-
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-
-                while True:
-                    allOnPath.append(currNode)
-
-                    # Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-
-                    for nn in Gwud.neighbors( currNode ):
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-
-                    if currNode == prevNode:
-                        break
-
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
-
-        loc2group = {}
-
-        synapseGroups[h] = {}
-        for ind, val in enumerate(uniqueTargs):
-            loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
-
-        for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
-            synapseGroups[h][ gi ].node_ids.append( node )
-            synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
-            synapseGroups[h][ gi ].relations.append( relations[ind] )
-
-    return synapseGroups
-
-def distanceMatrix(G, synNodes) -> Tuple[Any, Dict]:
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat:Dict = {}
-    nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
-
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
-
-    return dmat, {node: i for i,node in enumerate(nodeList)}
 
 def countTargets(skeleton_id, pid) -> Dict:
     nTargets = {}
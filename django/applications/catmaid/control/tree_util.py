@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
 
 # A 'tree' is a networkx.DiGraph with a single root node (a node without parents)
+# and edges from parent to child, or an ArrayTree. The latter is much more
+# compact and faster to build and query, all tree functions below accept both.
 
 from collections import defaultdict
-from itertools import islice
-from math import sqrt
+from django.db import connection
 from networkx import Graph, DiGraph
-from operator import itemgetter
-from typing import Any, DefaultDict, Dict, List, Optional, Set, Tuple
+from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Set, Tuple
 
+import numpy as np
+
+from catmaid.control.morphology import ArrayTree, segment_lengths
 from catmaid.models import Treenode
 
 
@@ -16,12 +19,16 @@ def find_root(tree):
     """ Search and return the first node that has zero predecessors.
     Will be the root node in directed graphs.
     Avoids one database lookup. """
+    if isinstance(tree, ArrayTree):
+        return tree.root_id
     for node in tree:
         if not next(tree.predecessors_iter(node), None):
             return node
 
 def edge_count_to_root(tree, root_node=None) -> Dict:
     """ Return a map of nodeID vs number of edges from the first node that lacks predecessors (aka the root). If root_id is None, it will be searched for."""
+    if isinstance(tree, ArrayTree):
+        return tree.edge_count_to_root(root_node)
     distances = {}
     count = 1
     current_level = [root_node if root_node else find_root(tree)]
@@ -42,28 +49,36 @@ def find_common_ancestor(tree, nodes, ds=None, root_node=None) -> Tuple[Any, Any
     Assumes that nodes contains at least 1 node.
     Assumes that all nodes are present in tree.
     Returns a tuple with the ancestor node and its distance to root. """
+    if isinstance(tree, ArrayTree):
+        return tree.common_ancestor(nodes)
     if 1 == len(nodes):
         return nodes[0], 0
     distances = ds if ds else edge_count_to_root(tree, root_node=root_node)
-    # Pick the pair with the shortest edge count to root
-    first, second = sorted({node: distances(node) for node in nodes}.items(), key=itemgetter(1))[:2]
-    # Start from the second, and bring it to an edge count equal to the first
-    while second[1] < first[1]:
-        second = (next(tree.predecessors_iter(second[0])), second[1] - 1)
-    # Walk parents up for both until finding the common ancestor
-    first = first[0]
-    second = second[0]
-    while first != second:
-        first = next(tree.predecessors_iter(first))
-        second = next(tree.predecessors_iter(second))
-    return first, distances[first]
+    ancestor = nodes[0]
+    for node in nodes[1:]:
+        first, second = ancestor, node
+        # Bring both to the same edge count to root
+        while distances[first] > distances[second]:
+            first = next(tree.predecessors_iter(first))
+        while distances[second] > distances[first]:
+            second = next(tree.predecessors_iter(second))
+        # Walk parents up for both until finding the common ancestor
+        while first != second:
+            first = next(tree.predecessors_iter(first))
+            second = next(tree.predecessors_iter(second))
+        ancestor = first
+    return ancestor, distances[ancestor]
 
 def find_common_ancestors(tree, node_groups):
+    if isinstance(tree, ArrayTree):
+        return tree.common_ancestors(node_groups)
     distances = edge_count_to_root(tree)
     return (find_common_ancestor(tree, nodes, ds=distances) for nodes in node_groups)
 
 def reroot(tree, new_root):
     """ Reverse in place the direction of the edges from the new_root to root. """
+    if isinstance(tree, ArrayTree):
+        return tree.reroot(new_root)
     parent = next(tree.predecessors_iter(new_root), None)
     if not parent:
         # new_root is already the root
@@ -80,6 +95,8 @@ def simplify(tree, keepers) -> Graph:
     where only the nodes to keep and the branch points between them are preserved.
     WARNING: will reroot the tree at the first of the keepers.
     WARNING: keepers can't be empty. """
+    if isinstance(tree, ArrayTree):
+        return tree.simplify(keepers)
     # Ensure no repeats
     keepers = set(keepers)
     # Add all keeper nodes to the minified graph
@@ -130,6 +147,9 @@ def partition(tree, root_node=None):
     with branch nodes repeated as ends of all sequences except the longest
     one that finishes at the root.
     Each sequence runs from an end node to either the root or a branch node. """
+    if isinstance(tree, ArrayTree):
+        yield from tree.partition()
+        return
     distances = edge_count_to_root(tree, root_node=root_node) # distance in number of edges from root
     seen:Set = set()
     # Iterate end nodes sorted from highest to lowest distance to root
@@ -151,50 +171,19 @@ def partition(tree, root_node=None):
 def spanning_tree(tree, preserve) -> DiGraph:
     """ Return a new DiGraph with the spanning tree including the desired nodes.
     preserve: the set of nodes that delimit the spanning tree. """
-    spanning = DiGraph()
-    preserve = set(preserve) # duplicate, will be altered
-    if 1 == len(preserve):
-        spanning.add_node(next(iter(preserve)))
-        return spanning
-
-    if len(tree.successors(find_root(tree))) > 1:
-        tree = tree.copy()
-        # First end node found
-        endNode = next(node for node in tree if not next(tree.successors_iter(node), None))
-        reroot(tree, endNode)
-
-    n_seen = 0
-
-    # Start from shortest sequence
-    for seq in sorted(partition(tree), key=len):
-        path = []
-        for node in seq:
-            if node in preserve:
-                path.append(node)
-                if node not in spanning:
-                    n_seen += 1
-                if len(preserve) == n_seen:
-                    break
-            elif path:
-                path.append(node)
-
-        if path:
-            spanning.add_path(path)
-            if seq[-1] == path[-1]:
-                preserve.add(path[-1])
-
-        if len(preserve) == n_seen:
-            break
-
-    return spanning
+    if not isinstance(tree, ArrayTree):
+        tree = ArrayTree.from_digraph(tree)
+    return tree.spanning_tree(preserve)
 
 def cable_length(tree, locations) -> float:
     """ locations: a dictionary of nodeID vs iterable of node position (1d, 2d, 3d, ...)
     Returns the total cable length. """
-    return sum(sqrt(sum(pow(loc2 - loc1, 2) for loc1, loc2 in zip(locations[a], locations[b]))) for a,b in tree.edges_iter())
+    edges = tree.edges()
+    return float(segment_lengths([locations[a] for a, _ in edges],
+            [locations[b] for _, b in edges]).sum())
 
 
-def lazy_load_trees(skeleton_ids, node_properties):
+def lazy_load_trees(skeleton_ids, node_properties) -> Iterator[Tuple[int, DiGraph]]:
     """ Return a lazy collection of pairs of (long, DiGraph)
     representing (skeleton_id, tree).
     The node_properties is a list of strings, each being a name of a column
@@ -203,27 +192,52 @@ def lazy_load_trees(skeleton_ids, node_properties):
 
     values_list:Tuple[str, ...] = ('id', 'parent_id', 'skeleton_id')
     props = tuple(set(node_properties) - set(values_list))
-    values_list += props
+    # Only known model fields can be selected
+    columns = [Treenode._meta.get_field(p).column for p in props]
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT skeleton_id, id, parent_id {}
+        FROM treenode
+        WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ORDER BY skeleton_id
+    """.format(''.join(', ' + c for c in columns)), {
+        'skeleton_ids': list(skeleton_ids),
+    })
 
-    ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
-            .order_by('skeleton') \
-            .values_list(*values_list)
     skid = None
     tree:Optional[DiGraph] = None
-    for t in ts:
-        if t[2] != skid:
+    for row in cursor:
+        if row[0] != skid:
             if tree:
                 yield (skid, tree)
             # Prepare for the next one
-            skid = t[2]
+            skid = row[0]
             tree = DiGraph()
 
-        fields = {k: v for k,v in zip(props, islice(t, 3, 3 + len(props)))}
-        tree.add_node(t[0], fields) # type: ignore # mypy cannot prove tree will have a value by this point
+        tree.add_node(row[1], dict(zip(props, row[3:]))) # type: ignore # mypy cannot prove tree will have a value by this point
 
-        if t[1]:
+        if row[2]:
             # From child to parent
-            tree.add_edge(t[0], t[1]) # type: ignore # mypy cannot prove tree will have a value by this point
+            tree.add_edge(row[1], row[2]) # type: ignore # mypy cannot prove tree will have a value by this point
 
     if tree:
         yield (skid, tree)
+
+
+def lazy_load_array_trees(skeleton_ids) -> Iterator[Tuple[int, ArrayTree]]:
+    """ Return a lazy collection of pairs of (skeleton_id, ArrayTree). Nodes
+    are loaded with a single query, without creating any model instances. """
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT skeleton_id, id, COALESCE(parent_id, -1)
+        FROM treenode
+        WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ORDER BY skeleton_id
+    """, {
+        'skeleton_ids': list(skeleton_ids),
+    })
+    rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+    starts = np.flatnonzero(np.diff(rows[:, 0], prepend=-1))
+    for start, end in zip(starts, np.append(starts[1:], len(rows))):
+        yield int(rows[start, 0]), ArrayTree(rows[start:end, 1], rows[start:end, 2])
@@ -3,7 +3,6 @@
 from collections import defaultdict
 import itertools
 import math
-import networkx as nx
 import re
 from typing import Any, DefaultDict, Dict, List, Union
 
@@ -24,6 +23,7 @@ from catmaid.control.common import (get_relation_to_id_map,
 from catmaid.control.neuron import _delete_if_empty
 from catmaid.control.node import _fetch_location, _fetch_locations
 from catmaid.control.link import create_connector_link
+from catmaid.control.morphology import ArrayTree
 from catmaid.util import Point3D, is_collinear
 
 
@@ -1149,23 +1149,14 @@ def update_confidence(request:HttpRequest, project_id=None, treenode_id=None) ->
     else:
         raise ValueError('Failed to update confidence at treenode %s.' % tnid)
 
-def _skeleton_as_graph(skeleton_id) -> nx.DiGraph:
+def _skeleton_as_tree(skeleton_id) -> ArrayTree:
     # Fetch all nodes of the skeleton
     cursor = connection.cursor()
     cursor.execute('''
         SELECT id, parent_id
         FROM treenode
         WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
+    return ArrayTree.from_rows(cursor.fetchall())
 
 
 def _find_first_interesting_node(sequence):
@@ -1212,16 +1203,16 @@ def find_previous_branchnode_or_root(request:HttpRequest, project_id=None, treen
         tnid = int(treenode_id)
         alt = 1 == int(request.POST['alt'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        tree = _skeleton_as_tree(skid)
         # Travel upstream until finding a parent node with more than one child
         # or reaching the root node
         seq = [] # Does not include the starting node tnid
         while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
+            parent = tree.parent(tnid)
+            if parent is not None:
+                tnid = parent
                 seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
+                if 1 != len(tree.children(tnid)):
                     break # Found a branch node
             else:
                 break # Found the root node
@@ -1239,9 +1230,9 @@ def find_next_branchnode_or_end(request:HttpRequest, project_id=None, treenode_i
     try:
         tnid = int(treenode_id)
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        tree = _skeleton_as_tree(skid)
 
-        children = graph.successors(tnid)
+        children = tree.children(tnid)
         branches = []
         for child_node_id in children:
             # Travel downstream until finding a child node with more than one
@@ -1249,7 +1240,7 @@ def find_next_branchnode_or_end(request:HttpRequest, project_id=None, treenode_i
             seq = [child_node_id] # Does not include the starting node tnid
             branch_end = child_node_id
             while True:
-                branch_children = graph.successors(branch_end)
+                branch_children = tree.children(branch_end)
                 if 1 == len(branch_children):
                     branch_end = branch_children[0]
                     seq.append(branch_end)
@@ -1262,8 +1253,10 @@ def find_next_branchnode_or_end(request:HttpRequest, project_id=None, treenode_i
 
         # If more than one branch exists, sort based on downstream arbor size.
         if len(children) > 1:
+            # Count downstream nodes that have children
+            n_children = tree.n_children
             branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
+                   key=lambda b: int((n_children[tree.downstream(b[0])] > 0).sum()),
                    reverse=True)
 
         # Leaf nodes will have no branches
@@ -0,0 +1,84 @@
+import numpy as np
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.control.edge import (get_intersected_grid_cells,
+        get_intersected_grid_cells_batch)
+
+
+class Command(BaseCommand):
+    help = "Compare the performance of the per-segment and the batched " \
+            "computation of grid cells intersected by random segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--segments', dest='n_segments', type=int,
+                default=100000, help='The number of random segments')
+        parser.add_argument('--max-length-xy', dest='max_length_xy',
+                type=float, default=300, help='The maximum X and Y extent of a segment')
+        parser.add_argument('--max-length-z', dest='max_length_z',
+                type=float, default=80, help='The maximum Z extent of a segment')
+        parser.add_argument('--extent', dest='extent', type=float,
+                default=100000, help='The size of the cube segments start in')
+        parser.add_argument('--cell-width', dest='cell_width', type=float,
+                default=settings.DEFAULT_CACHE_GRID_CELL_WIDTH)
+        parser.add_argument('--cell-height', dest='cell_height', type=float,
+                default=settings.DEFAULT_CACHE_GRID_CELL_HEIGHT)
+        parser.add_argument('--cell-depth', dest='cell_depth', type=float,
+                default=settings.DEFAULT_CACHE_GRID_CELL_DEPTH)
+        parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+                help='The number of runs per implementation, the fastest one is reported')
+        parser.add_argument('--seed', dest='seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        n_segments = options['n_segments']
+        if n_segments < 1:
+            raise CommandError('Need at least one segment')
+        cell_size = (options['cell_width'], options['cell_height'],
+                options['cell_depth'])
+
+        rng = np.random.RandomState(options['seed'])
+        max_length = np.array([options['max_length_xy'],
+                options['max_length_xy'], options['max_length_z']])
+        p1 = rng.uniform(0, options['extent'], (n_segments, 3))
+        p2 = p1 + rng.uniform(-max_length, max_length, (n_segments, 3))
+        # Like nodes, put segment end points on sections
+        p1[:, 2] = np.round(p1[:, 2] / cell_size[2]) * cell_size[2]
+        p2[:, 2] = np.round(p2[:, 2] / cell_size[2]) * cell_size[2]
+        p1_list, p2_list = p1.tolist(), p2.tolist()
+
+        def run_single():
+            cells = set()
+            for a, b in zip(p1_list, p2_list):
+                cells.update(map(tuple, get_intersected_grid_cells(a, b,
+                        *cell_size)))
+            return cells
+
+        def run_batch():
+            return get_intersected_grid_cells_batch(p1, p2, *cell_size)
+
+        def measure(fn):
+            durations = []
+            for _ in range(max(1, options['repeat'])):
+                start = time.perf_counter()
+                result = fn()
+                durations.append(time.perf_counter() - start)
+            return min(durations), result
+
+        single_time, single_cells = measure(run_single)
+        batch_time, batch_cells = measure(run_batch)
+        batch_cells = set(map(tuple, batch_cells.tolist()))
+
+        self.stdout.write(f'Segments: {n_segments}, cell size: {cell_size}')
+        self.stdout.write(f'Per-segment: {single_time:.4f}s ' +
+                f'({n_segments / single_time:.0f} segments/s), {len(single_cells)} cells')
+        self.stdout.write(f'Batched: {batch_time:.4f}s ' +
+                f'({n_segments / batch_time:.0f} segments/s), {len(batch_cells)} cells')
+        self.stdout.write(f'Speedup: {single_time / batch_time:.2f}x')
+
+        n_differences = len(single_cells ^ batch_cells)
+        if n_differences:
+            self.stdout.write(self.style.WARNING(f'Results differ in {n_differences} cells'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Results are identical'))
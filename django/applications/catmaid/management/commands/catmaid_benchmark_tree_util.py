@@ -0,0 +1,152 @@
+import numpy as np
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from networkx import DiGraph
+
+from catmaid.control import tree_util
+from catmaid.control.morphology import ArrayTree
+
+
+class Command(BaseCommand):
+    help = "Compare the performance of tree_util operations on networkx " \
+            "DiGraphs and ArrayTrees, either for a random tree or skeletons " \
+            "from the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skeleton', dest='skeleton_ids', type=int,
+                action='append', default=[], help='A skeleton to use instead ' +
+                'of a random tree, can be passed multiple times')
+        parser.add_argument('--nodes', dest='n_nodes', type=int,
+                default=100000, help='The number of nodes of the random tree')
+        parser.add_argument('--branch-probability', dest='branch_probability',
+                type=float, default=0.02, help='The probability of a random ' +
+                'node to not continue the previous node')
+        parser.add_argument('--keepers', dest='n_keepers', type=int,
+                default=100, help='The number of nodes to simplify and span')
+        parser.add_argument('--repeat', dest='repeat', type=int, default=3,
+                help='The number of runs per implementation, the fastest one is reported')
+        parser.add_argument('--seed', dest='seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = np.random.RandomState(options['seed'])
+        if options['skeleton_ids']:
+            trees = [(skeleton_id, self.load_rows(skeleton_id))
+                    for skeleton_id in options['skeleton_ids']]
+        else:
+            n_nodes = options['n_nodes']
+            if n_nodes < 2:
+                raise CommandError('Need at least two nodes')
+            trees = [('random', self.random_rows(n_nodes,
+                    options['branch_probability'], rng))]
+
+        for name, rows in trees:
+            self.stdout.write(f'Tree {name}: {len(rows)} nodes')
+            self.compare(rows, options, rng)
+
+    def load_rows(self, skeleton_id):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT id, parent_id
+            FROM treenode
+            WHERE skeleton_id = %(skeleton_id)s
+        """, {
+            'skeleton_id': skeleton_id,
+        })
+        rows = cursor.fetchall()
+        if len(rows) < 2:
+            raise CommandError(f'Skeleton {skeleton_id} needs at least two nodes')
+        return rows
+
+    def random_rows(self, n_nodes, branch_probability, rng):
+        # Most nodes continue the previous node, some start a new branch
+        parents = np.arange(-1, n_nodes - 1)
+        branching = np.flatnonzero(rng.uniform(size=n_nodes) < branch_probability)
+        branching = branching[branching > 1]
+        parents[branching] = (rng.uniform(size=len(branching)) * branching).astype(np.int64)
+        node_ids = rng.permutation(n_nodes) + 1
+        return [(node_id, None if parent < 0 else node_ids[parent])
+                for node_id, parent in zip(node_ids.tolist(), parents.tolist())]
+
+    def compare(self, rows, options, rng):
+        def build_digraph():
+            tree = DiGraph()
+            for node_id, parent_id in rows:
+                tree.add_node(node_id)
+                if parent_id:
+                    tree.add_edge(parent_id, node_id)
+            return tree
+
+        def build_array_tree():
+            return ArrayTree.from_rows(rows)
+
+        def measure(fn, setup=None):
+            durations = []
+            for _ in range(max(1, options['repeat'])):
+                arg = setup() if setup else None
+                start = time.perf_counter()
+                result = fn(arg) if setup else fn()
+                durations.append(time.perf_counter() - start)
+            return min(durations), result
+
+        def memory(fn):
+            tracemalloc.start()
+            result = fn()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del result
+            return size
+
+        node_ids = [row[0] for row in rows]
+        n_keepers = min(len(node_ids), max(2, options['n_keepers']))
+        keepers = rng.choice(node_ids, n_keepers, replace=False).tolist()
+        new_root = keepers[0]
+        graph = build_digraph()
+        array_tree = build_array_tree()
+
+        operations = [
+            ('build', build_digraph, build_array_tree, None, None),
+            ('edge_count_to_root', lambda t: tree_util.edge_count_to_root(t),
+                    lambda t: tree_util.edge_count_to_root(t),
+                    lambda: graph, lambda: array_tree),
+            ('reroot', lambda t: tree_util.reroot(t, new_root),
+                    lambda t: tree_util.reroot(t, new_root),
+                    graph.copy, build_array_tree),
+            ('partition', lambda t: list(tree_util.partition(t)),
+                    lambda t: list(tree_util.partition(t)),
+                    lambda: graph, lambda: array_tree),
+            ('common_ancestor', lambda t: tree_util.find_common_ancestor(t, keepers),
+                    lambda t: tree_util.find_common_ancestor(t, keepers),
+                    lambda: graph, lambda: array_tree),
+            ('simplify', lambda t: tree_util.simplify(t, keepers),
+                    lambda t: tree_util.simplify(t, keepers),
+                    graph.copy, build_array_tree),
+        ]
+
+        for name, graph_fn, array_fn, graph_setup, array_setup in operations:
+            graph_time, graph_result = measure(graph_fn, graph_setup)
+            array_time, array_result = measure(array_fn, array_setup)
+            self.stdout.write(f'{name}: networkx {graph_time:.4f}s, ' +
+                    f'arrays {array_time:.4f}s, speedup {graph_time / array_time:.2f}x')
+            if name == 'edge_count_to_root' or name == 'common_ancestor':
+                if graph_result != array_result:
+                    self.stdout.write(self.style.WARNING(f'{name}: results differ'))
+            elif name == 'simplify':
+                if set(graph_result.nodes()) != set(array_result.nodes()):
+                    self.stdout.write(self.style.WARNING(f'{name}: results differ'))
+
+        # The networkx version of spanning_tree() converts to an ArrayTree, so
+        # only conversion and computation are reported.
+        span_time, _ = measure(lambda t: tree_util.spanning_tree(t, keepers),
+                lambda: array_tree)
+        convert_time, _ = measure(lambda t: ArrayTree.from_digraph(t),
+                lambda: graph)
+        self.stdout.write(f'spanning_tree: {span_time:.4f}s, ' +
+                f'DiGraph conversion {convert_time:.4f}s')
+
+        graph_memory = memory(build_digraph)
+        array_memory = memory(build_array_tree)
+        self.stdout.write(f'Memory: networkx {graph_memory / 2**20:.1f} MiB, ' +
+                f'arrays {array_memory / 2**20:.1f} MiB')
@@ -1,20 +1,19 @@
 from collections import defaultdict
-import json
 import logging
 import select
 import signal
 import time
-from typing import Dict, List, Set
+from typing import DefaultDict, Dict, List, Optional, Set
 
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import connection
+from django.db import connection, transaction
 
-from catmaid.control.edge import get_intersected_grid_cells
-from catmaid.control.node import (get_configured_node_providers,
-        GridCachedNodeProvider, Postgis3dNodeProvider, update_grid_cell)
-from catmaid.models import NodeGridCache, DirtyNodeGridCacheCell
+from catmaid.control.node import (get_dirty_grid_cell_stats,
+        invalidate_overlay_tiles, overlay_tile_cache, Postgis3dNodeProvider,
+        update_grid_cells)
+from catmaid.models import NodeGridCache
 from catmaid.util import str2bool
 from .common import set_log_level
 
@@ -23,56 +22,158 @@ logger = logging.getLogger(__name__)
 
 
 class GridWorker():
+    """Recompute dirty grid cache cells. Dirty cells are read from the table
+    dirty_node_grid_cache_cell in batches. Dirty cells of the same grid and
+    depth that are close to each other are recomputed together with a single
+    spatial query. Each such block is claimed and recomputed in its own
+    transaction, using row level locks that are skipped by other workers. This
+    allows to run multiple workers in parallel and keeps rows locked only
+    briefly, which would otherwise block new invalidations of the same cells.
+    """
+
+    def __init__(self, batch_size=1000, block_size=4):
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.cells_updated = 0
+        self.cells_removed = 0
+        self.cells_failed = 0
+
+    def select_dirty_cells(self, cursor, exclude_ids:Set[int]) -> List:
+        """Return the oldest dirty cells, except the ones with the passed in
+        IDs. The cells aren't locked.
+        """
+        cursor.execute("""
+            SELECT id, grid_id, x_index, y_index, z_index
+            FROM dirty_node_grid_cache_cell
+            WHERE id <> ALL(%(exclude_ids)s::bigint[])
+            ORDER BY invalidation_time
+            LIMIT %(limit)s
+        """, {
+            'exclude_ids': list(exclude_ids),
+            'limit': self.batch_size,
+        })
+        return cursor.fetchall()
+
+    def claim_dirty_cells(self, cursor, cell_ids:List[int]) -> Set[int]:
+        """Lock the passed in dirty cells for the current transaction and
+        return the IDs of the ones that still exist and aren't currently
+        processed by another worker.
+        """
+        cursor.execute("""
+            SELECT id
+            FROM dirty_node_grid_cache_cell
+            WHERE id = ANY(%(cell_ids)s::bigint[])
+            FOR UPDATE SKIP LOCKED
+        """, {
+            'cell_ids': cell_ids,
+        })
+        return set(r[0] for r in cursor.fetchall())
+
+    def get_blocks(self, dirty_cells) -> Dict:
+        """Group dirty cells by grid, depth and a block of block_size x
+        block_size cells.
+        """
+        blocks:DefaultDict = defaultdict(list)
+        for cell_id, grid_id, x, y, z in dirty_cells:
+            key = (grid_id, z, x // self.block_size, y // self.block_size)
+            blocks[key].append((cell_id, (x, y, z)))
+        return blocks
+
+    def get_params(self, g) -> Dict:
+        params = {
+            'project_id': g.project_id,
+            'limit': settings.NODE_LIST_MAXIMUM_COUNT,
+            'ordering': g.ordering,
+        }
+        if g.n_largest_skeletons_limit:
+            params['n_largest_skeletons_limit'] = int(g.n_largest_skeletons_limit)
+        if g.n_last_edited_skeletons_limit:
+            params['n_last_edited_skeletons_limit'] = int(g.n_last_edited_skeletons_limit)
+        if g.hidden_last_editor_id:
+            params['hidden_last_editor_id'] = int(g.hidden_last_editor_id)
+        return params
+
+    def update(self, cursor, failed_ids:Set[int]) -> int:
+        """Read a batch of dirty cells, update the respective cache cells and
+        remove them from the dirty cell table. Dirty cells with an ID in
+        <failed_ids> are ignored and the IDs of cells that can't be updated
+        are added to it. Failed cells stay dirty. Returns the number of dirty
+        cells that were processed, which is zero if no progress can be made.
+        """
+        provider = Postgis3dNodeProvider()
 
-    def __init__(self):
-        pass
+        dirty_cells = self.select_dirty_cells(cursor, failed_ids)
+        if not dirty_cells:
+            return 0
 
-    def update(self, updates, cursor):
-        """Pop the oldest item from the diry cell table, compute the respective
-        FOV and update the cache cell.
-        """
         # Get all referenced grids along with their project IDs and node
         # constraints: n_last_edited_skeletons_limit,
         # n_last_edited_skeletons_limit, hidden_last_editor_id
-        referenced_grid_ids = set(u['grid_id'] for u in updates)
+        referenced_grid_ids = set(c[1] for c in dirty_cells)
         grids = NodeGridCache.objects.filter(pk__in=referenced_grid_ids)
         grid_map = dict((g.id, g) for g in grids)
 
-        provider = Postgis3dNodeProvider()
-        cursor = connection.cursor()
-
-        # Batch of grids to update during one run
-        updated_cells = 0
-        for update in updates:
-            g = grid_map[update['grid_id']]
-            w_i, h_i, d_i = update['x'], update['y'], update['z']
+        n_processed = 0
+        n_done = 0
+        for (grid_id, _, _, _), block in self.get_blocks(dirty_cells).items():
+            g = grid_map.get(grid_id)
+            if not g:
+                failed_ids.update(c[0] for c in block)
+                continue
+            with transaction.atomic():
+                claimed_ids = self.claim_dirty_cells(cursor,
+                        [c[0] for c in block])
+                if not claimed_ids:
+                    continue
+                block = [c for c in block if c[0] in claimed_ids]
+                n_processed += len(block)
+                cells = [c[1] for c in block]
+                try:
+                    with transaction.atomic():
+                        written, removed = update_grid_cells(g.project_id,
+                                g.id, cells, g.cell_width, g.cell_height,
+                                g.cell_depth, self.get_params(g), g.allow_empty,
+                                g.n_lod_levels, g.lod_min_bucket_size,
+                                g.lod_strategy, g.has_json_data,
+                                g.has_json_text_data, g.has_msgpack_data,
+                                provider=provider, cursor=cursor,
+                                update_columnar_cache=g.has_columnar_data)
+                except Exception as e:
+                    # Keep the cells dirty, they are retried with the next
+                    # run of the worker.
+                    logger.error(f'Could not update grid cells {cells} of grid {grid_id}: {e}')
+                    self.cells_failed += len(cells)
+                    failed_ids.update(claimed_ids)
+                    continue
 
-            params = {
-                'project_id': g.project_id,
-                'limit': settings.NODE_LIST_MAXIMUM_COUNT,
-                'ordering': g.ordering,
-            }
-            if g.n_last_edited_skeletons_limit:
-                params['n_largest_skeletons_limit'] = int(g.n_largest_skeletons_limit)
-            if g.n_last_edited_skeletons_limit:
-                params['n_last_edited_skeletons_limit'] = int(g.n_last_edited_skeletons_limit)
-            if g.hidden_last_editor_id:
-                params['hidden_last_editor_id'] = int(g.hidden_last_editor_id)
+                cursor.execute("""
+                    DELETE FROM dirty_node_grid_cache_cell
+                    WHERE id = ANY(%(ids)s::bigint[])
+                """, {
+                    'ids': list(claimed_ids),
+                })
+                self.cells_updated += written
+                self.cells_removed += removed
+                n_done += len(block)
 
-            added = update_grid_cell(g.project_id, g.id, w_i, h_i, d_i,
-                    g.cell_width, g.cell_height, g.cell_depth,
-                    params, g.allow_empty, g.n_lod_levels, g.lod_min_bucket_size,
-                    g.lod_strategy, g.has_json_data, g.has_json_text_data,
-                    g.has_msgpack_data, provider=provider, cursor=cursor)
+                # Rendered overlay tiles on disk are shared by all processes
+                # and are removed once the updated cells are visible.
+                if overlay_tile_cache.path:
+                    transaction.on_commit(lambda grid_id=grid_id, cells=cells:
+                            invalidate_overlay_tiles(grid_id, cells, delete_files=True))
 
-            if added:
-                updated_cells += 1
+        logger.debug(f'Updated {n_done} dirty grid cell(s) in {len(referenced_grid_ids)} grid cache(s)')
 
-                # TODO: delete in batches
-                DirtyNodeGridCacheCell.objects.filter(grid_id=g.id, x_index=w_i,
-                        y_index=h_i, z_index=d_i).delete()
+        return n_processed
 
-        logger.debug(f'Updated {updated_cells} grid cell(s) in {len(referenced_grid_ids)} grid cache(s)')
+    def get_stats(self, cursor) -> Dict:
+        stats = get_dirty_grid_cell_stats(cursor)
+        stats.update({
+            'cells_updated': self.cells_updated,
+            'cells_removed': self.cells_removed,
+            'cells_failed': self.cells_failed,
+        })
+        return stats
 
 
 class Command(BaseCommand):
@@ -90,18 +191,37 @@ class Command(BaseCommand):
         )
         parser.add_argument("--grid-cache", type=str2bool, nargs='?',
                 const=True, default=True, help="Update spatial grid caches.")
+        parser.add_argument('--debounce', type=float, default=0.5,
+                help="The number of seconds without new invalidations to " +
+                "wait before dirty cells are updated. This allows to update " +
+                "cells that are invalidated repeatedly only once.")
+        parser.add_argument('--max-delay', type=float, default=5,
+                help="The maximum number of seconds to defer updates while " +
+                "new invalidations arrive.")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                help="The maximum number of dirty cells read at once.")
+        parser.add_argument('--block-size', type=int, default=4,
+                help="Dirty cells within blocks of N x N cells of the same " +
+                "depth are updated using a single query.")
+        parser.add_argument('--stats-interval', type=float, default=60,
+                help="The number of seconds between logged queue depth and " +
+                "lag statistics.")
 
     def handle(self, **options):
         set_log_level(logger, options.get('verbosity', 1))
         self._shutdown = False
         self._in_task = False
         self.delay = options['delay']
+        self.debounce = options['debounce']
+        self.max_delay = options['max_delay']
+        self.stats_interval = options['stats_interval']
         self.grid_cache_update = options['grid_cache']
 
         self.workers:List = []
 
         if options['grid_cache']:
-            self.workers.append(GridWorker())
+            self.workers.append(GridWorker(options['batch_size'],
+                    options['block_size']))
 
         if not self.workers:
             logger.warn("No grids provided")
@@ -109,6 +229,14 @@ class Command(BaseCommand):
 
         self.listen()
 
+        # The time of the first and the last invalidation that hasn't been
+        # processed yet. Dirty cells that remained from a previous run are
+        # processed right away.
+        now = time.time()
+        self.pending_since:Optional[float] = now
+        self.last_invalidation = now - self.debounce
+        self.last_stats = now
+
         try:
             # Handle the signals for warm shutdown.
             signal.signal(signal.SIGINT, self.handle_shutdown)
@@ -146,32 +274,74 @@ class Command(BaseCommand):
         return notifies
 
 
-    def wait(self):
+    def wait(self, timeout):
         connection.connection.poll()
         notifies = self.filter_notifies()
         if notifies:
             return notifies
 
-        select.select([connection.connection], [], [], self.delay)
+        select.select([connection.connection], [], [], timeout)
         connection.connection.poll()
         notifies = self.filter_notifies()
-        count = len(self.filter_notifies())
-        logger.debug('Woke up with %s NOTIFYs.', count)
+        logger.debug('Woke up with %s NOTIFYs.', len(notifies))
         return notifies
 
     def wait_and_queue(self):
-        notifications = self.wait()
+        """Wait for invalidation events and process all dirty cells once no new
+        invalidations arrived for the debounce period or the oldest pending
+        invalidation reaches the maximum delay. The events themselves are only
+        used as a signal, the dirty cell table is the actual queue.
+        """
+        timeout = self.delay
+        if self.pending_since is not None:
+            timeout = max(0, min(timeout,
+                    self.last_invalidation + self.debounce - time.time(),
+                    self.pending_since + self.max_delay - time.time()))
+
+        notifications = self.wait(timeout)
+        now = time.time()
         if notifications:
-            cursor = connection.cursor()
-
-            updates = []
-            for n in notifications:
-                try:
-                    data = json.loads(n.payload)
-                    updates.append(data)
-                except json.decoder.JSONDecodeError:
-                    logger.warn(f'Could not parse Postgres NOTIFY message: {n.payload}')
-                    continue
-
+            self.last_invalidation = now
+            if self.pending_since is None:
+                self.pending_since = now
+
+        if self.pending_since is not None and \
+                (now - self.last_invalidation >= self.debounce or
+                now - self.pending_since >= self.max_delay):
+            self.pending_since = None
+            self.process()
+
+        if self.stats_interval and now - self.last_stats >= self.stats_interval:
+            self.last_stats = now
+            self.log_stats()
+
+    def process(self):
+        """Let all workers process dirty cells until no unclaimed ones are
+        left that can be updated.
+        """
+        cursor = connection.cursor()
+        self._in_task = True
+        try:
             for worker in self.workers:
-                worker.update(updates, cursor)
+                # Cells that fail are skipped for the rest of this run, which
+                # stops once a batch makes no progress.
+                failed_ids:Set[int] = set()
+                while worker.update(cursor, failed_ids):
+                    if self._shutdown:
+                        break
+        finally:
+            self._in_task = False
+        if self._shutdown:
+            raise InterruptedError
+
+    def log_stats(self):
+        cursor = connection.cursor()
+        for worker in self.workers:
+            stats = worker.get_stats(cursor)
+            logger.info(f"Dirty cell queue depth: {stats['queue_depth']}, " +
+                    f"lag: {stats['lag']:.1f}s, updated: {stats['cells_updated']}, " +
+                    f"removed: {stats['cells_removed']}, failed: {stats['cells_failed']}")
+            # Cells that are left over (e.g. from failed updates or missed
+            # events) are processed with the next run.
+            if stats['queue_depth'] and self.pending_since is None:
+                self.pending_since = self.last_invalidation = time.time()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+from itertools import chain
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.control import neuroglancer
+from catmaid.control.annotation import (get_annotated_entities,
+        get_annotation_to_id_map)
+from catmaid.control.common import get_class_to_id_map, get_relation_to_id_map
+from catmaid.models import ClassInstance, Project
+
+
+class Command(BaseCommand):
+    help = "Write skeletons of a project as neuroglancer precomputed " \
+            "skeleton source, which can be served by any static file server"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', dest='project_id', type=int,
+                required=True, help='The project to export skeletons from')
+        parser.add_argument('--output', dest='output', required=True,
+                help='The directory to write the skeleton source to')
+        parser.add_argument('--annotation', dest='annotations',
+                action='append', default=[], help='Only export skeletons of ' +
+                'neurons with this annotation or its sub-annotations. Can be ' +
+                'passed multiple times, all annotations are required.')
+        parser.add_argument('--skeleton', dest='skeleton_ids', type=int,
+                action='append', default=[], help='Export this skeleton, ' +
+                'can be passed multiple times')
+        parser.add_argument('--sharded', dest='sharded', action='store_true',
+                help='Write shard files instead of one file per skeleton')
+        parser.add_argument('--preshift-bits', dest='preshift_bits', type=int,
+                default=None, help='Sharding: number of low skeleton ID bits ' +
+                'to ignore')
+        parser.add_argument('--minishard-bits', dest='minishard_bits',
+                type=int, default=None, help='Sharding: number of bits ' +
+                'that select a minishard within a shard')
+        parser.add_argument('--shard-bits', dest='shard_bits', type=int,
+                default=None, help='Sharding: number of bits that select ' +
+                'a shard. By default, shards of about 10000 skeletons are used.')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=500, help='The number of skeletons to load at a time')
+
+    def handle(self, *args, **options):
+        project_id = options['project_id']
+        if not Project.objects.filter(id=project_id).exists():
+            raise CommandError(f'Project {project_id} does not exist')
+
+        skeleton_ids = set(options['skeleton_ids'])
+        if options['annotations']:
+            skeleton_ids.update(self.get_annotated_skeleton_ids(project_id,
+                    options['annotations']))
+        elif not skeleton_ids:
+            skeleton_ids.update(ClassInstance.objects.filter(
+                    project_id=project_id, class_column__class_name='skeleton') \
+                    .values_list('id', flat=True))
+
+        if not skeleton_ids:
+            raise CommandError('No skeletons found')
+
+        sharding = None
+        if options['sharded']:
+            sharding = neuroglancer.get_default_sharding(len(skeleton_ids))
+            for name in ('preshift_bits', 'minishard_bits', 'shard_bits'):
+                if options[name] is not None:
+                    sharding[name] = options[name]
+
+        n_skeletons = len(skeleton_ids)
+        self.stdout.write(f'Exporting {n_skeletons} skeletons to {options["output"]}')
+
+        def progress(n_written):
+            self.stdout.write(f'Exported {n_written}/{n_skeletons} skeletons')
+
+        n_written = neuroglancer.write_skeletons(project_id, skeleton_ids,
+                options['output'], sharding, options['batch_size'], progress)
+
+        self.stdout.write(self.style.SUCCESS(f'Exported {n_written} skeletons'))
+
+    def get_annotated_skeleton_ids(self, project_id, annotations):
+        relations = get_relation_to_id_map(project_id)
+        classes = get_class_to_id_map(project_id)
+        annotation_map = get_annotation_to_id_map(project_id, annotations,
+                relations, classes)
+        missing_annotations = set(annotations) - set(annotation_map.keys())
+        if missing_annotations:
+            raise CommandError('Could not find the following annotations: ' +
+                    ', '.join(missing_annotations))
+
+        # Separate parameters for each annotation require all of them
+        query_params = {}
+        for i, annotation_id in enumerate(annotation_map.values()):
+            query_params[f'annotated_with{i}'] = str(annotation_id)
+            query_params[f'sub_annotated_with{i}'] = str(annotation_id)
+        neuron_info, _ = get_annotated_entities(project_id, query_params,
+                relations, classes, ['neuron'], with_skeletons=True)
+        return chain.from_iterable(n['skeleton_ids'] for n in neuron_info)
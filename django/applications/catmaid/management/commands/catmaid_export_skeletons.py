@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.control import skeletonarchive
+from catmaid.control.annotation import get_annotation_to_id_map
+from catmaid.models import ClassInstance, Project
+
+
+class Command(BaseCommand):
+    help = "Write many skeletons of a project as ZIP or tar archive of SWC, " \
+            "eSWC or JSON files, one file per skeleton"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', dest='project_id', type=int,
+                required=True, help='The project to export skeletons from')
+        parser.add_argument('--output', dest='output', required=True,
+                help='The archive file to write, "-" for standard output')
+        parser.add_argument('--annotation', dest='annotations',
+                action='append', default=[], help='Only export skeletons of ' +
+                'neurons with this annotation or its sub-annotations. Can be ' +
+                'passed multiple times, all annotations are required.')
+        parser.add_argument('--skeleton', dest='skeleton_ids', type=int,
+                action='append', default=[], help='Export this skeleton, ' +
+                'can be passed multiple times')
+        parser.add_argument('--format', dest='file_format', default='swc',
+                choices=skeletonarchive.FILE_FORMATS,
+                help='The file format of individual skeletons')
+        parser.add_argument('--archive', dest='archive_format', default='zip',
+                choices=skeletonarchive.ARCHIVE_FORMATS,
+                help='The archive format')
+        parser.add_argument('--linearize-ids', dest='linearize_ids',
+                action='store_true', help='Renumber SWC nodes in ' +
+                'breadth-first order, starting with 1 for the root')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=skeletonarchive.DEFAULT_BATCH_SIZE,
+                help='The number of skeletons to load at a time')
+        parser.add_argument('--workers', dest='workers', type=int, default=1,
+                help='The number of processes that serialize skeletons')
+
+    def handle(self, *args, **options):
+        project_id = options['project_id']
+        if not Project.objects.filter(id=project_id).exists():
+            raise CommandError(f'Project {project_id} does not exist')
+
+        skeleton_ids = list(options['skeleton_ids'])
+        if options['annotations']:
+            skeleton_ids.extend(self.get_annotated_skeleton_ids(project_id,
+                    options['annotations']))
+        elif not skeleton_ids:
+            skeleton_ids.extend(ClassInstance.objects.filter(
+                    project_id=project_id, class_column__class_name='skeleton') \
+                    .order_by('id').values_list('id', flat=True))
+        skeleton_ids = list(dict.fromkeys(skeleton_ids))
+
+        if not skeleton_ids:
+            raise CommandError('No skeletons found')
+
+        chunks = skeletonarchive.iter_skeleton_archive(project_id,
+                skeleton_ids, options['file_format'],
+                options['archive_format'], options['linearize_ids'],
+                options['batch_size'], options['workers'])
+
+        if options['output'] == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            return
+
+        self.stdout.write(f'Exporting {len(skeleton_ids)} skeletons to {options["output"]}')
+        with open(options['output'], 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+        self.stdout.write(self.style.SUCCESS(
+                f'Exported {len(skeleton_ids)} skeletons'))
+
+    def get_annotated_skeleton_ids(self, project_id, annotations):
+        annotation_map = get_annotation_to_id_map(project_id, annotations)
+        missing_annotations = set(annotations) - set(annotation_map.keys())
+        if missing_annotations:
+            raise CommandError('Could not find the following annotations: ' +
+                    ', '.join(missing_annotations))
+
+        # Separate parameters for each annotation require all of them
+        query_params = {}
+        for i, annotation_id in enumerate(annotation_map.values()):
+            query_params[f'annotated_with{i}'] = str(annotation_id)
+            query_params[f'sub_annotated_with{i}'] = str(annotation_id)
+        return skeletonarchive.find_skeleton_ids(project_id, query_params)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.control import skeletonimport
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = "Import many skeletons from SWC and eSWC files, directories or " \
+            "ZIP and tar archives of them. Each file becomes a new neuron " \
+            "with a single skeleton, both named after the file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='SWC or eSWC files, ' +
+                'archives or directories, which are searched recursively')
+        parser.add_argument('--project', dest='project_id', type=int,
+                required=True, help='The project to import skeletons into')
+        parser.add_argument('--user', dest='user_id', type=int, required=True,
+                help='The ID of the user who will own the imported data')
+        parser.add_argument('--annotation', dest='annotations',
+                action='append', default=None, help='Annotate all imported ' +
+                'neurons with this annotation, can be passed multiple ' +
+                'times. "Import" by default.')
+        parser.add_argument('--source-url', dest='source_url', default=None,
+                help='Record skeletons with a numeric file name as ' +
+                'originating from the skeleton with this ID at this URL')
+        parser.add_argument('--source-project-id', dest='source_project_id',
+                type=int, default=None, help='The project ID at the source URL')
+        parser.add_argument('--source-type', dest='source_type',
+                default='skeleton', choices=('skeleton', 'segmentation'),
+                help='The type of the source data')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=skeletonimport.DEFAULT_BATCH_SIZE, help='The number ' +
+                'of skeletons to write with one set of COPY statements. ' +
+                'Each batch is committed on its own.')
+
+    def handle(self, *args, **options):
+        project_id = options['project_id']
+        if not Project.objects.filter(id=project_id).exists():
+            raise CommandError(f'Project {project_id} does not exist')
+        try:
+            user = User.objects.get(pk=options['user_id'])
+        except User.DoesNotExist:
+            raise CommandError(f'User {options["user_id"]} does not exist')
+
+        if bool(options['source_url']) != bool(options['source_project_id']):
+            raise CommandError('Source URL and source project ID are only ' +
+                    'used together')
+
+        annotations = options['annotations']
+        if annotations is None:
+            annotations = ['Import']
+
+        paths = list(self.find_files(options['paths']))
+        if not paths:
+            raise CommandError('No SWC files or archives found')
+        self.stdout.write(f'Importing skeletons from {len(paths)} files')
+
+        def open_files():
+            for path in paths:
+                with open(path, 'rb') as f:
+                    yield path, f
+
+        def progress(n_imported):
+            self.stdout.write(f'Imported {n_imported} skeletons')
+
+        skeletons = skeletonimport.iter_swc_skeletons(
+                skeletonimport.iter_swc_files(open_files()))
+        try:
+            imported = skeletonimport.bulk_import(user, project_id, skeletons,
+                    annotations, options['source_url'],
+                    options['source_project_id'], options['source_type'],
+                    options['batch_size'], progress)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(
+                f'Imported {len(imported)} skeletons'))
+
+    def find_files(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for filename in sorted(files):
+                        _, extension = skeletonimport.split_extension(filename)
+                        if extension in skeletonimport.SWC_EXTENSIONS or \
+                                skeletonimport.is_archive(extension):
+                            yield os.path.join(root, filename)
+            elif os.path.exists(path):
+                yield path
+            else:
+                raise CommandError(f'File not found: {path}')
@@ -4,14 +4,17 @@ import logging
 import select
 import signal
 import time
-from typing import Dict, List, Set
+import numpy as np
+from typing import DefaultDict, Dict, List, Set
 
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import connection
 
-from catmaid.control.edge import get_intersected_grid_cells
+from catmaid.control.edge import get_intersected_grid_cells_batch
+from catmaid.control.importance import (find_treenodes_at, get_update_points,
+        update_node_importance)
 from catmaid.control.node import (get_configured_node_providers,
         GridCachedNodeProvider)
 from catmaid.models import NodeGridCache
@@ -62,24 +65,28 @@ class GridWorker():
         """ We want regular node queries to be able to tell whether a particular
         cache segment is valid. Therefore we queue a new dirty cell entry and
         send another notify(). Queue entries are then processed by a set of
-        different workers. To do this, get all the enabled grid caches for each
-        project and then, for each notification compute the intersected grid
-        indices with each grid, update existing grids and create missing ones.
+        different workers. To do this, collect the changed segments of all
+        updates for each project and compute the intersected grid indices of
+        all segments with each enabled grid of the project at once.
         """
-        # Batch of grids to update during one run
-        grid_coords_to_update:Dict = {}
+        project_segments:DefaultDict[int, List] = defaultdict(list)
         for update in updates:
             self.updatesReceived += 1
-            self.get_intersected_grid_cell_ids(update,
-                    cursor, create=True, grid_coords_to_update=grid_coords_to_update)
+            self.append_segments(update, project_segments)
 
         dirty_rows:Set = set()
-        for grid_id, coords in grid_coords_to_update.items():
-            for c in coords:
-                self.cellsMarkedDirty += 1
-                key = f"({grid_id},{c[0]},{c[1]},{c[2]})"
-                if key not in dirty_rows:
-                    dirty_rows.add(key)
+        for grid_cache in self.grid_caches:
+            segments = project_segments.get(grid_cache.project_id)
+            if not segments:
+                continue
+            segments = np.array(segments, dtype=np.float64)
+            cells = get_intersected_grid_cells_batch(segments[:, 0],
+                    segments[:, 1], grid_cache.cell_width,
+                    grid_cache.cell_height, grid_cache.cell_depth)
+            self.cellsMarkedDirty += len(cells)
+            grid_id = grid_cache.id
+            dirty_rows.update(f"({grid_id},{c[0]},{c[1]},{c[2]})"
+                    for c in cells.tolist())
 
         if dirty_rows:
             # Mark cells as dirty
@@ -92,42 +99,9 @@ class GridWorker():
 
             logger.debug(f'Marked {len(dirty_rows)} grid cells as dirty and queued update')
 
-    def append_cells_to_update(self, coords_to_update, p1, p2, cell_width,
-            cell_height, cell_depth):
-
-        # Find intersecting grid cell indices for each cache and create
-        # the ones that aren't there yet.
-        p1_cell = [
-            int(p1[0] // cell_width),
-            int(p1[1] // cell_height),
-            int(p1[2] // cell_depth),
-        ]
-
-        p2_cell = [
-            int(p2[0] // cell_width),
-            int(p2[1] // cell_height),
-            int(p2[2] // cell_depth),
-        ]
-
-        n_cells = [
-            abs(p2_cell[0] - p1_cell[0]) + 1,
-            abs(p2_cell[1] - p1_cell[1]) + 1,
-            abs(p2_cell[2] - p1_cell[2]) + 1,
-        ]
-
-        n_cells_total = n_cells[0] * n_cells[1] * n_cells[2]
-        if n_cells_total == 1:
-            # Common case, only one cell is changed.
-            coords_to_update.append(p1_cell)
-        else:
-            # Find all intersecting cells in this grid.
-            coords_to_update.extend(get_intersected_grid_cells(p1,
-                p2, cell_width, cell_height, cell_depth, p1_cell, p2_cell))
-
-    def get_intersected_grid_cell_ids(self, data, cursor, create=True,
-            grid_coords_to_update=dict()):
-        """Iterate over all known enabled grid caches and find all intersected
-        cells.
+    def append_segments(self, data, project_segments):
+        """Add the changed segments of a spatial update to the segment list
+        of its project. Points are represented as segments of length zero.
         """
         project_id = data.get('project_id')
         if project_id is None:
@@ -139,42 +113,42 @@ class GridWorker():
             return
 
         data_type = data['type']
-        # Find all cells to update in each enabled grid
-        for grid_cache in self.grid_caches:
-            grid_id = grid_cache.id
-            coords_to_update = grid_coords_to_update.get(grid_id)
-            if not coords_to_update:
-                coords_to_update = []
-                grid_coords_to_update[grid_id] = coords_to_update
-            cell_width = grid_cache.cell_width
-            cell_height = grid_cache.cell_height
-            cell_depth = grid_cache.cell_depth
-            if data_type == 'edge':
-                p1 = data['p1']
-                p2 = data['p2']
-                self.append_cells_to_update(coords_to_update, p1, p2,
-                        cell_width, cell_height, cell_depth)
-            elif data_type == 'edges':
-                # Format: {"project_id": 1, "type": "edges", "edges": [
-                #    [[595708,418558,40000], [608508,418558,40000]],
-                #    [[595708,418558,40000], [608508,418558,40000]]]}
-                edge_1 = data['edges'][0]
-                edge_2 = data['edges'][1]
-                self.append_cells_to_update(coords_to_update, edge_1[0], edge_1[1],
-                        cell_width, cell_height, cell_depth)
-                self.append_cells_to_update(coords_to_update, edge_2[0], edge_2[1],
-                        cell_width, cell_height, cell_depth)
-            elif data_type == 'point':
-                p = data['p']
-                coords_to_update.append([
-                    int(p[0] // cell_width),
-                    int(p[1] // cell_height),
-                    int(p[2] // cell_depth),
-                ])
-            else:
-                logger.error(f"Unknown data type: {data_type}")
+        segments = project_segments[project_id]
+        if data_type == 'edge':
+            segments.append((data['p1'], data['p2']))
+        elif data_type == 'edges':
+            # Format: {"project_id": 1, "type": "edges", "edges": [
+            #    [[595708,418558,40000], [608508,418558,40000]],
+            #    [[595708,418558,40000], [608508,418558,40000]]]}
+            segments.append(data['edges'][0])
+            segments.append(data['edges'][1])
+        elif data_type == 'point':
+            segments.append((data['p'], data['p']))
+        else:
+            logger.error(f"Unknown data type: {data_type}")
 
-        return grid_coords_to_update
+
+class ImportanceWorker():
+    """Update the importance score of all nodes that are referenced by spatial
+    updates, along with their parents and children.
+    """
+
+    def __init__(self):
+        self.nodesUpdated = 0
+
+    def update(self, updates, cursor):
+        project_points:DefaultDict[int, List] = defaultdict(list)
+        for update in updates:
+            project_id = update.get('project_id')
+            if project_id is None:
+                continue
+            project_points[project_id].extend(get_update_points(update))
+
+        for project_id, points in project_points.items():
+            treenode_ids = find_treenodes_at(project_id, points, cursor)
+            n_updated = update_node_importance(project_id, treenode_ids, cursor)
+            self.nodesUpdated += n_updated
+            logger.debug(f'Updated the importance of {n_updated} node(s) in project {project_id}')
 
 
 class Command(BaseCommand):
@@ -192,6 +166,9 @@ class Command(BaseCommand):
         )
         parser.add_argument("--grid-cache", type=str2bool, nargs='?',
                 const=True, default=True, help="Update spatial grid caches.")
+        parser.add_argument("--node-importance", type=str2bool, nargs='?',
+                const=True, default=False, help="Update node importance " +
+                "scores of changed nodes, their parents and children.")
 
     def handle(self, **options):
         set_log_level(logger, options.get('verbosity', 1))
@@ -205,6 +182,9 @@ class Command(BaseCommand):
         if options['grid_cache']:
             self.workers.append(GridWorker())
 
+        if options['node_importance']:
+            self.workers.append(ImportanceWorker())
+
         if not self.workers:
             logger.warn("No grids provided")
             return
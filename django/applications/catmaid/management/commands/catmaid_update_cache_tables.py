@@ -20,9 +20,12 @@ class Command(BaseCommand):
         parser.add_argument('--project_id', dest='project_id', nargs='+',
             default=False, help='Compute only statistics for these projects only (otherwise all)'),
         parser.add_argument('--cache', dest='cache_type', default="section",
-            help='Which type of cache should be used: grid or section'),
+            help='Which type of cache should be used: grid or section. The ' +
+            'type connectivity recreates the skeleton connectivity table ' +
+            'instead, all other options except --project_id are ignored.'),
         parser.add_argument('--type', dest='data_type', default="msgpack",
-            help='Which type of cache to populate: json, json_text, msgpack'),
+            help='Which type of cache to populate: json, json_text, msgpack, ' +
+            'columnar. The columnar type is only available for grid caches.'),
         parser.add_argument('--orientation', dest='orientations', nargs='+',
             default='xy', help='Which orientations should be generated: xy, ' +
             'xz, zy. Only used if a section cache type is used.'),
@@ -76,7 +79,13 @@ class Command(BaseCommand):
         parser.add_argument('--chunk-size', dest='chunk_size', default=10, type=int,
                 help='The number of cache cells evaluated per process')
         parser.add_argument('--order', dest='order', default=None, type=str,
-                help='The order of data in the cache, can be either "cable-asc" or "cable-desc". By default no ordering is applied.')
+                help='The order of data in the cache, can be either "cable-asc", "cable-desc" or "importance". By default no ordering is applied.')
+        parser.add_argument('--slab-size', dest='slab_size', default=None, type=int,
+                help='If set, grid cells are computed in slabs of up to this many cells of the same depth, using a single query and bulk writes per slab. Each process handles one slab at a time.')
+        parser.add_argument('--checkpoint', dest='checkpoint', default=None, type=str,
+                help='A file to record completed grid cells in. If the file exists, recorded cells are skipped, which allows to resume an interrupted update with the same slab or chunk size. The file is removed after a complete update.')
+        parser.add_argument('--benchmark', dest='benchmark', action='store_true', default=False,
+                help='Compute grid cells without storing them and report the throughput')
 
     def handle(self, *args, **options):
         if options['from_config']:
@@ -98,8 +107,12 @@ class Command(BaseCommand):
             projects = Project.objects.all()
 
         cache_type = options['cache_type']
-        if cache_type not in ('section', 'grid'):
-            raise CommandError('Cache type must be one of: section, grid')
+        if cache_type not in ('section', 'grid', 'connectivity'):
+            raise CommandError('Cache type must be one of: section, grid, connectivity')
+
+        if cache_type == 'connectivity':
+            self.update_connectivity([p.id for p in projects] if project_ids else None)
+            return
 
         orientations = options['orientations']
         if type(orientations) in (list, tuple):
@@ -118,6 +131,8 @@ class Command(BaseCommand):
 
         delete = False
         clean = options['clean']
+        if clean and options['benchmark']:
+            raise CommandError("Benchmarks can't be combined with --clean")
         if clean:
             if project_ids:
                 delete = True
@@ -151,8 +166,8 @@ class Command(BaseCommand):
 
         data_type = options['data_type']
 
-        if data_type not in ('json', 'json_text', 'msgpack'):
-            raise CommandError('Type must be one of: json, json_text, msgpack')
+        if data_type not in ('json', 'json_text', 'msgpack', 'columnar'):
+            raise CommandError('Type must be one of: json, json_text, msgpack, columnar')
 
         cell_width = options['cell_width']
         if cell_width:
@@ -192,6 +207,16 @@ class Command(BaseCommand):
         ordering = options['order']
         progress = options['progress']
 
+        slab_size = options['slab_size']
+        checkpoint = options['checkpoint']
+        benchmark = options['benchmark']
+        if (slab_size or checkpoint or benchmark) and cache_type != 'grid':
+            raise ValueError("Slabs, checkpoints and benchmarks work currently only with grid caches")
+        if benchmark and checkpoint:
+            raise ValueError("Benchmarks can't be combined with --checkpoint")
+        if data_type == 'columnar' and cache_type != 'grid':
+            raise CommandError('The columnar type is only available for grid caches')
+
 
         for p in projects:
             self.stdout.write(f'Updating {cache_type} cache for project {p.id}')
@@ -209,5 +234,20 @@ class Command(BaseCommand):
                         lod_bucket_size=lod_bucket_size,
                         lod_strategy=lod_strategy, jobs=jobs,
                         depth_steps=depth_steps, chunksize=chunksize,
-                        ordering=ordering)
+                        ordering=ordering, slab_size=slab_size,
+                        checkpoint=checkpoint, dry_run=benchmark)
             self.stdout.write(f'Updated {cache_type} cache for project {p.id}')
+
+    def update_connectivity(self, project_ids):
+        if project_ids:
+            self.stdout.write('Updating skeleton connectivity for projects ' +
+                    ', '.join(map(str, project_ids)))
+        else:
+            self.stdout.write('Updating skeleton connectivity for all projects')
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT refresh_skeleton_connectivity_table(%(project_ids)s::integer[])
+        """, {
+            'project_ids': project_ids,
+        })
+        self.stdout.write('Updated skeleton connectivity')
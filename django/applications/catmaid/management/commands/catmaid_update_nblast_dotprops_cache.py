@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.apps import get_system_user
+from catmaid.control.nat import dotprops_cache
+from catmaid.control.nat.nblast import nm_to_um
+from catmaid.control.similarity import get_all_object_ids
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = "Update the per-object dotprops cache of the NumPy NBLAST " \
+            "backend. Only objects that changed since they were cached are " \
+            "recomputed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', dest='project_id', type=int,
+                required=True, help='The project to update the cache for')
+        parser.add_argument('--type', dest='object_type', default='skeleton',
+                choices=('skeleton', 'pointcloud'), help='The object type')
+        parser.add_argument('--tangent-neighbors', dest='tangent_neighbors',
+                type=int, default=5, help='The number of neighbor points ' +
+                'used to compute tangent vectors, has to match the NBLAST ' +
+                'configuration')
+        parser.add_argument('--resample', dest='resample_by', type=float,
+                default=1e3, help='The resampling step for skeletons in nm')
+        parser.add_argument('--required-branches', dest='required_branches',
+                type=int, default=10, help='The number of branches ' +
+                'skeletons are simplified to')
+        parser.add_argument('--no-simplify', dest='simplify',
+                action='store_false', help='Cache full skeletons')
+        parser.add_argument('--min-nodes', dest='min_nodes', type=int,
+                default=500, help='Only cache skeletons with at least this ' +
+                'many nodes')
+        parser.add_argument('--skeleton', dest='skeleton_ids', type=int,
+                action='append', default=[], help='Only update this ' +
+                'skeleton, can be passed multiple times')
+        parser.add_argument('--clean', dest='clean', action='store_true',
+                help='Remove cache files of objects that are not updated')
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+                default=1000, help='The number of objects loaded at a time')
+        parser.add_argument('--workers', dest='workers', type=int,
+                default=settings.MAX_PARALLEL_ASYNC_WORKERS,
+                help='The number of processes that compute dotprops')
+
+    def handle(self, *args, **options):
+        project_id = options['project_id']
+        if not Project.objects.filter(id=project_id).exists():
+            raise CommandError(f'Project {project_id} does not exist')
+
+        object_type = options['object_type']
+        if options['skeleton_ids']:
+            if object_type != 'skeleton':
+                raise CommandError('Skeleton IDs can only be used with the skeleton type')
+            if options['clean']:
+                raise CommandError('Cleaning the cache requires all skeletons')
+            object_ids = options['skeleton_ids']
+        else:
+            # The system user is superuser and should have access to all pointclouds
+            object_ids = get_all_object_ids(project_id, get_system_user().id,
+                    object_type, options['min_nodes'])
+
+        self.stdout.write(f'Updating dotprops cache for {len(object_ids)} objects')
+
+        def progress(n_done, n_total):
+            self.stdout.write(f'Processed {n_done}/{n_total} objects')
+
+        result = dotprops_cache.update_cache(project_id, object_type,
+                object_ids, options['tangent_neighbors'],
+                options['resample_by'] * nm_to_um,
+                options['required_branches'] if options['simplify'] else None,
+                options['clean'], options['batch_size'], options['workers'],
+                progress)
+
+        self.stdout.write(self.style.SUCCESS(('Updated {updated} objects, ' +
+                '{current} were up-to-date, {failed} failed and {removed} ' +
+                'were removed').format(**result)))
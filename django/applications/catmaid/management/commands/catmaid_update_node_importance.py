@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from catmaid.control.importance import update_node_importance
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = "Recompute the importance scores of all nodes, which are used for " \
+            "the \"importance\" node ordering."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clean', action='store_true', dest='clean',
+            default=False, help='Remove all existing scores before recomputation'),
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            default=False, help='Compute only scores for these projects only (otherwise all)'),
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+
+        project_ids = options['project_id']
+        if project_ids:
+            projects = Project.objects.filter(id__in=project_ids)
+        else:
+            projects = Project.objects.all()
+
+        for p in projects:
+            start = time.time()
+            with transaction.atomic():
+                if options['clean']:
+                    cursor.execute("""
+                        DELETE FROM treenode_importance
+                        WHERE project_id = %(project_id)s
+                    """, {
+                        'project_id': p.id,
+                    })
+                n_updated = update_node_importance(p.id, cursor=cursor)
+            self.stdout.write(f'Computed importance of {n_updated} nodes in '
+                    f'project {p.id} in {time.time() - start:.2f}s')
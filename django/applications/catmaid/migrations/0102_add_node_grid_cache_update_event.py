@@ -0,0 +1,61 @@
+from django.db import migrations
+
+
+forward = """
+    -- Emit the signal "catmaid.grid-cache-update" with the affected project ID
+    -- as payload if a grid cache definition is added, changed or removed. This
+    -- allows processes to keep grid definitions in memory. Unlike spatial
+    -- update events, this event is always sent, because grid definitions
+    -- change rarely.
+    CREATE OR REPLACE FUNCTION on_change_node_grid_cache() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('catmaid.grid-cache-update', OLD.project_id::text);
+            RETURN OLD;
+        END IF;
+        PERFORM pg_notify('catmaid.grid-cache-update', NEW.project_id::text);
+        RETURN NEW;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION on_truncate_node_grid_cache() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        -- An empty payload refers to all projects.
+        PERFORM pg_notify('catmaid.grid-cache-update', '');
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_change_node_grid_cache_tgr
+    AFTER INSERT OR UPDATE OR DELETE ON node_grid_cache
+    FOR EACH ROW EXECUTE PROCEDURE on_change_node_grid_cache();
+
+    CREATE TRIGGER on_truncate_node_grid_cache_tgr
+    AFTER TRUNCATE ON node_grid_cache
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_truncate_node_grid_cache();
+"""
+
+backward = """
+    DROP TRIGGER on_change_node_grid_cache_tgr ON node_grid_cache;
+    DROP TRIGGER on_truncate_node_grid_cache_tgr ON node_grid_cache;
+    DROP FUNCTION on_change_node_grid_cache();
+    DROP FUNCTION on_truncate_node_grid_cache();
+"""
+
+
+class Migration(migrations.Migration):
+    """Notify listeners about changed node grid cache definitions, so that
+    they can be kept in memory.
+    """
+
+    dependencies = [
+        ('catmaid', '0101_optimize_disabled_spatial_update_events'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+forward = """
+    ALTER TABLE node_grid_cache
+    ADD COLUMN has_columnar_data boolean DEFAULT FALSE NOT NULL;
+
+    ALTER TABLE node_grid_cache_cell ADD COLUMN columnar_data bytea[];
+"""
+
+backward = """
+    ALTER TABLE node_grid_cache_cell DROP COLUMN columnar_data;
+    ALTER TABLE node_grid_cache DROP COLUMN has_columnar_data;
+"""
+
+
+class Migration(migrations.Migration):
+    """Allow grid caches to store cell data in the columnar node format.
+    """
+
+    dependencies = [
+        ('catmaid', '0102_add_node_grid_cache_update_event'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nodegridcache',
+                name='has_columnar_data',
+                field=models.BooleanField(default=False),
+            ),
+            migrations.AddField(
+                model_name='nodegridcachecell',
+                name='columnar_data',
+                field=models.BinaryField(null=True),
+            ),
+        ])
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+forward = """
+    -- A precomputed, topology based importance score for each treenode. It is
+    -- combined with skeleton size and recency to order nodes if the
+    -- "importance" ordering is requested, e.g. to fill low LOD buckets of
+    -- grid caches with the most informative nodes. This table is maintained
+    -- by the spatial update worker and the catmaid_update_node_importance
+    -- management command, nodes without score are treated as unimportant.
+    CREATE TABLE treenode_importance (
+        treenode_id bigint PRIMARY KEY REFERENCES treenode (id)
+            ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        project_id integer NOT NULL REFERENCES project (id)
+            ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        score real NOT NULL
+    );
+
+    CREATE INDEX treenode_importance_project_id_idx
+        ON treenode_importance (project_id);
+
+    ALTER TABLE node_grid_cache DROP CONSTRAINT check_valid_ordering;
+    ALTER TABLE node_grid_cache ADD CONSTRAINT check_valid_ordering
+        CHECK (ordering IS NULL OR ordering IN ('cable-desc', 'cable-asc', 'importance'));
+"""
+
+backward = """
+    DROP TABLE treenode_importance;
+
+    UPDATE node_grid_cache SET ordering = NULL WHERE ordering = 'importance';
+    ALTER TABLE node_grid_cache DROP CONSTRAINT check_valid_ordering;
+    ALTER TABLE node_grid_cache ADD CONSTRAINT check_valid_ordering
+        CHECK (ordering IS NULL OR ordering IN ('cable-desc', 'cable-asc'));
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a table for per-node importance scores and allow grid caches to be
+    ordered by them.
+    """
+
+    dependencies = [
+        ('catmaid', '0103_add_columnar_node_grid_cache_data'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='TreenodeImportance',
+                fields=[
+                    ('treenode', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='catmaid.Treenode')),
+                    ('score', models.FloatField()),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                ],
+                options={
+                    'db_table': 'treenode_importance',
+                },
+            ),
+        ]),
+    ]
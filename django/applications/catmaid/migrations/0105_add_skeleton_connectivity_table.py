@@ -0,0 +1,294 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Compute the change of skeleton pair connectivity for links that changed in a
+# single statement and apply it to the connectivity table. The {new_links} and
+# {old_links} queries return the inserted or updated links after and the
+# updated or deleted links before the change. The connectivity of all touched
+# connectors is computed once for the state before and once for the state
+# after the statement and the difference is applied. Rows without links are
+# removed. The touched connectors are locked first, so that concurrent changes
+# of links of the same connector are applied one after the other and each
+# trigger sees the links committed by the others.
+update_connectivity_template = """
+    PERFORM 1
+    FROM connector c
+    WHERE c.id = ANY(ARRAY(
+        SELECT nl.connector_id FROM ({new_links}) nl
+        UNION
+        SELECT ol.connector_id FROM ({old_links}) ol
+    ))
+    ORDER BY c.id
+    FOR UPDATE;
+
+    WITH new_link AS (
+        {new_links}
+    ), old_link AS (
+        {old_links}
+    ), touched_connector AS (
+        SELECT connector_id FROM new_link
+        UNION
+        SELECT connector_id FROM old_link
+    ), link_after AS (
+        SELECT tc.id, tc.project_id, tc.connector_id, tc.skeleton_id,
+            tc.relation_id, tc.confidence
+        FROM treenode_connector tc
+        JOIN touched_connector c
+            ON c.connector_id = tc.connector_id
+    ), link_before AS (
+        SELECT la.*
+        FROM link_after la
+        WHERE NOT EXISTS (SELECT 1 FROM new_link nl WHERE nl.id = la.id)
+        UNION ALL
+        SELECT * FROM old_link
+    ), pair AS (
+        SELECT t1.project_id, t1.skeleton_id, t2.skeleton_id AS partner_skeleton_id,
+            t1.relation_id, t2.relation_id AS partner_relation_id,
+            LEAST(t1.confidence, t2.confidence) AS confidence, 1 AS sign
+        FROM link_after t1
+        JOIN link_after t2
+            ON t1.connector_id = t2.connector_id
+            AND t1.id <> t2.id
+        UNION ALL
+        SELECT t1.project_id, t1.skeleton_id, t2.skeleton_id,
+            t1.relation_id, t2.relation_id,
+            LEAST(t1.confidence, t2.confidence), -1
+        FROM link_before t1
+        JOIN link_before t2
+            ON t1.connector_id = t2.connector_id
+            AND t1.id <> t2.id
+    ), delta AS (
+        SELECT project_id, skeleton_id, partner_skeleton_id, relation_id,
+            partner_relation_id, SUM(sign)::integer AS count, ARRAY[
+                COALESCE(SUM(sign) FILTER (WHERE confidence = 1), 0),
+                COALESCE(SUM(sign) FILTER (WHERE confidence = 2), 0),
+                COALESCE(SUM(sign) FILTER (WHERE confidence = 3), 0),
+                COALESCE(SUM(sign) FILTER (WHERE confidence = 4), 0),
+                COALESCE(SUM(sign) FILTER (WHERE confidence = 5), 0)
+            ]::integer[] AS confidence_histogram
+        FROM pair
+        GROUP BY project_id, skeleton_id, partner_skeleton_id, relation_id,
+            partner_relation_id
+    ), updated AS (
+        INSERT INTO catmaid_skeleton_connectivity AS sc (project_id,
+            skeleton_id, partner_skeleton_id, relation_id, partner_relation_id,
+            count, confidence_histogram)
+        SELECT * FROM delta
+        WHERE count <> 0
+            OR confidence_histogram <> '{{0,0,0,0,0}}'::integer[]
+        ON CONFLICT (skeleton_id, partner_skeleton_id, relation_id, partner_relation_id)
+        DO UPDATE SET
+            count = sc.count + EXCLUDED.count,
+            confidence_histogram = ARRAY[
+                sc.confidence_histogram[1] + EXCLUDED.confidence_histogram[1],
+                sc.confidence_histogram[2] + EXCLUDED.confidence_histogram[2],
+                sc.confidence_histogram[3] + EXCLUDED.confidence_histogram[3],
+                sc.confidence_histogram[4] + EXCLUDED.confidence_histogram[4],
+                sc.confidence_histogram[5] + EXCLUDED.confidence_histogram[5]
+            ]
+        RETURNING sc.id, sc.count
+    )
+    SELECT array_agg(id) INTO empty_ids
+    FROM updated
+    WHERE count <= 0;
+
+    IF empty_ids IS NOT NULL THEN
+        DELETE FROM catmaid_skeleton_connectivity
+        WHERE id = ANY(empty_ids);
+    END IF;
+"""
+
+link_columns = "id, project_id, connector_id, skeleton_id, relation_id, confidence"
+
+update_connectivity_on_insert = update_connectivity_template.format(
+    new_links=f"SELECT {link_columns} FROM inserted_treenode_connector",
+    old_links=f"SELECT {link_columns} FROM inserted_treenode_connector WHERE FALSE")
+
+update_connectivity_on_delete = update_connectivity_template.format(
+    new_links=f"SELECT {link_columns} FROM deleted_treenode_connector WHERE FALSE",
+    old_links=f"SELECT {link_columns} FROM deleted_treenode_connector")
+
+# Only updates of the connector, skeleton, relation or confidence of a link
+# change connectivity.
+changed_links = """
+    SELECT {prefix}.id, {prefix}.project_id, {prefix}.connector_id,
+        {prefix}.skeleton_id, {prefix}.relation_id, {prefix}.confidence
+    FROM new_treenode_connector n
+    JOIN old_treenode_connector o
+        ON n.id = o.id
+    WHERE (n.connector_id, n.skeleton_id, n.relation_id, n.confidence)
+        IS DISTINCT FROM (o.connector_id, o.skeleton_id, o.relation_id, o.confidence)
+"""
+
+update_connectivity_on_edit = update_connectivity_template.format(
+    new_links=changed_links.format(prefix='n'),
+    old_links=changed_links.format(prefix='o'))
+
+
+forward = f"""
+    -- The number of links between each pair of skeletons that share a
+    -- connector, by the relation of both links to the connector, along with
+    -- a histogram of the lower confidence of both links (1-5). For instance,
+    -- the number of synapses from skeleton A to skeleton B can be found in
+    -- the row of A, B, presynaptic_to and postsynaptic_to. Each pair is stored
+    -- in both directions. The table is maintained by the triggers below and
+    -- can be recreated with refresh_skeleton_connectivity_table().
+    CREATE TABLE catmaid_skeleton_connectivity (
+        id bigserial PRIMARY KEY,
+        project_id integer NOT NULL REFERENCES project (id)
+            ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        skeleton_id bigint NOT NULL REFERENCES class_instance (id)
+            ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        partner_skeleton_id bigint NOT NULL REFERENCES class_instance (id)
+            ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        relation_id bigint NOT NULL REFERENCES relation (id)
+            ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        partner_relation_id bigint NOT NULL REFERENCES relation (id)
+            ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        count integer NOT NULL,
+        confidence_histogram integer[] NOT NULL,
+        CONSTRAINT catmaid_skeleton_connectivity_pair_uniq UNIQUE
+            (skeleton_id, partner_skeleton_id, relation_id, partner_relation_id)
+    );
+
+    CREATE INDEX catmaid_skeleton_connectivity_project_id_idx
+        ON catmaid_skeleton_connectivity (project_id);
+    CREATE INDEX catmaid_skeleton_connectivity_partner_skeleton_id_idx
+        ON catmaid_skeleton_connectivity (partner_skeleton_id);
+
+
+    CREATE FUNCTION refresh_skeleton_connectivity_table(project_ids integer[] DEFAULT NULL)
+        RETURNS void
+        LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            TRUNCATE catmaid_skeleton_connectivity;
+        ELSE
+            DELETE FROM catmaid_skeleton_connectivity
+            WHERE project_id = ANY(project_ids);
+        END IF;
+
+        INSERT INTO catmaid_skeleton_connectivity (project_id, skeleton_id,
+            partner_skeleton_id, relation_id, partner_relation_id, count,
+            confidence_histogram)
+        SELECT t1.project_id, t1.skeleton_id, t2.skeleton_id, t1.relation_id,
+            t2.relation_id, COUNT(*), ARRAY[
+                COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 1),
+                COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 2),
+                COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 3),
+                COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 4),
+                COUNT(*) FILTER (WHERE LEAST(t1.confidence, t2.confidence) = 5)
+            ]::integer[]
+        FROM treenode_connector t1
+        JOIN treenode_connector t2
+            ON t1.connector_id = t2.connector_id
+            AND t1.id <> t2.id
+        WHERE project_ids IS NULL OR t1.project_id = ANY(project_ids)
+        GROUP BY t1.project_id, t1.skeleton_id, t2.skeleton_id,
+            t1.relation_id, t2.relation_id;
+    END;
+    $$;
+
+
+    CREATE FUNCTION on_insert_treenode_connector_update_connectivity()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        empty_ids bigint[];
+    BEGIN
+        {update_connectivity_on_insert}
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE FUNCTION on_edit_treenode_connector_update_connectivity()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        empty_ids bigint[];
+    BEGIN
+        {update_connectivity_on_edit}
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE FUNCTION on_delete_treenode_connector_update_connectivity()
+        RETURNS trigger
+        LANGUAGE plpgsql AS
+    $$
+    DECLARE
+        empty_ids bigint[];
+    BEGIN
+        {update_connectivity_on_delete}
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_insert_treenode_connector_update_connectivity
+    AFTER INSERT ON treenode_connector
+    REFERENCING NEW TABLE AS inserted_treenode_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_insert_treenode_connector_update_connectivity();
+
+    CREATE TRIGGER on_edit_treenode_connector_update_connectivity
+    AFTER UPDATE ON treenode_connector
+    REFERENCING NEW TABLE AS new_treenode_connector OLD TABLE AS old_treenode_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_connector_update_connectivity();
+
+    CREATE TRIGGER on_delete_treenode_connector_update_connectivity
+    AFTER DELETE ON treenode_connector
+    REFERENCING OLD TABLE AS deleted_treenode_connector
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_delete_treenode_connector_update_connectivity();
+
+    SELECT refresh_skeleton_connectivity_table();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_treenode_connector_update_connectivity ON treenode_connector;
+    DROP TRIGGER on_edit_treenode_connector_update_connectivity ON treenode_connector;
+    DROP TRIGGER on_delete_treenode_connector_update_connectivity ON treenode_connector;
+
+    DROP FUNCTION on_insert_treenode_connector_update_connectivity();
+    DROP FUNCTION on_edit_treenode_connector_update_connectivity();
+    DROP FUNCTION on_delete_treenode_connector_update_connectivity();
+    DROP FUNCTION refresh_skeleton_connectivity_table(integer[]);
+
+    DROP TABLE catmaid_skeleton_connectivity;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a trigger maintained table of the number of links between pairs of
+    skeletons, which is used to answer connectivity queries without joining
+    treenode_connector with itself.
+    """
+
+    dependencies = [
+        ('catmaid', '0104_add_treenode_importance'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='SkeletonConnectivity',
+                fields=[
+                    ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                    ('count', models.IntegerField()),
+                    ('confidence_histogram', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=5)),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                    ('skeleton', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.ClassInstance')),
+                    ('partner_skeleton', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.ClassInstance')),
+                    ('relation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.Relation')),
+                    ('partner_relation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='catmaid.Relation')),
+                ],
+                options={
+                    'db_table': 'catmaid_skeleton_connectivity',
+                    'unique_together': {('skeleton', 'partner_skeleton', 'relation', 'partner_relation')},
+                },
+            ),
+        ]),
+    ]
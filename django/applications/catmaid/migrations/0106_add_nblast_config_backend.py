@@ -0,0 +1,58 @@
+from django.db import migrations, models
+
+
+forward = """
+    SELECT disable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass));
+    SELECT drop_history_view_for_table('nblast_config'::regclass);
+
+    ALTER TABLE nblast_config
+    ADD COLUMN backend text NOT NULL
+    DEFAULT 'r';
+
+    ALTER TABLE nblast_config__history
+    ADD COLUMN backend text;
+
+    UPDATE nblast_config__history
+    SET backend = 'r';
+
+    ALTER TABLE nblast_config
+    ADD CONSTRAINT nblast_config_backend_check
+    CHECK (backend IN ('r', 'numpy'));
+
+    SELECT create_history_view_for_table('nblast_config'::regclass);
+    SELECT enable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass), FALSE);
+"""
+
+backward = """
+    SELECT disable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass));
+    SELECT drop_history_view_for_table('nblast_config'::regclass);
+
+    ALTER TABLE nblast_config
+    DROP COLUMN backend;
+
+    ALTER TABLE nblast_config__history
+    DROP COLUMN backend;
+
+    SELECT create_history_view_for_table('nblast_config'::regclass);
+    SELECT enable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass), FALSE);
+"""
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catmaid', '0105_add_skeleton_connectivity_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nblastconfig',
+                name='backend',
+                field=models.TextField(default='r'),
+            ),
+        ]),
+    ]
@@ -0,0 +1,111 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+forward = """
+    SELECT disable_history_tracking_for_table('nblast_similarity'::regclass,
+            get_history_table_name('nblast_similarity'::regclass));
+    SELECT drop_history_view_for_table('nblast_similarity'::regclass);
+
+    ALTER TABLE nblast_similarity
+    ADD COLUMN storage text NOT NULL
+    DEFAULT 'dense';
+
+    ALTER TABLE nblast_similarity
+    ADD COLUMN min_score real;
+
+    ALTER TABLE nblast_similarity__history
+    ADD COLUMN storage text;
+
+    ALTER TABLE nblast_similarity__history
+    ADD COLUMN min_score real;
+
+    UPDATE nblast_similarity__history
+    SET storage = 'dense';
+
+    ALTER TABLE nblast_similarity
+    ADD CONSTRAINT nblast_similarity_storage_check
+    CHECK (storage IN ('dense', 'sparse'));
+
+    SELECT create_history_view_for_table('nblast_similarity'::regclass);
+    SELECT enable_history_tracking_for_table('nblast_similarity'::regclass,
+            get_history_table_name('nblast_similarity'::regclass), FALSE);
+
+    CREATE TABLE nblast_similarity_score (
+        id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        similarity_id integer NOT NULL REFERENCES nblast_similarity(id)
+            ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        query_object_id bigint NOT NULL,
+        target_object_id bigint NOT NULL,
+        score real NOT NULL
+    );
+
+    CREATE INDEX nblast_similarity_score_query_idx
+        ON nblast_similarity_score (similarity_id, query_object_id, score DESC);
+    CREATE INDEX nblast_similarity_score_target_idx
+        ON nblast_similarity_score (similarity_id, target_object_id, score DESC);
+"""
+
+backward = """
+    DROP TABLE nblast_similarity_score;
+
+    SELECT disable_history_tracking_for_table('nblast_similarity'::regclass,
+            get_history_table_name('nblast_similarity'::regclass));
+    SELECT drop_history_view_for_table('nblast_similarity'::regclass);
+
+    ALTER TABLE nblast_similarity
+    DROP COLUMN storage;
+
+    ALTER TABLE nblast_similarity
+    DROP COLUMN min_score;
+
+    ALTER TABLE nblast_similarity__history
+    DROP COLUMN storage;
+
+    ALTER TABLE nblast_similarity__history
+    DROP COLUMN min_score;
+
+    SELECT create_history_view_for_table('nblast_similarity'::regclass);
+    SELECT enable_history_tracking_for_table('nblast_similarity'::regclass,
+            get_history_table_name('nblast_similarity'::regclass), FALSE);
+"""
+
+
+class Migration(migrations.Migration):
+    """Allow NBLAST similarities to be stored sparsely: instead of a dense
+    scoring matrix, only the top N scores of each query object and/or scores
+    above a threshold are kept in an unversioned side table, which is written
+    while the similarity is computed.
+    """
+
+    dependencies = [
+        ('catmaid', '0106_add_nblast_config_backend'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nblastsimilarity',
+                name='storage',
+                field=models.TextField(default='dense'),
+            ),
+            migrations.AddField(
+                model_name='nblastsimilarity',
+                name='min_score',
+                field=models.FloatField(blank=True, null=True),
+            ),
+            migrations.CreateModel(
+                name='NblastSimilarityScore',
+                fields=[
+                    ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                    ('query_object_id', models.BigIntegerField()),
+                    ('target_object_id', models.BigIntegerField()),
+                    ('score', models.FloatField()),
+                    ('similarity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.NblastSimilarity')),
+                ],
+                options={
+                    'db_table': 'nblast_similarity_score',
+                },
+            ),
+        ]),
+    ]
@@ -0,0 +1,63 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+forward = """
+    CREATE TABLE nblast_similarity_block (
+        id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        similarity_id integer NOT NULL REFERENCES nblast_similarity(id)
+            ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        status text NOT NULL DEFAULT 'queued'
+            CHECK (status IN ('queued', 'computing', 'complete', 'error')),
+        query_objects bigint[] NOT NULL,
+        target_objects bigint[] NOT NULL,
+        valid_query_objects bigint[],
+        valid_target_objects bigint[],
+        scoring real[][],
+        computation_time real NOT NULL DEFAULT 0,
+        detailed_status text
+    );
+
+    CREATE INDEX nblast_similarity_block_similarity_id_idx
+        ON nblast_similarity_block (similarity_id);
+"""
+
+backward = """
+    DROP TABLE nblast_similarity_block;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add an unversioned table that keeps track of the blocks of query and
+    target objects an NBLAST similarity is computed in. Dense scores of each
+    block are stored with it until all blocks are complete, which allows
+    resuming interrupted computations.
+    """
+
+    dependencies = [
+        ('catmaid', '0107_add_sparse_nblast_similarity_storage'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='NblastSimilarityBlock',
+                fields=[
+                    ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                    ('status', models.TextField(default='queued')),
+                    ('query_objects', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                    ('target_objects', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+                    ('valid_query_objects', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), blank=True, default=None, null=True, size=None)),
+                    ('valid_target_objects', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), blank=True, default=None, null=True, size=None)),
+                    ('scoring', django.contrib.postgres.fields.ArrayField(base_field=django.contrib.postgres.fields.ArrayField(base_field=models.FloatField(), size=None), blank=True, default=None, null=True, size=None)),
+                    ('computation_time', models.FloatField(default=0)),
+                    ('detailed_status', models.TextField(blank=True, null=True)),
+                    ('similarity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.NblastSimilarity')),
+                ],
+                options={
+                    'db_table': 'nblast_similarity_block',
+                },
+            ),
+        ]),
+    ]
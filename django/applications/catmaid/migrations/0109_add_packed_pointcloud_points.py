@@ -0,0 +1,71 @@
+from django.db import migrations, models
+
+
+forward = """
+    SELECT disable_history_tracking_for_table('pointcloud'::regclass,
+            get_history_table_name('pointcloud'::regclass));
+    SELECT drop_history_view_for_table('pointcloud'::regclass);
+
+    ALTER TABLE pointcloud
+    ADD COLUMN packed_points bytea;
+
+    ALTER TABLE pointcloud__history
+    ADD COLUMN packed_points bytea;
+
+    -- Store the points of existing point clouds as big-endian float32 X, Y, Z
+    -- triples, ordered by point ID.
+    UPDATE pointcloud pc
+    SET packed_points = packed.data
+    FROM (
+        SELECT pcp.pointcloud_id,
+            string_agg(float4send(p.location_x::real) ||
+                float4send(p.location_y::real) ||
+                float4send(p.location_z::real), ''::bytea ORDER BY p.id) AS data
+        FROM pointcloud_point pcp
+        JOIN point p
+            ON p.id = pcp.point_id
+        GROUP BY pcp.pointcloud_id
+    ) packed
+    WHERE pc.id = packed.pointcloud_id;
+
+    SELECT create_history_view_for_table('pointcloud'::regclass);
+    SELECT enable_history_tracking_for_table('pointcloud'::regclass,
+            get_history_table_name('pointcloud'::regclass), FALSE);
+"""
+
+backward = """
+    SELECT disable_history_tracking_for_table('pointcloud'::regclass,
+            get_history_table_name('pointcloud'::regclass));
+    SELECT drop_history_view_for_table('pointcloud'::regclass);
+
+    ALTER TABLE pointcloud
+    DROP COLUMN packed_points;
+
+    ALTER TABLE pointcloud__history
+    DROP COLUMN packed_points;
+
+    SELECT create_history_view_for_table('pointcloud'::regclass);
+    SELECT enable_history_tracking_for_table('pointcloud'::regclass,
+            get_history_table_name('pointcloud'::regclass), FALSE);
+"""
+
+
+class Migration(migrations.Migration):
+    """Store the points of each point cloud additionally as a single packed
+    array of float32 values, which can be loaded without reading one row per
+    point.
+    """
+
+    dependencies = [
+        ('catmaid', '0108_add_nblast_similarity_block_table'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='pointcloud',
+                name='packed_points',
+                field=models.BinaryField(blank=True, null=True),
+            ),
+        ]),
+    ]
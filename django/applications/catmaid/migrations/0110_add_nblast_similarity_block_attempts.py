@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+forward = """
+    ALTER TABLE nblast_similarity_block
+    ADD COLUMN n_attempts integer NOT NULL DEFAULT 0;
+"""
+
+backward = """
+    ALTER TABLE nblast_similarity_block
+    DROP COLUMN n_attempts;
+"""
+
+
+class Migration(migrations.Migration):
+    """Count how often each block of an NBLAST similarity was claimed by a
+    task, so that blocks whose computation keeps failing can be given up on.
+    """
+
+    dependencies = [
+        ('catmaid', '0109_add_packed_pointcloud_points'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nblastsimilarityblock',
+                name='n_attempts',
+                field=models.IntegerField(default=0),
+            ),
+        ]),
+    ]
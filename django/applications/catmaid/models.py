@@ -943,6 +943,13 @@ class StackGroupClassInstance(models.Model):
 NblastConfigDefaultDotBreaks = list(n/10 for n in range(11))
 NblastConfigDefaultDistanceBreaks = (0, 0.75, 1.5, 2, 2.5, 3, 3.5, 4, 5, 6, 7,
         8, 9, 10, 12, 14, 16, 20, 25, 30, 40, 500)
+# NBLAST can be computed with the R packages nat and nat.nblast or with the
+# NumPy/SciPy implementation in catmaid.control.nat.nblast.
+NblastConfigBackends = ('r', 'numpy')
+
+# Similarities are either stored as a complete scoring matrix or as a sparse
+# list of the scores that pass the top N and minimum score filters.
+NblastSimilarityStorageModes = ('dense', 'sparse')
 
 
 class PointSet(NonCascadingUserFocusedModel):
@@ -999,6 +1006,7 @@ class NblastConfig(NonCascadingUserFocusedModel):
     scoring = ArrayField(ArrayField(models.FloatField()))
     resample_step = models.FloatField(default=1000)
     tangent_neighbors = models.IntegerField(default=5)
+    backend = models.TextField(default='r')
 
 
     class Meta:
@@ -1049,11 +1057,58 @@ class NblastSimilarity(NonCascadingUserFocusedModel):
     # To not neccessarily store large scoring matrixes with a lot of low score
     # results, only store the the top N results for each query. Disabled using 0.
     top_n = models.IntegerField(default=0, blank=True, null=True)
+    # With 'sparse' storage, scores are stored in the NblastSimilarityScore
+    # table rather than the scoring matrix.
+    storage = models.TextField(default='dense')
+    # Scores below this value aren't stored with sparse storage.
+    min_score = models.FloatField(blank=True, null=True)
 
     class Meta:
         db_table = "nblast_similarity"
 
 
+class NblastSimilarityScore(models.Model):
+    """A single score of a sparsely stored NBLAST similarity. Only scores that
+    pass the top N and minimum score filters of the similarity are stored. This
+    table isn't tracked by the history system, its rows are rewritten whenever
+    the similarity is recomputed.
+    """
+    id = models.BigAutoField(primary_key=True)
+    similarity = models.ForeignKey(NblastSimilarity, on_delete=models.CASCADE)
+    query_object_id = models.BigIntegerField()
+    target_object_id = models.BigIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        db_table = "nblast_similarity_score"
+
+
+class NblastSimilarityBlock(models.Model):
+    """A block of query and target objects of an NBLAST similarity, which is
+    computed by its own task. Until all blocks of a similarity are complete,
+    dense scores are stored with each block. This allows interrupted
+    computations to resume with the blocks that aren't complete yet. This
+    table isn't tracked by the history system, blocks are removed once the
+    similarity is complete.
+    """
+    id = models.BigAutoField(primary_key=True)
+    similarity = models.ForeignKey(NblastSimilarity, on_delete=models.CASCADE)
+    status = models.TextField(default='queued')
+    query_objects = ArrayField(models.BigIntegerField())
+    target_objects = ArrayField(models.BigIntegerField())
+    # The objects that could be used during the computation
+    valid_query_objects = ArrayField(models.BigIntegerField(), default=None, blank=True, null=True)
+    valid_target_objects = ArrayField(models.BigIntegerField(), default=None, blank=True, null=True)
+    scoring = ArrayField(ArrayField(models.FloatField()), default=None, blank=True, null=True)
+    computation_time = models.FloatField(default=0)
+    detailed_status = models.TextField(blank=True, null=True)
+    # How often the block was claimed by a task
+    n_attempts = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = "nblast_similarity_block"
+
+
 class PointCloud(NonCascadingUserFocusedModel):
     """A point cloud. Its points are linked through the point_cloud_point
     relation. A non-cascading user focused model is used, because cascading
@@ -1067,6 +1122,10 @@ class PointCloud(NonCascadingUserFocusedModel):
     # Points are stored in an array of the format [X, Y, Z, X, Y, Z, …]. A
     # length divisible by three is enforced by the database.
     points = models.ManyToManyField("Point", through='PointCloudPoint')
+    # The same points as big-endian float32 X, Y, Z triples, ordered by point
+    # ID. They can be loaded without reading one row per point. The point rows
+    # are authoritative, this copy is written when a point cloud is created.
+    packed_points = models.BinaryField(blank=True, null=True)
 
     def num_permissions(self) -> int:
         n_user_perms = PointCloudUserObjectPermission.objects.filter(content_object=self).count()
@@ -1347,6 +1406,50 @@ class SkeletonSummary(models.Model):
     def __str__(self) -> str:
         return f"Skeleton {self.skeleton_id} summary ({self.num_nodes} nodes, {self.cable_length} nm)"
 
+
+class TreenodeImportance(models.Model):
+    """A precomputed, topology based importance score of a treenode, which is
+    used for the "importance" node ordering. Scores are maintained by the
+    spatial update worker and the catmaid_update_node_importance management
+    command.
+    """
+
+    class Meta:
+        db_table = "treenode_importance"
+
+    treenode = models.OneToOneField(Treenode, on_delete=models.CASCADE,
+            primary_key=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    score = models.FloatField()
+
+
+class SkeletonConnectivity(models.Model):
+    """The number of links between two skeletons that share a connector, by
+    the relations of both links to the connector, and a histogram of the lower
+    confidence of both links. Each pair is stored in both directions. Data
+    insertion and updates are managed by the database through triggers on the
+    treenode_connector table.
+    """
+
+    class Meta:
+        db_table = "catmaid_skeleton_connectivity"
+        unique_together = (('skeleton', 'partner_skeleton', 'relation',
+                'partner_relation'),)
+
+    id = models.BigAutoField(primary_key=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    skeleton = models.ForeignKey(ClassInstance, on_delete=models.CASCADE,
+            related_name='+')
+    partner_skeleton = models.ForeignKey(ClassInstance,
+            on_delete=models.CASCADE, related_name='+')
+    relation = models.ForeignKey(Relation, on_delete=models.CASCADE,
+            related_name='+')
+    partner_relation = models.ForeignKey(Relation, on_delete=models.CASCADE,
+            related_name='+')
+    count = models.IntegerField()
+    confidence_histogram = ArrayField(models.IntegerField(), size=5)
+
+
 class DataSource(NonCascadingUserFocusedModel):
     """A simple object representing a data source, which are mainly used to
     reference the origin of imported skeletons. This table is tracked by the
@@ -1434,6 +1537,7 @@ class NodeGridCache(models.Model):
     has_json_data = models.BooleanField(default=False, null=False)
     has_json_text_data = models.BooleanField(default=False, null=False)
     has_msgpack_data = models.BooleanField(default=False, null=False)
+    has_columnar_data = models.BooleanField(default=False, null=False)
     enabled = models.BooleanField(default=True, null=False)
     ordering = models.TextField(null=True, default=None)
 
@@ -1451,6 +1555,7 @@ class NodeGridCacheCell(models.Model):
     json_data = JSONField(blank=True, null=True)
     json_text_data = models.TextField(blank=True, null=True)
     msgpack_data = models.BinaryField(null=True)
+    columnar_data = models.BinaryField(null=True)
 
     class Meta:
         db_table = "node_grid_cache_cell"
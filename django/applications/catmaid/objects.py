@@ -5,6 +5,7 @@ import numpy as np
 import networkx as nx
 from typing import Any, Dict, DefaultDict, List, Set
 
+from catmaid.control.morphology import segment_lengths
 from catmaid.models import (ClassInstance, ClassInstanceClassInstance, Relation,
         Review, Treenode, TreenodeConnector, TreenodeClassInstance )
 
@@ -181,11 +182,11 @@ class Skeleton(object):
         """ Compute the sum of the edge lengths which is the total cable length. """
         if self._edge_length_sum != 0.0:
             return self._edge_length_sum
-        sum = 0.0
         node = self.graph.node
-        for ID_from, ID_to in self.graph.edges(data=False):
-            sum += np.linalg.norm(node[ID_to]['location'] - node[ID_from]['location'])
-        self._edge_length_sum = sum
+        edges = self.graph.edges(data=False)
+        self._edge_length_sum = float(segment_lengths(
+                [node[ID_from]['location'] for ID_from, _ in edges],
+                [node[ID_to]['location'] for _, ID_to in edges]).sum())
         return self._edge_length_sum
 
     def _compute_skeleton_edge_deltatime(self):
@@ -360,6 +360,7 @@
           ['none', 'None'],
           ['cable-desc', 'Cable-length descending'],
           ['cable-asc', 'Cable-length ascending'],
+          ['importance', 'Node importance'],
       ],
       help: 'Apply a sorting to the tracing data. This is useful in combination with other filters that limit the number of nodes.',
     }, {
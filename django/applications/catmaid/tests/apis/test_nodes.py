@@ -1,10 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import json
+import os
+import tempfile
+import time
+from unittest.mock import patch
 
-from django.db import connection
+import msgpack
+import numpy as np
 
-from catmaid.models import Connector, Treenode
+from django.db import connection
+from django.test import TestCase
+
+from catmaid.cache import TileCache
+from catmaid.control import columnar, node
+from catmaid.control.edge import (get_intersected_grid_cells,
+        get_intersected_grid_cells_batch)
+from catmaid.control.node import (BasicNodeProvider, EncodedNodeResult,
+        GridCacheCheckpoint, NodeGridCacheRegistry, NodeGridInfo,
+        get_node_list_result, get_overlay_geometry, get_overlay_tile_cells,
+        node_provider_stats, partition_node_result)
+from catmaid.models import Connector, NodeGridCache, Treenode
 from catmaid.state import make_nocheck_state
 
 from .common import CatmaidApiTestCase
@@ -519,3 +535,335 @@ class NodesApiTests(CatmaidApiTestCase):
         self.assertEqual({}, parsed_response[2])
         self.assertEqual(False, parsed_response[3])
         self.assertEqual(expected_rel_response, parsed_response[4])
+
+    def test_overlay_tile_of_dirty_cells_is_not_cached(self):
+        self.fake_authentication()
+        grid = NodeGridCache.objects.create(project_id=self.test_project_id,
+                cell_width=1000, cell_height=1000, cell_depth=40,
+                has_json_data=True)
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO dirty_node_grid_cache_cell (grid_id, x_index, y_index, z_index)
+            VALUES (%(grid_id)s, 0, 0, 0)
+        """, {
+            'grid_id': grid.id,
+        })
+
+        # The cache worker updates and cleans the cell while the tile is
+        # rendered.
+        render_nodes_xy = node.render_nodes_xy
+
+        def clean_while_rendering(*args, **kwargs):
+            cursor.execute("""
+                DELETE FROM dirty_node_grid_cache_cell
+                WHERE grid_id = %(grid_id)s
+            """, {
+                'grid_id': grid.id,
+            })
+            node.invalidate_overlay_tiles(grid.id, [(0, 0, 0)])
+            return render_nodes_xy(*args, **kwargs)
+
+        tile_cache = TileCache(1024 ** 2)
+        node.grid_cache_registry.clear()
+        with patch.object(node, 'overlay_tile_cache', tile_cache), \
+                patch.object(node, 'render_nodes_xy', clean_while_rendering), \
+                patch.object(node.node_cache_listener, 'poll', return_value=True):
+            response = self.client.get(f'/{self.test_project_id}/node/overlay-tile', {
+                'col': 0,
+                'row': 0,
+                'z_index': 0,
+                'grid_id': grid.id,
+            })
+        self.assertStatus(response)
+        self.assertEqual(len(tile_cache.memory), 0)
+        self.assertIsNone(tile_cache.get((grid.id, 0, 0, 0, 0), 'png'))
+
+
+class NodeGridCacheRegistryTests(TestCase):
+
+    def test_find_grid_by_volume_and_type(self):
+        def grid(grid_id, size, data_types, enabled=True):
+            return NodeGridInfo(grid_id, 0, size, size, 40, size * size * 40.0,
+                    1, frozenset(data_types), enabled)
+
+        grids = [
+            grid(1, 10000, ['msgpack']),
+            grid(2, 20000, ['json']),
+            grid(3, 40000, ['msgpack']),
+            grid(4, 20000, ['msgpack'], enabled=False),
+        ]
+        loaded = []
+
+        class TestRegistry(NodeGridCacheRegistry):
+            def load_grids(self, project_id, cursor=None):
+                loaded.append(project_id)
+                return grids
+
+        registry = TestRegistry()
+        volume = 20000 * 20000 * 40.0
+        self.assertEqual(registry.find_grid(1, volume, 'json').id, 2)
+        self.assertEqual(registry.find_grid(1, volume, 'msgpack').id, 1)
+        self.assertEqual(registry.find_grid(1, volume, 'msgpack', grid_id=3).id, 3)
+        self.assertIsNone(registry.find_grid(1, volume, 'json_text'))
+        # Grids are only loaded once per project until the registry is reset.
+        self.assertEqual(loaded, [1])
+        registry.clear(1)
+        registry.find_grid(1, volume)
+        self.assertEqual(loaded, [1, 1])
+
+        # Grids without any data type flag set match every data type
+        grids.append(grid(5, 80000, []))
+        registry.clear(1)
+        self.assertEqual(registry.find_grid(1, volume, 'json_text').id, 5)
+
+
+class GridCellPartitionTests(TestCase):
+
+    def test_partition_node_result(self):
+        # Treenode rows: id, parent_id, x, y, z, confidence, radius,
+        # skeleton_id, edition_time, user_id
+        treenodes = [
+            (1, None, 10.0, 10.0, 0.0, 5, -1, 100, 0, 1),
+            (2, 1, 150.0, 10.0, 0.0, 5, -1, 100, 0, 1),
+            (3, None, 250.0, 10.0, 0.0, 5, -1, 101, 0, 1),
+        ]
+        # Connector rows: id, x, y, z, confidence, edition_time, user_id, links
+        connectors = [
+            (10, 50.0, 50.0, 0.0, 5, 0, 1, [(3, 7, 5, 0, 1000)]),
+        ]
+        labels = {1: ['a'], 3: ['b']}
+        relation_map = {7: 'presynaptic_to'}
+        cells = [(0, 0, 0), (1, 0, 0), (2, 0, 0), (3, 0, 0)]
+
+        result = partition_node_result([treenodes, connectors, labels, False,
+                relation_map], cells, 100, 100, 40)
+
+        self.assertEqual([t[0] for t in result[(0, 0, 0)][0]], [1, 2, 3])
+        self.assertEqual([t[0] for t in result[(1, 0, 0)][0]], [1, 2, 3])
+        self.assertEqual([t[0] for t in result[(2, 0, 0)][0]], [3])
+        self.assertEqual(result[(3, 0, 0)][0], [])
+
+        self.assertEqual([c[0] for c in result[(0, 0, 0)][1]], [10])
+        self.assertEqual([c[0] for c in result[(2, 0, 0)][1]], [10])
+        self.assertEqual(result[(0, 0, 0)][4], relation_map)
+
+        # Labels are only included for nodes in a cell.
+        self.assertEqual(result[(0, 0, 0)][2], {1: ['a']})
+        self.assertEqual(result[(2, 0, 0)][2], {3: ['b']})
+
+        limited = partition_node_result([treenodes, connectors, labels, False,
+                relation_map], cells, 100, 100, 40, node_limit=2)
+        self.assertEqual([t[0] for t in limited[(0, 0, 0)][0]], [1, 2])
+        self.assertTrue(limited[(0, 0, 0)][3])
+        self.assertFalse(limited[(2, 0, 0)][3])
+
+
+class GridCacheCheckpointTests(TestCase):
+
+    def test_checkpoint_parameters(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        cells = [(0, 0, 0), (1, 0, 0)]
+        checkpoint = GridCacheCheckpoint(path, slab_size=2)
+        checkpoint.mark_done(1, cells)
+        checkpoint.close()
+
+        # Only runs with the same slab size resume
+        checkpoint = GridCacheCheckpoint(path, slab_size=2)
+        self.assertTrue(checkpoint.is_done(1, cells))
+        checkpoint.close()
+        checkpoint = GridCacheCheckpoint(path, slab_size=4)
+        self.assertFalse(checkpoint.is_done(1, cells))
+        self.assertFalse(checkpoint.is_done(1, cells[:1]))
+        checkpoint.close()
+        checkpoint = GridCacheCheckpoint(path, chunksize=2)
+        self.assertFalse(checkpoint.is_done(1, cells))
+
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(path))
+
+
+class GridCellIntersectionTests(TestCase):
+
+    def test_batch_matches_single_segments(self):
+        rng = np.random.RandomState(42)
+        p1 = rng.uniform(0, 10000, (500, 3))
+        p2 = p1 + rng.uniform(-2000, 2000, (500, 3))
+        # Include zero-length segments, segments on cell boundaries and
+        # diagonals through cell corners.
+        p1[:10] = p2[:10]
+        p1[10:20, 2], p2[10:20, 2] = 400, 440
+        p1[20], p2[20] = (0, 0, 0), (3000, 3000, 120)
+
+        expected = set()
+        for a, b in zip(p1.tolist(), p2.tolist()):
+            expected.update(map(tuple, get_intersected_grid_cells(a, b,
+                    1000, 1000, 40)))
+        cells = get_intersected_grid_cells_batch(p1, p2, 1000, 1000, 40)
+
+        self.assertEqual(len(cells), len(expected))
+        self.assertEqual(set(map(tuple, cells.tolist())), expected)
+
+    def test_batch_without_segments(self):
+        cells = get_intersected_grid_cells_batch([], [], 1000, 1000, 40)
+        self.assertEqual(cells.shape, (0, 3))
+
+
+class EncodedNodeResultTests(TestCase):
+
+    def test_transcoding(self):
+        def cell(node_id):
+            return [[[node_id, None, 1.0, 2.0, 3.0, 5, -1, 7, 't', 1]], [], {},
+                    False, {'3': 'presynaptic_to'}]
+        cells = [cell(i) for i in range(20)]
+        extra = [[[99, None, 0, 0, 0, 5, -1, 7, 't', 1]], [], {}, False, {}]
+        expected = cells[0] + [cells[1:] + [extra]]
+
+        for encoding, encode in (('json', json.dumps), ('msgpack', msgpack.packb)):
+            result = EncodedNodeResult(encoding, [encode(c) for c in cells], [extra])
+            json_data = ''.join(result.iter_json())
+            msgpack_data = b''.join(result.iter_msgpack())
+            self.assertEqual(json.loads(json_data), expected)
+            self.assertEqual(msgpack.unpackb(msgpack_data, raw=False), expected)
+
+            # Without extra parts, an empty sixth element is added.
+            result = EncodedNodeResult(encoding, [encode(cells[0])])
+            self.assertEqual(json.loads(''.join(result.iter_json())), cells[0] + [[]])
+
+    def test_unexpected_format(self):
+        with self.assertRaises(ValueError):
+            EncodedNodeResult('json', ['[[], [], {}, false, {}, []]'])
+        with self.assertRaises(ValueError):
+            EncodedNodeResult('msgpack', [b'\x96'])
+
+
+class ColumnarFormatTests(TestCase):
+
+    def test_round_trip(self):
+        treenodes = [
+            (1, None, 10.0, 20.0, 40.0, 5, -1.0, 100, 1581000000.5, 3),
+            (2, 1, 15.5, 20.0, 40.0, 3, 12.0, 100, 1581000001.25, 3),
+        ]
+        connectors = [
+            (10, 50.0, 50.0, 40.0, 5, 1581000002.0, 3,
+                ((1, 7, 5, 1581000003.0, 1000), (2, 8, 4, 1581000004.0, 1001))),
+            (11, 60.0, 50.0, 40.0, 5, 1581000005.0, 3, ()),
+        ]
+        labels = {1: ['soma']}
+        relation_map = {7: 'presynaptic_to', 8: 'postsynaptic_to'}
+        extra = [[(3, None, 0.0, 0.0, 0.0, 5, -1.0, 101, 1581000006.0, 3)],
+                [], {}, True, {}]
+        origin = [[100, 1, 'neuron-a']]
+        result = [treenodes, connectors, labels, False, relation_map,
+                [extra, origin]]
+
+        data = columnar.encode_node_result(result)
+        blocks = list(columnar.decode_blocks(data))
+
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(blocks[0][0], treenodes)
+        self.assertEqual([c[0:7] for c in blocks[0][1]],
+                [c[0:7] for c in connectors])
+        self.assertEqual([list(c[7]) for c in blocks[0][1]],
+                [list(c[7]) for c in connectors])
+        self.assertEqual(blocks[0][2], labels)
+        self.assertFalse(blocks[0][3])
+        self.assertEqual(blocks[0][4], relation_map)
+        self.assertEqual(blocks[0][5], [origin])
+        self.assertEqual(blocks[1][0], extra[0])
+        self.assertTrue(blocks[1][3])
+
+    def test_encoded_result(self):
+        def cell(node_id):
+            return [[(node_id, None, 1.0, 2.0, 3.0, 5, -1.0, 7, 0.0, 1)], [],
+                    {}, False, {}]
+        cells = [cell(i) for i in range(3)]
+
+        result = EncodedNodeResult('columnar',
+                [columnar.encode_block(c) for c in cells])
+        self.assertEqual(json.loads(''.join(result.iter_json()))[5][1][0][0][0], 1)
+
+        result = EncodedNodeResult('json', [json.dumps(c) for c in cells])
+        blocks = list(columnar.decode_blocks(b''.join(result.iter_columnar())))
+        self.assertEqual([b[0][0][0] for b in blocks], [0, 1, 2])
+
+    def test_unexpected_format(self):
+        with self.assertRaises(ValueError):
+            list(columnar.decode_blocks(b'JSON' + b'\0' * 12))
+
+
+class OverlayGeometryTests(TestCase):
+
+    def test_projection(self):
+        params = {'left': 0, 'right': 1000, 'top': 0, 'bottom': 1000,
+                'z1': 40, 'z2': 80}
+        treenodes = [
+            (1, None, 100.0, 100.0, 40.0, 5, -1, 1, 0, 1),
+            (2, 1, 200.0, 100.0, 80.0, 5, -1, 1, 0, 1),
+            (3, 2, 300.0, 100.0, 120.0, 5, -1, 1, 0, 1),
+            # The edge to this node crosses the section without a node in it.
+            (4, 3, 400.0, 100.0, 0.0, 5, -1, 1, 0, 1),
+        ]
+        connectors = [
+            (10, 150.0, 150.0, 50.0, 5, 0, 1, [(1, 7, 5, 0, 100), (99, 8, 5, 0, 101)]),
+            (11, 150.0, 150.0, 500.0, 5, 0, 1, [(1, 7, 5, 0, 102)]),
+        ]
+        extra = [[(5, None, 500.0, 500.0, 60.0, 5, -1, 2, 0, 1)], [], {},
+                False, {}]
+        result = [treenodes, connectors, {}, False, {'7': 'presynaptic_to'},
+                [extra, [[1, 2, 'origin']]]]
+
+        geometry = get_overlay_geometry(result, params)
+
+        self.assertEqual(geometry.nodes.tolist(), [[100, 100], [500, 500]])
+        self.assertEqual(geometry.is_root.tolist(), [True, True])
+        self.assertEqual(geometry.edges.tolist(),
+                [[200, 100, 100, 100], [400, 100, 300, 100]])
+        self.assertEqual(len(geometry.virtual_nodes), 1)
+        self.assertAlmostEqual(geometry.virtual_nodes[0][0], 366.6667, places=3)
+        self.assertEqual(geometry.connectors.tolist(), [[150, 150]])
+        # Only links to treenodes in the result are drawn.
+        self.assertEqual(geometry.links.tolist(), [[150, 150, 100, 100]])
+        self.assertEqual(geometry.link_types.tolist(), [0])
+
+    def test_tile_cells(self):
+        self.assertEqual(get_overlay_tile_cells(0, 3, 4), (3, 4, 3, 4))
+        self.assertEqual(get_overlay_tile_cells(2, 1, -1), (4, -4, 7, -1))
+
+
+class NodeProviderHedgingTests(TestCase):
+
+    def get_providers(self, *behaviors):
+        class TestProvider(BasicNodeProvider):
+            def __init__(self, delay, result, **kwargs):
+                super().__init__(**kwargs)
+                self.delay = delay
+                self.result = result
+
+            def get_tuples(self, *args):
+                time.sleep(self.delay)
+                if isinstance(self.result, Exception):
+                    raise self.result
+                return self.result
+
+        return [TestProvider(delay, result, name=f'provider-{i}')
+                for i, (delay, result) in enumerate(behaviors)]
+
+    def test_slow_provider_is_hedged(self):
+        node_provider_stats.clear()
+        providers = self.get_providers((1.0, ('slow', 'json')),
+                (0, ('fast', 'json')))
+        result = get_node_list_result(1, providers, {}, hedge_delay=0.05)
+        self.assertEqual(result, ('fast', 'json'))
+        stats = node_provider_stats.stats()
+        self.assertEqual(stats['provider-1']['hits'], 1)
+
+    def test_failed_and_empty_providers_fall_back(self):
+        providers = self.get_providers((0, ValueError('failed')),
+                (0, (None, None)), (0, ('result', 'json')))
+        result = get_node_list_result(1, providers, {}, hedge_delay=10)
+        self.assertEqual(result, ('result', 'json'))
+
+        providers = self.get_providers((0, ValueError('failed')), (0, (None, None)))
+        with self.assertRaises(ValueError):
+            get_node_list_result(1, providers, {}, hedge_delay=10)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import json
+from urllib.parse import urlencode
+
+import numpy as np
+
+from catmaid.control.pointcloud import (get_pointcloud_points,
+        get_pointcloud_trees, unpack_points)
+from catmaid.models import Point, PointCloud, PointCloudPoint
+
+from .common import CatmaidApiTestCase
+
+
+class PointCloudApiTests(CatmaidApiTestCase):
+
+    def create_pointcloud(self, points):
+        response = self.client.put(f'/{self.test_project_id}/pointclouds/',
+                urlencode({
+                    'name': 'Test point cloud',
+                    'points': json.dumps(points),
+                }), content_type='application/x-www-form-urlencoded')
+        self.assertStatus(response)
+        return json.loads(response.content.decode('utf-8'))['id']
+
+    def test_packed_points(self):
+        self.fake_authentication()
+        points = [[1.0, 2.0, 3.0], [10.0, 10.0, 10.0], [0.5, 0.0, 0.0]]
+        pointcloud_id = self.create_pointcloud(points)
+
+        # Packed points are in point ID order
+        pointcloud = PointCloud.objects.get(pk=pointcloud_id)
+        point_ids = sorted(PointCloudPoint.objects.filter(
+                pointcloud_id=pointcloud_id).values_list('point_id', flat=True))
+        stored_points = [list(Point.objects.filter(pk=point_id).values_list(
+                'location_x', 'location_y', 'location_z')[0])
+                for point_id in point_ids]
+        self.assertEqual(unpack_points(pointcloud.packed_points).tolist(),
+                stored_points)
+        self.assertEqual(stored_points, points)
+
+        response = self.client.get(f'/{self.test_project_id}/pointclouds/'
+                f'{pointcloud_id}/points')
+        self.assertStatus(response)
+        self.assertEqual(unpack_points(response.content).tolist(), points)
+
+        # Point cloud details list point IDs along with the packed locations
+        response = self.client.get(f'/{self.test_project_id}/pointclouds/'
+                f'{pointcloud_id}/', {'with_points': 'true'})
+        self.assertStatus(response)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['points'],
+                [[point_id] + point for point_id, point in zip(point_ids, points)])
+
+        # Point clouds without packed points are read point by point
+        PointCloud.objects.filter(pk=pointcloud_id).update(packed_points=None)
+        loaded_points = get_pointcloud_points(self.test_project_id, [pointcloud_id])
+        self.assertEqual(loaded_points[pointcloud_id].tolist(), points)
+
+    def test_tree_cache(self):
+        self.fake_authentication()
+        pointcloud_id = self.create_pointcloud([[1.0, 2.0, 3.0]])
+
+        tree = get_pointcloud_trees(self.test_project_id, [pointcloud_id])[pointcloud_id]
+        self.assertIs(get_pointcloud_trees(self.test_project_id,
+                [pointcloud_id])[pointcloud_id], tree)
+
+    def test_nearest(self):
+        self.fake_authentication()
+        pointcloud_id = self.create_pointcloud([[1.0, 2.0, 3.0],
+                [10.0, 10.0, 10.0], [0.0, 0.0, 0.0]])
+
+        response = self.client.post(f'/{self.test_project_id}/pointclouds/nearest', {
+            'locations': json.dumps([[0.0, 0.0, 0.5], [3320.0, 5190.0, 0.0]]),
+            'radius': 5,
+            'k': 2,
+            'pointcloud_ids': [pointcloud_id],
+        })
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(parsed_response['nodes'], [])
+        self.assertEqual(len(parsed_response['pointclouds']), 2)
+        self.assertEqual(parsed_response['pointclouds'][0],
+                [0, pointcloud_id, 2, 0.0, 0.0, 0.0, 0.5])
+        self.assertEqual(parsed_response['pointclouds'][1][:6],
+                [0, pointcloud_id, 0, 1.0, 2.0, 3.0])
+        self.assertAlmostEqual(parsed_response['pointclouds'][1][6],
+                np.sqrt(1 + 4 + 2.5 ** 2))
+
+        # Points exactly <radius> away are included
+        response = self.client.post(f'/{self.test_project_id}/pointclouds/nearest', {
+            'locations': json.dumps([[0.0, 0.0, -5.0]]),
+            'radius': 5,
+            'pointcloud_ids': [pointcloud_id],
+        })
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(parsed_response['pointclouds'],
+                [[0, pointcloud_id, 2, 0.0, 0.0, 0.0, 5.0]])
+
+        response = self.client.post(f'/{self.test_project_id}/pointclouds/nearest', {
+            'locations': json.dumps([[0.0, 0.0, 0.5], [3320.0, 5190.0, 0.0]]),
+            'radius': 100,
+            'skeleton_ids': [2364],
+        })
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(parsed_response, {
+            'pointclouds': [],
+            'nodes': [[1, 2364, 2374, 3310.0, 5190.0, 0.0, 10.0]],
+        })
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import json
+from unittest.mock import patch
+
+from django.db import connection
+
+from catmaid.control.nat.nblast import NoValidObjectsError
+from catmaid.control.similarity import (MAX_NBLAST_BLOCK_ATTEMPTS,
+        compute_nblast_block, finalize_nblast, store_sparse_scores)
+from catmaid.models import (NblastConfig, NblastSimilarity,
+        NblastSimilarityBlock, NblastSimilarityScore)
+
+from .common import CatmaidApiTestCase
+
+
+class SimilarityApiTests(CatmaidApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = NblastConfig.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, name='Test config',
+                status='complete', distance_breaks=[0, 1], dot_breaks=[0, 1],
+                scoring=[[1.0]])
+        self.query_ids = [235, 361, 373]
+        self.target_ids = [2364, 2388, 2411, 2433]
+        self.scores = [
+            [0.125, 0.875, 0.5, 0.25],
+            [0.75, 0.25, 0.8125, 0.625],
+            [0.375, 0.375, 0.0, 0.9375],
+        ]
+
+    def create_similarity(self, **kwargs):
+        return NblastSimilarity.objects.create(project_id=self.test_project_id,
+                user_id=self.test_user_id, name='Test similarity',
+                status='complete', config=self.config, query_type_id='skeleton',
+                target_type_id='skeleton', query_objects=self.query_ids,
+                target_objects=self.target_ids, **kwargs)
+
+    def get_scores(self, similarity_id, **params):
+        response = self.client.get(f'/{self.test_project_id}/similarity/'
+                f'queries/{similarity_id}/scores', params)
+        self.assertStatus(response)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_sparse_scores(self):
+        self.fake_authentication()
+        similarity = self.create_similarity(storage='sparse', top_n=2,
+                min_score=0.5, scoring=None)
+        n_stored = store_sparse_scores(similarity.id, self.query_ids,
+                self.target_ids, self.scores, similarity.top_n,
+                similarity.min_score)
+        self.assertEqual(n_stored, 5)
+
+        parsed_response = self.get_scores(similarity.id)
+        self.assertEqual(parsed_response, {
+            'scores': [
+                [235, 2388, 0.875],
+                [235, 2411, 0.5],
+                [361, 2411, 0.8125],
+                [361, 2364, 0.75],
+                [373, 2433, 0.9375],
+            ],
+            'has_more': False,
+        })
+
+        parsed_response = self.get_scores(similarity.id, order='score',
+                limit=1, offset=1)
+        self.assertEqual(parsed_response, {
+            'scores': [[235, 2388, 0.875]],
+            'has_more': True,
+        })
+
+        parsed_response = self.get_scores(similarity.id, target_ids=[2411])
+        self.assertEqual(parsed_response['scores'], [
+            [235, 2411, 0.5],
+            [361, 2411, 0.8125],
+        ])
+
+        # Deleting the similarity removes its scores
+        cursor = connection.cursor()
+        cursor.execute("""
+            DELETE FROM nblast_similarity WHERE id = %(similarity_id)s
+        """, {
+            'similarity_id': similarity.id,
+        })
+        self.assertFalse(NblastSimilarityScore.objects.filter(
+                similarity_id=similarity.id).exists())
+
+    def test_dense_scores(self):
+        self.fake_authentication()
+        similarity = self.create_similarity(scoring=self.scores)
+
+        parsed_response = self.get_scores(similarity.id, query_ids=[373],
+                min_score=0.375, order='score')
+        self.assertEqual(parsed_response, {
+            'scores': [
+                [373, 2433, 0.9375],
+                [373, 2364, 0.375],
+                [373, 2388, 0.375],
+            ],
+            'has_more': False,
+        })
+
+        parsed_response = self.get_scores(similarity.id, order='target',
+                limit=2)
+        self.assertEqual(parsed_response, {
+            'scores': [
+                [361, 2364, 0.75],
+                [373, 2364, 0.375],
+            ],
+            'has_more': True,
+        })
+
+    def create_blocks(self, similarity, status='complete'):
+        # Query object 373 can't be used, its blocks have no scores.
+        blocks = [
+            ([235, 361], [2364, 2388], [[0.125, 0.875], [0.75, 0.25]]),
+            ([235, 361], [2411, 2433], [[0.5, 0.25], [0.8125, 0.625]]),
+            ([373], [2364, 2388], None),
+            ([373], [2411, 2433], None),
+        ]
+        for query_ids, target_ids, scoring in blocks:
+            NblastSimilarityBlock.objects.create(similarity=similarity,
+                    status=status, query_objects=query_ids,
+                    target_objects=target_ids,
+                    valid_query_objects=query_ids if scoring else [],
+                    valid_target_objects=target_ids if scoring else [],
+                    scoring=scoring, computation_time=1.0)
+
+    def test_finalize_dense_blocks(self):
+        similarity = self.create_similarity(status='computing', scoring=None)
+        self.create_blocks(similarity)
+        NblastSimilarityBlock.objects.filter(query_objects=[373],
+                target_objects=[2411, 2433]).update(status='computing')
+
+        # Nothing happens while blocks are incomplete
+        self.assertFalse(finalize_nblast(self.test_user_id, similarity.id))
+        similarity.refresh_from_db()
+        self.assertEqual(similarity.status, 'computing')
+
+        NblastSimilarityBlock.objects.update(status='complete')
+        self.assertTrue(finalize_nblast(self.test_user_id, similarity.id))
+        self.assertFalse(finalize_nblast(self.test_user_id, similarity.id))
+
+        similarity.refresh_from_db()
+        self.assertEqual(similarity.status, 'complete')
+        self.assertEqual(similarity.query_objects, [235, 361])
+        self.assertEqual(similarity.target_objects, self.target_ids)
+        self.assertEqual(similarity.invalid_query_objects, [373])
+        self.assertEqual(similarity.invalid_target_objects, [])
+        self.assertEqual(similarity.scoring, self.scores[:2])
+        self.assertEqual(similarity.computation_time, 4.0)
+        self.assertFalse(NblastSimilarityBlock.objects.filter(
+                similarity=similarity).exists())
+
+    def test_finalize_sparse_blocks(self):
+        similarity = self.create_similarity(status='computing', scoring=None,
+                storage='sparse', top_n=1)
+        self.create_blocks(similarity)
+        for block in NblastSimilarityBlock.objects.filter(similarity=similarity):
+            if block.scoring:
+                store_sparse_scores(similarity.id, block.query_objects,
+                        block.target_objects, block.scoring, similarity.top_n)
+
+        self.assertTrue(finalize_nblast(self.test_user_id, similarity.id))
+        self.fake_authentication()
+        parsed_response = self.get_scores(similarity.id)
+        self.assertEqual(parsed_response['scores'], [
+            [235, 2388, 0.875],
+            [361, 2411, 0.8125],
+        ])
+
+    def test_give_up_on_block(self):
+        similarity = self.create_similarity(status='computing', scoring=None)
+        self.create_blocks(similarity, status='queued')
+        block = NblastSimilarityBlock.objects.filter(
+                similarity=similarity).first()
+        block.n_attempts = MAX_NBLAST_BLOCK_ATTEMPTS
+        block.save()
+
+        with patch('catmaid.control.similarity.nblast') as nblast:
+            compute_nblast_block(self.test_project_id, self.test_user_id,
+                    similarity.id, block.id)
+            nblast.assert_not_called()
+
+        block.refresh_from_db()
+        self.assertEqual(block.status, 'error')
+        self.assertEqual(block.n_attempts, MAX_NBLAST_BLOCK_ATTEMPTS + 1)
+        similarity.refresh_from_db()
+        self.assertEqual(similarity.status, 'error')
+
+    def test_finalize_error_keeps_block_complete(self):
+        similarity = self.create_similarity(status='computing', scoring=None)
+        for status in ('complete', 'queued'):
+            NblastSimilarityBlock.objects.create(similarity=similarity,
+                    status=status, query_objects=[373],
+                    target_objects=self.target_ids, valid_query_objects=[],
+                    valid_target_objects=[])
+        block = NblastSimilarityBlock.objects.get(similarity=similarity,
+                status='queued')
+
+        # The last block has no valid objects either, which makes finalizing
+        # the similarity fail.
+        with patch('catmaid.control.similarity.nblast',
+                side_effect=NoValidObjectsError):
+            compute_nblast_block(self.test_project_id, self.test_user_id,
+                    similarity.id, block.id)
+
+        block.refresh_from_db()
+        self.assertEqual(block.status, 'complete')
+        self.assertEqual(block.n_attempts, 1)
+        similarity.refresh_from_db()
+        self.assertEqual(similarity.status, 'error')
+        self.assertEqual(similarity.detailed_status,
+                "No valid query objects found")
@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
 
-from io import StringIO
+from io import BytesIO, StringIO
 import json
 import platform
 import re
+import tarfile
 from typing import Any, Dict
 from unittest import skipIf
+from unittest.mock import patch
+import zipfile
 
 from django.db import connection, transaction
 from django.shortcuts import get_object_or_404
 from guardian.shortcuts import assign_perm
 
+from catmaid.cache import VersionedCache
+from catmaid.control import skeletonexport
 from catmaid.control.annotation import _annotate_entities
 from catmaid.models import (
     ClassInstance, ClassInstanceClassInstance, Log, Review, TreenodeConnector,
@@ -263,6 +268,44 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(new_skeleton_annotations, set(['A', 'B', 'C']))
 
 
+    def test_connectivity_counts(self):
+        self.fake_authentication()
+
+        response = self.client.get(
+            '/%d/skeletons/connectivity-counts' % (self.test_project_id,),
+            {'skeleton_ids': [235, 373]})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = {
+            'connectivity': {'235': {'1023': 3}, '373': {'1024': 3}},
+            'relations': {'1023': 'presynaptic_to', '1024': 'postsynaptic_to'}}
+        self.assertEqual(expected_result, parsed_response)
+
+        response = self.client.get(
+            '/%d/skeletons/connectivity-counts' % (self.test_project_id,),
+            {'skeleton_ids': [235, 373],
+             'target_relations': ['presynaptic_to']})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = {
+            'connectivity': {'373': {'1024': 2}},
+            'relations': {'1024': 'postsynaptic_to'}}
+        self.assertEqual(expected_result, parsed_response)
+
+        # Without partner links, all links of a skeleton are counted
+        response = self.client.get(
+            '/%d/skeletons/connectivity-counts' % (self.test_project_id,),
+            {'skeleton_ids': [235, 373],
+             'source_relations': ['presynaptic_to'],
+             'count_partner_links': 'false'})
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_result = {
+            'connectivity': {'235': {'1023': 3}},
+            'relations': {'1023': 'presynaptic_to'}}
+        self.assertEqual(expected_result, parsed_response)
+
+
     def test_skeleton_connectivity(self):
         self.fake_authentication()
 
@@ -488,6 +531,107 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_measure_skeletons(self):
+        self.fake_authentication()
+        response = self.client.post(
+                '/%d/skeletons/measure' % self.test_project_id, {
+                    'skeleton_ids[0]': 235,
+                    'skeleton_ids[1]': 373,
+                })
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(len(parsed_response), 2)
+        measurements = {row[0]: row for row in parsed_response}
+
+        skid, raw_cable, smooth_cable, n_pre, n_post, n_nodes, n_branch, \
+                n_ends, principal_branch_cable = measurements[235]
+        self.assertEqual(raw_cable, 11243)
+        self.assertEqual(n_pre, 0)
+        self.assertEqual(n_post, 3)
+        self.assertEqual(n_nodes, 28)
+        self.assertEqual(n_branch, 2)
+        self.assertEqual(n_ends, 4)
+        # Smoothing only shortens the cable
+        self.assertLessEqual(smooth_cable, raw_cable)
+        self.assertLess(principal_branch_cable, smooth_cable)
+        self.assertGreater(principal_branch_cable, 0)
+
+        self.assertEqual(measurements[373][5], 5)
+
+
+    def test_neuroglancer_skeleton(self):
+        import numpy as np
+
+        self.fake_authentication()
+        response = self.client.get('/%d/skeletons/neuroglancer/info' % self.test_project_id)
+        self.assertStatus(response)
+        info = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(info['@type'], 'neuroglancer_skeletons')
+
+        for url in ('/%d/skeletons/235/neuroglancer', '/%d/skeletons/neuroglancer/235'):
+            response = self.client.get(url % self.test_project_id)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/octet-stream')
+            data = response.content
+            n_vertices, n_edges = np.frombuffer(data, '<u4', 2)
+            self.assertEqual(n_vertices, 28)
+            self.assertEqual(n_edges, 27)
+            self.assertEqual(len(data), 8 + 12 * 28 + 8 * 27)
+            edges = np.frombuffer(data, '<u4', 2 * 27, 8 + 12 * 28).reshape(-1, 2)
+            # Every vertex except the root is the child of exactly one edge
+            self.assertEqual(len(set(edges[:, 0].tolist())), 27)
+            self.assertTrue((edges < 28).all())
+
+        response = self.client.get('/%d/skeletons/neuroglancer/99999' % self.test_project_id)
+        self.assertEqual(response.status_code, 404)
+
+
+    def test_neuroglancer_skeleton_source(self):
+        import os
+        import tempfile
+        import numpy as np
+        from catmaid.control import neuroglancer
+
+        skeleton_ids = [235, 361, 373]
+        expected = neuroglancer.get_encoded_skeletons(self.test_project_id, skeleton_ids)
+        self.assertCountEqual(expected.keys(), skeleton_ids)
+
+        with tempfile.TemporaryDirectory() as path:
+            n_written = neuroglancer.write_skeletons(self.test_project_id,
+                    skeleton_ids, path, batch_size=2)
+            self.assertEqual(n_written, 3)
+            with open(os.path.join(path, 'info')) as f:
+                self.assertNotIn('sharding', json.load(f))
+            for skeleton_id in skeleton_ids:
+                with open(os.path.join(path, str(skeleton_id)), 'rb') as f:
+                    self.assertEqual(f.read(), expected[skeleton_id])
+
+        # With one bit each, skeleton 235 is in shard 1 and 361 and 373 in
+        # shard 0. Read them back like neuroglancer does.
+        sharding = neuroglancer.get_sharding(minishard_bits=1, shard_bits=1)
+        with tempfile.TemporaryDirectory() as path:
+            neuroglancer.write_skeletons(self.test_project_id, skeleton_ids,
+                    path, sharding)
+            with open(os.path.join(path, 'info')) as f:
+                self.assertEqual(json.load(f)['sharding'], sharding)
+            self.assertCountEqual(os.listdir(path), ['info', '0.shard', '1.shard'])
+
+            for skeleton_id in skeleton_ids:
+                shard = (skeleton_id >> 1) & 1
+                minishard = skeleton_id & 1
+                with open(os.path.join(path, '%d.shard' % shard), 'rb') as f:
+                    data = f.read()
+                shard_index = np.frombuffer(data, '<u8', 4).reshape(2, 2)
+                data = data[shard_index.nbytes:]
+                start, end = shard_index[minishard]
+                minishard_index = np.frombuffer(data[start:end], '<u8').reshape(3, -1)
+                chunk_ids = np.cumsum(minishard_index[0]).tolist()
+                chunk_ends = np.cumsum(minishard_index[1] + minishard_index[2])
+                i = chunk_ids.index(skeleton_id)
+                chunk = data[chunk_ends[i] - minishard_index[2, i]:chunk_ends[i]]
+                self.assertEqual(chunk, expected[skeleton_id])
+
+
     def test_skeleton_ancestry(self):
         skeleton_id = 361
 
@@ -541,6 +685,62 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_skeleton_connectivity_matrix_export(self):
+        from catmaid.control.connectivityexport import arrow_available
+        self.fake_authentication()
+
+        skeleton_ids = [235, 361, 373]
+        response = self.client.post(
+                '/%d/skeletons/connectivity_matrix/csv' % (self.test_project_id,), {
+                    'rows': skeleton_ids,
+                    'columns': skeleton_ids,
+                    'names[0][0]': 235,
+                    'names[0][1]': 'neuron 235'})
+        self.assertStatus(response)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        expected_result = '"","neuron 235",361,373\r\n' + \
+                '"neuron 235",0,1,2\r\n' + \
+                '361,0,0,0\r\n' + \
+                '373,0,0,0\r\n'
+        self.assertEqual(expected_result, content)
+
+        # Rows and columns with the most synapses come first, ties keep their
+        # order.
+        skeleton_ids = [2411, 2388, 235, 2364, 361, 373]
+        response = self.client.post(
+                '/%d/skeletons/connectivity_matrix/export' % (self.test_project_id,), {
+                    'rows': skeleton_ids,
+                    'columns': skeleton_ids,
+                    'format': 'coo',
+                    'order': 'count'})
+        self.assertStatus(response)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        expected_result = 'row,column,count\r\n' + \
+                '235,373,2\r\n' + \
+                '235,361,1\r\n' + \
+                '2411,2364,1\r\n' + \
+                '2388,2364,1\r\n'
+        self.assertEqual(expected_result, content)
+
+        response = self.client.post(
+                '/%d/skeletons/connectivity_matrix/export' % (self.test_project_id,), {
+                    'rows': skeleton_ids,
+                    'columns': skeleton_ids,
+                    'format': 'arrow',
+                    'order': 'id'})
+        if not arrow_available:
+            self.assertStatus(response, 400)
+            return
+        import pyarrow
+        self.assertStatus(response)
+        table = pyarrow.ipc.open_stream(b''.join(response.streaming_content)).read_all()
+        self.assertEqual({
+            'row': [235, 235, 2388, 2411],
+            'column': [361, 373, 2364, 2364],
+            'count': [1, 2, 1, 1],
+        }, table.to_pydict())
+
+
     def test_skeleton_connectivity_matrix_with_locations(self):
         self.fake_authentication()
 
@@ -1238,6 +1438,73 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.compare_eswc_data(response.content.decode('utf-8'), eswc_output_for_skeleton_235)
 
 
+    def test_skeleton_archive(self):
+        self.fake_authentication()
+        url = '/%d/skeletons/export/archive' % (self.test_project_id,)
+        skeleton_ids = [235, 373, 361]
+
+        def get_single_export(skeleton_id, file_format, linearize_ids=False):
+            response = self.client.get('/%d/skeleton/%d/%s' % (
+                    self.test_project_id, skeleton_id, file_format),
+                    {'linearize_ids': linearize_ids})
+            self.assertStatus(response)
+            return response.content
+
+        response = self.client.post(url, {'skeleton_ids': skeleton_ids})
+        self.assertStatus(response)
+        self.assertEqual('application/zip', response['Content-Type'])
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(['235.swc', '373.swc', '361.swc'], archive.namelist())
+            for skeleton_id in skeleton_ids:
+                self.assertEqual(get_single_export(skeleton_id, 'swc'),
+                        archive.read(f'{skeleton_id}.swc'))
+
+        for archive_format in ('tar', 'tar.gz'):
+            response = self.client.post(url, {
+                'skeleton_ids': skeleton_ids,
+                'format': 'eswc',
+                'archive': archive_format,
+                'linearize_ids': True,
+            })
+            self.assertStatus(response)
+            content = BytesIO(b''.join(response.streaming_content))
+            with tarfile.open(fileobj=content) as archive:
+                self.assertEqual(['235.eswc', '373.eswc', '361.eswc'],
+                        archive.getnames())
+                for skeleton_id in skeleton_ids:
+                    self.assertEqual(get_single_export(skeleton_id, 'eswc', True),
+                            archive.extractfile(f'{skeleton_id}.eswc').read())
+
+        response = self.client.post(url, {
+            'skeleton_ids': [235],
+            'format': 'json',
+        })
+        self.assertStatus(response)
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as archive:
+            nodes = json.loads(archive.read('235.json').decode('utf-8'))
+        expected_nodes = Treenode.objects.filter(skeleton_id=235).order_by('id') \
+                .values_list('id', 'parent_id', 'user_id', 'location_x',
+                'location_y', 'location_z', 'radius', 'confidence')
+        self.assertEqual([list(n) for n in expected_nodes], nodes)
+
+        # Skeletons can be selected with an annotation query
+        _annotate_entities(self.test_project_id, [233, 362],
+                {'archive test': {'user_id': self.test_user_id}})
+        response = self.client.post(url, {
+            'annotated_with': 'archive test',
+            'annotation_reference': 'name',
+        })
+        self.assertStatus(response)
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(['235.swc', '361.swc'], sorted(archive.namelist()))
+
+        response = self.client.post(url, {'skeleton_ids': [235, 9999]})
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.post(url, {'skeleton_ids': [235], 'format': 'obj'})
+        self.assertEqual(response.status_code, 400)
+
+
     def assert_skeletons_by_node_labels(self, label_ids, expected_response):
         self.fake_authentication()
         url = f'/{self.test_project_id}/skeletons/node-labels'
@@ -1763,3 +2030,147 @@ class SkeletonsApiTransactionTests(CatmaidApiTransactionTestCase):
         # skeleton.
         n_skeleton_nodes = Treenode.objects.filter(skeleton_id=parsed_response['skeleton_id']).count()
         self.assertEqual(n_skeleton_nodes, n_orig_skeleton_nodes)
+
+    def test_import_skeletons_bulk(self):
+        self.fake_authentication()
+
+        orig_skeleton_id = 235
+        response = self.client.get('/%d/skeleton/%d/swc' % (self.test_project_id, orig_skeleton_id))
+        self.assertStatus(response)
+        orig_swc_string = response.content.decode('utf-8')
+        orig_nodes = Treenode.objects.filter(skeleton_id=orig_skeleton_id)
+        orig_locations = sorted((tn.location_x, tn.location_y, tn.location_z)
+                for tn in orig_nodes)
+
+        # Try inserting without permission and expect fail
+        response = self.client.post('/%d/skeletons/import/bulk' % (self.test_project_id,),
+                                    {'file.swc': ''})
+        self.assertTrue("PermissionError" in response.content.decode('utf-8'))
+
+        archive_file = BytesIO()
+        with zipfile.ZipFile(archive_file, 'w') as archive:
+            archive.writestr('1002.swc', orig_swc_string)
+            archive.writestr('neurons/other.swc', orig_swc_string)
+            archive.writestr('README.txt', 'Not a skeleton')
+        archive_file.seek(0)
+
+        assign_perm('can_import', self.test_user, self.test_project)
+        response = self.client.post('/%d/skeletons/import/bulk' % (self.test_project_id,), {
+            '1001.swc': StringIO(orig_swc_string),
+            'neurons.zip': archive_file,
+            'annotations': ['bulk import', 'test'],
+            'source_url': 'https://example.com/catmaid/',
+            'source_project_id': 1,
+        })
+
+        transaction.commit()
+
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        imported = parsed_response['skeletons']
+        self.assertEqual(['1001', '1002', 'other'], [s['name'] for s in imported])
+
+        for skeleton in imported:
+            self.assertEqual(orig_nodes.count(), skeleton['n_nodes'])
+            neuron = ClassInstance.objects.get(id=skeleton['neuron_id'],
+                    class_column__class_name='neuron')
+            self.assertEqual(skeleton['name'], neuron.name)
+            self.assertTrue(ClassInstanceClassInstance.objects.filter(
+                    class_instance_a_id=skeleton['skeleton_id'],
+                    class_instance_b_id=neuron.id,
+                    relation__relation_name='model_of').exists())
+            annotations = ClassInstanceClassInstance.objects.filter(
+                    class_instance_a_id=neuron.id,
+                    relation__relation_name='annotated_with') \
+                    .values_list('class_instance_b__name', flat=True)
+            self.assertEqual(['bulk import', 'test'], sorted(annotations))
+
+            new_nodes = Treenode.objects.filter(skeleton_id=skeleton['skeleton_id'])
+            self.assertEqual(orig_locations, sorted((tn.location_x,
+                    tn.location_y, tn.location_z) for tn in new_nodes))
+            self.assertEqual(1, new_nodes.filter(parent_id=None).count())
+            self.assertEqual(0, new_nodes.exclude(parent_id=None).exclude(
+                    parent__skeleton_id=skeleton['skeleton_id']).count())
+
+            # Edges and summary are maintained by the treenode triggers. All
+            # nodes are recorded as imported.
+            cursor = connection.cursor()
+            cursor.execute("""
+                SELECT num_nodes, num_imported_nodes
+                FROM catmaid_skeleton_summary
+                WHERE skeleton_id = %s
+            """, (skeleton['skeleton_id'],))
+            self.assertEqual([(skeleton['n_nodes'], skeleton['n_nodes'])],
+                    cursor.fetchall())
+            cursor.execute("""
+                SELECT COUNT(*) FROM treenode_edge WHERE id IN (
+                    SELECT id FROM treenode WHERE skeleton_id = %s)
+            """, (skeleton['skeleton_id'],))
+            self.assertEqual(skeleton['n_nodes'], cursor.fetchone()[0])
+
+        # Only skeletons with a numeric file name have a known origin.
+        cursor.execute("""
+            SELECT so.skeleton_id, so.source_id, ds.url, ds.source_project_id
+            FROM skeleton_origin so
+            JOIN data_source ds ON ds.id = so.data_source_id
+            ORDER BY so.source_id
+        """)
+        self.assertEqual([
+            (imported[0]['skeleton_id'], 1001, 'https://example.com/catmaid/', 1),
+            (imported[1]['skeleton_id'], 1002, 'https://example.com/catmaid/', 1),
+        ], cursor.fetchall())
+
+        # A malformed file fails the whole import.
+        n_skeletons = ClassInstance.objects.filter(
+                class_column__class_name='skeleton').count()
+        response = self.client.post('/%d/skeletons/import/bulk' % (self.test_project_id,), {
+            'good.swc': StringIO(orig_swc_string),
+            'bad.swc': StringIO('1 0 1.0 2.0 3.0 -1\n'),
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(n_skeletons, ClassInstance.objects.filter(
+                class_column__class_name='skeleton').count())
+
+
+class SkeletonPayloadCacheTests(CatmaidApiTransactionTestCase):
+    # Version stamps are based on transaction IDs, which requires edits to be
+    # committed.
+
+    def test_cached_payloads_follow_skeleton_versions(self):
+        options = {
+            'with_connectors': True,
+            'with_tags': True,
+            'with_reviews': True,
+            'with_annotations': True,
+        }
+        versions = skeletonexport.get_skeleton_version_stamps([235, 373],
+                **options)
+        self.assertEqual(set(versions), {235, 373})
+        self.assertNotEqual(versions[235], versions[373])
+
+        expected = skeletonexport.get_compact_skeleton_payloads(3, [235, 373],
+                'json', **options)
+
+        cache = VersionedCache(10 ** 6)
+        with patch.object(skeletonexport, 'skeleton_payload_cache', cache):
+            payloads = skeletonexport.get_compact_skeleton_payloads(3,
+                    [235, 373], 'json', **options)
+            self.assertEqual(payloads, expected)
+            self.assertEqual(cache.stats()['misses'], 2)
+            payloads = skeletonexport.get_compact_skeleton_payloads(3,
+                    [235, 373], 'json', **options)
+            self.assertEqual(payloads, expected)
+            self.assertEqual(cache.stats()['hits'], 2)
+
+            # Edits change the version of the skeleton, but not of others.
+            Treenode.objects.filter(skeleton_id=235).update(radius=42)
+            new_versions = skeletonexport.get_skeleton_version_stamps(
+                    [235, 373], **options)
+            self.assertNotEqual(new_versions[235], versions[235])
+            self.assertEqual(new_versions[373], versions[373])
+
+            payloads = skeletonexport.get_compact_skeleton_payloads(3,
+                    [235, 373], 'json', **options)
+            self.assertEqual(payloads[373], expected[373])
+            self.assertNotEqual(payloads[235], expected[235])
+            self.assertIn(b'42.0', payloads[235])
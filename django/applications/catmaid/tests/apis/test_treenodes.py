@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+from collections import Counter
 import json
 
 from io import StringIO
@@ -8,11 +9,14 @@ from operator import itemgetter
 from django.shortcuts import get_object_or_404
 from guardian.shortcuts import assign_perm
 
+from catmaid.control import importance
 from catmaid.control.authentication import (can_edit_all_or_fail,
     can_edit_or_fail, PermissionError)
 from catmaid.control.common import get_relation_to_id_map, get_class_to_id_map
+from catmaid.control.importance import find_treenodes_at, update_node_importance
 from catmaid.models import ClassInstance, ClassInstanceClassInstance, Log
 from catmaid.models import Treenode, TreenodeClassInstance, TreenodeConnector
+from catmaid.models import TreenodeImportance
 from catmaid.models import User, Group
 from catmaid.state import make_nocheck_state
 
@@ -1333,3 +1337,41 @@ class TreenodesApiTests(CatmaidApiTestCase):
         can_edit_all_or_fail(third_user, treenode_ids, 'treenode')
         for tn in parsed_response:
             can_edit_or_fail(third_user, tn[0], 'treenode')
+
+
+class NodeImportanceTests(CatmaidApiTestCase):
+
+    def get_expected_scores(self, project_id):
+        nodes = list(Treenode.objects.filter(project_id=project_id)
+                .values_list('id', 'parent_id'))
+        n_children = Counter(parent_id for _, parent_id in nodes if parent_id)
+        expected = {}
+        for node_id, parent_id in nodes:
+            if parent_id is None:
+                expected[node_id] = importance.ROOT_SCORE
+            elif n_children[node_id] == 0:
+                expected[node_id] = importance.LEAF_SCORE
+            elif n_children[node_id] > 1:
+                expected[node_id] = importance.BRANCH_SCORE
+            else:
+                expected[node_id] = importance.CONTINUATION_SCORE
+        return expected
+
+    def test_full_and_incremental_update(self):
+        expected = self.get_expected_scores(self.test_project_id)
+        n_updated = update_node_importance(self.test_project_id)
+        self.assertEqual(n_updated, len(expected))
+        scores = dict(TreenodeImportance.objects.filter(
+                project_id=self.test_project_id).values_list('treenode_id', 'score'))
+        self.assertEqual(scores, expected)
+
+        # Nodes near a changed location and their neighbors are updated.
+        TreenodeImportance.objects.all().update(score=-1)
+        node = Treenode.objects.get(pk=7)
+        treenode_ids = find_treenodes_at(self.test_project_id,
+                [(node.location_x, node.location_y, node.location_z)])
+        self.assertIn(7, treenode_ids)
+        for child in Treenode.objects.filter(parent_id=7):
+            self.assertIn(child.id, treenode_ids)
+        update_node_importance(self.test_project_id, treenode_ids)
+        self.assertEqual(TreenodeImportance.objects.get(pk=7).score, expected[7])
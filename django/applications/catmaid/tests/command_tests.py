@@ -7,10 +7,13 @@ import mock
 from rest_framework.authtoken.models import Token
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import connection
 from django.test import TestCase
 from django.test.client import Client
 from guardian.shortcuts import assign_perm
-from catmaid.models import Class, ClassInstance, Project, User, Treenode
+from catmaid.management.commands.catmaid_cache_update_worker import GridWorker
+from catmaid.models import (Class, ClassInstance, NodeGridCache, Project, User,
+        Treenode)
 
 
 class PruneSkeletonsTest(TestCase):
@@ -143,3 +146,63 @@ class GetTokenTest(TestCase):
         self.user.save()
         with self.assertRaisesMessage(CommandError, 'account is disabled'):
             self.attempt_command(self.username, '--password', self.password)
+
+
+class GridWorkerTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def test_dirty_cells_are_grouped_in_blocks(self):
+        worker = GridWorker(block_size=2)
+        blocks = worker.get_blocks([
+            (1, 1, 0, 0, 5),
+            (2, 1, 1, 1, 5),
+            (3, 1, 2, 0, 5),
+            (4, 1, 0, 0, 6),
+            (5, 2, 0, 0, 5),
+        ])
+        self.assertEqual(len(blocks), 4)
+        self.assertEqual(blocks[(1, 5, 0, 0)], [(1, (0, 0, 5)), (2, (1, 1, 5))])
+        self.assertEqual(blocks[(1, 5, 1, 0)], [(3, (2, 0, 5))])
+        self.assertEqual(blocks[(1, 6, 0, 0)], [(4, (0, 0, 6))])
+        self.assertEqual(blocks[(2, 5, 0, 0)], [(5, (0, 0, 5))])
+
+    def test_failed_cells_stay_dirty(self):
+        grid = NodeGridCache.objects.create(project_id=3, cell_width=1000,
+                cell_height=1000, cell_depth=40, has_json_data=True)
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO dirty_node_grid_cache_cell (grid_id, x_index, y_index, z_index)
+            SELECT %(grid_id)s, x, 0, 0
+            FROM generate_series(0, 9) x
+        """, {
+            'grid_id': grid.id,
+        })
+
+        def count_dirty_cells():
+            cursor.execute("""
+                SELECT COUNT(*) FROM dirty_node_grid_cache_cell
+                WHERE grid_id = %(grid_id)s
+            """, {
+                'grid_id': grid.id,
+            })
+            return cursor.fetchone()[0]
+
+        # Cells that fail every time don't keep the worker busy
+        worker = GridWorker(batch_size=4, block_size=2)
+        failed_ids:set = set()
+        with mock.patch('catmaid.management.commands.catmaid_cache_update_worker.update_grid_cells',
+                side_effect=ValueError('Test failure')):
+            n_batches = 0
+            while worker.update(cursor, failed_ids):
+                n_batches += 1
+        self.assertEqual(n_batches, 3)
+        self.assertEqual(len(failed_ids), 10)
+        self.assertEqual(worker.cells_failed, 10)
+        self.assertEqual(count_dirty_cells(), 10)
+
+        with mock.patch('catmaid.management.commands.catmaid_cache_update_worker.update_grid_cells',
+                return_value=(2, 0)):
+            while worker.update(cursor, set()):
+                pass
+        self.assertEqual(count_dirty_cells(), 0)
+        self.assertEqual(worker.cells_updated, 10)
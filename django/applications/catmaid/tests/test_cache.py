@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from django.test import TestCase
+
+from catmaid.cache import LRUCache, TileCache, VersionedCache
+
+
+class LRUCacheTests(TestCase):
+
+    def test_size_bounded_eviction(self):
+        cache = LRUCache(3 * (LRUCache.entry_overhead + 10))
+        cache.set('a', b'a' * 10, 10)
+        cache.set('b', b'b' * 10, 10)
+        cache.set('c', b'c' * 10, 10)
+        self.assertEqual(len(cache), 3)
+
+        # Mark "a" as recently used, so that "b" will be evicted next.
+        self.assertEqual(cache.get('a'), b'a' * 10)
+        cache.set('d', b'd' * 10, 10)
+
+        self.assertEqual(len(cache), 3)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertIn('d', cache)
+
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['bytes'], 3 * (LRUCache.entry_overhead + 10))
+
+    def test_oversized_entries_are_rejected(self):
+        cache = LRUCache(50)
+        self.assertFalse(cache.set('a', 'value', 100))
+        self.assertEqual(len(cache), 0)
+
+    def test_tag_invalidation(self):
+        cache = LRUCache(10000)
+        cache.set((1, 0, 0, 0, 1, 1), 'lod-1', 5, tag=(1, 0, 0, 0))
+        cache.set((1, 0, 0, 0, 1, 3), 'lod-3', 5, tag=(1, 0, 0, 0))
+        cache.set((1, 1, 0, 0, 1, 1), 'other', 5, tag=(1, 1, 0, 0))
+
+        cache.invalidate_tag((1, 0, 0, 0))
+
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get((1, 0, 0, 0, 1, 1)))
+        self.assertEqual(cache.get((1, 1, 0, 0, 1, 1)), 'other')
+        self.assertEqual(cache.stats()['invalidations'], 2)
+
+    def test_cached_none_differs_from_miss(self):
+        cache = LRUCache(10000)
+        missing = object()
+        cache.set('empty', None, 0)
+        self.assertIsNone(cache.get('empty', missing))
+        self.assertIs(cache.get('unknown', missing), missing)
+
+
+class TileCacheTests(TestCase):
+
+    def test_memory_and_disk_tiers(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = TileCache(10000, path)
+            tag = (1, 0, 5, 2, 3)
+            cache.set(tag, 'png', b'tile')
+            self.assertTrue(os.path.exists(os.path.join(path, '1', '0', '5', '2', '3.png')))
+            self.assertEqual(cache.get(tag, 'png'), b'tile')
+            self.assertIsNone(cache.get(tag, 'gif'))
+
+            # Other processes only see the disk tier.
+            other = TileCache(10000, path)
+            self.assertEqual(other.get(tag, 'png'), b'tile')
+            self.assertEqual(other.stats()['disk_hits'], 1)
+
+            # Invalidating without deleting files only affects memory.
+            cache.invalidate_tag(tag)
+            self.assertEqual(len(cache.memory), 0)
+            self.assertEqual(cache.get(tag, 'png'), b'tile')
+
+            cache.invalidate_tag(tag, delete_files=True)
+            self.assertIsNone(cache.get(tag, 'png'))
+
+            cache.set(tag, 'png', b'tile')
+            cache.clear((1,), delete_files=True)
+            self.assertIsNone(cache.get(tag, 'png'))
+
+    def test_invalidation_while_rendering(self):
+        cache = TileCache(10000)
+        tag = (1, 0, 5, 2, 3)
+        generation = cache.generation(tag)
+        cache.invalidate_tag(tag)
+        self.assertFalse(cache.set(tag, 'png', b'stale', generation=generation))
+        self.assertIsNone(cache.get(tag, 'png'))
+
+        generation = cache.generation(tag)
+        cache.clear()
+        self.assertFalse(cache.set(tag, 'png', b'stale', generation=generation))
+
+        generation = cache.generation(tag)
+        self.assertTrue(cache.set(tag, 'png', b'tile', generation=generation))
+        self.assertEqual(cache.get(tag, 'png'), b'tile')
+
+
+class VersionedCacheTests(TestCase):
+
+    def test_versions_and_tiers(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = VersionedCache(10000, path)
+            key = ('compact-skeleton', 3, 235, 'options.json')
+            cache.set(key, 'v1', b'payload')
+            self.assertTrue(os.path.exists(os.path.join(path,
+                    'compact-skeleton', '3', '235', 'options.json')))
+            self.assertEqual(cache.get(key, 'v1'), b'payload')
+            self.assertIsNone(cache.get(key, 'v2'))
+
+            # Other processes only see the disk tier, which checks versions too.
+            other = VersionedCache(10000, path)
+            self.assertEqual(other.get(key, 'v1'), b'payload')
+            self.assertIsNone(other.get(key, 'v2'))
+            stats = other.stats()
+            self.assertEqual(stats['disk_hits'], 1)
+            self.assertEqual(stats['hits'], 1)
+            self.assertEqual(stats['misses'], 1)
+            self.assertEqual(stats['stale'], 2)
+            self.assertEqual(stats['bytes_served'], len(b'payload'))
+
+            cache.set(key, 'v2', b'new payload')
+            self.assertEqual(other.get(key, 'v2'), b'new payload')
+
+            cache.invalidate_tag(key[:-1], delete_files=True)
+            self.assertIsNone(cache.get(key, 'v2'))
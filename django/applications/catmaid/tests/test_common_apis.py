@@ -536,6 +536,55 @@ class ViewPageTests(TestCase, AssertStatusMixin):
         self.assertEqual(parsed_response[3], expected_response[3])
         self.assertEqual(parsed_response[4], expected_response[4])
 
+    def test_export_compact_skeleton_many(self):
+        self.fake_authentication()
+
+        skeleton_ids = [235, 373, 361]
+        params = {
+            'with_connectors': True,
+            'with_tags': True,
+            'with_reviews': True,
+            'with_annotations': True,
+        }
+
+        def normalize(skeletons):
+            # Rows of a data kind are not returned in a particular order
+            return {skeleton_id: [sorted(s[0]), sorted(s[1]),
+                    {k: sorted(v) for k, v in s[2].items()}, sorted(s[3]),
+                    sorted(s[4])] for skeleton_id, s in skeletons.items()}
+
+        expected_skeletons = {}
+        for skeleton_id in skeleton_ids:
+            response = self.client.get('/%d/skeletons/%d/compact-detail' % (
+                    self.test_project_id, skeleton_id), params)
+            self.assertStatus(response)
+            expected_skeletons[str(skeleton_id)] = json.loads(
+                    response.content.decode('utf-8'))
+
+        url = '/%d/skeletons/compact-detail' % self.test_project_id
+        many_params = dict(params, skeleton_ids=skeleton_ids)
+        response = self.client.post(url, many_params)
+        self.assertStatus(response)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(list(parsed_response), ['skeletons'])
+        self.assertEqual(normalize(parsed_response['skeletons']),
+                normalize(expected_skeletons))
+
+        # Requests with more skeletons than the batch size are streamed
+        with self.settings(SKELETON_DETAIL_BATCH_SIZE=2):
+            response = self.client.post(url, many_params)
+            self.assertStatus(response)
+            self.assertTrue(response.streaming)
+            parsed_response = json.loads(b''.join(
+                    response.streaming_content).decode('utf-8'))
+            self.assertEqual(list(parsed_response), ['skeletons'])
+            self.assertEqual(normalize(parsed_response['skeletons']),
+                    normalize(expected_skeletons))
+
+            response = self.client.post(url, dict(many_params,
+                    skeleton_ids=skeleton_ids + [99999]))
+            self.assertEqual(response.status_code, 404)
+
     def test_export_compact_arbor(self):
         self.fake_authentication()
 
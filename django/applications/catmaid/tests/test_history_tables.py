@@ -276,6 +276,10 @@ class HistoryTableTests(TransactionTestCase):
         'catmaid_transaction_info',
         'catmaid_stats_summary',
         'catmaid_skeleton_summary',
+        'catmaid_skeleton_connectivity',
+        'nblast_similarity_score',
+        'nblast_similarity_block',
+        'treenode_importance',
 
         # Regular unversioned non-CATMAID tables
         'djkombu_queue',
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+
+from django.db import connection
+from django.test import override_settings
+
+from catmaid.tests.apis.common import CatmaidApiTestCase
+
+
+class NblastDotpropsCacheTests(CatmaidApiTestCase):
+    """Test the per-object dotprops cache of the NumPy NBLAST backend.
+    """
+
+    def setUp(self):
+        super().setUp()
+        cursor = connection.cursor()
+        cursor.execute("SELECT refresh_skeleton_summary_table()")
+
+    def test_incremental_update(self):
+        import numpy as np
+        from catmaid.control.nat.dotprops_cache import DotpropsCache, update_cache
+        from catmaid.control.nat.nblast import get_dotprops
+
+        # Skeleton 2433 has only a single node and can't be cached.
+        skeleton_ids = [235, 361, 2433]
+        params = {'k': 3, 'resample_step': 1.0, 'n_branches': None}
+
+        with tempfile.TemporaryDirectory() as path, \
+                override_settings(MEDIA_ROOT=path):
+            result = update_cache(self.test_project_id, 'skeleton',
+                    skeleton_ids, **params)
+            self.assertEqual(result, {'current': 0, 'updated': 2, 'failed': 1,
+                    'removed': 0})
+
+            cache = DotpropsCache(self.test_project_id, 'skeleton', **params)
+            self.assertEqual(cache.cached_object_ids(), [235, 361])
+            self.assertTrue(cache.path.startswith(path))
+
+            cached_ids, cached_dps = get_dotprops(self.test_project_id,
+                    skeleton_ids, use_cache=True, **params)
+            ids, dps = get_dotprops(self.test_project_id, skeleton_ids, **params)
+            self.assertEqual(cached_ids, [235, 361])
+            self.assertEqual(ids, cached_ids)
+            for a, b in zip(dps, cached_dps):
+                self.assertTrue(np.allclose(a.points, b.points))
+                self.assertTrue(np.allclose(a.vect, b.vect))
+                self.assertTrue(np.allclose(a.alpha, b.alpha))
+
+            # Only the edited skeleton is recomputed and its old file removed.
+            cursor = connection.cursor()
+            cursor.execute("""
+                UPDATE catmaid_skeleton_summary
+                SET last_edition_time = last_edition_time + interval '1 second'
+                WHERE skeleton_id = 361
+            """)
+            result = update_cache(self.test_project_id, 'skeleton',
+                    skeleton_ids, **params)
+            self.assertEqual(result, {'current': 1, 'updated': 1, 'failed': 1,
+                    'removed': 0})
+            self.assertEqual(len([f for f in os.listdir(cache.path)
+                    if f.startswith('361-')]), 1)
+
+            result = update_cache(self.test_project_id, 'skeleton', [235],
+                    clean=True, **params)
+            self.assertEqual(result, {'current': 1, 'updated': 0, 'failed': 0,
+                    'removed': 1})
+            self.assertEqual(cache.cached_object_ids(), [235])
+
+    def test_soma_tag_invalidates_skeleton(self):
+        from catmaid.control.nat.dotprops_cache import DotpropsCache, update_cache
+
+        skeleton_ids = [235, 361]
+        params = {'k': 3, 'resample_step': 1.0, 'n_branches': None}
+
+        with tempfile.TemporaryDirectory() as path, \
+                override_settings(MEDIA_ROOT=path):
+            update_cache(self.test_project_id, 'skeleton', skeleton_ids,
+                    **params)
+            cache = DotpropsCache(self.test_project_id, 'skeleton', **params)
+            stamps = cache.get_edition_stamps(skeleton_ids)
+            self.assertEqual(sorted(cache.load(skeleton_ids)), skeleton_ids)
+
+            # Tagging a soma reroots the skeleton without changing its edition
+            # time, its cached dotprops must not be used anymore.
+            self.fake_authentication()
+            response = self.client.post('/%d/label/treenode/%d/update' % (
+                    self.test_project_id, 383), {
+                        'tags': 'soma',
+                        'delete_existing': 'false',
+                    })
+            self.assertStatus(response)
+
+            new_stamps = cache.get_edition_stamps(skeleton_ids)
+            self.assertEqual(new_stamps[235], stamps[235])
+            self.assertNotEqual(new_stamps[361], stamps[361])
+            self.assertEqual(list(cache.load(skeleton_ids)), [235])
+
+            result = update_cache(self.test_project_id, 'skeleton',
+                    skeleton_ids, **params)
+            self.assertEqual(result, {'current': 1, 'updated': 1, 'failed': 0,
+                    'removed': 0})
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+
+from catmaid.state import make_nocheck_state
+from catmaid.tests.apis.common import CatmaidApiTestCase
+
+
+class SkeletonConnectivityTableTests(CatmaidApiTestCase):
+    """Test the trigger based skeleton connectivity update.
+    """
+
+    def get_connectivity(self, cursor):
+        cursor.execute("""
+            SELECT skeleton_id, partner_skeleton_id, relation_id,
+                partner_relation_id, count, confidence_histogram
+            FROM catmaid_skeleton_connectivity
+        """)
+        return {tuple(row[:4]): (row[4], row[5]) for row in cursor.fetchall()}
+
+    def get_expected_connectivity(self, cursor):
+        cursor.execute("""
+            SELECT t1.skeleton_id, t2.skeleton_id, t1.relation_id,
+                t2.relation_id, LEAST(t1.confidence, t2.confidence)
+            FROM treenode_connector t1
+            JOIN treenode_connector t2
+                ON t1.connector_id = t2.connector_id
+                AND t1.id <> t2.id
+        """)
+        connectivity = {}
+        for row in cursor.fetchall():
+            count, histogram = connectivity.get(row[:4], (0, [0, 0, 0, 0, 0]))
+            histogram[row[4] - 1] += 1
+            connectivity[row[:4]] = (count + 1, histogram)
+        return connectivity
+
+    def assertConnectivityIsCurrent(self, cursor):
+        self.assertEqual(self.get_expected_connectivity(cursor),
+                self.get_connectivity(cursor))
+
+    def test_link_changes(self):
+        self.fake_authentication()
+        cursor = connection.cursor()
+        self.assertConnectivityIsCurrent(cursor)
+        self.assertEqual((2, [0, 0, 0, 0, 2]),
+                self.get_connectivity(cursor)[(235, 373, 1023, 1024)])
+
+        response = self.client.post('/%d/link/delete' % self.test_project_id, {
+                'connector_id': 356,
+                'treenode_id': 377,
+                'state': make_nocheck_state()})
+        self.assertStatus(response)
+        self.assertConnectivityIsCurrent(cursor)
+        self.assertEqual((1, [0, 0, 0, 0, 1]),
+                self.get_connectivity(cursor)[(235, 373, 1023, 1024)])
+
+        response = self.client.post('/%d/link/create' % self.test_project_id, {
+                'from_id': 237,
+                'to_id': 432,
+                'link_type': 'postsynaptic_to',
+                'state': make_nocheck_state()})
+        self.assertStatus(response)
+        self.assertConnectivityIsCurrent(cursor)
+
+        # Confidence changes and merges update links in bulk
+        cursor.execute("""
+            UPDATE treenode_connector SET confidence = 2
+            WHERE connector_id = 421 AND relation_id = 1024
+        """)
+        self.assertConnectivityIsCurrent(cursor)
+        self.assertEqual((1, [0, 1, 0, 0, 0]),
+                self.get_connectivity(cursor)[(235, 373, 1023, 1024)])
+
+        cursor.execute("""
+            UPDATE treenode_connector SET skeleton_id = 235
+            WHERE skeleton_id = 373
+        """)
+        self.assertConnectivityIsCurrent(cursor)
+        self.assertNotIn((235, 373, 1023, 1024), self.get_connectivity(cursor))
+
+        cursor.execute("""
+            DELETE FROM treenode_connector WHERE connector_id IN (356, 421)
+        """)
+        self.assertConnectivityIsCurrent(cursor)
+
+    def test_refresh(self):
+        cursor = connection.cursor()
+        expected_connectivity = self.get_connectivity(cursor)
+        self.assertTrue(expected_connectivity)
+
+        cursor.execute("""
+            DELETE FROM catmaid_skeleton_connectivity;
+            SELECT refresh_skeleton_connectivity_table();
+        """)
+        self.assertEqual(expected_connectivity, self.get_connectivity(cursor))
+
+        cursor.execute("DELETE FROM catmaid_skeleton_connectivity")
+        call_command('catmaid_update_cache_tables', '--cache', 'connectivity',
+                '--project_id', str(self.test_project_id), stdout=StringIO())
+        self.assertEqual(expected_connectivity, self.get_connectivity(cursor))
@@ -79,3 +79,362 @@ class UtilTests(TestCase):
 
         version = get_version()
         self.assertNotEqual(version, "unknown")
+
+
+class MorphologyTests(TestCase):
+
+    def get_arbors(self):
+        from catmaid.control.morphology import ArborArrays
+
+        # Skeleton 100 branches at node 2, skeleton 200 is a single edge. Rows
+        # are not sorted topologically.
+        return ArborArrays.from_rows([
+            (5, 4, 100, 10.0, 30.0, 0.0),
+            (1, None, 100, 0.0, 0.0, 0.0),
+            (3, 2, 100, 20.0, 0.0, 0.0),
+            (7, 6, 200, 0.0, 0.0, 3.0),
+            (2, 1, 100, 10.0, 0.0, 0.0),
+            (4, 2, 100, 10.0, 10.0, 0.0),
+            (6, None, 200, 0.0, 0.0, 0.0),
+        ])
+
+    def test_topology(self):
+        arbors = self.get_arbors()
+        self.assertEqual(arbors.skeleton_ids.tolist(), [100, 200])
+        depth = dict(zip(arbors.node_ids.tolist(), arbors.depth.tolist()))
+        self.assertEqual(depth, {1: 0, 2: 1, 3: 2, 4: 2, 5: 3, 6: 0, 7: 1})
+
+        order = arbors.node_ids[arbors.order].tolist()
+        for child, parent in ((2, 1), (3, 2), (4, 2), (5, 4), (7, 6)):
+            self.assertLess(order.index(parent), order.index(child))
+
+        deepest = arbors.node_ids[arbors.deepest_nodes()].tolist()
+        self.assertEqual(deepest, [5, 7])
+        path = arbors.node_ids[arbors.path_to_root([0])].tolist()
+        self.assertCountEqual(path, [5, 4, 2, 1])
+
+    def test_cable_and_smoothing(self):
+        import numpy as np
+
+        arbors = self.get_arbors()
+        self.assertEqual(arbors.cable_lengths().tolist(), [50.0, 3.0])
+
+        # Only slab node 4 moves: towards the average of nodes 2 and 5,
+        # weighted by their distance (10 and 20).
+        smoothed = arbors.smooth_locations()
+        index = dict(zip(arbors.node_ids.tolist(), range(len(arbors))))
+        self.assertTrue(np.allclose(smoothed[index[4]], [10.0, 16.0, 0.0]))
+        for node_id in (1, 2, 3, 5, 6, 7):
+            self.assertEqual(smoothed[index[node_id]].tolist(),
+                    arbors.locations[index[node_id]].tolist())
+
+        smooth_lengths = arbors.segment_lengths(smoothed)
+        self.assertTrue(np.allclose(arbors.sum_per_skeleton(smooth_lengths),
+                [50.0, 3.0]))
+
+    def test_tree_util_cable_length(self):
+        import networkx as nx
+        from catmaid.control.tree_util import cable_length
+
+        tree = nx.DiGraph()
+        tree.add_edges_from([(1, 2), (2, 3)])
+        locations = {1: (0, 0, 0), 2: (3, 4, 0), 3: (3, 4, 2)}
+        self.assertEqual(cable_length(tree, locations), 7.0)
+        self.assertEqual(cable_length(nx.DiGraph(), {}), 0.0)
+
+    def get_trees(self):
+        import networkx as nx
+        from catmaid.control.morphology import ArrayTree
+
+        # Node 2 branches to 3 and 4, node 4 continues to 5 and 6, which
+        # branches again to 7 and 8.
+        edges = [(1, 2), (2, 3), (2, 4), (4, 5), (5, 6), (6, 7), (6, 8)]
+        graph = nx.DiGraph()
+        graph.add_edges_from(edges)
+        tree = ArrayTree.from_rows([(8, 6), (1, None), (3, 2), (2, 1), (7, 6),
+                (4, 2), (6, 5), (5, 4)])
+        return graph, tree
+
+    def test_array_tree(self):
+        graph, tree = self.get_trees()
+        self.assertEqual(len(tree), 8)
+        self.assertEqual(tree.root_id, 1)
+        self.assertIn(7, tree)
+        self.assertNotIn(9, tree)
+        self.assertEqual(tree.parent(1), None)
+        self.assertEqual(tree.parent(5), 4)
+        self.assertCountEqual(tree.children(2), [3, 4])
+        self.assertCountEqual(tree.end_nodes(), [3, 7, 8])
+        self.assertCountEqual(tree.edges(), graph.edges())
+        self.assertCountEqual(tree.node_ids[tree.downstream(5)].tolist(),
+                [5, 6, 7, 8])
+        self.assertRaises(KeyError, tree.indices, [1, 9])
+
+    def test_array_tree_path_to_root(self):
+        from catmaid.control.morphology import ArrayTree
+
+        _, tree = self.get_trees()
+        path = tree.node_ids[tree.path_to_root(tree.indices([7, 3, 7]))]
+        self.assertCountEqual(path.tolist(), [7, 6, 5, 4, 2, 3, 1])
+
+        # Many nodes on a long chain share most of their ancestors
+        chain = ArrayTree.from_rows([(i, i - 1 if i > 1 else None)
+                for i in range(1, 1001)])
+        path = chain.path_to_root(chain.indices(list(range(300, 700, 3))))
+        self.assertCountEqual(chain.node_ids[path].tolist(), range(1, 700))
+
+    def test_array_tree_util(self):
+        from catmaid.control import tree_util
+
+        graph, tree = self.get_trees()
+        self.assertEqual(tree_util.find_root(tree), tree_util.find_root(graph))
+        self.assertEqual(tree_util.edge_count_to_root(tree),
+                tree_util.edge_count_to_root(graph))
+        self.assertEqual(tree_util.edge_count_to_root(tree, root_node=4),
+                tree_util.edge_count_to_root(graph, root_node=4))
+        groups = [[7, 8], [3, 7, 8], [5, 8], [6]]
+        self.assertEqual(list(tree_util.find_common_ancestors(tree, groups)),
+                [(6, 5), (2, 2), (5, 4), (6, 0)])
+        self.assertEqual(list(tree_util.find_common_ancestors(tree, groups)),
+                list(tree_util.find_common_ancestors(graph, groups)))
+
+        # End nodes 7 and 8 are equally far from the root
+        partition = list(tree_util.partition(tree))
+        self.assertIn(partition[0][0], (7, 8))
+        self.assertEqual(partition[0][1:], [6, 5, 4, 2, 1])
+        other_end = 8 if partition[0][0] == 7 else 7
+        self.assertCountEqual(partition[1:], [[other_end, 6], [3, 2]])
+
+        spanning = tree_util.spanning_tree(tree, [3, 5])
+        self.assertCountEqual(spanning.nodes(), [2, 3, 4, 5])
+        self.assertCountEqual(spanning.edges(), [(2, 3), (2, 4), (4, 5)])
+        spanning = tree_util.spanning_tree(graph, [7, 8, 5])
+        self.assertCountEqual(spanning.nodes(), [5, 6, 7, 8])
+
+        # Only keepers and branch nodes between them remain
+        mini = tree_util.simplify(graph.copy(), [3, 7, 8])
+        array_mini = tree_util.simplify(tree, [3, 7, 8])
+        self.assertCountEqual(array_mini.nodes(), [3, 7, 8, 6])
+        self.assertCountEqual(array_mini.nodes(), mini.nodes())
+        self.assertEqual({frozenset(e) for e in array_mini.edges()},
+                {frozenset(e) for e in mini.edges()})
+
+        tree_util.reroot(tree, 7)
+        tree_util.reroot(graph, 7)
+        self.assertEqual(tree.root_id, 7)
+        self.assertCountEqual(tree.edges(), graph.edges())
+        self.assertEqual(tree_util.edge_count_to_root(tree),
+                tree_util.edge_count_to_root(graph))
+
+
+class SynapseClusteringTests(TestCase):
+
+    def get_rows(self):
+        # A straight line of nine nodes, 10 nm apart, with synapses on the
+        # first three and the last three nodes.
+        rows = [(i, i - 1 if i > 1 else None, 5, 10.0 * i, 0.0, 0.0)
+                for i in range(1, 10)]
+        synapses = [(node, 100 + node, 1023, 5) for node in (1, 2, 3, 7, 8, 9)]
+        return rows, synapses
+
+    def test_tree_max_density(self):
+        import networkx as nx
+        from catmaid.control.synapseclustering import tree_max_density
+
+        rows, synapses = self.get_rows()
+        graph = nx.Graph()
+        for node, parent, *_ in rows:
+            if parent:
+                graph.add_edge(parent, node, weight=10.0)
+        nodes = [s[0] for s in synapses]
+        connectors = [s[1] for s in synapses]
+        groups = tree_max_density(graph, nodes, connectors, [1023] * 6, [10, 1000])
+
+        self.assertEqual(len(groups[10]), 2)
+        self.assertEqual(groups[10][0].local_max, 2)
+        self.assertEqual(groups[10][0].node_ids, [1, 2, 3])
+        self.assertEqual(groups[10][1].local_max, 8)
+        self.assertEqual(groups[10][1].connector_ids, [107, 108, 109])
+        self.assertEqual(len(groups[1000]), 1)
+        self.assertEqual(groups[1000][0].local_max, 5)
+
+    def test_split_by_both(self):
+        from catmaid.control.graph2 import split_by_both
+
+        rows, synapses = self.get_rows()
+        nodes, branch_nodes, links, intraedges = split_by_both(5, rows,
+                synapses, confidence_threshold=1, bandwidth=10)
+        self.assertEqual(nodes, ['5_1', '5_2'])
+        self.assertEqual(branch_nodes, [])
+        self.assertCountEqual(links, [(100 + n, 1023, '5_1' if n < 5 else '5_2', 5)
+                for n in (1, 2, 3, 7, 8, 9)])
+        self.assertEqual([frozenset(e) for e in intraedges],
+                [frozenset(('5_1', '5_2'))])
+
+        # Break the skeleton between node 4 and 5, which leaves one synapse
+        # domain per part.
+        rows[4] = (5, 4, 1, 50.0, 0.0, 0.0)
+        nodes, branch_nodes, links, intraedges = split_by_both(5, rows,
+                synapses, confidence_threshold=2, bandwidth=10)
+        self.assertEqual(nodes, ['5_1', '5_2'])
+        self.assertEqual(intraedges, [])
+        self.assertCountEqual(links, [(100 + n, 1023, '5_1' if n < 5 else '5_2', 5)
+                for n in (1, 2, 3, 7, 8, 9)])
+
+
+class NblastTests(TestCase):
+
+    def get_arbors(self):
+        import numpy as np
+
+        # Three Y-shaped arbors with 1 µm long edges, the second one is a
+        # slightly shifted copy of the first one and the third one points in a
+        # different direction.
+        parents = np.array([-1] + list(range(29)) + [9] + list(range(30, 49)))
+        steps = np.zeros((50, 3))
+        steps[1:30, 0] = 1.0
+        steps[30:, 1] = 1.0
+        locations = np.zeros((50, 3))
+        for i in range(1, 50):
+            locations[i] = locations[parents[i]] + steps[i]
+        rotated = locations[:, [2, 1, 0]]
+        return [(parents, locations), (parents, locations + 0.2),
+                (parents, rotated + 5.0)]
+
+    def test_dotprops(self):
+        import numpy as np
+        from catmaid.control.nat.nblast import dotprops
+
+        points = np.array([[x, 0.0, 0.0] for x in range(10)])
+        dps = dotprops(points, k=5)
+        self.assertTrue(np.allclose(np.abs(dps.vect), [[1.0, 0.0, 0.0]] * 10))
+        self.assertTrue(np.allclose(dps.alpha, 1.0))
+        self.assertRaises(ValueError, dotprops, points[:3], 5)
+
+    def test_resample_and_simplify(self):
+        import numpy as np
+        from catmaid.control.nat.nblast import resample_arbor, simplify_arbor
+
+        # Node 1 branches into nodes 2 and 3, which are kept along with the
+        # root. All other points are placed at 1 µm steps along segments.
+        parents = np.array([-1, 0, 1, 1])
+        locations = np.array([[0.0, 0, 0], [2, 0, 0], [4, 0, 0], [2, 3.5, 0]])
+        points = resample_arbor(parents, locations, 1.0)
+        self.assertCountEqual(points.tolist(), [[0, 0, 0], [1, 0, 0],
+                [2, 0, 0], [3, 0, 0], [4, 0, 0], [2, 1, 0], [2, 2, 0],
+                [2, 3, 0], [2, 3.5, 0]])
+
+        # Without any branches, only the longest path is kept.
+        new_parents, new_locations = simplify_arbor(parents, locations, 0)
+        self.assertEqual(new_parents.tolist(), [-1, 0, 1])
+        self.assertEqual(new_locations.tolist(), [[0, 0, 0], [2, 0, 0], [2, 3.5, 0]])
+        new_parents, _ = simplify_arbor(parents, locations, 1)
+        self.assertEqual(new_parents.tolist(), parents.tolist())
+
+    def test_reroot(self):
+        import numpy as np
+        from catmaid.control.nat.nblast import find_soma, reroot_arbor
+
+        # Node 1 branches into nodes 2 and 3
+        parents = np.array([-1, 0, 1, 1])
+        self.assertEqual(reroot_arbor(parents, 3).tolist(), [1, 3, 1, -1])
+        self.assertEqual(reroot_arbor(parents, 0).tolist(), parents.tolist())
+
+        # A single root among the soma candidates is preferred
+        self.assertIsNone(find_soma(parents, []))
+        self.assertEqual(find_soma(parents, [2, 3]), 2)
+        self.assertEqual(find_soma(parents, [2, 0]), 0)
+
+    def test_reference_scores(self):
+        import os
+        import numpy as np
+        from catmaid.control.nat.nblast import NblastScorer, dotprops, nblast_matrix
+        from catmaid.models import (NblastConfigDefaultDistanceBreaks,
+                NblastConfigDefaultDotBreaks)
+
+        # The FCWB scoring matrix of nat.nblast (smat.fcwb), which the
+        # front-end ships as well.
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                'static', 'data', 'neuron-similarity', 'smat_jefferis.csv')
+        with open(path) as f:
+            scoring = [[float(v) for v in line.split()[1:]]
+                    for line in f.readlines()[1:]]
+        scorer = NblastScorer(scoring, NblastConfigDefaultDistanceBreaks,
+                NblastConfigDefaultDotBreaks)
+
+        # Parallel lines of ten points, 1 µm and 2.2 µm apart. All tangent
+        # vectors are parallel and the nearest neighbor of each point is as
+        # far away as the other line. Scores are sums of smat.fcwb entries.
+        # This only checks the binning and summation of scores, it doesn't
+        # compare them with scores computed by nat.nblast.
+        line = np.array([[x, 0.0, 0.0] for x in range(10)])
+        dps = [dotprops(line + [0.0, offset, 0.0], k=5)
+                for offset in (0.0, 1.0, 2.2)]
+        raw = nblast_matrix(dps[:1], dps, scorer, 'raw')
+        expected_raw = np.array([[10 * 11.3892297520051,
+                10 * 10.5558600418055, 10 * 9.35647238546052]])
+        self.assertTrue(np.allclose(raw, expected_raw))
+        normalized = nblast_matrix(dps[:1], dps, scorer, 'normalized')
+        self.assertTrue(np.allclose(normalized, expected_raw / expected_raw[0, 0]))
+
+    def test_scores(self):
+        import numpy as np
+        from catmaid.control.nat.nblast import (NblastScorer, all_pairs,
+                arbor_dotprops, nblast_matrix, pair_histogram, score_matrix)
+        from catmaid.models import (NblastConfigDefaultDistanceBreaks,
+                NblastConfigDefaultDotBreaks)
+
+        dps = [arbor_dotprops(parents, locations, k=5, resample_step=1.0)
+                for parents, locations in self.get_arbors()]
+        distance_breaks = NblastConfigDefaultDistanceBreaks
+        dot_breaks = NblastConfigDefaultDotBreaks
+        matching = pair_histogram(dps[:2], all_pairs(2), distance_breaks, dot_breaks)
+        random = pair_histogram(dps, all_pairs(3), distance_breaks, dot_breaks)
+        self.assertEqual(matching.shape, (len(distance_breaks) - 1, len(dot_breaks) - 1))
+        self.assertEqual(matching.sum(), 2 * len(dps[0]))
+        self.assertEqual(random.sum(), 4 * len(dps[0]) + 2 * len(dps[2]))
+
+        scorer = NblastScorer(score_matrix(matching, random), distance_breaks,
+                dot_breaks)
+        raw = nblast_matrix(dps[:2], dps, scorer, 'raw')
+        self.assertEqual(raw.shape, (2, 3))
+        self.assertGreater(raw[0, 1], raw[0, 2])
+        self.assertTrue(np.allclose(nblast_matrix(dps, dps[:2], scorer, 'raw',
+                reverse=True), raw.T))
+
+        normalized = nblast_matrix(dps, dps, scorer, 'normalized')
+        self.assertTrue(np.allclose(np.diag(normalized), 1.0))
+        mean = nblast_matrix(dps, dps, scorer, 'mean')
+        self.assertTrue(np.allclose(mean, (normalized + normalized.T) / 2))
+        geometric_mean = nblast_matrix(dps, dps, scorer, 'geometric-mean')
+        self.assertTrue((geometric_mean >= 0).all())
+
+    def test_block_shape(self):
+        from catmaid.control.nat.scheduling import (BYTES_PER_POINT,
+                BYTES_PER_SCORE, get_block_shape, split_into_blocks)
+
+        memory = 100 * 1024 ** 2
+        n_queries, n_targets = get_block_shape(10000, 10000, 1000, memory)
+        self.assertEqual(n_queries, n_targets)
+        self.assertLessEqual((n_queries + n_targets) * 1000 * BYTES_PER_POINT['numpy'] +
+                n_queries * n_targets * BYTES_PER_SCORE, memory)
+        self.assertGreater((n_queries + n_targets + 2) * 1000 * BYTES_PER_POINT['numpy'] +
+                (n_queries + 1) * (n_targets + 1) * BYTES_PER_SCORE, memory)
+
+        # Few query objects allow more target objects per block.
+        n_few_queries, n_more_targets = get_block_shape(10, 10000, 1000, memory)
+        self.assertEqual(n_few_queries, 10)
+        self.assertGreater(n_more_targets, n_targets)
+
+        # R objects need more memory.
+        self.assertLess(get_block_shape(10000, 10000, 1000, memory, 'r')[0],
+                n_queries)
+
+        # Everything fits into a single block and blocks hold at least one
+        # object.
+        self.assertEqual(get_block_shape(3, 4, 1000, memory), (3, 4))
+        self.assertEqual(get_block_shape(3, 4, 1e9, memory), (1, 1))
+
+        blocks = split_into_blocks([1, 2, 3], [4, 5, 6, 7, 8], 2, 3)
+        self.assertEqual(blocks, [([1, 2], [4, 5, 6]), ([1, 2], [7, 8]),
+                ([3], [4, 5, 6]), ([3], [7, 8])])
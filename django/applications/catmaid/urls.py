@@ -242,6 +242,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/nodes/nearest$', node.node_nearest),
     url(r'^(?P<project_id>\d+)/node/update$', record_view("nodes.update_location")(node.node_update)),
     url(r'^(?P<project_id>\d+)/node/list$', node.node_list_tuples),
+    url(r'^(?P<project_id>\d+)/node/overlay-tile$', node.overlay_tile),
     url(r'^(?P<project_id>\d+)/node/get_location$', node.get_location),
     url(r'^(?P<project_id>\d+)/node/user-info$', node.user_info),
     url(r'^(?P<project_id>\d+)/nodes/find-labels$', node.find_labels),
@@ -290,6 +291,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeletons/in-bounding-box$', skeleton.skeletons_in_bounding_box),
     url(r'^(?P<project_id>\d+)/skeleton/connectivity_matrix$', skeleton.connectivity_matrix),
     url(r'^(?P<project_id>\d+)/skeletons/connectivity_matrix/csv$', skeleton.connectivity_matrix_csv),
+    url(r'^(?P<project_id>\d+)/skeletons/connectivity_matrix/export$', skeleton.connectivity_matrix_export),
     url(r'^(?P<project_id>\d+)/skeletons/review-status$', skeleton.review_status),
     url(r'^(?P<project_id>\d+)/skeletons/from-origin$', skeleton.from_origin),
     url(r'^(?P<project_id>\d+)/skeletons/origin$', skeleton.origin_info),
@@ -309,6 +311,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeletons/sampler-count$', skeleton.list_sampler_count),
     url(r'^(?P<project_id>\d+)/skeleton/(?P<skeleton_id>\d+)/permissions$', skeleton.get_skeleton_permissions),
     url(r'^(?P<project_id>\d+)/skeletons/import$', record_view("skeletons.import")(skeleton.import_skeleton)),
+    url(r'^(?P<project_id>\d+)/skeletons/import/bulk$', record_view("skeletons.import")(skeleton.import_skeletons)),
     url(r'^(?P<project_id>\d+)/skeleton/annotationlist$', skeleton.annotation_list),
     url(r'^(?P<project_id>\d+)/skeletons/within-spatial-distance$', skeleton.within_spatial_distance),
     url(r'^(?P<project_id>\d+)/skeletons/node-labels$', skeleton.skeletons_by_node_labels),
@@ -341,8 +344,11 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeletons/connector-polyadicity$', skeletonexport.connector_polyadicity),
     url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/compact-detail$', skeletonexport.compact_skeleton_detail),
     url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/neuroglancer$', skeletonexport.neuroglancer_skeleton),
+    url(r'^(?P<project_id>\d+)/skeletons/neuroglancer/info$', skeletonexport.neuroglancer_skeleton_info),
+    url(r'^(?P<project_id>\d+)/skeletons/neuroglancer/(?P<skeleton_id>\d+)$', skeletonexport.neuroglancer_skeleton),
     url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/node-overview$', skeletonexport.treenode_overview),
     url(r'^(?P<project_id>\d+)/skeletons/compact-detail$', skeletonexport.compact_skeleton_detail_many),
+    url(r'^(?P<project_id>\d+)/skeletons/export/archive$', skeletonexport.export_skeleton_archive),
     # Marked as deprecated, but kept for backwards compatibility
     url(r'^(?P<project_id>\d+)/(?P<skeleton_id>\d+)/(?P<with_connectors>\d)/(?P<with_tags>\d)/compact-skeleton$', skeletonexport.compact_skeleton),
 ]
@@ -356,7 +362,9 @@ urlpatterns += [
 # Pointclouds
 urlpatterns += [
     url(r'^(?P<project_id>\d+)/pointclouds/$', pointcloud.PointCloudList.as_view()),
+    url(r'^(?P<project_id>\d+)/pointclouds/nearest$', pointcloud.nearest),
     url(r'^(?P<project_id>\d+)/pointclouds/(?P<pointcloud_id>\d+)/$', pointcloud.PointCloudDetail.as_view()),
+    url(r'^(?P<project_id>\d+)/pointclouds/(?P<pointcloud_id>\d+)/points$', pointcloud.pointcloud_points),
     url(r'^(?P<project_id>\d+)/pointclouds/(?P<pointcloud_id>\d+)/images/(?P<image_id>\d+)/$', pointcloud.PointCloudImageDetail.as_view()),
 ]
 
@@ -374,6 +382,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/similarity/queries/similarity$', similarity.compare_skeletons),
     url(r'^(?P<project_id>\d+)/similarity/queries/(?P<similarity_id>\d+)/$', similarity.SimilarityDetail.as_view()),
     url(r'^(?P<project_id>\d+)/similarity/queries/(?P<similarity_id>\d+)/recompute$', similarity.recompute_similarity),
+    url(r'^(?P<project_id>\d+)/similarity/queries/(?P<similarity_id>\d+)/scores$', similarity.similarity_scores),
     url(r'^(?P<project_id>\d+)/similarity/test-setup$', similarity.test_setup),
 ]
 
@@ -193,6 +193,49 @@ NODE_PROVIDERS = [
     'postgis3d'
 ]
 
+# Weights of the parts of a node's importance, which is used by the
+# "importance" node ordering: the node's stored topology score (root, branch
+# and leaf nodes are more important), the cable length of its skeleton and how
+# recently its skeleton was edited.
+NODE_IMPORTANCE_WEIGHTS = {
+    'topology': 1.0,
+    'size': 1.0,
+    'recency': 0.5,
+}
+
+# If set to a number of seconds, node providers are queried concurrently: the
+# next matching provider in NODE_PROVIDERS is started in a separate thread (and
+# database connection) if the previous ones didn't return a result after this
+# delay, or immediately if they failed. The first result is used. None queries
+# providers one after the other.
+NODE_PROVIDER_HEDGE_DELAY = None
+# The maximum number of threads per process that run hedged node provider
+# queries.
+NODE_PROVIDER_HEDGE_THREADS = 8
+
+# The number of skeletons the compact-detail endpoint for multiple skeletons
+# loads with one set of queries. Requests for more skeletons are streamed to the
+# client in batches of this size, which keeps memory use flat.
+SKELETON_DETAIL_BATCH_SIZE = 500
+
+# The maximum size in bytes of the per-process cache of encoded compact
+# skeletons. Entries are only used as long as the skeleton's data is unchanged.
+# Zero disables the memory cache.
+SKELETON_PAYLOAD_CACHE_SIZE = 0
+# If set to a directory path, encoded compact skeletons are also cached in this
+# directory, which is shared by all processes.
+SKELETON_PAYLOAD_CACHE_PATH = None
+
+# The number of processes that split skeletons into synapse domains in parallel
+# for compartment graphs. With 1, skeletons are split in the request process.
+SKELETON_GRAPH_WORKERS = 1
+
+# The number of skeletons the skeleton archive export loads with one query and
+# the number of processes that serialize them. With 1 worker, skeletons are
+# serialized in the request process.
+SKELETON_EXPORT_BATCH_SIZE = 1000
+SKELETON_EXPORT_WORKERS = 1
+
 # By default, prepared statements are disabled. If connection pooling is used,
 # this can further improve performance.
 PREPARED_STATEMENTS = False
@@ -427,12 +470,50 @@ CREATE_DEFAULT_DATAVIEWS = True
 # NBLAST support
 NBLAST_ALL_BY_ALL_MIN_SIZE = 10
 MAX_PARALLEL_ASYNC_WORKERS = 1
+# The NBLAST implementation of new NBLAST configurations, if not specified
+# otherwise. Either 'r' (nat.nblast through rpy2) or 'numpy'.
+NBLAST_DEFAULT_BACKEND = 'r'
+# The memory in MB a single block of an NBLAST similarity computation may use.
+# If None, half of the available memory is shared by MAX_PARALLEL_ASYNC_WORKERS
+# blocks.
+NBLAST_BLOCK_MEMORY = None
+# The number of point cloud KD-trees each process keeps in memory for nearest
+# neighbor queries.
+POINTCLOUD_TREE_CACHE_SIZE = 16
 
 # Intersection grid settings, dimensions in project coordinates (nm)
 DEFAULT_CACHE_GRID_CELL_WIDTH = 25000
 DEFAULT_CACHE_GRID_CELL_HEIGHT = 25000
 DEFAULT_CACHE_GRID_CELL_DEPTH = 40
 
+# Size in bytes of the per-process in-memory cache for node grid cache cells. It
+# is invalidated by "catmaid.dirty-cache" events, which are only emitted if
+# SPATIAL_UPDATE_NOTIFICATIONS is enabled. A size of 0 disables this cache.
+NODE_GRID_CELL_CACHE_SIZE = 0
+# Optional maximum age of an entry in the grid cell cache in seconds. This is
+# useful if cache cells are also updated without spatial update notifications,
+# e.g. using catmaid_update_cache_tables. None means no expiration.
+NODE_GRID_CELL_CACHE_MAX_AGE = None
+
+# Node grid cache definitions are kept in memory by each process and are
+# updated on "catmaid.grid-cache-update" events. Additionally, they are reloaded
+# after this many seconds. None means they are only reloaded on events.
+NODE_GRID_REGISTRY_MAX_AGE = 300
+
+# Rendered node overlay tiles (node/overlay-tile) have this width and height
+# in pixels. A tile of zoom level N covers 2^N x 2^N cells of a grid cache,
+# with N < NODE_OVERLAY_ZOOM_LEVELS.
+NODE_OVERLAY_TILE_SIZE = 512
+NODE_OVERLAY_ZOOM_LEVELS = 4
+# Size in bytes of the per-process in-memory cache for rendered overlay tiles.
+# Like the grid cell cache, it is invalidated by "catmaid.dirty-cache" events. A
+# size of 0 disables this cache.
+NODE_OVERLAY_TILE_CACHE_SIZE = 0
+# An optional directory in which rendered overlay tiles are stored for all
+# processes. Tiles are removed by the cache update worker when the grid cells
+# they cover are updated. None disables the disk cache.
+NODE_OVERLAY_TILE_CACHE_PATH = None
+
 # Whether Postgres should emit "catmaid.spatial-update" events on changes of
 # spatial data (e.g. inserts, updates and deletions of treenodes, connectors and
 # connector links).